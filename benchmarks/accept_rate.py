@@ -0,0 +1,172 @@
+"""Rate of accepting inbound streams in ACCEPT and FORWARD listen modes.
+
+A fake SAM bridge on localhost answers HELLO, STREAM ACCEPT and STREAM
+FORWARD. Each simulated peer is handed to a pending STREAM ACCEPT connection
+(queuing in the bridge if none is pending), or in FORWARD mode is connected to
+the local port that the endpoint asked the bridge to forward to. A burst of
+peers arrives with CONCURRENCY of them in flight at a time, and the time is
+taken until every one of them has reached the application Protocol.
+
+In ACCEPT mode each accepted peer costs a new SAM connection, HELLO and
+STREAM ACCEPT before the next peer can be taken, while in FORWARD mode it
+costs a single local TCP connection.
+
+The line parser is used, as the OMeta grammar hands a peer line that arrives
+in the same read as STREAM STATUS to the receiver as text.
+"""
+from __future__ import print_function
+import time
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import ClientFactory, Factory, Protocol
+
+from txi2p.address import I2PAddress
+from txi2p.sam.base import SAMParserProtocol
+from txi2p.sam.endpoints import (
+    LISTEN_ACCEPT,
+    LISTEN_FORWARD,
+    SAMI2PStreamServerEndpoint,
+)
+from txi2p.sam.session import SAMSession
+from txi2p.test.util import TEST_B64
+
+PEERS = 2000
+# Peers that the bridge has in flight at once
+CONCURRENCY = 32
+RUNS = 3
+PEER_LINE = ('%s FROM_PORT=0 TO_PORT=0\n' % TEST_B64).encode('utf-8')
+
+
+class FakeBridge(Protocol):
+    buf = b''
+
+    def dataReceived(self, data):
+        self.buf += data
+        while b'\n' in self.buf:
+            line, self.buf = self.buf.split(b'\n', 1)
+            if line.startswith(b'HELLO'):
+                self.transport.write(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+            elif line.startswith(b'STREAM ACCEPT'):
+                self.transport.write(b'STREAM STATUS RESULT=OK\n')
+                self.factory.acceptReady(self)
+            elif line.startswith(b'STREAM FORWARD'):
+                port = int(line.split(b'PORT=')[1].split(b' ')[0])
+                self.transport.write(b'STREAM STATUS RESULT=OK\n')
+                self.factory.forwardPort = port
+
+    def connectionLost(self, reason):
+        if self in self.factory.accepts:
+            self.factory.accepts.remove(self)
+
+
+class ForwardedPeer(Protocol):
+    def connectionMade(self):
+        self.transport.write(PEER_LINE)
+
+
+class FakeBridgeFactory(Factory):
+    protocol = FakeBridge
+
+    def __init__(self):
+        self.accepts = []
+        self.queued = 0
+        self.forwardPort = None
+
+    def acceptReady(self, proto):
+        if self.queued:
+            self.queued -= 1
+            proto.transport.write(PEER_LINE)
+        else:
+            self.accepts.append(proto)
+
+    def peerArrives(self):
+        if self.forwardPort:
+            reactor.connectTCP('127.0.0.1', self.forwardPort,
+                               ClientFactory.forProtocol(ForwardedPeer))
+        elif self.accepts:
+            self.accepts.pop(0).transport.write(PEER_LINE)
+        else:
+            self.queued += 1
+
+
+class Counter(Protocol):
+    def connectionMade(self):
+        self.transport.loseConnection()
+        self.factory.arrived += 1
+        if self.factory.arrived == PEERS:
+            self.factory.done.callback(None)
+        elif self.factory.sent < PEERS:
+            self.factory.sendPeer()
+
+
+class CounterFactory(Factory):
+    protocol = Counter
+
+    def __init__(self, bridge, done):
+        self.bridge = bridge
+        self.done = done
+        self.arrived = 0
+        self.sent = 0
+
+    def sendPeer(self):
+        self.sent += 1
+        self.bridge.peerArrives()
+
+
+def makeSession(port):
+    s = SAMSession()
+    s.nickname = s.id = 'bench'
+    s.samEndpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', port)
+    s.samVersion = '3.2'
+    s.style = 'STREAM'
+    s.address = I2PAddress(TEST_B64)
+    return s
+
+
+def settle():
+    d = defer.Deferred()
+    reactor.callLater(0.2, d.callback, None)
+    return d
+
+
+@defer.inlineCallbacks
+def burst(listenMode):
+    bridge = FakeBridgeFactory()
+    bridgePort = reactor.listenTCP(0, bridge, interface='127.0.0.1')
+    endpoint = SAMI2PStreamServerEndpoint(
+        makeSession(bridgePort.getHost().port), listenMode=listenMode)
+    done = defer.Deferred()
+    fac = CounterFactory(bridge, done)
+    port = yield endpoint.listen(fac)
+    # Let the initial accepts or the forward get set up
+    yield settle()
+    start = time.time()
+    for i in range(CONCURRENCY):
+        fac.sendPeer()
+    yield done
+    elapsed = time.time() - start
+    port.stopListening()
+    yield bridgePort.stopListening()
+    yield settle()
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def main():
+    SAMParserProtocol.useLineParser = True
+    try:
+        for name, mode in [('accept', LISTEN_ACCEPT), ('forward', LISTEN_FORWARD)]:
+            best = None
+            for i in range(RUNS):
+                elapsed = yield burst(mode)
+                best = elapsed if best is None else min(best, elapsed)
+            print('%-8s %8.0f streams/s (%d streams in %.3f s)' % (
+                name, PEERS / best, PEERS, best))
+    finally:
+        SAMParserProtocol.useLineParser = False
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
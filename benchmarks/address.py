@@ -0,0 +1,53 @@
+"""Cost of building I2PAddress objects on the stream accept path.
+
+Each accepted stream starts with the peer's Destination, which peerSAM turns
+into an I2PAddress. Before the host was made lazy, that meant a base64 decode,
+a SHA-256 and a base32 encode per stream, even when nothing looked at the
+host. This times peerSAM for a set of repeat peers, with and without reading
+the host, against the old eager computation.
+"""
+from __future__ import print_function
+import base64
+import hashlib
+import os
+import timeit
+
+from txi2p import address
+from txi2p.sam.base import peerSAM
+
+PEERS = 100
+NUMBER = 100000
+
+
+def randomDest():
+    return base64.b64encode(os.urandom(387), b'-~').decode('utf-8')
+
+
+def eagerB32(destination):
+    raw_key = base64.b64decode(destination.encode('utf-8'), b'-~')
+    hash = hashlib.sha256(raw_key)
+    base32_hash = base64.b32encode(hash.digest()).decode('utf-8')
+    return base32_hash.lower().replace('=', '')+'.b32.i2p'
+
+
+if __name__ == '__main__':
+    lines = [('%s FROM_PORT=%d TO_PORT=0\n' % (randomDest(), i)).encode('utf-8')
+             for i in range(PEERS)]
+    state = {'i': 0}
+
+    def nextLine():
+        state['i'] = (state['i'] + 1) % PEERS
+        return lines[state['i']]
+
+    def old():
+        addr = peerSAM(nextLine())
+        addr.host = eagerB32(addr.destination)
+
+    cases = [
+        ('eager host (old)', old),
+        ('lazy host, unused', lambda: peerSAM(nextLine())),
+        ('lazy host, cached', lambda: peerSAM(nextLine()).host),
+    ]
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=NUMBER, repeat=3))
+        print('%-20s %6.2f us/address' % (name, best / NUMBER * 1e6))
@@ -0,0 +1,252 @@
+"""Stream throughput and latency over the Twisted and asyncio APIs.
+
+A fake SAM bridge runs in a child process, so that both runs talk to the
+same bridge. It answers HELLO, SESSION CREATE, NAMING LOOKUP and STREAM
+CONNECT. A stream that starts with "SEND <n>" is sent n bytes and closed;
+any other stream is echoed.
+
+Each API creates a session, then times ROUNDTRIPS echoes of a small message
+over one stream, and a bulk transfer of PAYLOAD_SIZE bytes from the bridge.
+The Twisted run uses SAMI2PStreamClientEndpoint on the default reactor, and
+the asyncio run uses txi2p.sam.aio with asyncio Protocols on a plain asyncio
+event loop.
+
+The line parser is used for both runs, as the OMeta grammar hands stream
+data that arrives in the same read as STREAM STATUS to the receiver as text.
+"""
+from __future__ import print_function
+import asyncio
+import multiprocessing
+import socket
+import time
+
+from txi2p.sam.base import SAMParserProtocol
+from txi2p.test.util import TEST_B64
+
+PAYLOAD_SIZE = 128 * 1024 * 1024
+CHUNK = b'x' * 65536
+ROUNDTRIPS = 10000
+MESSAGE = b'm' * 64
+RUNS = 3
+
+
+class FakeBridge(asyncio.Protocol):
+    buf = b''
+    streaming = False
+    paused = False
+    # Bytes left to send, for a "SEND <n>" stream
+    remaining = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.streaming:
+            self.stream(data)
+            return
+        self.buf += data
+        while b'\n' in self.buf and not self.streaming:
+            line, self.buf = self.buf.split(b'\n', 1)
+            if line.startswith(b'HELLO'):
+                self.reply(b'HELLO REPLY RESULT=OK VERSION=3.1')
+            elif line.startswith(b'SESSION CREATE'):
+                self.reply(b'SESSION STATUS RESULT=OK DESTINATION=' + TEST_B64.encode())
+            elif line.startswith(b'NAMING LOOKUP'):
+                name = line.split(b'NAME=')[1]
+                self.reply(b'NAMING REPLY RESULT=OK NAME=' + name +
+                           b' VALUE=' + TEST_B64.encode())
+            elif line.startswith(b'STREAM CONNECT'):
+                self.reply(b'STREAM STATUS RESULT=OK')
+                self.streaming = True
+                data, self.buf = self.buf, b''
+                if data:
+                    self.stream(data)
+
+    def stream(self, data):
+        if data.startswith(b'SEND '):
+            self.remaining = int(data[5:].split(b'\n')[0])
+            self.transport.pause_reading()
+            self.resume_writing()
+        else:
+            self.transport.write(data)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.remaining is None:
+            return
+        while self.remaining > 0 and not self.paused:
+            self.transport.write(CHUNK)
+            self.remaining -= len(CHUNK)
+        if self.remaining <= 0:
+            self.remaining = None
+            # Not from inside resume_writing(), which the transport calls
+            # while it is flushing
+            asyncio.get_event_loop().call_soon(self.transport.close)
+
+    def reply(self, line):
+        self.transport.write(line + b'\n')
+
+
+def runBridge(sock):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(loop.create_server(FakeBridge, sock=sock))
+    loop.run_forever()
+
+
+def twistedRun(samPort):
+    from twisted.internet import defer, reactor, task
+    from twisted.internet.endpoints import TCP4ClientEndpoint
+    from twisted.internet.protocol import Factory, Protocol
+    from txi2p.sam.endpoints import SAMI2PStreamClientEndpoint
+    from txi2p.sam.session import getSession
+
+    results = {}
+
+    class Echo(Protocol):
+        def __init__(self):
+            self.done = defer.Deferred()
+            self.remaining = 0
+
+        def dataReceived(self, data):
+            self.remaining -= len(data)
+            if self.remaining <= 0:
+                self.done.callback(None)
+
+        def send(self):
+            self.done = defer.Deferred()
+            self.remaining = len(MESSAGE)
+            self.transport.write(MESSAGE)
+            return self.done
+
+    class Sink(Protocol):
+        received = 0
+
+        def __init__(self):
+            self.done = defer.Deferred()
+
+        def connectionMade(self):
+            self.transport.write(b'SEND %d\n' % PAYLOAD_SIZE)
+
+        def dataReceived(self, data):
+            self.received += len(data)
+
+        def connectionLost(self, reason):
+            self.done.callback(self.received)
+
+    @defer.inlineCallbacks
+    def main():
+        samEndpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', samPort)
+        session = yield getSession('twisted', samEndpoint)
+        endpoint = SAMI2PStreamClientEndpoint(session, 'spam.i2p')
+        latency = throughput = None
+        for i in range(RUNS):
+            echo = yield endpoint.connect(Factory.forProtocol(Echo))
+            start = time.time()
+            for j in range(ROUNDTRIPS):
+                yield echo.send()
+            elapsed = (time.time() - start) / ROUNDTRIPS
+            latency = elapsed if latency is None else min(latency, elapsed)
+            echo.transport.loseConnection()
+
+            sink = yield endpoint.connect(Factory.forProtocol(Sink))
+            start = time.time()
+            received = yield sink.done
+            rate = received / (time.time() - start)
+            throughput = rate if throughput is None else max(throughput, rate)
+        results['latency'] = latency
+        results['throughput'] = throughput
+        # Streams must be gone before their session is closed
+        while session._streams:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        session.close()
+        reactor.stop()
+
+    reactor.callWhenRunning(main)
+    reactor.run()
+    return results
+
+
+def asyncioRun(samPort):
+    from txi2p.sam import aio
+
+    class Echo(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            self.remaining -= len(data)
+            if self.remaining <= 0:
+                self.done.set_result(None)
+
+        def send(self):
+            self.done = asyncio.get_event_loop().create_future()
+            self.remaining = len(MESSAGE)
+            self.transport.write(MESSAGE)
+            return self.done
+
+    class Sink(asyncio.Protocol):
+        received = 0
+
+        def __init__(self):
+            self.done = asyncio.get_event_loop().create_future()
+
+        def connection_made(self, transport):
+            transport.write(b'SEND %d\n' % PAYLOAD_SIZE)
+
+        def data_received(self, data):
+            self.received += len(data)
+
+        def connection_lost(self, exc):
+            self.done.set_result(self.received)
+
+    async def main():
+        session = await aio.getSession('asyncio', samPort=samPort)
+        latency = throughput = None
+        for i in range(RUNS):
+            transport, echo = await aio.createConnection(Echo, session, 'spam.i2p')
+            start = time.time()
+            for j in range(ROUNDTRIPS):
+                await echo.send()
+            elapsed = (time.time() - start) / ROUNDTRIPS
+            latency = elapsed if latency is None else min(latency, elapsed)
+            transport.close()
+
+            transport, sink = await aio.createConnection(Sink, session, 'spam.i2p')
+            start = time.time()
+            received = await sink.done
+            rate = received / (time.time() - start)
+            throughput = rate if throughput is None else max(throughput, rate)
+        while session._streams:
+            await asyncio.sleep(0.01)
+        session.close()
+        return {'latency': latency, 'throughput': throughput}
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(100)
+    samPort = sock.getsockname()[1]
+    bridge = multiprocessing.Process(target=runBridge, args=(sock,))
+    bridge.daemon = True
+    bridge.start()
+    sock.close()
+
+    SAMParserProtocol.useLineParser = True
+    print('%d echoes of %d bytes, %d MB transfer, best of %d' % (
+        ROUNDTRIPS, len(MESSAGE), PAYLOAD_SIZE // 2 ** 20, RUNS))
+    # The reactor can't be restarted, so the asyncio run goes first
+    for name, run in (('asyncio', asyncioRun), ('twisted', twistedRun)):
+        results = run(samPort)
+        print('%-8s %6.1f us/roundtrip  %7.1f MB/s' % (
+            name, results['latency'] * 1e6, results['throughput'] / 1e6))
+    bridge.terminate()
@@ -0,0 +1,99 @@
+"""Creating many BOB client tunnels, with and without a shared BOB connection.
+
+A fake BOB bridge on localhost answers the BOB commands, and one local port
+stands in for the listeners of all the tunnels. Each run creates TUNNELS
+client tunnels with distinct nicknames through BOBI2PClientEndpoint, one after
+another, first with a TCP endpoint to BOB (a connection per tunnel) and then
+with a BOBControlChannel (one connection for all of them).
+
+The tunnels are created one at a time in both cases, because every creator
+starts with ``list``, and parsing that reply costs more the more tunnels
+there are.
+"""
+from __future__ import print_function
+import sys
+import time
+from twisted.internet import defer, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import Factory, Protocol
+
+from txi2p.bob.control import BOBControlChannel
+from txi2p.bob.endpoints import BOBI2PClientEndpoint
+from txi2p.bob.test.util import FakeBOBBridge
+
+TUNNELS = 20
+RUNS = 3
+# The tunnel creators print their progress, which is hidden while running
+OUT = sys.stdout
+
+
+class CountingBOBBridge(FakeBOBBridge):
+    opened = 0
+
+    def buildProtocol(self, addr):
+        self.opened += 1
+        return FakeBOBBridge.buildProtocol(self, addr)
+
+
+@defer.inlineCallbacks
+def createTunnels(bobEndpoint, tunnelPort, run):
+    fac = Factory.forProtocol(Protocol)
+    protos = []
+    for i in range(TUNNELS):
+        endpoint = BOBI2PClientEndpoint(
+            reactor, bobEndpoint, 'spam.i2p',
+            tunnelNick='bench-%d-%d' % (run, i),
+            inhost='127.0.0.1', inport=tunnelPort, lingerTime=0)
+        proto = yield endpoint.connect(fac)
+        protos.append(proto)
+    defer.returnValue(protos)
+
+
+@defer.inlineCallbacks
+def removeTunnels(bridge, protos):
+    for proto in protos:
+        proto.transport.loseConnection()
+    while bridge.tunnels:
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+
+@defer.inlineCallbacks
+def main():
+    bridge = CountingBOBBridge()
+    bobPort = reactor.listenTCP(0, bridge, interface='127.0.0.1')
+    tunnelPort = reactor.listenTCP(
+        0, Factory.forProtocol(Protocol), interface='127.0.0.1')
+    tcpEndpoint = TCP4ClientEndpoint(
+        reactor, '127.0.0.1', bobPort.getHost().port)
+
+    run = 0
+    for name, makeEndpoint in [('connection per tunnel', lambda: tcpEndpoint),
+                               ('shared channel',
+                                lambda: BOBControlChannel(tcpEndpoint))]:
+        for i in range(RUNS):
+            run += 1
+            bobEndpoint = makeEndpoint()
+            before = bridge.opened
+            start = time.time()
+            protos = yield createTunnels(
+                bobEndpoint, tunnelPort.getHost().port, run)
+            elapsed = time.time() - start
+            print('%-22s %4d tunnels in %.3fs (%d BOB connections)' % (
+                name, TUNNELS, elapsed, bridge.opened - before),
+                file=OUT)
+            yield removeTunnels(bridge, protos)
+            if isinstance(bobEndpoint, BOBControlChannel):
+                yield bobEndpoint.close()
+
+    yield bobPort.stopListening()
+    yield tunnelPort.stopListening()
+
+
+if __name__ == '__main__':
+    import os
+    from twisted.python import log
+    sys.stdout = open(os.devnull, 'w')
+    d = main()
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
@@ -0,0 +1,62 @@
+"""Compare the OMeta grammar against the line-based BOB reply parser on large
+``list`` replies.
+
+Runs a client tunnel creator up to the end of its ``list`` reply, with BOB
+listing TUNNELS other tunnels, and reports the time taken with each parser.
+The OMeta grammar is only run for the smaller lists, as its time grows with
+the square of the reply length.
+"""
+from __future__ import print_function
+import time
+from twisted.internet.protocol import ClientFactory
+from twisted.test import proto_helpers
+
+from txi2p.bob import protocol
+from txi2p.bob.test.util import tunnelStatus
+from txi2p.bob.tunnels import tunnelManager
+
+TUNNELS = [10, 100, 1000, 5000]
+# Beyond this, the OMeta grammar takes too long
+GRAMMAR_MAX = 100
+
+
+def listing(count):
+    return ''.join(
+        'DATA %s\n' % tunnelStatus({'nickname': 'bench-%d' % i,
+                                    'running': True, 'inport': 20000 + i})
+        for i in range(count)) + 'OK Listing done\n'
+
+
+def creatorListed(reply):
+    fac = ClientFactory.forProtocol(protocol.I2PClientTunnelCreatorBOBClient)
+    fac.tunnelNick = 'bench-0'
+    fac.options = {}
+    proto = fac.buildProtocol(None)
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto.dataReceived('BOB 00.00.10\nOK\n')
+    start = time.time()
+    proto.dataReceived(reply)
+    elapsed = time.time() - start
+    assert proto.receiver.tunnelExists
+    tunnelManager.tunnels = {}
+    return elapsed
+
+
+def run(useLineParser, reply):
+    protocol.BOBParserProtocol.useLineParser = useLineParser
+    try:
+        return min(creatorListed(reply) for _ in range(3))
+    finally:
+        protocol.BOBParserProtocol.useLineParser = True
+
+
+if __name__ == '__main__':
+    for count in TUNNELS:
+        reply = listing(count)
+        line = run(True, reply)
+        if count <= GRAMMAR_MAX:
+            grammar = '%9.1f ms' % (run(False, reply) * 1e3)
+        else:
+            grammar = '%12s' % 'skipped'
+        print('%5d tunnels: OMeta grammar %s, line parser %8.2f ms' % (
+            count, grammar, line * 1e3))
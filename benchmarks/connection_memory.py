@@ -0,0 +1,86 @@
+"""Memory used per connection by I2PAddress and I2PTunnelTransport.
+
+Each established stream holds a local address, a peer address and a transport
+wrapper. This builds CONNECTIONS of them, spread over PEERS remote
+Destinations, and measures the allocations with tracemalloc. The "old"
+classes are copies of the implementations before they were slotted: an
+instance __dict__ each, an eager B32 host, and a Destination string per
+connection as it arrives off the wire.
+"""
+from __future__ import print_function
+import base64
+import hashlib
+import os
+import tracemalloc
+
+from twisted.python.util import FancyEqMixin
+from twisted.test import proto_helpers
+
+from txi2p.address import I2PAddress, I2PTunnelTransport
+
+CONNECTIONS = 20000
+PEERS = 200
+
+
+class OldI2PAddress(FancyEqMixin, object):
+    compareAttributes = ('destination', 'port')
+
+    def __init__(self, destination, host=None, port=None):
+        if hasattr(destination, 'destination'):
+            self.destination = destination.destination
+        else:
+            self.destination = destination
+        self.port = int(port) if port else None
+
+        if host:
+            self.host = host
+        elif hasattr(destination, 'host'):
+            self.host = destination.host
+        else:
+            raw_key = base64.b64decode(destination.encode('utf-8'), b'-~')
+            hash = hashlib.sha256(raw_key)
+            base32_hash = base64.b32encode(hash.digest()).decode('utf-8')
+            self.host = base32_hash.lower().replace('=', '')+'.b32.i2p'
+
+
+class OldI2PTunnelTransport(object):
+    def __init__(self, wrappedTransport, localAddr, peerAddr=None, invertTLS=False):
+        self.t = wrappedTransport
+        self._localAddr = localAddr
+        self.peerAddr = peerAddr
+
+    def __getattr__(self, attr):
+        return getattr(self.t, attr)
+
+
+def randomDest():
+    return base64.b64encode(os.urandom(387), b'-~').decode('utf-8')
+
+
+def measure(addressClass, transportClass, lines, transports, localAddr):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    conns = []
+    for i in range(CONNECTIONS):
+        # Decoding gives a fresh string per connection, as off the wire
+        dest = lines[i % PEERS].decode('utf-8').split(' ')[0]
+        peer = addressClass(dest, port=i)
+        local = addressClass(localAddr, port=80)
+        conns.append(transportClass(transports[i], local, peer))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    total = sum(stat.size_diff for stat in stats)
+    return total / float(CONNECTIONS)
+
+
+if __name__ == '__main__':
+    lines = [('%s FROM_PORT=0 TO_PORT=0\n' % randomDest()).encode('utf-8')
+             for i in range(PEERS)]
+    localAddr = I2PAddress(randomDest())
+    transports = [proto_helpers.StringTransport() for i in range(CONNECTIONS)]
+    for name, addressClass, transportClass in [
+            ('old', OldI2PAddress, OldI2PTunnelTransport),
+            ('slotted', I2PAddress, I2PTunnelTransport)]:
+        perConn = measure(addressClass, transportClass, lines, transports, localAddr)
+        print('%-8s %7.0f bytes/connection' % (name, perConn))
@@ -0,0 +1,36 @@
+"""Measure the startup cost of importing txi2p.plugins.
+
+Each import runs in a fresh interpreter, as Twisted plugin discovery would in
+a new process. "with BOB" additionally loads the BOB endpoints, which is what
+importing txi2p.plugins used to do unconditionally.
+"""
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ('python only', 'pass'),
+    ('txi2p.plugins', 'import txi2p.plugins'),
+    ('txi2p.plugins with SAM', 'import txi2p.plugins, txi2p.sam.endpoints'),
+    ('txi2p.plugins with BOB', 'import txi2p.plugins, txi2p.bob.endpoints'),
+]
+
+
+def timeImport(code, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], cwd=ROOT)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    runs = 5
+    for name, code in CASES:
+        print('%-24s %7.1f ms' % (name, timeImport(code, runs) * 1e3))
@@ -0,0 +1,75 @@
+"""Cost of keepalive timer churn across many SAM control connections.
+
+Each SAM session's control connection sends a PING every KEEPALIVE_TIMEOUT
+seconds and arms a timeout for the PONG, which is cancelled when the PONG
+arrives. This replays ROUNDS of that cycle for SESSIONS connections: arm the
+timeout, cancel it, and arm the next ping.
+
+The "reactor" version gives every connection its own reactor DelayedCalls, as
+txi2p did before the shared timer wheel, so each step is a push onto (or a
+lazy removal from) the reactor's timer heap. The "wheel" version resets the
+connection's two wheel timers in place, which leaves a single DelayedCall
+pending in the reactor however many connections there are.
+"""
+from __future__ import print_function
+import time
+from twisted.internet import reactor
+
+from txi2p.sam.base import KEEPALIVE_TIMEOUT
+from txi2p.sam.keepalive import TimerWheel
+
+SESSIONS = 1000
+ROUNDS = 200
+RUNS = 3
+
+
+def noop():
+    pass
+
+
+def reactorChurn():
+    pingers = [reactor.callLater(KEEPALIVE_TIMEOUT, noop) for i in range(SESSIONS)]
+    start = time.time()
+    for r in range(ROUNDS):
+        for i in range(SESSIONS):
+            timeout = reactor.callLater(KEEPALIVE_TIMEOUT, noop)
+            timeout.cancel()
+            # Stands in for the previous ping having fired
+            pingers[i].cancel()
+            pingers[i] = reactor.callLater(KEEPALIVE_TIMEOUT, noop)
+    elapsed = time.time() - start
+    pending = len(reactor.getDelayedCalls())
+    for pinger in pingers:
+        pinger.cancel()
+    return elapsed, pending
+
+
+def wheelChurn():
+    wheel = TimerWheel()
+    pingers = [wheel.callLater(KEEPALIVE_TIMEOUT, noop) for i in range(SESSIONS)]
+    timeouts = [None] * SESSIONS
+    start = time.time()
+    for r in range(ROUNDS):
+        for i in range(SESSIONS):
+            if timeouts[i] is None:
+                timeouts[i] = wheel.callLater(KEEPALIVE_TIMEOUT, noop)
+            else:
+                timeouts[i].reset(KEEPALIVE_TIMEOUT)
+            timeouts[i].cancel()
+            pingers[i].reset(KEEPALIVE_TIMEOUT)
+    elapsed = time.time() - start
+    pending = len(reactor.getDelayedCalls())
+    for pinger in pingers:
+        pinger.cancel()
+    return elapsed, pending
+
+
+if __name__ == '__main__':
+    cycles = SESSIONS * ROUNDS
+    print('%d connections, %d keepalive cycles each' % (SESSIONS, ROUNDS))
+    for name, churn in (('reactor', reactorChurn), ('wheel', wheelChurn)):
+        results = [churn() for i in range(RUNS)]
+        best = min(elapsed for elapsed, pending in results)
+        pending = results[-1][1]
+        print('%-8s %6.0f ns/cycle  %5d reactor calls pending' % (
+            name, best / cycles * 1e9, pending))
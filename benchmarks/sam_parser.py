@@ -0,0 +1,61 @@
+"""Compare the OMeta grammar against the line-based SAM reply parser.
+
+Runs the HELLO / NAMING REPLY / STREAM STATUS exchange of an outbound stream
+through a StreamConnectProtocol with each parser, and reports the time taken.
+"""
+from __future__ import print_function
+import timeit
+from twisted.internet.protocol import ClientFactory
+from twisted.test import proto_helpers
+
+from txi2p.sam.base import SAMParserProtocol
+from txi2p.sam.stream import StreamConnectProtocol
+from txi2p.test.util import TEST_B64
+
+
+REPLIES = [
+    b'HELLO REPLY RESULT=OK VERSION=3.1\n',
+    ('NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=%s\n' % TEST_B64).encode('utf-8'),
+    b'STREAM STATUS RESULT=OK\n',
+]
+
+
+class Session(object):
+    id = 'bench'
+
+
+class BenchFactory(ClientFactory):
+    protocol = StreamConnectProtocol
+    session = Session()
+    host = 'spam.i2p'
+    port = None
+    localPort = None
+
+    def streamConnectionEstablished(self, streamProto):
+        pass
+
+
+def handshake():
+    fac = BenchFactory()
+    fac.dest = None
+    proto = fac.buildProtocol(None)
+    proto.makeConnection(proto_helpers.StringTransport())
+    for reply in REPLIES:
+        proto.dataReceived(reply)
+
+
+def run(useLineParser, number):
+    SAMParserProtocol.useLineParser = useLineParser
+    try:
+        return min(timeit.repeat(handshake, number=number, repeat=3))
+    finally:
+        SAMParserProtocol.useLineParser = False
+
+
+if __name__ == '__main__':
+    number = 200
+    grammar = run(False, number)
+    line = run(True, number)
+    print('OMeta grammar: %8.1f us/handshake' % (grammar / number * 1e6))
+    print('Line parser:   %8.1f us/handshake' % (line / number * 1e6))
+    print('Speedup:       %8.1fx' % (grammar / line))
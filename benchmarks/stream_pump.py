@@ -0,0 +1,132 @@
+"""Bulk transfer over an established SAM stream, with and without the pump.
+
+A fake SAM bridge on localhost answers HELLO and STREAM CONNECT, then sends a
+payload and closes the stream. The client side is a real StreamConnectFactory,
+so each received chunk either goes straight to the application Protocol (the
+SAMStreamPump) or through SAMParserProtocol and the receiver first.
+
+The line parser is used for both runs: the OMeta grammar hands any stream data
+that arrives in the same read as STREAM STATUS to the receiver one character
+at a time, which would swamp the per-chunk cost being measured here.
+"""
+from __future__ import print_function
+import time
+from twisted.internet import defer, reactor, tcp
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import Factory, Protocol
+
+from txi2p.address import I2PAddress
+from txi2p.sam.base import SAMParserProtocol, SAMReceiver
+from txi2p.sam.session import SAMSession
+from txi2p.sam.stream import StreamConnectFactory
+from txi2p.test.util import TEST_B64
+
+PAYLOAD_SIZE = 256 * 1024 * 1024
+CHUNK = b'x' * 4096
+# Small client reads make the per-chunk cost visible
+READ_SIZE = 4096
+RUNS = 3
+
+
+class FakeBridge(Protocol):
+    """Answers the SAM handshake, then streams PAYLOAD_SIZE bytes."""
+    buf = b''
+    paused = False
+    remaining = 0
+
+    def dataReceived(self, data):
+        self.buf += data
+        while b'\n' in self.buf:
+            line, self.buf = self.buf.split(b'\n', 1)
+            if line.startswith(b'HELLO'):
+                self.transport.write(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+            elif line.startswith(b'STREAM CONNECT'):
+                self.transport.write(b'STREAM STATUS RESULT=OK\n')
+                self.remaining = PAYLOAD_SIZE
+                self.transport.registerProducer(self, True)
+                self.resumeProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.remaining > 0 and not self.paused:
+            self.transport.write(CHUNK)
+            self.remaining -= len(CHUNK)
+        if self.remaining <= 0:
+            self.transport.unregisterProducer()
+            self.transport.loseConnection()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def stopProducing(self):
+        self.remaining = 0
+
+
+class Sink(Protocol):
+    def __init__(self, done):
+        self.done = done
+        self.received = 0
+        self.chunks = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        self.chunks += 1
+
+    def connectionLost(self, reason):
+        self.done.callback(self)
+
+
+class SinkFactory(Factory):
+    def __init__(self, done):
+        self.done = done
+
+    def buildProtocol(self, addr):
+        return Sink(self.done)
+
+
+def makeSession(port):
+    s = SAMSession()
+    s.nickname = s.id = 'bench'
+    s.samEndpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', port)
+    s.samVersion = '3.1'
+    s.address = I2PAddress(TEST_B64)
+    return s
+
+
+@defer.inlineCallbacks
+def transfer(session):
+    done = defer.Deferred()
+    fac = StreamConnectFactory(SinkFactory(done), session, None, TEST_B64)
+    start = time.time()
+    yield session.samEndpoint.connect(fac)
+    sink = yield done
+    defer.returnValue((time.time() - start, sink))
+
+
+@defer.inlineCallbacks
+def main():
+    port = reactor.listenTCP(0, Factory.forProtocol(FakeBridge), interface='127.0.0.1')
+    session = makeSession(port.getHost().port)
+    startPumping = SAMReceiver.startPumping
+    SAMParserProtocol.useLineParser = True
+    try:
+        for name, pump in [('without pump', False), ('with pump', True)]:
+            SAMReceiver.startPumping = startPumping if pump else (lambda self: None)
+            best = None
+            for i in range(RUNS):
+                elapsed, sink = yield transfer(session)
+                best = elapsed if best is None else min(best, elapsed)
+            print('%-13s %7.1f MB/s, %5.2f us/chunk (%d chunks)' % (
+                name, sink.received / best / 1e6, best / sink.chunks * 1e6,
+                sink.chunks))
+    finally:
+        SAMReceiver.startPumping = startPumping
+        SAMParserProtocol.useLineParser = False
+        port.stopListening()
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    tcp.Client.bufferSize = READ_SIZE
+    reactor.callWhenRunning(main)
+    reactor.run()
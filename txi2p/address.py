@@ -3,15 +3,55 @@
 
 from builtins import object
 import base64
+from collections import OrderedDict
 import hashlib
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern() as a builtin
+    pass
 from twisted.internet.interfaces import IAddress, ITransport
 from twisted.internet.protocol import Protocol
-from twisted.python.util import FancyEqMixin
 from zope.interface import implementer
 
+B32_CACHE_SIZE = 1024
+
+# Destination -> B32 host, least recently used first
+_b32Cache = OrderedDict()
+
+
+def b32Host(destination):
+    """Return the ``.b32.i2p`` host for an I2P Destination.
+
+    Recently used Destinations are cached, because the same peers tend to be
+    seen many times.
+
+    Args:
+        destination (str): An I2P Destination string in I2P-style B64 format.
+    """
+    host = _b32Cache.pop(destination, None)
+    if host is None:
+        raw_key = base64.b64decode(destination.encode('utf-8'), b'-~')
+        hash = hashlib.sha256(raw_key)
+        base32_hash = base64.b32encode(hash.digest()).decode('utf-8')
+        host = base32_hash.lower().replace('=', '')+'.b32.i2p'
+        if len(_b32Cache) >= B32_CACHE_SIZE:
+            _b32Cache.popitem(last=False)
+    _b32Cache[destination] = host
+    return host
+
+
+def _intern(s):
+    # Connections to the same peer then share one copy of its Destination
+    try:
+        return intern(s)
+    except TypeError:
+        # Python 2 can only intern byte strings
+        return s
+
 
 @implementer(IAddress)
-class I2PAddress(FancyEqMixin, object):
+class I2PAddress(object):
     """An :class:`IAddress` that represents the address of an I2P Destination.
 
     Args:
@@ -25,29 +65,40 @@ class I2PAddress(FancyEqMixin, object):
         destination (str): An I2P Destination string in I2P-style B64 format.
         host (str): An I2P host string; for example, ``'example.i2p'`` or
             ``'fiftytwocharacters.b32.i2p'``. If looked up, it is guaranteed to
-            resolve to ``destination``.
+            resolve to ``destination``. The B32 host is only computed when it
+            is first used.
         port (int): An integer representing the port number. Will be ``None`` if
             no port is configured.
     """
+    __slots__ = ('destination', 'port', '_host')
     compareAttributes = ('destination', 'port')
 
     def __init__(self, destination, host=None, port=None):
         if hasattr(destination, 'destination'):
             self.destination = destination.destination
         else:
-            self.destination = destination
+            self.destination = _intern(destination)
         self.port = int(port) if port else None
 
         if host:
-            self.host = host
+            self._host = host
+        elif isinstance(destination, I2PAddress):
+            # Don't force the other address to compute its B32 host
+            self._host = destination._host
         elif hasattr(destination, 'host'):
-            self.host = destination.host
+            self._host = destination.host
         else:
-            raw_key = base64.b64decode(destination.encode('utf-8'), b'-~')
-            hash = hashlib.sha256(raw_key)
-            base32_hash = base64.b32encode(hash.digest()).decode('utf-8')
-            self.host = base32_hash.lower().replace('=', '')+'.b32.i2p'
+            self._host = None
+
+    @property
+    def host(self):
+        if self._host is None:
+            self._host = b32Host(self.destination)
+        return self._host
 
+    @host.setter
+    def host(self, host):
+        self._host = host
 
     def __repr__(self):
         if self.port:
@@ -57,12 +108,27 @@ class I2PAddress(FancyEqMixin, object):
             self.__class__.__name__, self.host)
 
 
+    def __eq__(self, other):
+        # As for twisted.python.util.FancyEqMixin, which would add a __dict__
+        if isinstance(self, other.__class__):
+            return all(getattr(self, name) == getattr(other, name)
+                       for name in self.compareAttributes)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
     def __hash__(self):
         return hash((self.host, self.port))
 
 
 @implementer(ITransport)
 class I2PTunnelTransport(object):
+    __slots__ = ('t', '_localAddr', 'peerAddr', 'startTLS')
+
     def __init__(self, wrappedTransport, localAddr, peerAddr=None, invertTLS=False):
         self.t = wrappedTransport
         self._localAddr = localAddr
@@ -76,8 +142,33 @@ class I2PTunnelTransport(object):
             self.startTLS = types.MethodType(startTLSWrapper, self)
 
     def __getattr__(self, attr):
+        if attr == 't':
+            # Not yet initialised, e.g. while being copied
+            raise AttributeError(attr)
         return getattr(self.t, attr)
 
+    # The hot methods are spelled out so that they don't go through
+    # __getattr__. They are not bound per instance, which would cost memory
+    # on every connection.
+
+    def write(self, data):
+        self.t.write(data)
+
+    def writeSequence(self, data):
+        self.t.writeSequence(data)
+
+    def loseConnection(self):
+        self.t.loseConnection()
+
+    def abortConnection(self):
+        self.t.abortConnection()
+
+    def registerProducer(self, producer, streaming):
+        self.t.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.t.unregisterProducer()
+
     def getPeer(self):
         return self.peerAddr
 
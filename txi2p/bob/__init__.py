@@ -1,3 +1,8 @@
+from .control import (
+    BOBControlChannel,
+    BOBError,
+    controlChannel,
+)
 from .endpoints import (
     BOBI2PClientEndpoint,
     BOBI2PServerEndpoint,
@@ -0,0 +1,479 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from collections import deque
+from twisted.internet import defer
+from twisted.internet.error import ConnectionAborted, ConnectionDone
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.internet.protocol import ClientFactory
+from twisted.python.failure import Failure
+from zope.interface import implementer
+
+from txi2p.bob.protocol import BOBError, BOBSender, makeBOBProtocol
+
+# The BOB commands, which are also the names of the grammar rules and the
+# receiver methods that handle their replies
+COMMANDS = [
+    'clear', 'getdest', 'getkeys', 'getnick', 'inhost', 'inport', 'list',
+    'newkeys', 'option', 'outhost', 'outport', 'quiet', 'quit', 'setkeys',
+    'setnick', 'show', 'showprops', 'start', 'status', 'stop', 'verify',
+    'visit',
+]
+
+
+class BOBControlReceiver(object):
+    """Matches BOB replies to the commands that were sent, in order.
+
+    Commands may be pipelined: the reply to each one is parsed with the rule
+    for that command once the replies before it have been parsed.
+    """
+    currentRule = 'State_init'
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.version = None
+        self._waiting = deque()
+        self._parsing = False
+        self._lost = None
+
+    def prepareParsing(self, parser):
+        self.factory = parser.factory
+        self._protocol = parser
+
+    def finishParsing(self, reason):
+        self._lost = reason
+        waiting, self._waiting = self._waiting, deque()
+        for rule, d in waiting:
+            d.errback(reason)
+        self.factory.controlLost(self, reason)
+
+    def initBOB(self, version):
+        self.version = version
+        self._parsing = True
+        try:
+            self.factory.controlReady(self)
+        finally:
+            self._parsing = False
+
+    def expect(self, command):
+        """Wait for the reply to ``command``, which must be sent next.
+
+        Returns:
+            A Deferred that fires with the parsed reply, as passed to the
+            :class:`txi2p.bob.protocol.BOBReceiver` method for ``command``.
+        """
+        if self._lost:
+            return defer.fail(self._lost)
+        d = defer.Deferred()
+        rule = 'State_%s' % command
+        self._waiting.append((rule, d))
+        if len(self._waiting) == 1:
+            self.currentRule = rule
+            if not self._parsing:
+                # The parser was waiting for a rule that has now been replaced.
+                self._protocol._parser._setupInterp()
+        return d
+
+    def reply(self, *response):
+        rule, d = self._waiting.popleft()
+        if self._waiting:
+            self.currentRule = self._waiting[0][0]
+        self._parsing = True
+        try:
+            d.callback(response)
+        finally:
+            self._parsing = False
+
+for command in COMMANDS:
+    setattr(BOBControlReceiver, command, vars(BOBControlReceiver)['reply'])
+del command
+
+
+BOBControlProtocol = makeBOBProtocol(BOBSender, BOBControlReceiver)
+
+
+class BOBControlFactory(ClientFactory):
+    protocol = BOBControlProtocol
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def controlReady(self, receiver):
+        self.channel._controlReady(receiver)
+
+    def controlLost(self, receiver, reason):
+        self.channel._controlLost(receiver, reason)
+
+    # This method is not called if an endpoint deferred errbacks
+    def clientConnectionFailed(self, connector, reason):
+        self.channel._connectFailed(reason)
+
+
+def _result(response):
+    success, info = response[0], response[1]
+    if not success:
+        raise BOBError(info)
+    if len(response) > 2:
+        # list, show and status
+        return response[2]
+    return info
+
+
+class BOBCommands(object):
+    """Mixin for the BOB commands, as methods that return a Deferred.
+
+    Each Deferred fires with the ``OK`` message of the reply, except where
+    noted, or fails with :class:`BOBError` if BOB replied ``ERROR``.
+
+    Classes that use this must have a ``command(name, *args)`` method, that
+    sends the BOB command ``name`` with ``args`` and returns a Deferred for
+    its reply as above.
+    """
+
+    def clear(self):
+        return self.command('clear')
+
+    def getdest(self):
+        return self.command('getdest')
+
+    def getkeys(self):
+        return self.command('getkeys')
+
+    def getnick(self, tunnelNick):
+        return self.command('getnick', tunnelNick)
+
+    def inhost(self, inhost):
+        return self.command('inhost', inhost)
+
+    def inport(self, inport):
+        return self.command('inport', inport)
+
+    def list(self):
+        """Fires with a list of the tunnels, each a
+        :class:`txi2p.bob.parser.TunnelStatus`."""
+        return self.command('list')
+
+    def newkeys(self):
+        return self.command('newkeys')
+
+    def option(self, options):
+        return self.command('option', options)
+
+    def outhost(self, outhost):
+        return self.command('outhost', outhost)
+
+    def outport(self, outport):
+        return self.command('outport', outport)
+
+    def quiet(self):
+        return self.command('quiet')
+
+    def setkeys(self, keys):
+        return self.command('setkeys', keys)
+
+    def setnick(self, tunnelNick):
+        return self.command('setnick', tunnelNick)
+
+    def show(self):
+        """Fires with the selected tunnel as a
+        :class:`txi2p.bob.parser.TunnelStatus`."""
+        return self.command('show')
+
+    def showprops(self):
+        return self.command('showprops')
+
+    def start(self):
+        return self.command('start')
+
+    def status(self, tunnelNick):
+        """Fires with the tunnel as a :class:`txi2p.bob.parser.TunnelStatus`."""
+        return self.command('status', tunnelNick)
+
+    def stop(self):
+        return self.command('stop')
+
+    def verify(self, key):
+        return self.command('verify', key)
+
+    def visit(self):
+        return self.command('visit')
+
+
+class BOBTransaction(BOBCommands):
+    """Exclusive use of a :class:`BOBControlChannel`.
+
+    BOB keeps the tunnel selected with ``getnick`` or ``setnick`` per
+    connection, so a sequence of commands that works on a tunnel must not be
+    interleaved with others. Commands are sent as soon as they are called, so
+    a sequence that doesn't need to look at each reply can be sent without
+    waiting for them. The BOB client protocols do look at each reply, so
+    they send one command at a time.
+    """
+
+    def __init__(self, channel, receiver):
+        self.channel = channel
+        self.version = receiver.version
+        self._receiver = receiver
+
+    def command(self, name, *args):
+        d = self._receiver.expect(name)
+        getattr(self._receiver.sender, 'send%s' % name.capitalize())(*args)
+        self.channel.commands += 1
+        d.addCallback(_result)
+        return d
+
+    def sendLine(self, command, line):
+        """Send a command line that was written by a BOB client protocol.
+
+        Returns:
+            A Deferred that fires with the parsed reply to the command.
+        """
+        d = self._receiver.expect(command)
+        self._receiver.sender.transport.write(line + b'\n')
+        self.channel.commands += 1
+        return d
+
+    def getPeer(self):
+        return self._receiver.sender.transport.getPeer()
+
+    def getHost(self):
+        return self._receiver.sender.transport.getHost()
+
+
+class _TransactionTransport(object):
+    """The transport of a BOB client protocol that runs in a transaction.
+
+    Each command that the protocol writes is sent over the channel, and the
+    reply is passed to the method of its receiver for that command, just as
+    its own parser would. ``quit`` ends the transaction, but not the
+    connection to BOB.
+    """
+    disconnecting = False
+
+    def __init__(self, transaction, protocol):
+        self._transaction = transaction
+        self._protocol = protocol
+        self._buffer = b''
+        self._outstanding = 0
+        self._dispatching = False
+        self._quitting = False
+        self._lastError = None
+        self.ended = defer.Deferred()
+
+    def write(self, data):
+        if self.disconnecting:
+            return
+        self._buffer += data
+        while b'\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            self._sendLine(line)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def _sendLine(self, line):
+        command = line.split(b' ', 1)[0].decode('utf-8')
+        if command == 'quit':
+            self._quitting = True
+            if not self._dispatching:
+                self._quit()
+            return
+        self._outstanding += 1
+        d = self._transaction.sendLine(command, line)
+        d.addCallbacks(self._replied, self._failed, callbackArgs=(command,))
+
+    def _replied(self, response, command):
+        self._outstanding -= 1
+        if self.disconnecting:
+            return
+        self._lastError = None if response[0] else response[1]
+        self._dispatching = True
+        try:
+            getattr(self._protocol.receiver, command)(*response)
+        except Exception:
+            self._end(Failure())
+            return
+        finally:
+            self._dispatching = False
+        if self._quitting:
+            self._quit()
+        elif not self._outstanding:
+            # The protocol has given up without quitting.
+            if self._lastError:
+                self._end(Failure(BOBError(self._lastError)))
+            else:
+                self._end(Failure(ConnectionDone()))
+
+    def _failed(self, reason):
+        self._outstanding -= 1
+        self._end(reason)
+
+    def _quit(self):
+        # The protocol expects the reply before the connection closes.
+        self._protocol.receiver.quit(True, 'Bye!')
+        self._end(Failure(ConnectionDone()))
+
+    def _end(self, reason):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        self._protocol.connectionLost(reason)
+        self.ended.callback(None)
+
+    def loseConnection(self):
+        self._end(Failure(ConnectionDone()))
+
+    def abortConnection(self):
+        self._end(Failure(ConnectionAborted()))
+
+    def getPeer(self):
+        return self._transaction.getPeer()
+
+    def getHost(self):
+        return self._transaction.getHost()
+
+
+@implementer(IStreamClientEndpoint)
+class BOBControlChannel(BOBCommands):
+    """A single, long-lived connection to the BOB API.
+
+    The channel can be used as the ``bobEndpoint`` of BOB endpoints, in place
+    of an endpoint that connects to BOB. Each tunnel creator or remover then
+    runs its commands over the channel in turn, instead of opening a
+    connection to BOB and ending it with ``quit``. This saves a connection
+    per tunnel, but not round trips, as they still wait for the reply to
+    each command before sending the next. The typed command methods each run
+    a single command.
+
+    BOB endpoints only use a channel if they are given one. Everything that
+    uses a channel waits for it in turn, so a tunnel that is slow to set up
+    holds up the others.
+
+    The channel connects when it is first used, and again on the next use
+    after the connection is lost.
+
+    Args:
+        bobEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the BOB API.
+
+    Attributes:
+        connections (int): The number of connections made to BOB.
+        commands (int): The number of commands sent to BOB.
+    """
+
+    def __init__(self, bobEndpoint):
+        self.bobEndpoint = bobEndpoint
+        self.connections = 0
+        self.commands = 0
+        self._receiver = None
+        self._connecting = []
+        self._lock = defer.DeferredLock()
+
+    def _connect(self):
+        if self._receiver:
+            return defer.succeed(self._receiver)
+        d = defer.Deferred()
+        self._connecting.append(d)
+        if len(self._connecting) == 1:
+            self.connections += 1
+            fac = BOBControlFactory(self)
+            self.bobEndpoint.connect(fac).addErrback(self._connectFailed)
+        return d
+
+    def _controlReady(self, receiver):
+        self._receiver = receiver
+        connecting, self._connecting = self._connecting, []
+        for d in connecting:
+            d.callback(receiver)
+
+    def _controlLost(self, receiver, reason):
+        if self._receiver is receiver:
+            self._receiver = None
+        elif receiver.version is None:
+            # Lost before the BOB banner arrived
+            self._connectFailed(reason)
+
+    def _connectFailed(self, reason):
+        connecting, self._connecting = self._connecting, []
+        for d in connecting:
+            d.errback(reason)
+
+    def run(self, f, *args, **kwargs):
+        """Call ``f`` with a :class:`BOBTransaction` once the channel is free.
+
+        Args:
+            f (callable): Called with the transaction and any other
+                arguments. It may return a Deferred, and holds the channel
+                until that fires.
+
+        Returns:
+            A Deferred that fires with the result of ``f``.
+        """
+        return self._lock.run(self._run, f, *args, **kwargs)
+
+    def _run(self, f, *args, **kwargs):
+        d = self._connect()
+        d.addCallback(lambda receiver: f(
+            BOBTransaction(self, receiver), *args, **kwargs))
+        return d
+
+    def command(self, name, *args):
+        return self.run(lambda transaction: transaction.command(name, *args))
+
+    def connect(self, factory):
+        """Run the BOB client protocol of ``factory`` over the channel.
+
+        The protocol gets the channel to itself until it sends ``quit`` or
+        stops sending commands.
+
+        Returns:
+            A Deferred that fires with the protocol, as for
+            ``bobEndpoint.connect``.
+        """
+        d = defer.Deferred(lambda d: None)
+
+        def failed(reason):
+            if not d.called:
+                d.errback(reason)
+        self.run(self._adopt, factory, d).addErrback(failed)
+        return d
+
+    def _adopt(self, transaction, factory, d):
+        if d.called:
+            # Cancelled while waiting for the channel
+            return
+        factory.doStart()
+        proto = factory.buildProtocol(None)
+        transport = _TransactionTransport(transaction, proto)
+        proto.makeConnection(transport)
+        transport.ended.addBoth(lambda _: factory.doStop())
+        d.callback(proto)
+        proto.receiver.initBOB(transaction.version)
+        return transport.ended
+
+    def close(self):
+        """Close the connection to BOB, once the channel is free.
+
+        Returns:
+            A Deferred that fires once BOB has replied to ``quit``.
+        """
+        def quit(transaction):
+            self._receiver = None
+            return transaction.command('quit')
+        if not (self._receiver or self._connecting or self._lock.locked):
+            return defer.succeed(None)
+        return self.run(quit)
+
+
+_channels = {}
+
+
+def controlChannel(bobEndpoint):
+    """Get the :class:`BOBControlChannel` that is shared by everything in the
+    process that uses ``bobEndpoint``."""
+    channel = _channels.get(bobEndpoint)
+    if channel is None:
+        channel = _channels[bobEndpoint] = BOBControlChannel(bobEndpoint)
+    return channel
@@ -5,7 +5,14 @@ from builtins import object
 from twisted.internet import interfaces
 from zope.interface import implementer
 
-from txi2p.bob.factory import BOBI2PClientFactory, BOBI2PServerFactory
+from txi2p.bob.factory import (
+    DEFAULT_LINGER_TIME,
+    BOBI2PClientFactory,
+    BOBI2PServerFactory,
+    tunnelReaper,
+)
+from txi2p.bob.protocol import defaultTunnelNick
+from txi2p.bob.tunnels import tunnelManager
 
 
 def _validateDestination(dest):
@@ -13,6 +20,14 @@ def _validateDestination(dest):
     pass
 
 
+def _setUpTunnel(bobEndpoint, i2pFac):
+    # Holds up other creators of the tunnel until BOB has set it up, or
+    # failed to, but not while connecting or listening over it.
+    d = bobEndpoint.connect(i2pFac)
+    d.addCallback(lambda proto: i2pFac.setupFinished)
+    return d
+
+
 @implementer(interfaces.IStreamClientEndpoint)
 class BOBI2PClientEndpoint(object):
     """I2P client endpoint backed by the BOB API.
@@ -32,12 +47,18 @@ class BOBI2PClientEndpoint(object):
             * The implication of this is that by default, all endpoints (both
               client and server) created by the same process will use the same
               BOB tunnel.
+            * If the tunnel is running and already listens for clients, it is
+              used without being restarted, unless ``options`` differ from
+              those it was set up with.
 
         inhost (str): The host that the tunnel created by BOB will listen on.
             Defaults to ``localhost``.
         inport (int): The port that the tunnel created by BOB will listen on.
             Defaults to a port over 9000.
         options (dict): I2CP options to configure the tunnel with.
+        lingerTime (float): Seconds to keep the tunnel after the last
+            connection over it is lost, so that new connections can reuse it.
+            Defaults to 5 seconds.
     """
 
     def __init__(self, reactor, bobEndpoint, dest,
@@ -45,7 +66,8 @@ class BOBI2PClientEndpoint(object):
                  tunnelNick=None,
                  inhost='localhost',
                  inport=None,
-                 options=None):
+                 options=None,
+                 lingerTime=None):
         _validateDestination(dest)
         self._reactor = reactor
         self._bobEndpoint = bobEndpoint
@@ -55,6 +77,7 @@ class BOBI2PClientEndpoint(object):
         self._inhost = inhost
         self._inport = inport
         self._options = options
+        self._lingerTime = DEFAULT_LINGER_TIME if lingerTime is None else lingerTime
 
     def connect(self, fac):
         """Connect over I2P.
@@ -64,20 +87,32 @@ class BOBI2PClientEndpoint(object):
 
         If the factory's ``buildProtocol`` returns ``None``, the connection
         will immediately close.
-        """
 
+        Endpoints using the same tunnel nickname set it up one at a time, so
+        that a running tunnel is set up once and then reused.
+        """
+        tunnelNick = self._tunnelNick or defaultTunnelNick()
+        tunnelReaper.acquire(tunnelNick)
         i2pFac = BOBI2PClientFactory(self._reactor, fac, self._bobEndpoint, self._dest,
-                                     self._tunnelNick,
+                                     tunnelNick,
                                      self._inhost,
                                      self._inport,
-                                     self._options)
-        d = self._bobEndpoint.connect(i2pFac)
-        # Once the BOB IProtocol is returned, wait for the
-        # real IProtocol to be returned after tunnel creation,
-        # and pass it to any further registered callbacks.
-        d.addCallback(lambda proto: i2pFac.deferred)
+                                     self._options,
+                                     self._lingerTime)
+        # Other endpoints can use the tunnel as soon as it is set up, while
+        # this one connects to it.
+        d = tunnelManager.run(tunnelNick, _setUpTunnel, self._bobEndpoint, i2pFac)
+        # Once the tunnel is set up, wait for the real IProtocol to be
+        # returned, and pass it to any further registered callbacks.
+        d.addCallback(lambda _: i2pFac.deferred)
+        d.addErrback(self._releaseTunnel, tunnelNick)
         return d
 
+    def _releaseTunnel(self, reason, tunnelNick):
+        tunnelReaper.release(tunnelNick, self._bobEndpoint,
+                             self._reactor, self._lingerTime)
+        return reason
+
 
 @implementer(interfaces.IStreamServerEndpoint)
 class BOBI2PServerEndpoint(object):
@@ -104,8 +139,12 @@ class BOBI2PServerEndpoint(object):
         outhost (str): The host that the tunnel created by BOB will forward data
             to. Defaults to ``localhost``.
         outport (int): The port that the tunnel created by BOB will forward data
-            to. Defaults to a port over 9000.
+            to. Defaults to a free port that is listened on before BOB is told
+            it.
         options (dict): I2CP options to configure the tunnel with.
+        lingerTime (float): Seconds to keep the tunnel after the listening
+            port is stopped, so that a new listener can reuse it. Defaults to
+            5 seconds.
     """
 
     def __init__(self, reactor, bobEndpoint, keyfile,
@@ -113,7 +152,8 @@ class BOBI2PServerEndpoint(object):
                  tunnelNick=None,
                  outhost='localhost',
                  outport=None,
-                 options=None):
+                 options=None,
+                 lingerTime=None):
         self._reactor = reactor
         self._bobEndpoint = bobEndpoint
         self._keyfile = keyfile
@@ -122,6 +162,7 @@ class BOBI2PServerEndpoint(object):
         self._outhost = outhost
         self._outport = outport
         self._options = options
+        self._lingerTime = DEFAULT_LINGER_TIME if lingerTime is None else lingerTime
 
     def listen(self, fac):
         """Listen over I2P.
@@ -132,15 +173,22 @@ class BOBI2PServerEndpoint(object):
         If the factory's ``buildProtocol`` returns ``None``, the connection
         will immediately close.
         """
-
+        tunnelNick = self._tunnelNick or defaultTunnelNick()
+        tunnelReaper.acquire(tunnelNick)
         i2pFac = BOBI2PServerFactory(self._reactor, fac, self._bobEndpoint, self._keyfile,
-                                     self._tunnelNick,
+                                     tunnelNick,
                                      self._outhost,
                                      self._outport,
-                                     self._options)
-        d = self._bobEndpoint.connect(i2pFac)
-        # Once the BOB IProtocol is returned, wait for the
-        # IListeningPort to be returned after tunnel creation,
-        # and pass it to any further registered callbacks.
-        d.addCallback(lambda proto: i2pFac.deferred)
+                                     self._options,
+                                     self._lingerTime)
+        d = tunnelManager.run(tunnelNick, _setUpTunnel, self._bobEndpoint, i2pFac)
+        # Once the tunnel is set up, wait for the IListeningPort to be
+        # returned, and pass it to any further registered callbacks.
+        d.addCallback(lambda _: i2pFac.deferred)
+        d.addErrback(self._releaseTunnel, tunnelNick)
         return d
+
+    def _releaseTunnel(self, reason, tunnelNick):
+        tunnelReaper.release(tunnelNick, self._bobEndpoint,
+                             self._reactor, self._lingerTime)
+        return reason
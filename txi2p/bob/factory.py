@@ -3,17 +3,28 @@
 
 from __future__ import print_function
 from builtins import object
+from twisted.internet import defer, reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint
 from twisted.internet.protocol import ClientFactory, Factory
 
 from txi2p.address import I2PAddress
+from txi2p.keystore import keyStore
 from txi2p.bob.protocol import (I2PClientTunnelCreatorBOBClient,
                                 I2PServerTunnelCreatorBOBClient,
                                 I2PTunnelRemoverBOBClient,
                                 I2PClientTunnelProtocol,
                                 I2PServerTunnelProtocol,
                                 I2PListeningPort)
+from txi2p.bob.tunnels import tunnelManager
+
+DEFAULT_LINGER_TIME = 5
+# Removals that fall due this close together are sent as one batch
+REMOVAL_BATCH_WINDOW = 1
+# Seconds after which a batch of removals is given up on
+REMOVAL_TIMEOUT = 30
+# Seconds that removals can hold up reactor shutdown for
+SHUTDOWN_REMOVAL_TIMEOUT = 5
 
 
 class BOBI2PClientFactory(ClientFactory):
@@ -30,7 +41,8 @@ class BOBI2PClientFactory(ClientFactory):
                  tunnelNick=None,
                  inhost='localhost',
                  inport=None,
-                 options={}):
+                 options={},
+                 lingerTime=DEFAULT_LINGER_TIME):
         self._reactor = reactor
         self._clientFactory = clientFactory
         self._bobEndpoint = bobEndpoint
@@ -39,7 +51,10 @@ class BOBI2PClientFactory(ClientFactory):
         self.inhost = inhost
         self.inport = inport
         self.options = options
-        self.deferred = Deferred(self._cancel);
+        self.lingerTime = lingerTime
+        self.deferred = Deferred(self._cancel)
+        # Fires once BOB has set up the tunnel, or failed to
+        self.setupFinished = Deferred()
 
     def buildProtocol(self, addr):
         proto = self.protocol()
@@ -47,8 +62,13 @@ class BOBI2PClientFactory(ClientFactory):
         self.bobProto = proto
         return proto
 
+    def _finishSetup(self):
+        if not self.setupFinished.called:
+            self.setupFinished.callback(None)
+
     def bobConnectionFailed(self, reason):
-        if not self.canceled:
+        self._finishSetup()
+        if not (self.canceled or self.deferred.called):
             self.deferred.errback(reason)
 
     # This method is not called if an endpoint deferred errbacks
@@ -56,6 +76,9 @@ class BOBI2PClientFactory(ClientFactory):
         self.bobConnectionFailed(reason)
 
     def i2pTunnelCreated(self):
+        self._finishSetup()
+        if self.removeTunnelWhenFinished:
+            tunnelManager.own(self.tunnelNick)
         # BOB is now listening for a tunnel.
         # BOB only listens on TCP4 (for now).
         clientEndpoint = TCP4ClientEndpoint(self._reactor, self.inhost, self.inport)
@@ -64,7 +87,8 @@ class BOBI2PClientFactory(ClientFactory):
                                                  self._bobEndpoint,
                                                  I2PAddress(self.localDest),
                                                  self.tunnelNick,
-                                                 self.removeTunnelWhenFinished)
+                                                 self._reactor,
+                                                 self.lingerTime)
         wrappedFactory.setDest(self.dest)
         d = clientEndpoint.connect(wrappedFactory)
         def checkProto(proto):
@@ -81,6 +105,8 @@ class BOBI2PServerFactory(Factory):
     bobProto = None
     canceled = False
     removeTunnelWhenFinished = True
+    _wrappedFactory = None
+    _localPort = None
 
     def _cancel(self, d):
         self.bobProto.sender.transport.abortConnection()
@@ -90,7 +116,8 @@ class BOBI2PServerFactory(Factory):
                  tunnelNick=None,
                  outhost='localhost',
                  outport=None,
-                 options={}):
+                 options={},
+                 lingerTime=DEFAULT_LINGER_TIME):
         self._reactor = reactor
         self._serverFactory = serverFactory
         self._bobEndpoint = bobEndpoint
@@ -100,16 +127,24 @@ class BOBI2PServerFactory(Factory):
         self.outhost = outhost
         self.outport = outport
         self.options = options
+        self.lingerTime = lingerTime
         self.deferred = Deferred(self._cancel)
+        # Fires once BOB has set up the tunnel, or failed to
+        self.setupFinished = Deferred()
 
     def startFactory(self):
-        try:
-            f = open(self._keyfile, 'r')
-            self.keypair = f.read()
-            f.close()
-        except IOError:
-            self.keypair = None
-            self._writeKeypair = True
+        self.keypair = None
+        self.keyLoading = keyStore.load(self._keyfile, self._reactor)
+        self.keyLoading.addCallbacks(self._keyLoaded, self._keyLoadFailed)
+
+    def _keyLoaded(self, keypair):
+        self.keypair = keypair
+        self._writeKeypair = keypair is None
+
+    def _keyLoadFailed(self, reason):
+        print('Could not read keypair from %s' % self._keyfile)
+        self.bobConnectionFailed(reason)
+        return reason
 
     def buildProtocol(self, addr):
         proto = self.protocol()
@@ -117,8 +152,17 @@ class BOBI2PServerFactory(Factory):
         self.bobProto = proto
         return proto
 
+    def _finishSetup(self):
+        if not self.setupFinished.called:
+            self.setupFinished.callback(None)
+
     def bobConnectionFailed(self, reason):
-        if not self.canceled:
+        self._finishSetup()
+        if self._localPort is not None:
+            # BOB won't forward data to it
+            self._localPort.stopListening()
+            self._localPort = None
+        if not (self.canceled or self.deferred.called):
             self.deferred.errback(reason)
 
     # This method is not called if an endpoint deferred errbacks
@@ -126,49 +170,78 @@ class BOBI2PServerFactory(Factory):
         self.bobConnectionFailed(reason)
 
     def i2pTunnelCreated(self):
+        self._finishSetup()
+        if self.removeTunnelWhenFinished:
+            tunnelManager.own(self.tunnelNick)
         if self._writeKeypair:
-            try:
-                f = open(self._keyfile, 'w')
-                f.write(self.keypair)
-                f.close()
-            except IOError:
-                print('Could not save keypair')
+            # Listening doesn't need to wait for the keyfile to be written
+            d = keyStore.save(self._keyfile, self.keypair, self._reactor)
+            d.addErrback(lambda f: print('Could not save keypair'))
         # BOB will now forward data to a listener.
-        # BOB only forwards to TCP4 (for now).
-        serverEndpoint = TCP4ServerEndpoint(self._reactor, self.outport)
-        # Wrap the server Factory.
-        wrappedFactory = BOBServerFactoryWrapper(self._serverFactory,
-                                                 self._bobEndpoint,
-                                                 I2PAddress(self.localDest),
-                                                 self.tunnelNick,
-                                                 self.removeTunnelWhenFinished)
-        d = serverEndpoint.listen(wrappedFactory)
+        if self._localPort is None:
+            d = self._listen(self.outport)
+        else:
+            d = defer.succeed(self._localPort)
         def handlePort(port):
             if port is None:
                 self.deferred.cancel()
             serverAddr = I2PAddress(self.localDest)
-            p = I2PListeningPort(port, wrappedFactory, serverAddr)
+            p = I2PListeningPort(port, self._wrappedFactory, serverAddr)
             return p
         d.addCallback(handlePort)
         # When the Deferred returns an IListeningPort, pass it on.
         d.chainDeferred(self.deferred)
 
+    def listenLocally(self):
+        """Listen on a free local port, for BOB to forward data to.
+
+        The OS picks the port when the listener is bound, so unlike a port
+        picked in advance, nothing else can take it before BOB is told it.
+
+        Returns:
+            twisted.internet.defer.Deferred: Fires with the port number.
+        """
+        d = self._listen(0)
+        def gotPort(port):
+            self._localPort = port
+            return port.getHost().port
+        d.addCallback(gotPort)
+        return d
+
+    def _listen(self, port):
+        # BOB only forwards to TCP4 (for now).
+        serverEndpoint = TCP4ServerEndpoint(self._reactor, port)
+        # Wrap the server Factory.
+        self._wrappedFactory = BOBServerFactoryWrapper(self._serverFactory,
+                                                       self._bobEndpoint,
+                                                       I2PAddress(self.localDest),
+                                                       self.tunnelNick,
+                                                       self._reactor,
+                                                       self.lingerTime)
+        return serverEndpoint.listen(self._wrappedFactory)
+
 
 class BOBFactoryWrapperCommon(object):
     def __init__(self, wrappedFactory,
                        bobEndpoint,
                        localAddr,
                        tunnelNick,
-                       removeTunnelWhenFinished):
+                       clock=None,
+                       lingerTime=DEFAULT_LINGER_TIME):
         self.w = wrappedFactory
         self.bobEndpoint = bobEndpoint
         self.localAddr = localAddr
         self.tunnelNick = tunnelNick
-        self.removeTunnelWhenFinished = removeTunnelWhenFinished
+        self.clock = clock
+        self.lingerTime = lingerTime
 
     def __getattr__(self, attr):
         return getattr(self.w, attr)
 
+    def releaseTunnel(self):
+        tunnelReaper.release(self.tunnelNick, self.bobEndpoint,
+                             self.clock, self.lingerTime)
+
 
 class BOBClientFactoryWrapper(BOBFactoryWrapperCommon):
     protocol = I2PClientTunnelProtocol
@@ -183,16 +256,9 @@ class BOBClientFactoryWrapper(BOBFactoryWrapperCommon):
         return proto
 
     def i2pConnectionLost(self, wrappedProto, reason):
-        if self.removeTunnelWhenFinished:
-            # Notify the underlying Protocol once the tunnel has
-            # been removed, in case they stop the reactor.
-            rmTunnelFac = BOBI2PClientTunnelRemoverFactory(self.tunnelNick,
-                                                           wrappedProto,
-                                                           reason)
-            self.bobEndpoint.connect(rmTunnelFac)
-        else:
-            # Notify the underlying Protocol now.
-            wrappedProto.connectionLost(reason)
+        # The tunnel is removed later, if nothing else is using it by then.
+        wrappedProto.connectionLost(reason)
+        self.releaseTunnel()
 
 
 class BOBServerFactoryWrapper(BOBFactoryWrapperCommon):
@@ -205,39 +271,162 @@ class BOBServerFactoryWrapper(BOBFactoryWrapperCommon):
         return proto
 
     def stopListening(self, wrappedPort):
-        if self.removeTunnelWhenFinished:
-            # Notify the underlying ListeningPort once the tunnel
-            # has been removed, in case they stop the reactor.
-            rmTunnelFac = BOBI2PServerTunnelRemoverFactory(self.tunnelNick,
-                                                           wrappedPort)
-            self.bobEndpoint.connect(rmTunnelFac)
-        else:
-            # Notify the underlying ListeningPort now.
-            wrappedPort.stopListening()
+        # The tunnel is removed later, if nothing else is using it by then.
+        d = wrappedPort.stopListening()
+        self.releaseTunnel()
+        return d
 
 
-class BOBI2PClientTunnelRemoverFactory(ClientFactory):
+class BOBI2PTunnelRemoverFactory(ClientFactory):
     protocol = I2PTunnelRemoverBOBClient
+    bobProto = None
+    canceled = False
 
-    def __init__(self, tunnelNick, protoToNotify, reason):
-        self.tunnelNick = tunnelNick
-        self._protoToNotify = protoToNotify
-        self._reason = reason
+    def _cancel(self, d):
+        self.canceled = True
+        if self.bobProto:
+            self.bobProto.sender.transport.abortConnection()
 
-    def i2pTunnelRemoved(self):
-        # Now that the I2P tunnel has been removed,
-        # notify the underlying Protocol.
-        self._protoToNotify.connectionLost(self._reason)
+    def __init__(self, tunnelNicks):
+        self.tunnelNicks = list(tunnelNicks)
+        self.removed = []
+        self.deferred = Deferred(self._cancel)
 
+    def buildProtocol(self, addr):
+        proto = self.protocol()
+        proto.factory = self
+        self.bobProto = proto
+        return proto
 
-class BOBI2PServerTunnelRemoverFactory(ClientFactory):
-    protocol = I2PTunnelRemoverBOBClient
+    def i2pTunnelRemoved(self, tunnelNick):
+        self.removed.append(tunnelNick)
+
+    def i2pTunnelsRemoved(self):
+        self.deferred.callback(self.removed)
+
+    def bobConnectionFailed(self, reason):
+        if not (self.canceled or self.deferred.called):
+            self.deferred.errback(reason)
+
+    # This method is not called if an endpoint deferred errbacks
+    def clientConnectionFailed(self, connector, reason):
+        self.bobConnectionFailed(reason)
 
-    def __init__(self, tunnelNick, portToNotify):
-        self.tunnelNick = tunnelNick
-        self._portToNotify = portToNotify
 
-    def i2pTunnelRemoved(self):
-        # Now that the I2P tunnel has been removed,
-        # notify the underlying ListeningPort.
-        self._portToNotify.stopListening()
+class BOBTunnelReaper(object):
+    """Removes BOB tunnels that nothing in the process uses any more.
+
+    A tunnel is removed once the last connection or listening port using it
+    has been closed for its linger time, unless something has started using
+    it again by then. Removals that fall due at about the same time, through
+    the same BOB API, are sent as one batch. Removals that are still waiting
+    when the reactor shuts down are sent straight away, and shutdown waits
+    up to :data:`SHUTDOWN_REMOVAL_TIMEOUT` seconds for them.
+
+    Attributes:
+        batches (int): The number of batches of removals sent.
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self._due = {}
+        self._timers = {}
+        self._watching = set()
+
+    def acquire(self, tunnelNick):
+        """Record a new user of ``tunnelNick``, and keep it from being
+        removed."""
+        tunnelManager.acquire(tunnelNick)
+        self._due.pop(tunnelNick, None)
+
+    def release(self, tunnelNick, bobEndpoint, clock=None,
+                lingerTime=DEFAULT_LINGER_TIME):
+        """Record that a user of ``tunnelNick`` is done with it.
+
+        Args:
+            tunnelNick (str): The tunnel nickname.
+            bobEndpoint (twisted.internet.interfaces.IStreamClientEndpoint):
+                An endpoint that will connect to the BOB API.
+            clock: An :class:`twisted.internet.interfaces.IReactorTime`
+                provider. Defaults to the global reactor.
+            lingerTime (float): Seconds to wait before removing the tunnel if
+                nothing else uses it.
+        """
+        if not tunnelManager.release(tunnelNick):
+            return
+        clock = clock or reactor
+        self._due[tunnelNick] = (clock.seconds() + lingerTime, bobEndpoint, clock)
+        if clock not in self._watching and \
+                hasattr(clock, 'addSystemEventTrigger'):
+            self._watching.add(clock)
+            clock.addSystemEventTrigger(
+                'before', 'shutdown', self.flush, clock, float('inf'),
+                SHUTDOWN_REMOVAL_TIMEOUT)
+        self._schedule(clock)
+
+    def _schedule(self, clock):
+        times = [due for due, bobEndpoint, c in self._due.values() if c is clock]
+        timer = self._timers.get(clock)
+        if timer and timer.active():
+            if times and timer.getTime() <= min(times):
+                return
+            timer.cancel()
+        self._timers.pop(clock, None)
+        if times:
+            delay = max(0, min(times) - clock.seconds())
+            self._timers[clock] = clock.callLater(delay, self.flush, clock)
+
+    def flush(self, clock=None, window=REMOVAL_BATCH_WINDOW,
+              timeout=REMOVAL_TIMEOUT):
+        """Remove the tunnels that are due to be removed within ``window``
+        seconds.
+
+        Returns:
+            A Deferred that fires once they have been removed, or removing
+            them has been given up on after ``timeout`` seconds.
+        """
+        clock = clock or reactor
+        timer = self._timers.pop(clock, None)
+        if timer and timer.active():
+            timer.cancel()
+        cutoff = clock.seconds() + window
+        batches = {}
+        for tunnelNick, (due, bobEndpoint, c) in list(self._due.items()):
+            if c is clock and due <= cutoff:
+                del self._due[tunnelNick]
+                batches.setdefault(bobEndpoint, []).append(tunnelNick)
+        self._schedule(clock)
+        return defer.DeferredList(
+            [self._remove(bobEndpoint, sorted(tunnelNicks), clock, timeout)
+             for bobEndpoint, tunnelNicks in batches.items()])
+
+    def _remove(self, bobEndpoint, tunnelNicks, clock, timeout):
+        # Creators of these tunnels don't run while they are removed.
+        d = tunnelManager.runAll(
+            tunnelNicks, self._removeNow, bobEndpoint, tunnelNicks)
+        timeoutCall = clock.callLater(timeout, d.cancel)
+
+        def done(result):
+            if timeoutCall.active():
+                timeoutCall.cancel()
+            return result
+        d.addBoth(done)
+        d.addErrback(lambda f: print(
+            'Could not remove tunnels: %s' % f.getErrorMessage()))
+        return d
+
+    def _removeNow(self, bobEndpoint, tunnelNicks):
+        # Tunnels that were picked up again while waiting are kept.
+        tunnelNicks = [tunnelNick for tunnelNick in tunnelNicks
+                       if not tunnelManager.inUse(tunnelNick)]
+        if not tunnelNicks:
+            return
+        self.batches += 1
+        fac = BOBI2PTunnelRemoverFactory(tunnelNicks)
+        d = bobEndpoint.connect(fac)
+        d.addCallback(lambda proto: fac.deferred)
+        return d
+
+
+# The BOBTunnelReaper that every BOB endpoint in the process shares
+tunnelReaper = BOBTunnelReaper()
@@ -0,0 +1,219 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+import re
+try:
+    # Python 3
+    from collections.abc import Mapping
+except ImportError:
+    # Python 2
+    from collections import Mapping
+
+
+class BOBParseError(ValueError):
+    """Raised when a BOB bridge sends a line that cannot be parsed."""
+
+
+# Matches the TUNNEL_STATUS rule in txi2p.grammar.bobGrammarSource
+_tunnelStatus = re.compile(
+    r'NICKNAME: (\S*) STARTING: (true|false) RUNNING: (true|false) '
+    r'STOPPING: (true|false) KEYS: (true|false) QUIET: (true|false) '
+    r'INPORT: (not_set|\d+) INHOST: (\S*) OUTPORT: (not_set|\d+) '
+    r'OUTHOST: (.*)$')
+
+_b64 = re.compile(r'[A-Za-z0-9~-]+$')
+
+
+class TunnelStatus(Mapping):
+    """The state of one tunnel, from a BOB ``list``, ``show`` or ``status``
+    reply.
+
+    It reads like the dict that the OMeta grammar builds, with the keys
+    ``nickname``, ``starting``, ``running``, ``stopping``, ``keys``,
+    ``quiet``, ``inport``, ``inhost``, ``outport`` and ``outhost``, but only
+    keeps a tuple of the values.
+    """
+    __slots__ = ('_values',)
+
+    _fields = ('nickname', 'starting', 'running', 'stopping', 'keys',
+               'quiet', 'inport', 'inhost', 'outport', 'outhost')
+    _index = dict((field, i) for i, field in enumerate(_fields))
+
+    def __init__(self, values):
+        self._values = tuple(values)
+
+    @classmethod
+    def fromLine(cls, line):
+        """Parse a tunnel status, without the ``DATA`` or ``OK`` prefix.
+
+        Raises:
+            BOBParseError: if ``line`` is not a tunnel status.
+        """
+        match = _tunnelStatus.match(line)
+        if match is None:
+            raise BOBParseError('Invalid tunnel status: %r' % line)
+        (nickname, starting, running, stopping, keys, quiet,
+         inport, inhost, outport, outhost) = match.groups()
+        return cls((
+            nickname,
+            starting == 'true',
+            running == 'true',
+            stopping == 'true',
+            keys == 'true',
+            quiet == 'true',
+            None if inport == 'not_set' else int(inport),
+            inhost,
+            None if outport == 'not_set' else int(outport),
+            outhost,
+        ))
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return 'TunnelStatus(%r)' % (dict(self),)
+
+
+def _parseReply(line):
+    if line.startswith('ERROR '):
+        return (False, line[len('ERROR '):])
+    if line.startswith('OK '):
+        return (True, line[len('OK '):])
+    if line == 'OK':
+        return (True, '')
+    raise BOBParseError('Expected OK or ERROR, got %r' % line)
+
+
+def _parseKeyReply(line):
+    success, info = _parseReply(line)
+    if success and not _b64.match(info):
+        raise BOBParseError('Invalid key: %r' % info)
+    return (success, info)
+
+
+def _parseStatusReply(prefix):
+    def parse(line):
+        if line.startswith('OK ' + prefix):
+            return (True, '', TunnelStatus.fromLine(line[3 + len(prefix):]))
+        success, info = _parseReply(line)
+        if success:
+            raise BOBParseError('Expected a tunnel status, got %r' % line)
+        return (False, info, {})
+    return parse
+
+
+def _parseQuitReply(line):
+    success, info = _parseReply(line)
+    if not success:
+        raise BOBParseError('Unexpected %r' % line)
+    return (success, info)
+
+
+# Maps each BOB command that has a one-line reply onto its parser. list and
+# the version greeting are handled separately.
+_replyRules = {
+    'clear':     _parseReply,
+    'getdest':   _parseKeyReply,
+    'getkeys':   _parseKeyReply,
+    'getnick':   _parseReply,
+    'inhost':    _parseReply,
+    'inport':    _parseReply,
+    'newkeys':   _parseKeyReply,
+    'option':    _parseReply,
+    'outhost':   _parseReply,
+    'outport':   _parseReply,
+    'quiet':     _parseReply,
+    'quit':      _parseQuitReply,
+    'setkeys':   _parseReply,
+    'setnick':   _parseReply,
+    'show':      _parseStatusReply(''),
+    'showprops': _parseReply,
+    'start':     _parseReply,
+    'status':    _parseStatusReply('DATA '),
+    'stop':      _parseReply,
+    'verify':    _parseReply,
+    'visit':     _parseQuitReply,
+}
+
+
+class BOBLineParser(object):
+    """An incremental, line-based parser for BOB replies.
+
+    This is a drop-in replacement for the ``TrampolinedParser`` that Parsley
+    builds from :data:`txi2p.grammar.bobGrammarSource`. It reads whole lines
+    and dispatches them to the same receiver methods, based on the
+    receiver's ``currentRule``.
+
+    Each ``DATA`` line of a ``list`` reply is parsed into a
+    :class:`TunnelStatus` as soon as it arrives, and the receiver gets the
+    list of them once the reply ends.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self._buffer = ''
+        self._version = None
+        self._tunnels = []
+
+    def _setupInterp(self):
+        # The grammar interpreter must be reset when currentRule is changed
+        # from outside of a rule action. This parser reads currentRule for
+        # every line, so there is nothing to reset.
+        pass
+
+    def receive(self, data):
+        """Receive and parse some data.
+
+        Args:
+            data (str): Data received from the BOB bridge.
+        """
+        buf = self._buffer + data if self._buffer else data
+        pos = 0
+        while True:
+            eol = buf.find('\n', pos)
+            if eol < 0:
+                break
+            line = buf[pos:eol]
+            pos = eol + 1
+            self._dispatch(line)
+        self._buffer = buf[pos:]
+
+    def _dispatch(self, line):
+        receiver = self.receiver
+        rule = receiver.currentRule
+        if not rule.startswith('State_'):
+            raise BOBParseError('Unknown parser state: %s' % rule)
+        command = rule[len('State_'):]
+
+        if command == 'init':
+            if self._version is None:
+                if not line.startswith('BOB '):
+                    raise BOBParseError('Expected BOB greeting, got %r' % line)
+                self._version = line[len('BOB '):]
+            elif line == 'OK':
+                version, self._version = self._version, None
+                receiver.initBOB(version)
+            else:
+                raise BOBParseError('Expected OK, got %r' % line)
+        elif command == 'list':
+            if line.startswith('DATA '):
+                self._tunnels.append(TunnelStatus.fromLine(line[len('DATA '):]))
+                return
+            success, info = _parseReply(line)
+            tunnels, self._tunnels = self._tunnels, []
+            if not success and tunnels:
+                raise BOBParseError('Unexpected %r after DATA' % line)
+            receiver.list(success, info, tunnels)
+        else:
+            try:
+                parse = _replyRules[command]
+            except KeyError:
+                raise BOBParseError('Unknown parser state: %s' % rule)
+            getattr(receiver, command)(*parse(line))
@@ -0,0 +1,94 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+import socket
+from twisted.internet.error import CannotListenError
+
+# How many times to ask the OS for a free port before giving up
+MAX_PROBES = 100
+
+
+class PortAllocator(object):
+    """Hands out free local ports for client tunnels to listen on.
+
+    BOB binds these ports itself when the tunnel is started. Server tunnels
+    don't need one, as their listener is bound on a port the OS picks before
+    BOB is told to forward data to it.
+
+    The OS is asked for a free port by binding to port 0, so ports that
+    other software is listening on are never picked. Every port that is
+    handed out is reserved for its tunnel until the tunnel is removed, so
+    that tunnels set up in parallel in this process don't get the same port
+    before BOB has bound it.
+
+    Attributes:
+        probes (int): The number of times the OS was asked for a free port.
+    """
+
+    def __init__(self):
+        self.probes = 0
+        self._allocations = {}
+        self._reserved = set()
+
+    def allocate(self, tunnelNick, setting, interface='', exclude=()):
+        """Get a free port for a setting of a tunnel.
+
+        A tunnel that already has a port for the setting keeps it, unless
+        it is excluded.
+
+        Args:
+            tunnelNick (str): The tunnel nickname.
+            setting (str): The tunnel setting the port is for, ``inport`` or
+                ``outport``.
+            interface (str): The local interface the port must be free on.
+                By default it must be free on all of them.
+            exclude: Ports that must not be picked, such as those that other
+                BOB tunnels are configured with.
+
+        Returns:
+            int: The port.
+
+        Raises:
+            twisted.internet.error.CannotListenError: if no free port could
+                be found.
+        """
+        key = (tunnelNick, setting)
+        port = self._allocations.get(key)
+        if port is not None and port not in exclude:
+            return port
+        self.free(tunnelNick, setting)
+        for _ in range(MAX_PROBES):
+            port = self._probe(interface)
+            if port not in self._reserved and port not in exclude:
+                self._allocations[key] = port
+                self._reserved.add(port)
+                return port
+        raise CannotListenError(interface, 0, 'no free port found')
+
+    def _probe(self, interface):
+        self.probes += 1
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind((interface, 0))
+            return s.getsockname()[1]
+        finally:
+            s.close()
+
+    def allocated(self, tunnelNick, setting):
+        """The port that a setting of a tunnel has, or `None`."""
+        return self._allocations.get((tunnelNick, setting))
+
+    def free(self, tunnelNick, setting):
+        """Give back the port that a setting of a tunnel has, if any."""
+        port = self._allocations.pop((tunnelNick, setting), None)
+        self._reserved.discard(port)
+
+    def release(self, tunnelNick):
+        """Give back all the ports of ``tunnelNick``, which has been removed."""
+        for setting in ('inport', 'outport'):
+            self.free(tunnelNick, setting)
+
+
+# The PortAllocator that every BOB tunnel in the process shares
+portAllocator = PortAllocator()
@@ -2,10 +2,10 @@
 # See COPYING for details.
 
 from __future__ import print_function
-from builtins import range
 from builtins import object
+import functools
 import os
-from parsley import makeProtocol
+from ometa.protocol import ParserProtocol
 from twisted.internet.error import ConnectError, UnknownHostError
 from twisted.internet.interfaces import IListeningPort
 from twisted.internet.protocol import Protocol
@@ -18,9 +18,23 @@ from txi2p.address import (
     I2PTunnelTransport,
     I2PServerTunnelProtocol,
 )
+from txi2p.bob.parser import BOBLineParser
+from txi2p.bob.ports import portAllocator
+from txi2p.bob.tunnels import tunnelManager
 
-DEFAULT_INPORT  = 9000
-DEFAULT_OUTPORT = 9001
+
+# How many times a remover asks BOB to clear a tunnel that is still stopping
+MAX_CLEAR_RETRIES = 100
+
+
+class BOBError(Exception):
+    """BOB replied ``ERROR`` to a command."""
+
+
+def defaultTunnelNick():
+    # All tunnels in the same process use the same tunnelNick
+    # TODO is using the PID a security risk?
+    return 'txi2p-%d' % os.getpid()
 
 
 class BOBSender(object):
@@ -56,7 +70,7 @@ class BOBSender(object):
 
     def sendOption(self, options={}):
         msg = 'option'
-        for key in sorted(options):
+        for key in sorted(options or {}):
             msg += ' %s=%s' % (key, options[key])
         msg += '\n'
         self.transport.write(msg.encode('utf-8'))
@@ -113,6 +127,9 @@ class BOBReceiver(object):
     def __init__(self, sender):
         self.sender = sender
         self.tunnelExists = False
+        # Whether the existing tunnel can be used as it is
+        self.reuseTunnel = False
+        self.optionsChanged = False
 
     def prepareParsing(self, parser):
         # Store the factory for later use
@@ -123,85 +140,138 @@ class BOBReceiver(object):
             self.factory.bobConnectionFailed(reason)
 
     def initBOB(self, version):
-        self.sender.sendList()
         self.currentRule = 'State_list'
+        # Hold back until the keyfile has been read, so option() knows
+        # whether there is a keypair
+        keyLoading = getattr(self.factory, 'keyLoading', None)
+        if keyLoading:
+            keyLoading.addCallbacks(lambda _: self.sender.sendList(),
+                                    self._keysNotLoaded)
+        else:
+            self.sender.sendList()
+
+    def _keysNotLoaded(self, reason):
+        # The factory has already failed, so end the connection to BOB
+        self.sender.sendQuit()
+        self.currentRule = 'State_quit'
 
     def processTunnelList(self, tunnels):
         if not (hasattr(self.factory, 'tunnelNick') and self.factory.tunnelNick):
-            # All tunnels in the same process use the same tunnelNick
-            # TODO is using the PID a security risk?
-            self.factory.tunnelNick = 'txi2p-%d' % os.getpid()
-
-        used_ports = []
-        for i in range(0, len(tunnels)):
-            if tunnels[i]['nickname'] == self.factory.tunnelNick:
-                # Tunnel already exists, use its settings.
-                self.tunnelExists = True
-                self.tunnelRunning = tunnels[i]['running']
-                self.factory.inhost = tunnels[i]['inhost']
-                self.factory.inport = tunnels[i]['inport']
-                self.factory.outhost = tunnels[i]['outhost']
-                self.factory.outport = tunnels[i]['outport']
-                # The tunnel will be removed by the Factory
-                # that created it.
-                self.factory.removeTunnelWhenFinished = False
-                break
-            else:
-                if tunnels[i]['inport']:
-                    used_ports.append(tunnels[i]['inport'])
-                if tunnels[i]['outport']:
-                    used_ports.append(tunnels[i]['outport'])
-        else:
-            # This is a new tunnel.
-            # Default port offset is at the end of the tunnels list
-            offset = 2*(len(tunnels))
-            # Find an offset that does not clash
-            while (DEFAULT_INPORT + offset) in used_ports or (DEFAULT_OUTPORT + offset) in used_ports:
-                offset += 2
-            # If the in/outport were not user-configured, set them.
-            if not (hasattr(self.factory, 'inport') and self.factory.inport):
-                self.factory.inport = DEFAULT_INPORT + offset
-            if not (hasattr(self.factory, 'outport') and self.factory.outport):
-                self.factory.outport = DEFAULT_OUTPORT + offset
+            self.factory.tunnelNick = defaultTunnelNick()
+        tunnelManager.listed(tunnels)
+
+        # The list was indexed by nickname, so the other tunnels are only
+        # looked at again if a port has to be picked.
+        tunnel = tunnelManager.tunnels.get(self.factory.tunnelNick)
+        if tunnel is not None:
+            # Tunnel already exists, use its settings.
+            self.tunnelExists = True
+            self.tunnelRunning = tunnel['running']
+            self.factory.inhost = tunnel['inhost']
+            self.factory.outhost = tunnel['outhost']
+            # A port that the tunnel doesn't have yet is chosen below
+            if tunnel['inport']:
+                self.factory.inport = tunnel['inport']
+            if tunnel['outport']:
+                self.factory.outport = tunnel['outport']
+            # The tunnel will be removed by the Factory
+            # that created it.
+            self.factory.removeTunnelWhenFinished = False
+        self.choosePorts(tunnels)
+
+        if self.tunnelExists:
+            tunnel = tunnelManager.tunnels[self.factory.tunnelNick]
+            # Tunnel removers have no options
+            self.optionsChanged = tunnelManager.optionsChanged(
+                self.factory.tunnelNick, getattr(self.factory, 'options', None))
+            # A running tunnel that already has what we need doesn't have to
+            # be stopped, reconfigured and started again
+            self.reuseTunnel = self.tunnelRunning and \
+                not self.optionsChanged and self.canReuse(tunnel)
+
+    def _fail(self, command, info):
+        # Give up on the tunnel, and end the connection to BOB
+        print('%s ERROR: %s' % (command, info))
+        self.factory.bobConnectionFailed(Failure(BOBError(info)))
+        self.sender.sendQuit()
+        self.currentRule = 'State_quit'
+
+    def canReuse(self, tunnel):
+        """Whether the running ``tunnel`` can be used as it is."""
+        return False
+
+    def choosePorts(self, tunnels):
+        """Pick free local ports for the tunnel settings that aren't set.
+
+        Args:
+            tunnels (list): The tunnels that BOB has.
+        """
+        pass
+
+    def _allocatePort(self, setting, tunnels):
+        # Keep a port that was user-configured or that the tunnel has
+        if getattr(self.factory, setting, None):
+            return
+        usedPorts = set()
+        for tunnel in tunnels:
+            if tunnel['nickname'] != self.factory.tunnelNick:
+                usedPorts.add(tunnel['inport'])
+                usedPorts.add(tunnel['outport'])
+        setattr(self.factory, setting, portAllocator.allocate(
+            self.factory.tunnelNick, setting, exclude=usedPorts))
 
     def getnick(self, success, info):
         if success:
-            if self.tunnelRunning:
+            if self.tunnelRunning and not self.reuseTunnel:
                 self.sender.sendStop()
                 self.currentRule = 'State_stop'
+            elif self.optionsChanged:
+                self._setOptions()
             else:
                 # Update the local Destination
                 self.sender.sendGetdest()
                 self.currentRule = 'State_getdest'
         else:
-            print('ERROR: %s' % info)
+            self._fail('getnick', info)
 
     def stop(self, success, info):
         if success:
-            # Update the local Destination
-            self.sender.sendGetdest()
-            self.currentRule = 'State_getdest'
+            if self.optionsChanged:
+                self._setOptions()
+            else:
+                # Update the local Destination
+                self.sender.sendGetdest()
+                self.currentRule = 'State_getdest'
         else:
-            print('stop ERROR: %s' % info)
+            self._fail('stop', info)
+
+    def _setOptions(self):
+        self.sender.sendOption(self.factory.options)
+        self.currentRule = 'State_option'
 
     def setnick(self, success, info):
         if success:
             # Set the options
-            self.sender.sendOption(self.factory.options)
-            self.currentRule = 'State_option'
+            self._setOptions()
         else:
-            print('setnick ERROR: %s' % info)
+            self._fail('setnick', info)
 
     def option(self, success, info):
         if success:
-            if hasattr(self.factory, 'keypair') and self.factory.keypair: # If a keypair was provided, use it
+            tunnelManager.update(self.factory.tunnelNick,
+                                 options=dict(self.factory.options or {}))
+            if self.tunnelExists:
+                # The tunnel already has keys. Update the local Destination
+                self.sender.sendGetdest()
+                self.currentRule = 'State_getdest'
+            elif hasattr(self.factory, 'keypair') and self.factory.keypair: # If a keypair was provided, use it
                 self.sender.sendSetkeys(self.factory.keypair)
                 self.currentRule = 'State_setkeys'
             else: # Get a new keypair
                 self.sender.sendNewkeys()
                 self.currentRule = 'State_newkeys'
         else:
-            print('option ERROR: %s' % info)
+            self._fail('option', info)
 
     def setkeys(self, success, info):
         if success:
@@ -209,7 +279,7 @@ class BOBReceiver(object):
             self.sender.sendGetdest()
             self.currentRule = 'State_getdest'
         else:
-            print('setkeys ERROR: %s' % info)
+            self._fail('setkeys', info)
 
     def newkeys(self, success, info):
         if success:
@@ -219,13 +289,19 @@ class BOBReceiver(object):
             self.sender.sendGetkeys()
             self.currentRule = 'State_getkeys'
         else:
-            print('newkeys ERROR: %s' % info)
+            self._fail('newkeys', info)
 
     def quit(self, success, info):
         pass
 
 
 class I2PClientTunnelCreatorBOBReceiver(BOBReceiver):
+    def canReuse(self, tunnel):
+        return tunnel['inport'] is not None
+
+    def choosePorts(self, tunnels):
+        self._allocatePort('inport', tunnels)
+
     def list(self, success, info, data):
         if success:
             self.processTunnelList(data)
@@ -237,20 +313,23 @@ class I2PClientTunnelCreatorBOBReceiver(BOBReceiver):
                 self.sender.sendSetnick(self.factory.tunnelNick)
                 self.currentRule = 'State_setnick'
         else:
-            print('list ERROR: %s' % info)
+            self._fail('list', info)
 
     def getdest(self, success, info):
         if success:
             # Save the local Destination
             self.factory.localDest = info
-            if self.tunnelExists:
+            if self.reuseTunnel:
+                tunnelManager.reused(self.factory.tunnelNick)
+                self._tunnelReady()
+            elif self.tunnelExists:
                 # Get the keypair
                 self.sender.sendGetkeys()
                 self.currentRule = 'State_getkeys'
             else:
                 self._setInhost()
         else:
-            print('getdest ERROR: %s' % info)
+            self._fail('getdest', info)
 
     def getkeys(self, success, info):
         if success:
@@ -258,7 +337,7 @@ class I2PClientTunnelCreatorBOBReceiver(BOBReceiver):
             self.factory.keypair = info
             self._setInhost()
         else:
-            print('getkeys ERROR: %s' % info)
+            self._fail('getkeys', info)
 
     def _setInhost(self):
         self.sender.sendInhost(self.factory.inhost)
@@ -274,26 +353,33 @@ class I2PClientTunnelCreatorBOBReceiver(BOBReceiver):
                 # Try again. TODO: Limit retries
                 self.sender.sendInhost(self.factory.inhost)
             else:
-                print('inhost ERROR: %s' % info)
+                self._fail('inhost', info)
 
     def inport(self, success, info):
         if success:
             self.sender.sendStart()
             self.currentRule = 'State_start'
         else:
-            print('inport ERROR: %s' % info)
+            self._fail('inport', info)
 
     def start(self, success, info):
         if success:
             print("Client tunnel started")
-            self.factory.i2pTunnelCreated()
-            self.sender.sendQuit()
-            self.currentRule = 'State_quit'
+            tunnelManager.started(self.factory.tunnelNick)
+            self._tunnelReady()
         else:
-            print('start ERROR: %s' % info)
+            self._fail('start', info)
+
+    def _tunnelReady(self):
+        self.factory.i2pTunnelCreated()
+        self.sender.sendQuit()
+        self.currentRule = 'State_quit'
 
 
 class I2PServerTunnelCreatorBOBReceiver(BOBReceiver):
+    def canReuse(self, tunnel):
+        return tunnel['outport'] is not None
+
     def list(self, success, info, data):
         if success:
             self.processTunnelList(data)
@@ -305,15 +391,19 @@ class I2PServerTunnelCreatorBOBReceiver(BOBReceiver):
                 self.sender.sendSetnick(self.factory.tunnelNick)
                 self.currentRule = 'State_setnick'
         else:
-            print('list ERROR: %s' % info)
+            self._fail('list', info)
 
     def getdest(self, success, info):
         if success:
             # Save the local Destination
             self.factory.localDest = info
-            self._setOuthost()
+            if self.reuseTunnel:
+                tunnelManager.reused(self.factory.tunnelNick)
+                self._tunnelReady()
+            else:
+                self._setOuthost()
         else:
-            print('getdest ERROR: %s' % info)
+            self._fail('getdest', info)
 
     def getkeys(self, success, info):
         if success:
@@ -321,7 +411,7 @@ class I2PServerTunnelCreatorBOBReceiver(BOBReceiver):
             self.factory.keypair = info
             self._setOuthost()
         else:
-            print('getkeys ERROR: %s' % info)
+            self._fail('getkeys', info)
 
     def _setOuthost(self):
         self.sender.sendOuthost(self.factory.outhost)
@@ -329,45 +419,77 @@ class I2PServerTunnelCreatorBOBReceiver(BOBReceiver):
 
     def outhost(self, success, info):
         if success:
-            self.sender.sendOutport(self.factory.outport)
-            self.currentRule = 'State_outport'
+            if getattr(self.factory, 'outport', None):
+                self._setOutport(self.factory.outport)
+            else:
+                # Listen first, so that BOB forwards to a port that is ours
+                d = self.factory.listenLocally()
+                d.addCallbacks(self._setOutport, self._notListening)
         else:
             if info in ['tunnel is active',
                         'tunnel shutting down']:
                 # Try again. TODO: Limit retries
                 self.sender.sendOuthost(self.factory.outhost)
             else:
-                print('outhost ERROR: %s' % info)
+                self._fail('outhost', info)
+
+    def _setOutport(self, outport):
+        self.factory.outport = outport
+        self.sender.sendOutport(outport)
+        self.currentRule = 'State_outport'
+
+    def _notListening(self, reason):
+        # Give up on the tunnel, and end the connection to BOB
+        print('outport ERROR: %s' % reason.getErrorMessage())
+        self.factory.bobConnectionFailed(reason)
+        self.sender.sendQuit()
+        self.currentRule = 'State_quit'
 
     def outport(self, success, info):
         if success:
             self.sender.sendStart()
             self.currentRule = 'State_start'
         else:
-            print('outport ERROR: %s' % info)
+            self._fail('outport', info)
 
     def start(self, success, info):
         if success:
             print("Server tunnel started")
-            self.factory.i2pTunnelCreated()
-            self.sender.sendQuit()
-            self.currentRule = 'State_quit'
+            tunnelManager.started(self.factory.tunnelNick)
+            self._tunnelReady()
         else:
-            print('start ERROR: %s' % info)
+            self._fail('start', info)
+
+    def _tunnelReady(self):
+        self.factory.i2pTunnelCreated()
+        self.sender.sendQuit()
+        self.currentRule = 'State_quit'
 
 class I2PTunnelRemoverBOBReceiver(BOBReceiver):
+    """Removes each of ``factory.tunnelNicks`` in turn."""
+    clearRetries = 0
+
     def list(self, success, info, data):
         if success:
-            self.processTunnelList(data)
-            if self.tunnelExists:
-                # Get tunnel for nickname
-                self.sender.sendGetnick(self.factory.tunnelNick)
-                self.currentRule = 'State_getnick'
-            else:
-                # Tunnel already removed
-                pass
+            tunnelManager.listed(data)
+            existing = set(tunnel['nickname'] for tunnel in data)
+            # Tunnels that aren't listed are already removed
+            self.toRemove = [tunnelNick for tunnelNick in self.factory.tunnelNicks
+                             if tunnelNick in existing]
+            self._removeNext()
+        else:
+            self._fail('list', info)
+
+    def _removeNext(self):
+        if self.toRemove:
+            # Get tunnel for nickname
+            self.tunnelNick = self.toRemove.pop(0)
+            self.sender.sendGetnick(self.tunnelNick)
+            self.currentRule = 'State_getnick'
         else:
-            print('list ERROR: %s' % info)
+            self.factory.i2pTunnelsRemoved()
+            self.sender.sendQuit()
+            self.currentRule = 'State_quit'
 
     def getnick(self, success, info):
         if success:
@@ -375,44 +497,74 @@ class I2PTunnelRemoverBOBReceiver(BOBReceiver):
             self.currentRule = 'State_stop'
         else:
             print('getnick ERROR: %s' % info)
+            self._removeNext()
 
     def stop(self, success, info):
-        if success:
+        if success or info == 'tunnel not active':
+            self.clearRetries = 0
             self.sender.sendClear()
             self.currentRule = 'State_clear'
         else:
             print('stop ERROR: %s' % info)
+            self._removeNext()
 
     def clear(self, success, info):
         if success:
             print('Tunnel removed')
-            self.factory.i2pTunnelRemoved()
-            self.sender.sendQuit()
-            self.currentRule = 'State_quit'
+            tunnelManager.removed(self.tunnelNick)
+            self.factory.i2pTunnelRemoved(self.tunnelNick)
+            self._removeNext()
         else:
             if info in ['tunnel is active',
-                        'tunnel shutting down']:
-                # Try again. TODO: Limit retries
+                        'tunnel shutting down'] and \
+                    self.clearRetries < MAX_CLEAR_RETRIES:
+                # Try again
+                self.clearRetries += 1
                 self.sender.sendClear()
             else:
                 print('clear ERROR: %s ' % info)
+                self._removeNext()
+
+
+class BOBParserProtocol(ParserProtocol):
+    # Set to True to parse BOB replies with txi2p.bob.parser.BOBLineParser
+    # instead of interpreting the OMeta grammar.
+    useLineParser = False
+
+    def connectionMade(self):
+        if not self.useLineParser:
+            ParserProtocol.connectionMade(self)
+            return
+        self.sender = self._senderFactory(self.transport)
+        self.receiver = self._receiverFactory(self.sender)
+        self.receiver.prepareParsing(self)
+        self._parser = BOBLineParser(self.receiver)
+
+    def dataReceived(self, data):
+        # Parsley expects a str but Twisted provides a bytes.
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        ParserProtocol.dataReceived(self, data)
+
+
+def makeBOBProtocol(senderFactory, receiverFactory):
+    g = grammar.parseGrammar(grammar.bobGrammarSource)
+    return functools.partial(
+        BOBParserProtocol, g, senderFactory, receiverFactory, {})
 
 
 # A Protocol for making an I2P client tunnel via BOB
-I2PClientTunnelCreatorBOBClient = makeProtocol(
-    grammar.bobGrammarSource,
+I2PClientTunnelCreatorBOBClient = makeBOBProtocol(
     BOBSender,
     I2PClientTunnelCreatorBOBReceiver)
 
 # A Protocol for making an I2P server tunnel via BOB
-I2PServerTunnelCreatorBOBClient = makeProtocol(
-    grammar.bobGrammarSource,
+I2PServerTunnelCreatorBOBClient = makeBOBProtocol(
     BOBSender,
     I2PServerTunnelCreatorBOBReceiver)
 
 # A Protocol for removing a BOB I2P tunnel
-I2PTunnelRemoverBOBClient = makeProtocol(
-    grammar.bobGrammarSource,
+I2PTunnelRemoverBOBClient = makeBOBProtocol(
     BOBSender,
     I2PTunnelRemoverBOBReceiver)
 
@@ -467,7 +619,7 @@ class I2PListeningPort(object):
         self._wrappedPort.startListening()
 
     def stopListening(self):
-        self._factoryWrapper.stopListening(self._wrappedPort)
+        return self._factoryWrapper.stopListening(self._wrappedPort)
 
     def getHost(self):
         return self._serverAddr
@@ -0,0 +1,182 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.protocol import Factory, Protocol
+from twisted.trial import unittest
+
+from txi2p.bob import control
+from txi2p.bob.control import BOBControlChannel, BOBError, controlChannel
+from txi2p.bob.endpoints import BOBI2PClientEndpoint
+from txi2p.bob.factory import BOBI2PTunnelRemoverFactory
+from txi2p.bob.tunnels import tunnelManager
+from txi2p.sam.test.util import waitFor
+from txi2p.test.util import TEST_B64
+
+from .util import FakeBOBBridge
+
+
+class RecordingProtocol(Protocol):
+    def __init__(self):
+        self.lost = []
+
+    def connectionLost(self, reason):
+        self.lost.append(reason)
+
+
+class BOBControlChannelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeBOBBridge()
+        self.port = reactor.listenTCP(0, self.bridge, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.bobEndpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.port.getHost().port)
+        self.channel = BOBControlChannel(self.bobEndpoint)
+        self.addCleanup(setattr, tunnelManager, 'tunnels', {})
+        self.addCleanup(setattr, tunnelManager, '_users', {})
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.channel.close()
+        yield waitFor(lambda: not self.bridge.connections)
+
+    @defer.inlineCallbacks
+    def test_typedCommands(self):
+        tunnels = yield self.channel.list()
+        self.assertEqual([], tunnels)
+        info = yield self.channel.setnick('spam')
+        self.assertEqual('Nickname set to spam', info)
+        yield self.channel.inport(9000)
+        tunnels = yield self.channel.list()
+        self.assertEqual(['spam'], [t['nickname'] for t in tunnels])
+        self.assertEqual(9000, tunnels[0]['inport'])
+        status = yield self.channel.status('spam')
+        self.assertEqual('spam', status['nickname'])
+        self.assertFalse(status['running'])
+        dest = yield self.channel.getdest()
+        self.assertEqual(TEST_B64, dest)
+        self.assertEqual(1, self.channel.connections)
+        self.assertEqual(6, self.channel.commands)
+
+    def test_errorReply(self):
+        d = self.channel.getnick('spam')
+        d = self.assertFailure(d, BOBError)
+        d.addCallback(lambda e: self.assertEqual('Nickname not found', str(e)))
+        return d
+
+    @defer.inlineCallbacks
+    def test_pipelinedTransaction(self):
+        def create(transaction):
+            return defer.gatherResults([
+                transaction.setnick('spam'),
+                transaction.inhost('localhost'),
+                transaction.inport(9000),
+                transaction.start(),
+            ])
+        results = yield self.channel.run(create)
+        self.assertEqual(
+            ['Nickname set to spam', 'inhost set', 'inport set',
+             'tunnel starting'],
+            results)
+        self.assertTrue(self.bridge.tunnels['spam']['running'])
+
+    @defer.inlineCallbacks
+    def test_transactionsDoNotInterleave(self):
+        self.bridge.tunnels['eggs'] = {'nickname': 'eggs', 'running': True}
+        def stop(transaction, tunnelNick):
+            d = transaction.getnick(tunnelNick)
+            d.addCallback(lambda _: transaction.stop())
+            return d
+        # Each stop selects its own tunnel first.
+        yield defer.gatherResults([
+            self.channel.run(lambda t: t.setnick('spam').addCallback(
+                lambda _: t.start())),
+            self.channel.run(stop, 'eggs'),
+            self.channel.run(stop, 'spam'),
+        ])
+        self.assertFalse(self.bridge.tunnels['eggs']['running'])
+        self.assertFalse(self.bridge.tunnels['spam']['running'])
+        self.assertEqual(1, self.channel.connections)
+
+    @defer.inlineCallbacks
+    def test_reconnectsAfterConnectionLost(self):
+        yield self.channel.list()
+        self.bridge.disconnectAll()
+        yield waitFor(lambda: self.channel._receiver is None)
+        yield self.channel.list()
+        self.assertEqual(2, self.channel.connections)
+        self.assertEqual(1, len(self.bridge.connections))
+
+    def test_connectionRefused(self):
+        self.port.stopListening()
+        d = self.channel.list()
+        return self.assertFailure(d, ConnectionRefusedError)
+
+    @defer.inlineCallbacks
+    def test_clientEndpointsShareConnection(self):
+        # Stands in for the client tunnel that BOB would listen with
+        tunnelPort = reactor.listenTCP(
+            0, Factory.forProtocol(Protocol), interface='127.0.0.1')
+        self.addCleanup(tunnelPort.stopListening)
+        endpoint = BOBI2PClientEndpoint(
+            reactor, self.channel, 'spam.i2p', tunnelNick='spam',
+            inhost='127.0.0.1', inport=tunnelPort.getHost().port,
+            lingerTime=0)
+        fac = Factory.forProtocol(RecordingProtocol)
+        setups = tunnelManager.setups
+        first = yield endpoint.connect(fac)
+        second = yield endpoint.connect(fac)
+        self.assertTrue(self.bridge.tunnels['spam']['running'])
+        self.assertEqual(setups + 1, tunnelManager.setups)
+        self.assertEqual(1, self.channel.connections)
+        self.assertNotIn('quit', self.bridge.commands)
+
+        # The tunnel is kept while the second connection uses it.
+        first.transport.loseConnection()
+        yield waitFor(lambda: first.wrappedProto.lost)
+        self.assertIn('spam', self.bridge.tunnels)
+        # Removing the tunnel goes over the same connection.
+        second.transport.loseConnection()
+        yield waitFor(lambda: 'spam' not in self.bridge.tunnels)
+        self.assertEqual(1, self.channel.connections)
+
+    def test_failedCommandFailsCreation(self):
+        self.bridge.failures['start'] = 'tunnel failed'
+        endpoint = BOBI2PClientEndpoint(
+            reactor, self.channel, 'spam.i2p', tunnelNick='spam',
+            inhost='127.0.0.1', inport=9000)
+        d = endpoint.connect(Factory.forProtocol(Protocol))
+        d = self.assertFailure(d, BOBError)
+        # The channel is free again.
+        d.addCallback(lambda _: self.channel.status('spam'))
+        d.addCallback(lambda status: self.assertFalse(status['running']))
+        return d
+
+    @defer.inlineCallbacks
+    def test_batchRemoval(self):
+        for tunnelNick in ['eggs', 'spam']:
+            self.bridge.tunnels[tunnelNick] = {
+                'nickname': tunnelNick, 'running': True}
+        fac = BOBI2PTunnelRemoverFactory(['eggs', 'ham', 'spam'])
+        yield self.channel.connect(fac)
+        removed = yield fac.deferred
+        self.assertEqual(['eggs', 'spam'], removed)
+        self.assertEqual({}, self.bridge.tunnels)
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        yield self.channel.list()
+        yield self.channel.close()
+        self.assertEqual('quit', self.bridge.commands[-1])
+        yield waitFor(lambda: not self.bridge.connections)
+
+
+class ControlChannelTestCase(unittest.TestCase):
+    def test_sharedPerEndpoint(self):
+        self.addCleanup(control._channels.clear)
+        endpoint = object()
+        channel = controlChannel(endpoint)
+        self.assertIs(channel, controlChannel(endpoint))
+        self.assertIsNot(channel, controlChannel(object()))
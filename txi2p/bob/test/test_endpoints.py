@@ -1,11 +1,14 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+from twisted.internet import defer
 from twisted.internet.error import ConnectionLost, ConnectionRefusedError
 from twisted.python import failure
 from twisted.trial import unittest
 
 from txi2p.bob import endpoints
+from txi2p.bob.protocol import BOBError, defaultTunnelNick
+from txi2p.bob.tunnels import tunnelManager
 from txi2p.test.util import FakeEndpoint, FakeFactory
 
 
@@ -44,3 +47,94 @@ class BOBI2PClientEndpointTestCase(unittest.TestCase):
         bobEndpoint.proto.transport.clear()
         wrappedFac.proto.transport.write('xxxxx')
         self.assertEqual(bobEndpoint.proto.transport.value(), 'xxxxx')
+
+
+class PendingEndpoint(object):
+    """Hands each connecting factory a BOB connection that is yet to
+    reply."""
+
+    def __init__(self):
+        self.factories = []
+
+    def connect(self, fac):
+        self.factories.append(fac)
+        return defer.succeed(None)
+
+
+class TunnelSerializationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, tunnelManager, '_users', {})
+
+    def test_concurrentConnectsWait(self):
+        bobEndpoint = PendingEndpoint()
+        endpoint = endpoints.BOBI2PClientEndpoint(None, bobEndpoint, 'foo.i2p',
+                                                  tunnelNick='spam')
+        d1 = endpoint.connect(None)
+        d2 = endpoint.connect(None)
+        self.assertTrue(tunnelManager.busy('spam'))
+        self.assertEqual(1, len(bobEndpoint.factories))
+        bobEndpoint.factories[0].setupFinished.callback(None)
+        # The second waited for the first to set the tunnel up, but not to
+        # connect over it
+        self.assertEqual(2, len(bobEndpoint.factories))
+        self.assertNoResult(d1)
+        bobEndpoint.factories[0].deferred.callback('proto1')
+        self.assertEqual('proto1', self.successResultOf(d1))
+        self.assertNoResult(d2)
+        bobEndpoint.factories[1].setupFinished.callback(None)
+        bobEndpoint.factories[1].deferred.callback('proto2')
+        self.assertEqual('proto2', self.successResultOf(d2))
+        self.assertFalse(tunnelManager.busy('spam'))
+
+    def test_failureReleasesTunnel(self):
+        bobEndpoint = PendingEndpoint()
+        endpoint = endpoints.BOBI2PServerEndpoint(None, bobEndpoint, '',
+                                                  tunnelNick='spam')
+        d1 = endpoint.listen(None)
+        d2 = endpoint.listen(None)
+        bobEndpoint.factories[0].bobConnectionFailed(
+            failure.Failure(ConnectionLost()))
+        self.failureResultOf(d1, ConnectionLost)
+        self.assertEqual(2, len(bobEndpoint.factories))
+        bobEndpoint.factories[1].setupFinished.callback(None)
+        bobEndpoint.factories[1].deferred.callback('port')
+        self.assertEqual('port', self.successResultOf(d2))
+
+    def test_failedSetupDoesNotBlockOthers(self):
+        bobEndpoint = PendingEndpoint()
+        first = endpoints.BOBI2PClientEndpoint(None, bobEndpoint, 'foo.i2p')
+        second = endpoints.BOBI2PClientEndpoint(None, bobEndpoint, 'bar.i2p')
+        d1 = first.connect(None)
+        d2 = second.connect(None)
+        self.assertEqual(1, len(bobEndpoint.factories))
+        bobEndpoint.factories[0].bobConnectionFailed(
+            failure.Failure(BOBError('tunnel failed')))
+        self.failureResultOf(d1, BOBError)
+        # The second setup goes ahead
+        self.assertEqual(2, len(bobEndpoint.factories))
+        bobEndpoint.factories[1].setupFinished.callback(None)
+        bobEndpoint.factories[1].deferred.callback('proto')
+        self.assertEqual('proto', self.successResultOf(d2))
+
+    def test_connectCountsUser(self):
+        bobEndpoint = PendingEndpoint()
+        endpoint = endpoints.BOBI2PClientEndpoint(None, bobEndpoint, 'foo.i2p',
+                                                  tunnelNick='spam')
+        d = endpoint.connect(None)
+        self.assertTrue(tunnelManager.inUse('spam'))
+        bobEndpoint.factories[0].bobConnectionFailed(
+            failure.Failure(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+        self.assertFalse(tunnelManager.inUse('spam'))
+
+    def test_defaultNicksShareTunnel(self):
+        bobEndpoint = PendingEndpoint()
+        client = endpoints.BOBI2PClientEndpoint(None, bobEndpoint, 'foo.i2p')
+        server = endpoints.BOBI2PServerEndpoint(None, bobEndpoint, '')
+        client.connect(None)
+        server.listen(None)
+        self.assertEqual(1, len(bobEndpoint.factories))
+        self.assertEqual(defaultTunnelNick(), bobEndpoint.factories[0].tunnelNick)
+        bobEndpoint.factories[0].setupFinished.callback(None)
+        self.assertEqual(2, len(bobEndpoint.factories))
+        bobEndpoint.factories[1].setupFinished.callback(None)
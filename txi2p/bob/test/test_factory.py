@@ -2,7 +2,7 @@
 # See COPYING for details.
 
 from builtins import object
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.internet.error import ConnectionLost, ConnectionRefusedError
 from twisted.python import failure
 from twisted.test import proto_helpers
@@ -11,7 +11,12 @@ from twisted.trial import unittest
 from txi2p.bob.factory import (BOBI2PClientFactory,
                                BOBI2PServerFactory,
                                BOBClientFactoryWrapper,
-                               BOBServerFactoryWrapper)
+                               BOBServerFactoryWrapper,
+                               BOBTunnelReaper,
+                               SHUTDOWN_REMOVAL_TIMEOUT,
+                               tunnelReaper)
+from txi2p.bob.tunnels import tunnelManager
+from txi2p.keystore import keyStore
 from txi2p.test.util import FakeFactory
 
 connectionLostFailure = failure.Failure(ConnectionLost())
@@ -80,6 +85,53 @@ class TestBOBI2PClientFactory(BOBFactoryTestMixin, unittest.TestCase):
 class TestBOBI2PServerFactory(BOBFactoryTestMixin, unittest.TestCase):
     factory = BOBI2PServerFactory
 
+    def test_unreadableKeyfile(self):
+        self.patch(keyStore, 'load',
+                   lambda path, reactor: defer.fail(ValueError('bad keyfile')))
+        fac, proto = self.makeProto(None, None, None, '/tmp/spam.keys')
+        fac.doStart()
+        self.assertFailure(fac.deferred, ValueError)
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        # BOB is not asked to set up the tunnel
+        self.assertEqual(b'quit\n', proto.transport.value())
+        return fac.deferred
+
+    def makeListener(self):
+        mreactor = proto_helpers.MemoryReactor()
+        fac, proto = self.makeProto(mreactor, FakeFactory(), None, '', 'spam')
+        fac.localDest = 'spam.i2p'
+        return mreactor, fac
+
+    def test_listenLocallyOnFreePort(self):
+        mreactor, fac = self.makeListener()
+        self.successResultOf(fac.listenLocally())
+        self.assertEqual(0, mreactor.tcpServers[0][0])
+
+    def test_tunnelUsesLocalListener(self):
+        mreactor, fac = self.makeListener()
+        self.successResultOf(fac.listenLocally())
+        fac.i2pTunnelCreated()
+        port = self.successResultOf(fac.deferred)
+        # BOB forwards to the port that was already listened on
+        self.assertEqual(1, len(mreactor.tcpServers))
+        self.assertEqual(fac._localPort, port._wrappedPort)
+
+    def test_tunnelListensOnOutport(self):
+        mreactor, fac = self.makeListener()
+        fac.outport = 1234
+        fac.i2pTunnelCreated()
+        self.successResultOf(fac.deferred)
+        self.assertEqual(1234, mreactor.tcpServers[0][0])
+
+    def test_localListenerStoppedOnFailure(self):
+        mreactor, fac = self.makeListener()
+        self.successResultOf(fac.listenLocally())
+        stopped = []
+        fac._localPort.stopListening = lambda: stopped.append(True)
+        fac.bobConnectionFailed(connectionLostFailure)
+        self.failureResultOf(fac.deferred, ConnectionLost)
+        self.assertEqual([True], stopped)
+
     def TODO_test_noProtocolFromWrappedFactory(self):
         wrappedFac = FakeFactory(returnNoProtocol=True)
         mreactor = proto_helpers.MemoryReactor()
@@ -94,18 +146,211 @@ class TestBOBI2PServerFactory(BOBFactoryTestMixin, unittest.TestCase):
         return self.assertFailure(fac.deferred, defer.CancelledError)
 
 
-class TestBOBClientFactoryWrapper(unittest.TestCase):
+class RecordingEndpoint(object):
+    def __init__(self):
+        self.factories = []
+
+    def connect(self, fac):
+        # Removes the tunnels straight away
+        self.factories.append(fac)
+        fac.i2pTunnelsRemoved()
+        return defer.succeed(None)
+
+
+class StallingEndpoint(object):
+    """Hands each connecting factory a BOB connection that never replies."""
+
+    def __init__(self):
+        self.factories = []
+        self.aborted = []
+
+    def connect(self, fac):
+        self.factories.append(fac)
+        proto = fac.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto.sender.transport.abortConnection = \
+            lambda: self.aborted.append(fac)
+        return defer.succeed(proto)
+
+
+class ReaperTestMixin(object):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bobEndpoint = RecordingEndpoint()
+        self.addCleanup(setattr, tunnelManager, '_users', {})
+        self.addCleanup(setattr, tunnelManager, '_owned', set())
+
+    def removed(self):
+        return [fac.tunnelNicks for fac in self.bobEndpoint.factories]
+
+
+class TestBOBClientFactoryWrapper(ReaperTestMixin, unittest.TestCase):
     def test_buildProtocol(self):
         wrappedFac = FakeFactory()
-        fac = BOBClientFactoryWrapper(wrappedFac, None, None, '', True)
+        fac = BOBClientFactoryWrapper(wrappedFac, None, None, '')
         fac.setDest('spam.i2p')
         proto = fac.buildProtocol(None)
         self.assertEqual(proto.wrappedProto.factory, wrappedFac)
 
+    def test_connectionLostNotifiesBeforeRemoval(self):
+        self.patch(tunnelReaper, '_due', {})
+        self.patch(tunnelReaper, '_timers', {})
+        tunnelManager.own('spam')
+        tunnelReaper.acquire('spam')
+        fac = BOBClientFactoryWrapper(FakeFactory(), self.bobEndpoint, None,
+                                      'spam', self.clock, 5)
+        lost = []
+        wrappedProto = FakeFactory().buildProtocol(None)
+        wrappedProto.connectionLost = lost.append
+        fac.i2pConnectionLost(wrappedProto, 'reason')
+        self.assertEqual(['reason'], lost)
+        self.assertEqual([], self.removed())
+        self.clock.advance(5)
+        self.assertEqual([['spam']], self.removed())
+
 
-class TestBOBServerFactoryWrapper(unittest.TestCase):
+class TestBOBServerFactoryWrapper(ReaperTestMixin, unittest.TestCase):
     def test_buildProtocol(self):
         wrappedFac = FakeFactory()
-        fac = BOBServerFactoryWrapper(wrappedFac, None, None, '', True)
+        fac = BOBServerFactoryWrapper(wrappedFac, None, None, '')
         proto = fac.buildProtocol(None)
         self.assertEqual(proto.wrappedProto.factory, wrappedFac)
+
+    def test_stopListeningBeforeRemoval(self):
+        self.patch(tunnelReaper, '_due', {})
+        self.patch(tunnelReaper, '_timers', {})
+        tunnelManager.own('spam')
+        tunnelReaper.acquire('spam')
+        fac = BOBServerFactoryWrapper(FakeFactory(), self.bobEndpoint, None,
+                                      'spam', self.clock, 5)
+        stopped = []
+        class FakePort(object):
+            def stopListening(self):
+                stopped.append(True)
+                return defer.succeed(None)
+        self.successResultOf(fac.stopListening(FakePort()))
+        self.assertEqual([True], stopped)
+        self.assertEqual([], self.removed())
+        self.clock.advance(5)
+        self.assertEqual([['spam']], self.removed())
+
+
+class TestBOBTunnelReaper(ReaperTestMixin, unittest.TestCase):
+    def setUp(self):
+        ReaperTestMixin.setUp(self)
+        self.reaper = BOBTunnelReaper()
+
+    def use(self, *tunnelNicks):
+        for tunnelNick in tunnelNicks:
+            tunnelManager.own(tunnelNick)
+            self.reaper.acquire(tunnelNick)
+
+    def release(self, tunnelNick, lingerTime=5):
+        self.reaper.release(tunnelNick, self.bobEndpoint, self.clock, lingerTime)
+
+    def test_removedAfterLinger(self):
+        self.use('spam')
+        self.release('spam')
+        self.clock.advance(4)
+        self.assertEqual([], self.removed())
+        self.clock.advance(1)
+        self.assertEqual([['spam']], self.removed())
+        self.assertEqual(1, self.reaper.batches)
+
+    def test_keptWhileInUse(self):
+        self.use('spam', 'spam')
+        self.release('spam')
+        self.clock.advance(10)
+        self.assertEqual([], self.removed())
+        self.release('spam')
+        self.clock.advance(5)
+        self.assertEqual([['spam']], self.removed())
+
+    def test_reuseCancelsRemoval(self):
+        self.use('spam')
+        self.release('spam')
+        self.clock.advance(3)
+        self.reaper.acquire('spam')
+        self.clock.advance(10)
+        self.assertEqual([], self.removed())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_notOwnedNotRemoved(self):
+        self.reaper.acquire('spam')
+        self.release('spam')
+        self.clock.advance(10)
+        self.assertEqual([], self.removed())
+
+    def test_removalsDueTogetherBatched(self):
+        self.use('spam', 'eggs', 'ham')
+        self.release('spam')
+        self.clock.advance(0.5)
+        self.release('eggs')
+        self.clock.advance(3)
+        self.release('ham')
+        self.clock.advance(1.5)
+        self.assertEqual([['eggs', 'spam']], self.removed())
+        self.clock.advance(5)
+        self.assertEqual([['eggs', 'spam'], ['ham']], self.removed())
+        self.assertEqual(2, self.reaper.batches)
+
+    def test_batchedPerEndpoint(self):
+        self.use('spam', 'eggs')
+        other = RecordingEndpoint()
+        self.release('spam')
+        self.reaper.release('eggs', other, self.clock, 5)
+        self.clock.advance(5)
+        self.assertEqual([['spam']], self.removed())
+        self.assertEqual(['eggs'], other.factories[0].tunnelNicks)
+
+    def test_zeroLinger(self):
+        self.use('spam')
+        self.release('spam', 0)
+        self.assertEqual([], self.removed())
+        self.clock.advance(0)
+        self.assertEqual([['spam']], self.removed())
+
+    def test_flushRemovesEverythingWaiting(self):
+        self.use('spam', 'eggs')
+        self.release('spam')
+        self.release('eggs', 60)
+        self.reaper.flush(self.clock, float('inf'))
+        self.assertEqual([['eggs', 'spam']], self.removed())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_waitsForCreator(self):
+        self.use('spam')
+        self.release('spam')
+        creating = defer.Deferred()
+        tunnelManager.run('spam', lambda: creating)
+        self.clock.advance(5)
+        self.assertEqual([], self.removed())
+        creating.callback(None)
+        self.assertEqual([['spam']], self.removed())
+
+    def test_stalledRemovalGivenUp(self):
+        bobEndpoint = StallingEndpoint()
+        self.use('spam')
+        self.reaper.release('spam', bobEndpoint, self.clock, 0)
+        d = self.reaper.flush(self.clock, 0, timeout=30)
+        self.assertNoResult(d)
+        self.assertTrue(tunnelManager.busy('spam'))
+        self.clock.advance(30)
+        self.successResultOf(d)
+        self.assertEqual(bobEndpoint.factories, bobEndpoint.aborted)
+        # Creators of the tunnel can run again
+        self.assertFalse(tunnelManager.busy('spam'))
+
+    def test_shutdownFlushBounded(self):
+        triggers = []
+        self.clock.addSystemEventTrigger = \
+            lambda *args: triggers.append(args)
+        bobEndpoint = StallingEndpoint()
+        self.use('spam')
+        self.reaper.release('spam', bobEndpoint, self.clock, 60)
+        phase, event, f = triggers[0][:3]
+        self.assertEqual(('before', 'shutdown'), (phase, event))
+        d = f(*triggers[0][3:])
+        self.assertNoResult(d)
+        self.clock.advance(SHUTDOWN_REMOVAL_TIMEOUT)
+        self.successResultOf(d)
@@ -0,0 +1,198 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+import operator
+try:
+    # Python 3
+    from unittest.mock import Mock
+except:
+    # Python 2 (library)
+    from mock import Mock
+from twisted.internet.protocol import ClientFactory
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txi2p.bob import protocol
+from txi2p.bob.parser import BOBLineParser, BOBParseError, TunnelStatus
+from txi2p.bob.ports import portAllocator
+from txi2p.bob.test import test_control, test_protocol
+from txi2p.bob.tunnels import tunnelManager
+
+from .util import tunnelStatus
+
+STATUS = ('NICKNAME: spam STARTING: false RUNNING: true STOPPING: false '
+          'KEYS: true QUIET: false INPORT: 1234 INHOST: localhost '
+          'OUTPORT: not_set OUTHOST: localhost')
+
+
+class TestTunnelStatus(unittest.TestCase):
+    def test_fromLine(self):
+        status = TunnelStatus.fromLine(STATUS)
+        self.assertEqual({
+            'nickname': 'spam',
+            'starting': False,
+            'running': True,
+            'stopping': False,
+            'keys': True,
+            'quiet': False,
+            'inport': 1234,
+            'inhost': 'localhost',
+            'outport': None,
+            'outhost': 'localhost',
+        }, status)
+
+    def test_readOnly(self):
+        status = TunnelStatus.fromLine(STATUS)
+        self.assertRaises(TypeError, operator.setitem, status, 'running', False)
+        self.assertRaises(KeyError, status.__getitem__, 'options')
+        self.assertIsNone(status.get('options'))
+
+    def test_invalid(self):
+        self.assertRaises(BOBParseError, TunnelStatus.fromLine,
+                          STATUS.replace('INPORT: 1234', 'INPORT: spam'))
+
+
+class TestBOBLineParser(unittest.TestCase):
+    def makeParser(self, rule):
+        receiver = Mock()
+        receiver.currentRule = rule
+        return receiver, BOBLineParser(receiver)
+
+    def test_init(self):
+        receiver, parser = self.makeParser('State_init')
+        parser.receive('BOB 00.00.10\n')
+        self.assertFalse(receiver.initBOB.called)
+        parser.receive('OK\n')
+        receiver.initBOB.assert_called_with('00.00.10')
+
+    def test_reply(self):
+        receiver, parser = self.makeParser('State_setnick')
+        parser.receive('OK Nickname set to spam\n')
+        receiver.setnick.assert_called_with(True, 'Nickname set to spam')
+
+    def test_error(self):
+        receiver, parser = self.makeParser('State_getnick')
+        parser.receive('ERROR Nickname not found\n')
+        receiver.getnick.assert_called_with(False, 'Nickname not found')
+
+    def test_partialLines(self):
+        receiver, parser = self.makeParser('State_start')
+        parser.receive('OK tunnel ')
+        self.assertFalse(receiver.start.called)
+        parser.receive('starting\n')
+        receiver.start.assert_called_with(True, 'tunnel starting')
+
+    def test_invalidKey(self):
+        receiver, parser = self.makeParser('State_getdest')
+        self.assertRaises(BOBParseError, parser.receive, 'OK spam eggs\n')
+
+    def test_list(self):
+        receiver, parser = self.makeParser('State_list')
+        parser.receive('DATA %s\nDATA %s' % (
+            STATUS, STATUS.replace('spam', 'eggs')))
+        self.assertFalse(receiver.list.called)
+        parser.receive('\nOK Listing done\n')
+        success, info, tunnels = receiver.list.call_args[0]
+        self.assertEqual((True, 'Listing done'), (success, info))
+        self.assertEqual(['spam', 'eggs'], [t['nickname'] for t in tunnels])
+
+    def test_listError(self):
+        receiver, parser = self.makeParser('State_list')
+        parser.receive('ERROR spam\n')
+        receiver.list.assert_called_with(False, 'spam', [])
+
+    def test_status(self):
+        receiver, parser = self.makeParser('State_status')
+        parser.receive('OK DATA %s\n' % STATUS)
+        success, info, status = receiver.status.call_args[0]
+        self.assertEqual((True, '', 'spam'), (success, info, status['nickname']))
+
+    def test_statusError(self):
+        receiver, parser = self.makeParser('State_status')
+        parser.receive('ERROR Nickname not found\n')
+        receiver.status.assert_called_with(False, 'Nickname not found', {})
+
+    def test_show(self):
+        receiver, parser = self.makeParser('State_show')
+        parser.receive('OK %s\n' % STATUS)
+        self.assertEqual(1234, receiver.show.call_args[0][2]['inport'])
+
+    def test_unexpectedReply(self):
+        receiver, parser = self.makeParser('State_setnick')
+        self.assertRaises(BOBParseError, parser.receive, 'DATA spam\n')
+
+    def test_unknownState(self):
+        receiver, parser = self.makeParser('State_spam')
+        self.assertRaises(BOBParseError, parser.receive, 'OK\n')
+
+    def test_rulesChangedByReceiver(self):
+        receiver, parser = self.makeParser('State_setnick')
+        def setnick(success, info):
+            receiver.currentRule = 'State_option'
+        receiver.setnick.side_effect = setnick
+        parser.receive('OK Nickname set to spam\nOK options set\n')
+        receiver.option.assert_called_with(True, 'options set')
+
+    def test_matchesGrammar(self):
+        tunnels = [
+            {'nickname': 'spam', 'running': True, 'inport': 1234},
+            {'nickname': 'eggs', 'running': False, 'outport': 2345,
+             'outhost': 'camelot'},
+        ]
+        reply = ''.join('DATA %s\n' % tunnelStatus(t) for t in tunnels)
+        reply += 'OK Listing done\n'
+        results = []
+        for useLineParser in (True, False):
+            self.patch(protocol.BOBParserProtocol, 'useLineParser', useLineParser)
+            fac = ClientFactory.forProtocol(
+                protocol.I2PClientTunnelCreatorBOBClient)
+            proto = fac.buildProtocol(None)
+            proto.makeConnection(proto_helpers.StringTransport())
+            proto.receiver.list = lambda *response: results.append(response)
+            proto.dataReceived('BOB 00.00.10\nOK\n')
+            proto.dataReceived(reply)
+        self.assertEqual(results[0], results[1])
+
+
+class LineParserMixin(object):
+    def setUp(self):
+        self.patch(protocol.BOBParserProtocol, 'useLineParser', True)
+        super(LineParserMixin, self).setUp()
+
+
+class TestI2PClientTunnelCreatorBOBClientLineParser(
+        LineParserMixin,
+        test_protocol.TestI2PClientTunnelCreatorBOBClient):
+    def test_manyListedTunnels(self):
+        # Too slow to run with the OMeta grammar
+        listing = ''.join(
+            'DATA %s\n' % tunnelStatus(
+                {'nickname': 'test-%d' % i, 'running': True,
+                 'inport': 20000 + i, 'outport': 21000 + i})
+            for i in range(1000))
+        probed = iter([20000, 21500, 20999, 22000])
+        self.patch(portAllocator, '_probe', lambda interface: next(probed))
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.dataReceived(listing + 'OK Listing done\n')
+        self.assertEqual(fac.inport, 22000)
+        self.assertEqual(1000, len(tunnelManager.tunnels))
+
+
+class TestI2PServerTunnelCreatorBOBClientLineParser(
+        LineParserMixin,
+        test_protocol.TestI2PServerTunnelCreatorBOBClient):
+    pass
+
+
+class TestI2PTunnelRemoverBOBClientLineParser(
+        LineParserMixin,
+        test_protocol.TestI2PTunnelRemoverBOBClient):
+    pass
+
+
+class BOBControlChannelLineParserTestCase(
+        LineParserMixin,
+        test_control.BOBControlChannelTestCase):
+    pass
@@ -0,0 +1,83 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+import socket
+from twisted.internet.error import CannotListenError
+from twisted.trial import unittest
+
+from txi2p.bob import tunnels
+from txi2p.bob.ports import PortAllocator
+
+
+class TestPortAllocator(unittest.TestCase):
+    def setUp(self):
+        self.allocator = PortAllocator()
+
+    def test_allocatedPortIsFree(self):
+        port = self.allocator.allocate('spam', 'inport')
+        self.assertEqual(port, self.allocator.allocated('spam', 'inport'))
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(s.close)
+        s.bind(('127.0.0.1', port))
+
+    def test_boundPortNotAllocated(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(s.close)
+        s.bind(('', 0))
+        s.listen(1)
+        bound = s.getsockname()[1]
+        allocated = [self.allocator.allocate('test-%d' % i, 'inport')
+                     for i in range(50)]
+        self.assertNotIn(bound, allocated)
+
+    def test_tunnelKeepsItsPort(self):
+        port = self.allocator.allocate('spam', 'inport')
+        self.assertEqual(port, self.allocator.allocate('spam', 'inport'))
+        self.assertEqual(1, self.allocator.probes)
+
+    def test_excludedPortReplaced(self):
+        probed = iter([9000, 9000, 9002])
+        self.patch(self.allocator, '_probe', lambda interface: next(probed))
+        self.assertEqual(9000, self.allocator.allocate('spam', 'inport'))
+        self.assertEqual(
+            9002, self.allocator.allocate('spam', 'inport', exclude={9000}))
+
+    def test_reservedPortNotReused(self):
+        probed = iter([9000, 9000, 9001])
+        self.patch(self.allocator, '_probe', lambda interface: next(probed))
+        self.assertEqual(9000, self.allocator.allocate('spam', 'inport'))
+        self.assertEqual(9001, self.allocator.allocate('eggs', 'inport'))
+
+    def test_release(self):
+        probed = iter([9000, 9001, 9000])
+        self.patch(self.allocator, '_probe', lambda interface: next(probed))
+        self.allocator.allocate('spam', 'inport')
+        self.allocator.allocate('spam', 'outport')
+        self.allocator.release('spam')
+        self.assertIsNone(self.allocator.allocated('spam', 'inport'))
+        self.assertIsNone(self.allocator.allocated('spam', 'outport'))
+        self.assertEqual(9000, self.allocator.allocate('eggs', 'inport'))
+
+    def test_noFreePort(self):
+        self.patch(self.allocator, '_probe', lambda interface: 9000)
+        self.assertRaises(CannotListenError, self.allocator.allocate,
+                          'spam', 'inport', exclude={9000})
+        self.assertIsNone(self.allocator.allocated('spam', 'inport'))
+
+    def test_hundredsOfTunnels(self):
+        listed = set(range(20000, 20500))
+        allocated = set()
+        for i in range(500):
+            for setting in ('inport', 'outport'):
+                allocated.add(self.allocator.allocate(
+                    'test-%d' % i, setting, exclude=listed))
+        self.assertEqual(1000, len(allocated))
+        self.assertFalse(allocated & listed)
+        # Ports are almost never probed twice
+        self.assertLess(self.allocator.probes, 1100)
+
+    def test_removedTunnelReleasesPorts(self):
+        self.patch(tunnels, 'portAllocator', self.allocator)
+        self.allocator.allocate('spam', 'inport')
+        tunnels.BOBTunnelManager().removed('spam')
+        self.assertIsNone(self.allocator.allocated('spam', 'inport'))
@@ -3,18 +3,25 @@
 
 from builtins import object
 import os
-from twisted.internet.error import UnknownHostError
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.error import (CannotListenError, ConnectionDone,
+                                    UnknownHostError)
 from twisted.internet.protocol import ClientFactory
 from twisted.python.failure import Failure
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
-from txi2p.bob.protocol import (I2PClientTunnelCreatorBOBClient,
+from txi2p.bob.protocol import (BOBError,
+                                MAX_CLEAR_RETRIES,
+                                I2PClientTunnelCreatorBOBClient,
                                 I2PServerTunnelCreatorBOBClient,
                                 I2PTunnelRemoverBOBClient,
                                 I2PClientTunnelProtocol,
-                                I2PServerTunnelProtocol,
-                                DEFAULT_INPORT, DEFAULT_OUTPORT)
+                                I2PServerTunnelProtocol)
+from txi2p.bob.ports import portAllocator
+from txi2p.bob.tunnels import tunnelManager
+
+from .util import tunnelStatus
 
 TEST_B64 = "2wDRF5nDfeTNgM4X-TI5xEk3R-WiaTABvkMQ2eYpvEzayUZQJgr9E2T6Y2m9HHn3xHYGEOg-RLisjW9AubTaUTx-v66AsEEtv745qPcuWuV1SP~w1bdzYEn8MSoK7Zh4mwHBg1uHq8z17TUNvWz19q76vHNth-2PDuBToD7ySBn3cGBFDUU83wJJXPD6OueLY8yosWWtksk7WZk60~6z~nVePPSEY8JDry3myLDe11szAVER4A8eX1sFpw247cXGGJK9wQhV-TXFj~m76GPVcFKh7u79zwTwZnZ1GXXKqqyRoj1c4-U69CvvJsQRLmdLFwFEpRkxwV8z6LIFclYJk443YpTnPXC7vNdFOzqqS4FLR1ra~DNfN5foMtR2~2VxuR5m2dYiOS6GzHDxA4acJJSGqnasJjcEIFNVSQKxMnFu9PvGLNJHZ83EraHCErENcOGkPlnVgcJCtPGNGiirwCbBz38jE0lfjkrNrWabc6uWeU559CobG8F8KUDx1irpAAAA"
 
@@ -32,6 +39,9 @@ class BOBProtoTestMixin(object):
         transport = proto_helpers.StringTransport()
         transport.abortConnection = lambda: None
         proto.makeConnection(transport)
+        self.addCleanup(setattr, tunnelManager, 'tunnels', {})
+        self.addCleanup(setattr, portAllocator, '_allocations', {})
+        self.addCleanup(setattr, portAllocator, '_reserved', set())
         return fac, proto
 
     def test_initBOBListsTunnels(self):
@@ -39,6 +49,11 @@ class BOBProtoTestMixin(object):
         proto.dataReceived('BOB 00.00.10\nOK\n')
         self.assertEqual(proto.transport.value(), b'list\n')
 
+    def test_bytesDecoded(self):
+        fac, proto = self.makeProto()
+        proto.dataReceived(b'BOB 00.00.10\nOK\n')
+        self.assertEqual(proto.transport.value(), b'list\n')
+
     def TODO_test_quitDoesNotErrback(self):
         fac, proto = self.makeProto()
         # Shortcut to end of BOB protocol
@@ -48,67 +63,23 @@ class BOBProtoTestMixin(object):
         self.assertTrue(False, 'TODO: Test something') # TODO: Test something
 
 class BOBTunnelCreationMixin(BOBProtoTestMixin):
-    def test_defaultInportSelected(self):
+    def test_errorFailsCreation(self):
         fac, proto = self.makeProto()
         fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
+        failures = []
+        fac.bobConnectionFailed = failures.append
         proto.dataReceived('BOB 00.00.10\nOK\n')
         proto.transport.clear()
         proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertTrue(hasattr(fac, 'inport'))
-        self.assertEqual(fac.inport, DEFAULT_INPORT)
-
-    def test_higherInportSelectedWhenDefaultBusy(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: test STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 9000 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
-        self.assertTrue(hasattr(fac, 'inport'))
-        self.assertEqual(fac.inport, DEFAULT_INPORT + 2)
-
-    def test_existingInhostAndInportSelectedForExistingTunnel(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        fac.inport = 1234
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 2345 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
-        self.assertEqual(fac.inhost, 'localhost')
-        self.assertEqual(fac.inport, 2345)
-
-    def test_defaultOutportSelected(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.inhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
         proto.transport.clear()
-        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertTrue(hasattr(fac, 'outport'))
-        self.assertEqual(fac.outport, DEFAULT_OUTPORT)
-
-    def test_higherOutportSelectedWhenDefaultBusy(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: test STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 9001 OUTHOST: localhost\nOK Listing done\n')
-        self.assertTrue(hasattr(fac, 'outport'))
-        self.assertEqual(fac.outport, DEFAULT_OUTPORT + 2)
-
-    def test_existingOuthostAndOutportSelectedForExistingTunnel(self):
-        fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.outhost = 'camelot'
-        fac.outport = 1234
-        proto.dataReceived('BOB 00.00.10\nOK\n')
-        proto.transport.clear()
-        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 2345 OUTHOST: localhost\nOK Listing done\n')
-        self.assertEqual(fac.outhost, 'localhost')
-        self.assertEqual(fac.outport, 2345)
+        proto.dataReceived('ERROR Nickname already in use\n')
+        self.assertEqual(1, len(failures))
+        failures[0].trap(BOBError)
+        self.assertEqual('Nickname already in use', str(failures[0].value))
+        self.assertEqual(proto.transport.value(), b'quit\n')
+        proto.dataReceived('OK Bye!\n')
+        proto.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(1, len(failures))
 
     def test_defaultNickSetsNick(self):
         fac, proto = self.makeProto()
@@ -202,6 +173,8 @@ class BOBTunnelCreationMixin(BOBProtoTestMixin):
     def test_stopRequestedForRunningTunnel(self):
         fac, proto = self.makeProto()
         fac.tunnelNick = 'spam'
+        # The tunnel can't be used as it is
+        fac.options = {'foo': 'bar'}
         proto.dataReceived('BOB 00.00.10\nOK\n')
         proto.transport.clear()
         proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
@@ -221,6 +194,7 @@ class BOBTunnelCreationMixin(BOBProtoTestMixin):
 
     def test_quitRequestedAfterStart(self):
         fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
         called = []
         fac.i2pTunnelCreated = lambda: called.append(True)
         # Shortcut
@@ -232,6 +206,72 @@ class BOBTunnelCreationMixin(BOBProtoTestMixin):
 class TestI2PClientTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestCase):
     protocol = I2PClientTunnelCreatorBOBClient
 
+    def test_inportAllocated(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.inhost = 'camelot'
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
+        self.assertTrue(fac.inport)
+        self.assertEqual(fac.inport, portAllocator.allocated('spam', 'inport'))
+        self.assertIsNone(portAllocator.allocated('spam', 'outport'))
+
+    def test_listedPortsNotAllocated(self):
+        probed = iter([9000, 9001, 9002])
+        self.patch(portAllocator, '_probe', lambda interface: next(probed))
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.inhost = 'camelot'
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: test STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 9000 INHOST: localhost OUTPORT: 9001 OUTHOST: localhost\nOK Listing done\n')
+        self.assertEqual(fac.inport, 9002)
+
+    def test_portsNotSharedBetweenTunnels(self):
+        self.patch(portAllocator, '_probe', lambda interface: 9000)
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.dataReceived('OK Listing done\n')
+        self.assertEqual(fac.inport, 9000)
+        # BOB hasn't bound the port yet, so it isn't listed
+        fac2, proto2 = self.makeProto()
+        fac2.tunnelNick = 'eggs'
+        proto2.dataReceived('BOB 00.00.10\nOK\n')
+        self.assertRaises(CannotListenError,
+                          proto2.dataReceived, 'OK Listing done\n')
+
+    def test_userConfiguredInportKept(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.inport = 1234
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.dataReceived('OK Listing done\n')
+        self.assertEqual(fac.inport, 1234)
+        self.assertIsNone(portAllocator.allocated('spam', 'inport'))
+
+    def test_existingInhostAndInportSelectedForExistingTunnel(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.inhost = 'camelot'
+        fac.inport = 1234
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: 2345 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
+        self.assertEqual(fac.inhost, 'localhost')
+        self.assertEqual(fac.inport, 2345)
+
+    def test_inportAllocatedForExistingTunnelWithoutOne(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
+        self.assertTrue(fac.inport)
+        self.assertEqual(fac.inport, portAllocator.allocated('spam', 'inport'))
+        self.assertEqual(fac.outport, 23456)
+
     def test_inhostRequestRepeatedIfActive(self):
         fac, proto = self.makeProto()
         fac.tunnelNick = 'spam'
@@ -304,7 +344,7 @@ class TestI2PClientTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestC
         proto.dataReceived('OK rubberyeggs\n') # The new keypair
         proto.transport.clear()
         proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value().decode('utf-8'), 'inport %d\n' % DEFAULT_INPORT)
+        self.assertEqual(proto.transport.value().decode('utf-8'), 'inport %d\n' % portAllocator.allocated('spam', 'inport'))
 
     def test_inportSet(self):
         fac, proto = self.makeProto()
@@ -348,10 +388,104 @@ class TestI2PClientTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestC
         proto.dataReceived('OK HTTP 418\n')
         self.assertEqual(proto.transport.value(), b'start\n')
 
+    def test_runningTunnelReused(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        called = []
+        fac.i2pTunnelCreated = lambda: called.append(True)
+        setups = tunnelManager.setups
+        reuses = tunnelManager.reuses
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
+        self.assertEqual(proto.transport.value(), b'getnick spam\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\n')
+        # Not stopped
+        self.assertEqual(proto.transport.value(), b'getdest\n')
+        proto.transport.clear()
+        proto.dataReceived('OK shrubbery\n')
+        self.assertEqual(proto.transport.value(), b'quit\n')
+        self.assertEqual(([True], 'shrubbery', 12345),
+                         (called, fac.localDest, fac.inport))
+        self.assertFalse(fac.removeTunnelWhenFinished)
+        self.assertEqual((setups, reuses + 1),
+                         (tunnelManager.setups, tunnelManager.reuses))
+
+    def test_runningTunnelWithoutInportStopped(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\n')
+        self.assertEqual(proto.transport.value(), b'stop\n')
+
+    def test_changedOptionsSetOnExistingTunnel(self):
+        tunnelManager.update('spam', options={'foo': 'bar'})
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.options = {'foo': 'baz'}
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: not_set OUTHOST: localhost\nOK Listing done\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\n')
+        self.assertEqual(proto.transport.value(), b'stop\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\n')
+        self.assertEqual(proto.transport.value(), b'option foo=baz\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418 options set\n')
+        # The existing keys are kept
+        self.assertEqual(proto.transport.value(), b'getdest\n')
+        self.assertEqual({'foo': 'baz'}, tunnelManager.tunnels['spam']['options'])
+
 
 class TestI2PServerTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestCase):
     protocol = I2PServerTunnelCreatorBOBClient
 
+    def test_outportNotAllocated(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.outhost = 'camelot'
+        fac.outport = None
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
+        # The port is picked when listening, before BOB is told it
+        self.assertFalse(fac.outport)
+        self.assertIsNone(portAllocator.allocated('spam', 'outport'))
+
+    def test_existingOuthostAndOutportSelectedForExistingTunnel(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.outhost = 'camelot'
+        fac.outport = 1234
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: false STOPPING: false KEYS: false QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 2345 OUTHOST: localhost\nOK Listing done\n')
+        self.assertEqual(fac.outhost, 'localhost')
+        self.assertEqual(fac.outport, 2345)
+
+    def test_listWaitsForKeyfile(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        fac.keyLoading = Deferred()
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        self.assertEqual(proto.transport.value(), b'')
+        fac.keypair = 'eggs'
+        fac.keyLoading.callback('eggs')
+        self.assertEqual(proto.transport.value(), b'list\n')
+        proto.transport.clear()
+        proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418 options set\n')
+        self.assertEqual(proto.transport.value(), b'setkeys eggs\n')
+
     def test_outhostRequestRepeatedIfActive(self):
         fac, proto = self.makeProto()
         fac.tunnelNick = 'spam'
@@ -407,8 +541,7 @@ class TestI2PServerTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestC
         proto.dataReceived('OK rubberyeggs\n') # The new keypair
         self.assertEqual(proto.transport.value(), b'outhost camelot\n')
 
-    def test_defaultOutportSet(self):
-        fac, proto = self.makeProto()
+    def makeNewTunnel(self, fac, proto):
         fac.tunnelNick = 'spam'
         fac.outhost = 'camelot'
         proto.dataReceived('BOB 00.00.10\nOK\n')
@@ -423,8 +556,29 @@ class TestI2PServerTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestC
         proto.transport.clear()
         proto.dataReceived('OK rubberyeggs\n') # The new keypair
         proto.transport.clear()
+
+    def test_defaultOutportListenedOnFirst(self):
+        fac, proto = self.makeProto()
+        listening = Deferred()
+        fac.listenLocally = lambda: listening
+        self.makeNewTunnel(fac, proto)
         proto.dataReceived('OK HTTP 418\n')
-        self.assertEqual(proto.transport.value().decode('utf-8'), 'outport %d\n' % DEFAULT_OUTPORT)
+        # BOB isn't told the port until it is listened on
+        self.assertEqual(proto.transport.value(), b'')
+        listening.callback(23456)
+        self.assertEqual(proto.transport.value(), b'outport 23456\n')
+        self.assertEqual(fac.outport, 23456)
+
+    def test_defaultOutportNotListened(self):
+        fac, proto = self.makeProto()
+        fac.listenLocally = lambda: fail(CannotListenError('', 0, 'spam'))
+        failures = []
+        fac.bobConnectionFailed = failures.append
+        self.makeNewTunnel(fac, proto)
+        proto.dataReceived('OK HTTP 418\n')
+        self.assertEqual(proto.transport.value(), b'quit\n')
+        self.assertEqual(1, len(failures))
+        failures[0].trap(CannotListenError)
 
     def test_outportSet(self):
         fac, proto = self.makeProto()
@@ -468,21 +622,44 @@ class TestI2PServerTunnelCreatorBOBClient(BOBTunnelCreationMixin, unittest.TestC
         proto.dataReceived('OK HTTP 418\n')
         self.assertEqual(proto.transport.value(), b'start\n')
 
+    def test_runningTunnelReused(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNick = 'spam'
+        called = []
+        fac.i2pTunnelCreated = lambda: called.append(True)
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: not_set INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\n')
+        self.assertEqual(proto.transport.value(), b'getdest\n')
+        proto.transport.clear()
+        proto.dataReceived('OK shrubbery\n')
+        self.assertEqual(proto.transport.value(), b'quit\n')
+        self.assertEqual(([True], 23456), (called, fac.outport))
+
 
 class TestI2PTunnelRemoverBOBClient(BOBProtoTestMixin, unittest.TestCase):
     protocol = I2PTunnelRemoverBOBClient
 
+    def makeProto(self, *a, **kw):
+        fac, proto = super(TestI2PTunnelRemoverBOBClient, self).makeProto(*a, **kw)
+        fac.tunnelNicks = ['spam']
+        fac.removed = []
+        fac.i2pTunnelRemoved = fac.removed.append
+        fac.i2pTunnelsRemoved = lambda: fac.removed.append(None)
+        return fac, proto
+
     def test_noTunnelWithNick(self):
         fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
         proto.dataReceived('BOB 00.00.10\nOK\n')
         proto.transport.clear()
         proto.dataReceived('OK Listing done\n') # No DATA, no tunnels
-        self.assertEqual(proto.transport.value(), b'')
+        self.assertEqual(proto.transport.value(), b'quit\n')
+        self.assertEqual([None], fac.removed)
 
     def test_tunnelExistsGetsNick(self):
         fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
         proto.dataReceived('BOB 00.00.10\nOK\n')
         proto.transport.clear()
         proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
@@ -490,7 +667,6 @@ class TestI2PTunnelRemoverBOBClient(BOBProtoTestMixin, unittest.TestCase):
 
     def test_stopRequested(self):
         fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
         proto.dataReceived('BOB 00.00.10\nOK\n')
         proto.transport.clear()
         proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
@@ -500,7 +676,6 @@ class TestI2PTunnelRemoverBOBClient(BOBProtoTestMixin, unittest.TestCase):
 
     def test_clearRequested(self):
         fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
         proto.dataReceived('BOB 00.00.10\nOK\n')
         proto.transport.clear()
         proto.dataReceived('DATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
@@ -510,10 +685,19 @@ class TestI2PTunnelRemoverBOBClient(BOBProtoTestMixin, unittest.TestCase):
         proto.dataReceived('OK HTTP 418\n')
         self.assertEqual(proto.transport.value(), b'clear\n')
 
+    def test_clearRequestedIfNotActive(self):
+        fac, proto = self.makeProto()
+        # Shortcut
+        proto.receiver.tunnelNick = 'spam'
+        proto.receiver.currentRule = 'State_stop'
+        proto._parser._setupInterp()
+        proto.dataReceived('ERROR tunnel not active\n')
+        self.assertEqual(proto.transport.value(), b'clear\n')
+
     def test_clearRequestRepeatedIfActive(self):
         fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
         # Shortcut
+        proto.receiver.tunnelNick = 'spam'
         proto.receiver.currentRule = 'State_clear'
         proto._parser._setupInterp()
         proto.dataReceived('ERROR tunnel is active\n')
@@ -521,22 +705,74 @@ class TestI2PTunnelRemoverBOBClient(BOBProtoTestMixin, unittest.TestCase):
 
     def test_clearRequestRepeatedIfShuttingDown(self):
         fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
         # Shortcut
+        proto.receiver.tunnelNick = 'spam'
         proto.receiver.currentRule = 'State_clear'
         proto._parser._setupInterp()
         proto.dataReceived('ERROR tunnel shutting down\n')
         self.assertEqual(proto.transport.value(), b'clear\n')
 
+    def test_clearRetriesLimited(self):
+        fac, proto = self.makeProto()
+        # Shortcut
+        proto.receiver.tunnelNick = 'spam'
+        proto.receiver.toRemove = []
+        proto.receiver.currentRule = 'State_stop'
+        proto._parser._setupInterp()
+        proto.dataReceived('OK tunnel stopping\n')
+        proto.dataReceived('ERROR tunnel shutting down\n' * MAX_CLEAR_RETRIES)
+        self.assertEqual(proto.transport.value(),
+                         b'clear\n' * (MAX_CLEAR_RETRIES + 1))
+        proto.transport.clear()
+        proto.dataReceived('ERROR tunnel shutting down\n')
+        # The tunnel is given up on
+        self.assertEqual(proto.transport.value(), b'quit\n')
+        self.assertEqual([None], fac.removed)
+
+    def test_listErrorFailsRemoval(self):
+        fac, proto = self.makeProto()
+        failures = []
+        fac.bobConnectionFailed = failures.append
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.transport.clear()
+        proto.dataReceived('ERROR spam\n')
+        self.assertEqual(1, len(failures))
+        failures[0].trap(BOBError)
+        self.assertEqual(proto.transport.value(), b'quit\n')
+
     def test_quitRequestedAfterClearSuccess(self):
         fac, proto = self.makeProto()
-        fac.tunnelNick = 'spam'
-        fac.i2pTunnelRemoved = lambda: None
         # Shortcut
+        proto.receiver.tunnelNick = 'spam'
+        proto.receiver.toRemove = []
         proto.receiver.currentRule = 'State_clear'
         proto._parser._setupInterp()
         proto.dataReceived('OK HTTP 418\n')
         self.assertEqual(proto.transport.value(), b'quit\n')
+        self.assertEqual(['spam', None], fac.removed)
+
+    def test_batchRemoved(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNicks = ['eggs', 'ham', 'spam']
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.dataReceived('DATA NICKNAME: eggs STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12347 INHOST: localhost OUTPORT: 23458 OUTHOST: localhost\nDATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\nOK HTTP 418\nOK HTTP 418\n')
+        # ham is already gone
+        self.assertEqual(proto.transport.value(), b'stop\nclear\ngetnick spam\n')
+        proto.transport.clear()
+        proto.dataReceived('OK HTTP 418\nOK HTTP 418\nOK HTTP 418\n')
+        self.assertEqual(proto.transport.value(), b'stop\nclear\nquit\n')
+        self.assertEqual(['eggs', 'spam', None], fac.removed)
+
+    def test_batchContinuesAfterError(self):
+        fac, proto = self.makeProto()
+        fac.tunnelNicks = ['eggs', 'spam']
+        proto.dataReceived('BOB 00.00.10\nOK\n')
+        proto.dataReceived('DATA NICKNAME: eggs STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12347 INHOST: localhost OUTPORT: 23458 OUTHOST: localhost\nDATA NICKNAME: spam STARTING: false RUNNING: true STOPPING: false KEYS: true QUIET: false INPORT: 12345 INHOST: localhost OUTPORT: 23456 OUTHOST: localhost\nOK Listing done\n')
+        proto.transport.clear()
+        proto.dataReceived('ERROR Nickname not found\n')
+        self.assertEqual(proto.transport.value(), b'getnick spam\n')
 
 
 class FakeDisconnectingFactory(object):
@@ -0,0 +1,122 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from txi2p.bob.tunnels import BOBTunnelManager
+
+
+def tunnel(nickname, running=True, inport=None, outport=None):
+    return {
+        'nickname': nickname,
+        'starting': False,
+        'running': running,
+        'stopping': False,
+        'keys': True,
+        'quiet': False,
+        'inport': inport,
+        'inhost': 'localhost',
+        'outport': outport,
+        'outhost': 'localhost',
+    }
+
+
+class TestBOBTunnelManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = BOBTunnelManager()
+
+    def test_listed(self):
+        self.manager.listed([tunnel('spam', inport=1234), tunnel('eggs')])
+        self.assertEqual(['eggs', 'spam'], sorted(self.manager.tunnels))
+        self.assertEqual(1234, self.manager.tunnels['spam']['inport'])
+        self.manager.listed([tunnel('eggs')])
+        self.assertEqual(['eggs'], list(self.manager.tunnels))
+
+    def test_listedKeepsOptions(self):
+        self.manager.update('spam', options={'foo': 'bar'})
+        self.manager.listed([tunnel('spam', inport=1234)])
+        self.assertEqual({'foo': 'bar'}, self.manager.tunnels['spam']['options'])
+        self.assertTrue(self.manager.tunnels['spam']['running'])
+
+    def test_optionsChanged(self):
+        # Unknown options
+        self.assertFalse(self.manager.optionsChanged('spam', None))
+        self.assertFalse(self.manager.optionsChanged('spam', {}))
+        self.assertTrue(self.manager.optionsChanged('spam', {'foo': 'bar'}))
+        self.manager.update('spam', options={'foo': 'bar'})
+        self.assertFalse(self.manager.optionsChanged('spam', {'foo': 'bar'}))
+        self.assertTrue(self.manager.optionsChanged('spam', {'foo': 'baz'}))
+        self.assertTrue(self.manager.optionsChanged('spam', None))
+
+    def test_startedAndRemoved(self):
+        self.manager.started('spam')
+        self.assertEqual(1, self.manager.setups)
+        self.assertTrue(self.manager.tunnels['spam']['running'])
+        self.manager.reused('spam')
+        self.assertEqual(1, self.manager.reuses)
+        self.manager.removed('spam')
+        self.assertEqual({}, self.manager.tunnels)
+
+    def test_runSerializesPerNick(self):
+        pending = [defer.Deferred() for i in range(3)]
+        calls = []
+
+        def create(i):
+            calls.append(i)
+            return pending[i]
+        ds = [self.manager.run('spam', create, i) for i in range(2)]
+        ds.append(self.manager.run('eggs', create, 2))
+        # Different nicknames don't wait for each other
+        self.assertEqual([0, 2], calls)
+        pending[0].callback('a')
+        self.assertEqual('a', self.successResultOf(ds[0]))
+        self.assertEqual([0, 2, 1], calls)
+        pending[1].callback('b')
+        pending[2].callback('c')
+        self.assertEqual(['b', 'c'], [self.successResultOf(d) for d in ds[1:]])
+        self.assertFalse(self.manager.busy('spam'))
+        self.assertFalse(self.manager.busy('eggs'))
+
+    def test_runManyWaiters(self):
+        pending = []
+
+        def create():
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+        ds = [self.manager.run('spam', create) for i in range(100)]
+        while pending:
+            pending.pop().callback(None)
+        self.assertEqual([None] * 100, [self.successResultOf(d) for d in ds])
+        self.assertFalse(self.manager.busy('spam'))
+
+    def test_acquireAndRelease(self):
+        self.manager.own('spam')
+        self.manager.acquire('spam')
+        self.manager.acquire('spam')
+        self.assertFalse(self.manager.release('spam'))
+        self.assertTrue(self.manager.inUse('spam'))
+        self.assertTrue(self.manager.release('spam'))
+        self.assertFalse(self.manager.inUse('spam'))
+
+    def test_releaseNotOwned(self):
+        self.manager.acquire('spam')
+        self.assertFalse(self.manager.release('spam'))
+        self.manager.own('spam')
+        self.manager.removed('spam')
+        self.manager.acquire('spam')
+        self.assertFalse(self.manager.release('spam'))
+
+    def test_runAll(self):
+        creating = defer.Deferred()
+        self.manager.run('spam', lambda: creating)
+        called = []
+        d = self.manager.runAll(['eggs', 'spam'], called.append, True)
+        self.assertTrue(self.manager.busy('eggs'))
+        self.assertEqual([], called)
+        creating.callback(None)
+        self.assertEqual([True], called)
+        self.successResultOf(d)
+        self.assertFalse(self.manager.busy('eggs'))
+        self.assertFalse(self.manager.busy('spam'))
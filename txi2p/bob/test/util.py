@@ -0,0 +1,129 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet.protocol import Factory, Protocol
+
+from txi2p.test.util import TEST_B64
+
+
+def tunnelStatus(tunnel):
+    """Format a tunnel as BOB does in ``list`` and ``status`` replies."""
+    def setting(key):
+        value = tunnel.get(key)
+        return 'not_set' if value is None else value
+    return ('NICKNAME: %s STARTING: false RUNNING: %s STOPPING: false '
+            'KEYS: true QUIET: false INPORT: %s INHOST: %s OUTPORT: %s '
+            'OUTHOST: %s' % (
+                tunnel['nickname'],
+                'true' if tunnel['running'] else 'false',
+                setting('inport'), tunnel.get('inhost', 'localhost'),
+                setting('outport'), tunnel.get('outhost', 'localhost')))
+
+
+class FakeBOBBridgeProtocol(Protocol):
+    """Answers BOB commands like a BOB bridge, without building tunnels."""
+
+    def connectionMade(self):
+        self.buf = b''
+        self.selected = None
+        self.factory.connections.append(self)
+        self.reply('BOB 00.00.10')
+        self.reply('OK')
+
+    def dataReceived(self, data):
+        self.buf += data
+        while b'\n' in self.buf:
+            line, self.buf = self.buf.split(b'\n', 1)
+            self.lineReceived(line.decode('utf-8'))
+
+    def lineReceived(self, line):
+        self.factory.commands.append(line)
+        parts = line.split(' ', 1)
+        command, arg = parts[0], parts[1] if len(parts) > 1 else None
+        tunnels = self.factory.tunnels
+        tunnel = tunnels.get(self.selected)
+        if command in self.factory.failures:
+            self.reply('ERROR %s' % self.factory.failures[command])
+        elif command == 'list':
+            for nick in sorted(tunnels):
+                self.reply('DATA %s' % tunnelStatus(tunnels[nick]))
+            self.reply('OK Listing done')
+        elif command == 'status':
+            if arg in tunnels:
+                self.reply('OK DATA %s' % tunnelStatus(tunnels[arg]))
+            else:
+                self.reply('ERROR Nickname not found')
+        elif command == 'quit':
+            self.reply('OK Bye!')
+            self.transport.loseConnection()
+        elif command == 'setnick':
+            tunnels[arg] = {'nickname': arg, 'running': False}
+            self.selected = arg
+            self.reply('OK Nickname set to %s' % arg)
+        elif command == 'getnick':
+            if arg in tunnels:
+                self.selected = arg
+                self.reply('OK Nickname set to %s' % arg)
+            else:
+                self.reply('ERROR Nickname not found')
+        elif tunnel is None:
+            self.reply('ERROR Request ignored, no nickname set')
+        elif command in ('getdest', 'newkeys', 'getkeys'):
+            self.reply('OK %s' % TEST_B64)
+        elif command in ('inhost', 'outhost'):
+            tunnel[command] = arg
+            self.reply('OK %s set' % command)
+        elif command in ('inport', 'outport'):
+            tunnel[command] = int(arg)
+            self.reply('OK %s set' % command)
+        elif command in ('option', 'setkeys', 'quiet'):
+            self.reply('OK %s set' % command)
+        elif command == 'start':
+            if tunnel['running']:
+                self.reply('ERROR tunnel is active')
+            else:
+                tunnel['running'] = True
+                self.reply('OK tunnel starting')
+        elif command == 'stop':
+            if tunnel['running']:
+                tunnel['running'] = False
+                self.reply('OK tunnel stopping')
+            else:
+                self.reply('ERROR tunnel not active')
+        elif command == 'clear':
+            if tunnel['running']:
+                self.reply('ERROR tunnel is active')
+            else:
+                del tunnels[self.selected]
+                self.selected = None
+                self.reply('OK cleared')
+        else:
+            self.reply('ERROR UNKNOWN COMMAND')
+
+    def reply(self, line):
+        self.transport.write(('%s\n' % line).encode('utf-8'))
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+
+
+class FakeBOBBridge(Factory):
+    """A fake BOB bridge to listen with on a real port.
+
+    Attributes:
+        commands (list): Every command line received.
+        connections (list): The open connections.
+        tunnels (dict): The tunnels, by nickname.
+        failures (dict): Error messages to reply with, by command.
+    """
+    protocol = FakeBOBBridgeProtocol
+
+    def __init__(self):
+        self.commands = []
+        self.connections = []
+        self.tunnels = {}
+        self.failures = {}
+
+    def disconnectAll(self):
+        for proto in list(self.connections):
+            proto.transport.loseConnection()
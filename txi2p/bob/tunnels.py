@@ -0,0 +1,159 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from twisted.internet import defer
+
+from txi2p.bob.ports import portAllocator
+
+
+class BOBTunnelManager(object):
+    """Tracks the state of BOB tunnels, and who is setting them up.
+
+    Every ``list`` reply updates the known state of each tunnel, and tunnel
+    creators record the settings that they start a tunnel with. A creator
+    that finds a running tunnel that already has what it needs can use it
+    as it is, instead of stopping, reconfiguring and starting it again.
+
+    Only one creator at a time sets up a given tunnel nickname, so that
+    endpoints connecting in parallel over the same tunnel wait for the first
+    one to set it up, and then reuse it.
+
+    The connections and listening ports that use each tunnel are counted, so
+    that a tunnel that this process set up can be removed once nothing uses
+    it any more.
+
+    Attributes:
+        tunnels (dict): The last known state of each tunnel, by nickname, as
+            parsed from ``list``.
+        setups (int): The number of times a tunnel was (re)started.
+        reuses (int): The number of times a running tunnel was used as it
+            was.
+    """
+
+    def __init__(self):
+        self.tunnels = {}
+        self.setups = 0
+        self.reuses = 0
+        self._locks = {}
+        self._users = {}
+        self._owned = set()
+
+    def run(self, tunnelNick, f, *args, **kwargs):
+        """Call ``f`` once no other creator of ``tunnelNick`` is running.
+
+        Args:
+            tunnelNick (str): The tunnel nickname.
+            f (callable): Sets up the tunnel. It may return a Deferred, and
+                holds up other creators of the tunnel until that fires.
+
+        Returns:
+            A Deferred that fires with the result of ``f``.
+        """
+        lock = self._locks.get(tunnelNick)
+        if lock is None:
+            lock = self._locks[tunnelNick] = defer.DeferredLock()
+        d = lock.run(f, *args, **kwargs)
+
+        def release(result):
+            if not (lock.locked or lock.waiting) and \
+                    self._locks.get(tunnelNick) is lock:
+                del self._locks[tunnelNick]
+            return result
+        d.addBoth(release)
+        return d
+
+    def runAll(self, tunnelNicks, f, *args, **kwargs):
+        """Call ``f`` once no creator of any of ``tunnelNicks`` is running,
+        holding them all up until it is done.
+
+        Returns:
+            A Deferred that fires with the result of ``f``.
+        """
+        if not tunnelNicks:
+            return defer.maybeDeferred(f, *args, **kwargs)
+        return self.run(tunnelNicks[0], self.runAll, tunnelNicks[1:],
+                        f, *args, **kwargs)
+
+    def busy(self, tunnelNick):
+        """Whether a creator of ``tunnelNick`` is running."""
+        return tunnelNick in self._locks
+
+    def listed(self, tunnels):
+        """Update the known tunnels from a ``list`` reply.
+
+        Tunnels that aren't in the list are forgotten. BOB doesn't list the
+        options of a tunnel, so those that this process set are kept.
+        """
+        known = {}
+        for tunnel in tunnels:
+            nickname = tunnel['nickname']
+            old = self.tunnels.get(nickname)
+            if old and 'options' in old:
+                tunnel = dict(tunnel, options=old['options'])
+            known[nickname] = tunnel
+        self.tunnels = known
+
+    def optionsChanged(self, tunnelNick, options):
+        """Whether ``options`` differ from those ``tunnelNick`` was set up
+        with. If those aren't known, any options count as a change."""
+        options = options or {}
+        known = self.tunnels.get(tunnelNick, {}).get('options')
+        if known is None:
+            return bool(options)
+        return options != known
+
+    def update(self, tunnelNick, **settings):
+        """Record settings of ``tunnelNick`` that this process has seen or
+        set."""
+        # Listed tunnels may be read-only records, so they are copied
+        record = dict(self.tunnels.get(tunnelNick) or {'nickname': tunnelNick})
+        record.update(settings)
+        self.tunnels[tunnelNick] = record
+
+    def started(self, tunnelNick):
+        """Record that ``tunnelNick`` was (re)started."""
+        self.setups += 1
+        self.update(tunnelNick, running=True)
+
+    def reused(self, tunnelNick):
+        """Record that ``tunnelNick`` was used as it was."""
+        self.reuses += 1
+
+    def removed(self, tunnelNick):
+        """Forget ``tunnelNick``, which has been cleared, and give back its
+        ports."""
+        self.tunnels.pop(tunnelNick, None)
+        portAllocator.release(tunnelNick)
+        self._owned.discard(tunnelNick)
+
+    def own(self, tunnelNick):
+        """Record that ``tunnelNick`` was set up by this process, and should
+        be removed once nothing uses it."""
+        self._owned.add(tunnelNick)
+
+    def acquire(self, tunnelNick):
+        """Record a new user of ``tunnelNick``."""
+        self._users[tunnelNick] = self._users.get(tunnelNick, 0) + 1
+
+    def release(self, tunnelNick):
+        """Record that a user of ``tunnelNick`` is done with it.
+
+        Returns:
+            `True` if nothing uses the tunnel any more, and it should be
+            removed.
+        """
+        users = self._users.get(tunnelNick, 0) - 1
+        if users > 0:
+            self._users[tunnelNick] = users
+            return False
+        self._users.pop(tunnelNick, None)
+        return tunnelNick in self._owned
+
+    def inUse(self, tunnelNick):
+        """Whether anything uses ``tunnelNick``."""
+        return tunnelNick in self._users
+
+
+# The BOBTunnelManager that every BOB endpoint in the process shares
+tunnelManager = BOBTunnelManager()
@@ -1,6 +1,15 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+import hashlib
+import marshal
+import os
+import sys
+
+import parsley
+from ometa.grammar import OMeta
+from terml.nodes import Tag, Term
+
 # General I2P grammar
 i2pGrammarSource = r"""
 digit = anything:x ?(x in '0123456789')
@@ -121,4 +130,108 @@ SAM_pong = 'PONG' KEEPALIVE_DATA:data '\n' -> data
 
 State_keepalive = ((SAM_ping:data -> receiver.ping(data))
                   |(SAM_pong:data -> receiver.pong(data)))
+
+State_primary = ((SAM_ping:data -> receiver.ping(data))
+                |(SAM_pong:data -> receiver.pong(data))
+                |(SAM_session_status:options -> receiver.subsessionStatus(**options)))
+
+State_resolver = ((SAM_ping:data -> receiver.ping(data))
+                 |(SAM_pong:data -> receiver.pong(data))
+                 |(SAM_naming_reply:options -> receiver.lookupReply(**options)))
 """
+
+
+def _userCacheDir():
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    if base.startswith('~'):
+        # No home directory to cache in
+        return ''
+    return os.path.join(base, 'txi2p')
+
+
+# Directory where parsed grammars are persisted between processes, by default
+# in the user's cache directory. Can be overridden with the
+# TXI2P_GRAMMAR_CACHE_DIR environment variable; set it to an empty string to
+# disable the on-disk cache.
+GRAMMAR_CACHE_DIR = os.environ.get('TXI2P_GRAMMAR_CACHE_DIR', _userCacheDir())
+
+# The parsed form of a grammar depends on the Parsley that parsed it
+_parsleyVersion = getattr(parsley, '__version__', '')
+
+# Parsed grammars, keyed by the SHA-256 of their source
+_grammarCache = {}
+
+
+def _dumpTerm(term):
+    return (term.tag.name, term.data,
+            tuple(_dumpTerm(arg) for arg in term.args), term.span)
+
+
+def _loadTerm(dumped):
+    name, data, args, span = dumped
+    return Term(Tag(name), data, [_loadTerm(arg) for arg in args], span)
+
+
+def _cachePath(key):
+    return os.path.join(GRAMMAR_CACHE_DIR, 'txi2p-grammar-%s.py%d%d.marshal' % (
+        key[:16], sys.version_info[0], sys.version_info[1]))
+
+
+def _readCachedGrammar(key):
+    if not GRAMMAR_CACHE_DIR:
+        return None
+    try:
+        with open(_cachePath(key), 'rb') as f:
+            return _loadTerm(marshal.load(f))
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _writeCachedGrammar(key, parsed):
+    if not GRAMMAR_CACHE_DIR:
+        return
+    path = _cachePath(key)
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(GRAMMAR_CACHE_DIR):
+            os.makedirs(GRAMMAR_CACHE_DIR)
+        with open(tmpPath, 'wb') as f:
+            marshal.dump(_dumpTerm(parsed), f)
+        os.rename(tmpPath, path)
+    except (IOError, OSError):
+        # The cache is an optimisation; a read-only install just re-parses.
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+
+
+def parseGrammar(source, name='Grammar'):
+    """Parse an OMeta grammar, sharing the result across the process.
+
+    Each distinct source is only parsed once per process. Parsed grammars are
+    also persisted in :data:`GRAMMAR_CACHE_DIR`, so later processes can skip
+    parsing entirely.
+
+    Args:
+        source (str): The grammar source.
+        name (str): The name of the grammar.
+
+    Returns:
+        The parsed grammar, for use with a Parsley ``TrampolinedParser``.
+    """
+    key = hashlib.sha256(('%s\n%s\n%s' % (
+        _parsleyVersion, name, source)).encode('utf-8')).hexdigest()
+    parsed = _grammarCache.get(key)
+    if parsed is None:
+        parsed = _readCachedGrammar(key)
+        if parsed is None:
+            parsed = OMeta(source).parseGrammar(name)
+            _writeCachedGrammar(key, parsed)
+        _grammarCache[key] = parsed
+    return parsed
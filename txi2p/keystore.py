@@ -0,0 +1,190 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+import errno
+import os
+from twisted.internet import defer, threads
+from twisted.python import failure
+
+# Atomic even if the keyfile exists, where the platform allows it
+_replace = getattr(os, 'replace', os.rename)
+# Missing on Windows before Python 3.2
+_link = getattr(os, 'link', None)
+# Errors from filesystems that have no hard links
+_noLinks = set(getattr(errno, name) for name in
+               ('EPERM', 'EINVAL', 'ENOSYS', 'ENOTSUP', 'EOPNOTSUPP')
+               if hasattr(errno, name))
+
+
+def _readKeys(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def _linkKeys(tmpPath, path):
+    # Linking fails if the keyfile exists, even if it was created after we
+    # started writing. Returns False if hard links can't be used here.
+    if _link is None:
+        return False
+    try:
+        _link(tmpPath, path)
+    except OSError as e:
+        if e.errno in _noLinks:
+            return False
+        raise
+    return True
+
+
+def _createKeys(path, keys):
+    # Creating the keyfile fails if it exists. Without a link to move the
+    # written keys into place, a crash while writing can truncate them.
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(keys))
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        os.remove(path)
+        raise
+
+
+def _writeKeys(path, keys, exclusive=False):
+    # Write to a file alongside, then move it into place, so that a crash
+    # can't leave a truncated keyfile behind.
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmpPath, 'w') as f:
+            f.write(str(keys))
+            f.flush()
+            os.fsync(f.fileno())
+        if exclusive:
+            try:
+                if not _linkKeys(tmpPath, path):
+                    _createKeys(path, keys)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    raise ValueError('The keyfile already exists')
+                raise
+            os.remove(tmpPath)
+        else:
+            _replace(tmpPath, path)
+    except Exception:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        raise
+
+
+class KeyStore(object):
+    """Loads and saves Destination keyfiles in a thread pool.
+
+    Keyfiles may be on slow or network-mounted storage, so they are never
+    read or written on the reactor thread. Keys are cached in memory once
+    read or saved, and concurrent loads of the same keyfile share one read,
+    so endpoints that share a keyfile only read it once per process. Nothing
+    else is expected to change the keyfiles while the process runs.
+
+    Attributes:
+        reads (int): The number of keyfile reads.
+        writes (int): The number of keyfile writes.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self._keys = {}
+        self._loading = {}
+
+    def _deferToThread(self, reactor, f, *args):
+        if not hasattr(reactor, 'getThreadPool'):
+            return threads.deferToThread(f, *args)
+        return threads.deferToThreadPool(reactor, reactor.getThreadPool(), f, *args)
+
+    def load(self, path, reactor=None):
+        """Load the keys in a keyfile.
+
+        Args:
+            path (str): The keyfile.
+            reactor: An :class:`twisted.internet.interfaces.IReactorThreads`
+                provider to read the keyfile with. The global reactor is used
+                if it is `None` or can't run threads.
+
+        Returns:
+            A Deferred that fires with the keys, or `None` if the keyfile
+            does not exist. It fails if the keyfile could not be read. A
+            missing keyfile is looked for again on the next load.
+        """
+        path = os.path.abspath(path)
+        if path in self._keys:
+            return defer.succeed(self._keys[path])
+        if path in self._loading:
+            d = defer.Deferred()
+            self._loading[path].append(d)
+            return d
+
+        self._loading[path] = []
+        self.reads += 1
+        d = self._deferToThread(reactor, _readKeys, path)
+
+        def loaded(result):
+            if isinstance(result, failure.Failure):
+                for waiting in self._loading.pop(path):
+                    waiting.errback(result)
+            else:
+                if result is not None:
+                    self._keys[path] = result
+                for waiting in self._loading.pop(path):
+                    waiting.callback(result)
+            return result
+        d.addBoth(loaded)
+        return d
+
+    def save(self, path, keys, reactor=None, exclusive=False):
+        """Save keys to a keyfile.
+
+        Once the keyfile is written, loads of it return the new keys without
+        reading it again.
+
+        Args:
+            path (str): The keyfile.
+            keys (str): The keys.
+            reactor: As for :meth:`load`.
+            exclusive (bool): If `True`, fail rather than replace an existing
+                keyfile.
+
+        Returns:
+            A Deferred that fires once the keyfile has been written.
+
+        Raises:
+            ValueError: if ``exclusive`` is set and the keyfile exists.
+            IOError: if the keyfile could not be written.
+        """
+        path = os.path.abspath(path)
+        self.writes += 1
+        d = self._deferToThread(reactor, _writeKeys, path, keys, exclusive)
+
+        def saved(result):
+            self._keys[path] = keys
+            return result
+        d.addCallback(saved)
+        return d
+
+    def forget(self, path=None):
+        """Drop a keyfile from the cache, or every keyfile if ``path`` is
+        `None`."""
+        if path is None:
+            self._keys.clear()
+        else:
+            self._keys.pop(os.path.abspath(path), None)
+
+
+# The KeyStore that every endpoint in the process shares
+keyStore = KeyStore()
@@ -5,16 +5,18 @@ from builtins import object
 from twisted.internet.endpoints import clientFromString
 from twisted.internet.interfaces import IStreamClientEndpointStringParserWithReactor
 from twisted.internet.interfaces import IStreamServerEndpointStringParser
-from twisted.python.compat import _PY3
 from zope.interface import implementer
 
-from txi2p.bob.endpoints import BOBI2PClientEndpoint, BOBI2PServerEndpoint
-from txi2p.sam.endpoints import (
-    SAMI2PStreamClientEndpoint,
-    SAMI2PStreamServerEndpoint,
-)
+# The per-API endpoint modules are imported by the parsers that use them, so
+# that plugin discovery doesn't have to load every API.
 from txi2p.utils import getApi
 
+try:
+    from twisted.python.compat import _PY3
+except ImportError:
+    # Removed from Twisted along with Python 2 support
+    _PY3 = True
+
 if not _PY3:
     from twisted.plugin import IPlugin
 else:
@@ -26,6 +28,12 @@ else:
 def _parseOptions(options):
     return dict([option.split(':') for option in options.split(',')]) if options else {}
 
+def _parseSupervisor(reconnect):
+    if not reconnect:
+        return None
+    from txi2p.sam.supervisor import SessionSupervisor
+    return SessionSupervisor(whileRecovering=reconnect)
+
 @implementer(IPlugin, IStreamClientEndpointStringParserWithReactor)
 class I2PClientParser(object):
     prefix = 'i2p'
@@ -34,11 +42,14 @@ class I2PClientParser(object):
                      tunnelNick=None,
                      inhost='localhost',
                      inport=None,
-                     options=None):
+                     options=None,
+                     lingerTime=None):
+        from txi2p.bob.endpoints import BOBI2PClientEndpoint
         return BOBI2PClientEndpoint(reactor, clientFromString(reactor, bobEndpoint),
                                     host, port, tunnelNick, inhost,
                                     inport and int(inport) or None,
-                                    _parseOptions(options))
+                                    _parseOptions(options),
+                                    lingerTime and float(lingerTime))
 
     def _parseSAMClient(self, reactor, host, port, samEndpoint,
                      nickname=None,
@@ -46,11 +57,29 @@ class I2PClientParser(object):
                      keyfile=None,
                      localPort=None,
                      options=None,
-                     sigType=None):
+                     sigType=None,
+                     poolSize=None,
+                     warmup=None,
+                     warmupTimeout=None,
+                     shards=None,
+                     shardStrategy='roundRobin',
+                     reconnect=None):
+        if shards:
+            from txi2p.sam.endpoints import SAMI2PShardedClientEndpoint
+            return SAMI2PShardedClientEndpoint.new(
+                clientFromString(reactor, samEndpoint),
+                host, port, nickname, int(shards), shardStrategy, autoClose,
+                localPort and int(localPort) or None, _parseOptions(options),
+                sigType, poolSize and int(poolSize) or None)
+        from txi2p.sam.endpoints import SAMI2PStreamClientEndpoint
         return SAMI2PStreamClientEndpoint.new(
             clientFromString(reactor, samEndpoint),
             host, port, nickname, autoClose, keyfile,
-            localPort and int(localPort) or None, _parseOptions(options), sigType)
+            localPort and int(localPort) or None, _parseOptions(options), sigType,
+            poolSize and int(poolSize) or None,
+            warmup=warmup,
+            warmupTimeout=warmupTimeout and float(warmupTimeout) or None,
+            supervisor=_parseSupervisor(reconnect))
 
     _apiParsers = {
         'BOB': _parseBOBClient,
@@ -79,20 +108,36 @@ class I2PServerParser(object):
                      tunnelNick=None,
                      outhost='localhost',
                      outport=None,
-                     options=None):
+                     options=None,
+                     lingerTime=None):
+        from txi2p.bob.endpoints import BOBI2PServerEndpoint
         return BOBI2PServerEndpoint(reactor, clientFromString(reactor, bobEndpoint),
                                     keyfile, port, tunnelNick, outhost,
                                     outport and int(outport) or None,
-                                    _parseOptions(options))
+                                    _parseOptions(options),
+                                    lingerTime and float(lingerTime))
 
     def _parseSAMServer(self, reactor, keyfile, port, samEndpoint,
                      nickname=None,
                      autoClose=False,
                      options=None,
-                     sigType=None):
+                     sigType=None,
+                     minAccepts=None,
+                     maxAccepts=None,
+                     listenMode='accept',
+                     warmup=None,
+                     warmupTimeout=None,
+                     reconnect=None):
+        from txi2p.sam.endpoints import SAMI2PStreamServerEndpoint
         return SAMI2PStreamServerEndpoint.new(
             clientFromString(reactor, samEndpoint),
-            keyfile, port, nickname, autoClose, _parseOptions(options), sigType)
+            keyfile, port, nickname, autoClose, _parseOptions(options), sigType,
+            minAccepts and int(minAccepts) or None,
+            maxAccepts and int(maxAccepts) or None,
+            listenMode, reactor,
+            warmup=warmup,
+            warmupTimeout=warmupTimeout and float(warmupTimeout) or None,
+            supervisor=_parseSupervisor(reconnect))
 
     _apiParsers = {
         'BOB': _parseBOBServer,
@@ -1,10 +1,23 @@
+from .datagram import (
+    SAMDatagramPort,
+    listenDatagrams,
+)
 from .endpoints import (
+    SAMI2PShardedClientEndpoint,
     SAMI2PStreamClientEndpoint,
     SAMI2PStreamServerEndpoint,
 )
+from .group import (
+    SAMSessionGroup,
+    getSessionGroup,
+)
 from .session import (
     SAMSession,
     generateDestination,
     getSession,
+    lookupCheck,
+    streamCheck,
     testAPI,
+    warmSession,
 )
+from .supervisor import SessionSupervisor
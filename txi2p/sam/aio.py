@@ -0,0 +1,422 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+"""Use SAM sessions and streams from :mod:`asyncio`.
+
+The SAM protocols, sessions, naming and stream handling are the same objects
+that the Twisted endpoints use, driven directly by the asyncio event loop.
+The Twisted reactor is never run. Python 3.5 or later is required.
+"""
+import asyncio
+import socket
+import weakref
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.internet.protocol import Factory
+from twisted.python.failure import Failure
+from zope.interface import implementer
+
+from txi2p.sam import session as _session
+from txi2p.sam.endpoints import SAMI2PStreamClientEndpoint
+from txi2p.sam.stream import StreamAcceptPort
+
+DEFAULT_SAM_HOST = '127.0.0.1'
+DEFAULT_SAM_PORT = 7656
+
+# getSession() options that schedule timers on the Twisted reactor
+_REACTOR_OPTIONS = ('poolSize', 'readyTimeout', 'supervisor')
+
+
+class _LoopCall(object):
+    __slots__ = ('_handle', '_time')
+
+    def __init__(self, handle, time):
+        self._handle = handle
+        self._time = time
+
+    def active(self):
+        return not self._handle.cancelled()
+
+    def cancel(self):
+        self._handle.cancel()
+
+    def getTime(self):
+        return self._time
+
+
+class LoopClock(object):
+    """An :class:`twisted.internet.interfaces.IReactorTime` provider for an
+    asyncio event loop.
+
+    It can also stand in for the reactor and its thread pool in
+    :func:`twisted.internet.threads.deferToThreadPool`, running functions in
+    the loop's default executor.
+
+    Args:
+        loop: The event loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        if kwargs:
+            handle = self.loop.call_later(delay, lambda: f(*args, **kwargs))
+        else:
+            handle = self.loop.call_later(delay, f, *args)
+        return _LoopCall(handle, self.loop.time() + delay)
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.loop.call_soon_threadsafe(lambda: f(*args, **kwargs))
+
+    def getThreadPool(self):
+        return self
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        def run():
+            try:
+                result = f(*args, **kwargs)
+            except BaseException:
+                onResult(False, Failure())
+            else:
+                onResult(True, result)
+        self.loop.run_in_executor(None, run)
+
+
+_clocks = weakref.WeakKeyDictionary()
+
+
+def loopClock(loop=None):
+    """The :class:`LoopClock` for ``loop``, or for the running event loop."""
+    loop = loop or asyncio.get_event_loop()
+    clock = _clocks.get(loop)
+    if clock is None:
+        clock = _clocks[loop] = LoopClock(loop)
+    return clock
+
+
+class _ConnectionAdapter(asyncio.Protocol):
+    """Runs a Twisted Protocol on an asyncio transport.
+
+    This is the asyncio Protocol of the connection, and the Twisted transport
+    of the Protocol that ``factory`` builds. Once a SAM stream is open, the
+    SAM receiver swaps ``protocol`` for a pump, so that stream data goes
+    straight to the application.
+    """
+    protocol = None
+    transport = None
+    streamProtocol = None
+
+    def __init__(self, factory, clock):
+        self.factory = factory
+        self.reactor = clock
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.makeConnection(self)
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def eof_received(self):
+        if self.streamProtocol:
+            return self.streamProtocol.eof_received()
+
+    def connection_lost(self, exc):
+        self.protocol.connectionLost(Failure(exc or ConnectionDone()))
+        self.factory.doStop()
+
+    def pause_writing(self):
+        if self.streamProtocol:
+            self.streamProtocol.pause_writing()
+
+    def resume_writing(self):
+        if self.streamProtocol:
+            self.streamProtocol.resume_writing()
+
+    # The Twisted transport
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.transport.writelines(data)
+
+    def loseConnection(self):
+        self.transport.close()
+
+    def abortConnection(self):
+        self.transport.abort()
+
+    def getPeer(self):
+        return self.transport.get_extra_info('peername')
+
+    def getHost(self):
+        return self.transport.get_extra_info('sockname')
+
+    def setTcpKeepAlive(self, enabled):
+        sock = self.transport.get_extra_info('socket')
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+            raise AttributeError('setTcpKeepAlive')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, enabled)
+
+
+@implementer(IStreamClientEndpoint)
+class AsyncioClientEndpoint(object):
+    """Connects Twisted factories to the SAM bridge over an asyncio event loop.
+
+    Args:
+        host (str): The SAM bridge's host.
+        port (int): The SAM bridge's port.
+        path (str): If set, connect to the SAM bridge on this Unix socket
+            instead.
+        loop: The event loop. Defaults to the running one.
+    """
+
+    def __init__(self, host=DEFAULT_SAM_HOST, port=DEFAULT_SAM_PORT, path=None, loop=None):
+        self._host = host
+        self._port = port
+        self._path = path
+        self._loop = loop
+
+    def connect(self, fac):
+        loop = self._loop or asyncio.get_event_loop()
+        clock = loopClock(loop)
+        adapter = _ConnectionAdapter(fac, clock)
+        # Factories that read keyfiles do so on the loop's executor
+        fac.reactor = clock
+        fac.doStart()
+        if self._path:
+            coro = loop.create_unix_connection(lambda: adapter, self._path)
+        else:
+            coro = loop.create_connection(lambda: adapter, self._host, self._port)
+        task = loop.create_task(coro)
+        d = Deferred(lambda d: task.cancel())
+
+        def connected(task):
+            if task.cancelled():
+                fac.doStop()
+            elif task.exception():
+                fac.doStop()
+                d.errback(task.exception())
+            else:
+                d.callback(adapter.protocol)
+        task.add_done_callback(connected)
+        return d
+
+
+def _asFuture(d):
+    """Wrap a Deferred in an asyncio Future."""
+    future = asyncio.get_event_loop().create_future()
+
+    def succeeded(result):
+        if not future.cancelled():
+            future.set_result(result)
+
+    def failed(f):
+        if not future.cancelled():
+            future.set_exception(f.value)
+    d.addCallbacks(succeeded, failed)
+
+    def cancelled(future):
+        if future.cancelled():
+            d.cancel()
+    future.add_done_callback(cancelled)
+    return future
+
+
+class I2PStreamTransport(object):
+    """The asyncio transport of an I2P stream.
+
+    Everything goes to the transport of the SAM connection that carries the
+    stream, except that ``get_extra_info('peername')`` and
+    ``get_extra_info('sockname')`` give the peer's and the session's
+    :class:`txi2p.address.I2PAddress`.
+    """
+    __slots__ = ('_transport', '_host', '_peer')
+
+    def __init__(self, transport, host, peer):
+        self._transport = transport
+        self._host = host
+        self._peer = peer
+
+    def __getattr__(self, attr):
+        return getattr(self._transport, attr)
+
+    def write(self, data):
+        self._transport.write(data)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self._peer
+        if name == 'sockname':
+            return self._host
+        return self._transport.get_extra_info(name, default)
+
+
+class _ProtocolShim(object):
+    """Stands in for the Twisted Protocol of a SAM stream, and hands the
+    stream to an asyncio Protocol."""
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        # Stream data goes straight to the asyncio Protocol
+        self.dataReceived = protocol.data_received
+
+    def makeConnection(self, transport):
+        # transport is an I2PTunnelTransport around the connection adapter
+        adapter = transport.t
+        adapter.streamProtocol = self.protocol
+        self.transport = I2PStreamTransport(
+            adapter.transport, transport.getHost(), transport.getPeer())
+        self.protocol.connection_made(self.transport)
+
+    def connectionLost(self, reason):
+        self.protocol.connection_lost(
+            None if reason.check(ConnectionDone) else reason.value)
+
+
+class _ProtocolFactory(Factory):
+    def __init__(self, protocolFactory):
+        self.protocolFactory = protocolFactory
+
+    def buildProtocol(self, addr):
+        return _ProtocolShim(self.protocolFactory())
+
+
+async def getSession(nickname=None, samHost=DEFAULT_SAM_HOST, samPort=DEFAULT_SAM_PORT, samPath=None, **kwargs):
+    """Get or create a SAM session over the running event loop.
+
+    Sessions are shared with :func:`txi2p.sam.session.getSession`, so an
+    existing session for ``nickname`` is returned as it is, even if it was
+    created over the Twisted reactor.
+
+    Args:
+        nickname (str): The session nickname.
+        samHost (str): The SAM bridge's host.
+        samPort (int): The SAM bridge's port.
+        samPath (str): If set, connect to the SAM bridge on this Unix socket
+            instead.
+
+    The other arguments are as for :func:`txi2p.sam.session.getSession`,
+    except ``poolSize``, ``readyTimeout`` and ``supervisor``, which need the
+    Twisted reactor.
+
+    Returns:
+        txi2p.sam.SAMSession: The session.
+    """
+    for name in _REACTOR_OPTIONS:
+        if kwargs.get(name) is not None:
+            raise ValueError('%s is not supported with asyncio' % name)
+    samEndpoint = AsyncioClientEndpoint(samHost, samPort, samPath)
+    return await _asFuture(_session.getSession(nickname, samEndpoint, **kwargs))
+
+
+async def createConnection(protocolFactory, session, host, port=None, localPort=None):
+    """Open an I2P stream, like :meth:`asyncio.loop.create_connection`.
+
+    Args:
+        protocolFactory (callable): Returns the asyncio Protocol for the
+            stream.
+        session (txi2p.sam.SAMSession): The session to connect from.
+        host (str): The I2P hostname or Destination to connect to.
+        port (int): The port to connect to inside I2P.
+        localPort (int): The port to connect from inside I2P.
+
+    Returns:
+        tuple: The stream's transport and Protocol.
+    """
+    endpoint = SAMI2PStreamClientEndpoint(session, host, port, localPort)
+    shim = await _asFuture(endpoint.connect(_ProtocolFactory(protocolFactory)))
+    return shim.transport, shim.protocol
+
+
+async def openConnection(session, host, port=None, localPort=None, limit=2 ** 16):
+    """Open an I2P stream, like :func:`asyncio.open_connection`.
+
+    The arguments are as for :func:`createConnection`.
+
+    Returns:
+        tuple: An :class:`asyncio.StreamReader` and
+        :class:`asyncio.StreamWriter` for the stream.
+    """
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=limit, loop=loop)
+    transport, protocol = await createConnection(
+        lambda: asyncio.StreamReaderProtocol(reader, loop=loop),
+        session, host, port, localPort)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+class I2PServer(object):
+    """Accepts I2P streams for a session.
+
+    Attributes:
+        address (txi2p.address.I2PAddress): The address being listened on.
+        port (txi2p.sam.stream.StreamAcceptPort): The port that keeps
+            ``STREAM ACCEPT`` connections pending.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.address = port.getHost()
+
+    def close(self):
+        """Stop accepting streams. Open streams are left alone."""
+        self.port.stopListening()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+async def createServer(protocolFactory, session, minAccepts=None, maxAccepts=None):
+    """Accept I2P streams, like :meth:`asyncio.loop.create_server`.
+
+    Args:
+        protocolFactory (callable): Returns the asyncio Protocol for each
+            stream.
+        session (txi2p.sam.SAMSession): The session to listen on.
+        minAccepts (int): The fewest pending ``STREAM ACCEPT`` connections to
+            keep open. See :class:`txi2p.sam.stream.StreamAcceptPort`.
+        maxAccepts (int): The most pending ``STREAM ACCEPT`` connections to
+            keep open.
+
+    Returns:
+        I2PServer: The server.
+    """
+    if not session.ready:
+        await _asFuture(session.whenReady())
+    port = StreamAcceptPort(session, _ProtocolFactory(protocolFactory),
+                            minAccepts, maxAccepts, clock=loopClock())
+    port.startListening()
+    return I2PServer(port)
+
+
+async def startServer(clientConnected, session, minAccepts=None, maxAccepts=None, limit=2 ** 16):
+    """Accept I2P streams, like :func:`asyncio.start_server`.
+
+    Args:
+        clientConnected (callable): Called with an :class:`asyncio.StreamReader`
+            and :class:`asyncio.StreamWriter` for each stream. If it is a
+            coroutine function, it is run as a task.
+
+    The other arguments are as for :func:`createServer`.
+
+    Returns:
+        I2PServer: The server.
+    """
+    loop = asyncio.get_event_loop()
+
+    def factory():
+        reader = asyncio.StreamReader(limit=limit, loop=loop)
+        return asyncio.StreamReaderProtocol(reader, clientConnected, loop=loop)
+    return await createServer(factory, session, minAccepts, maxAccepts)
@@ -4,23 +4,22 @@
 from builtins import str
 from builtins import object
 import functools
-from ometa.grammar import OMeta
 from ometa.protocol import ParserProtocol
 import re
 import time
-from twisted.internet import reactor
 from twisted.internet.interfaces import IProtocolFactory
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ClientFactory, Protocol
 from twisted.python.failure import Failure
 from zope.interface import implementer
 
 from txi2p import grammar
 from txi2p.address import (
     I2PAddress,
-    I2PServerTunnelProtocol,
     I2PTunnelTransport,
 )
 from txi2p.sam import constants as c
+from txi2p.sam.keepalive import keepaliveWheel
+from txi2p.sam.parser import SAMLineParser
 
 KEEPALIVE_TIMEOUT = 2 * 60
 
@@ -40,9 +39,22 @@ def peerSAM(data):
 
 
 class SAMParserProtocol(ParserProtocol):
+    # Set to True to parse SAM replies with txi2p.sam.parser.SAMLineParser
+    # instead of interpreting the OMeta grammar.
+    useLineParser = False
+
     def __init__(self, *args):
         ParserProtocol.__init__(self, *args)
 
+    def connectionMade(self):
+        if not self.useLineParser:
+            ParserProtocol.connectionMade(self)
+            return
+        self.sender = self._senderFactory(self.transport)
+        self.receiver = self._receiverFactory(self.sender)
+        self.receiver.prepareParsing(self)
+        self._parser = SAMLineParser(self.receiver)
+
     def dataReceived(self, data):
         """
         Receive and parse some data.
@@ -60,15 +72,31 @@ class SAMParserProtocol(ParserProtocol):
             # Duplicated from Parsley because it expects a str but Twisted
             # provides a bytes.
             try:
-                self._parser.receive(data.decode('utf-8'))
+                if isinstance(self._parser, SAMLineParser):
+                    self._parser.receive(data)
+                else:
+                    self._parser.receive(data.decode('utf-8'))
             except Exception:
                 self.connectionLost(Failure())
                 self.transport.abortConnection()
                 return
 
 
+class SAMStreamPump(object):
+    """Stands in for a :class:`SAMParserProtocol` once its stream is open.
+
+    The transport delivers data straight to the wrapped Protocol, and only
+    ``connectionLost`` is passed back through the parser.
+    """
+
+    def __init__(self, parserProto, wrappedProto):
+        self.parserProto = parserProto
+        self.dataReceived = wrappedProto.dataReceived
+        self.connectionLost = parserProto.connectionLost
+
+
 def makeSAMProtocol(senderFactory, receiverFactory):
-    g = OMeta(grammar.samGrammarSource).parseGrammar('Grammar')
+    g = grammar.parseGrammar(grammar.samGrammarSource)
     return functools.partial(
         SAMParserProtocol, g, senderFactory, receiverFactory, {})
 
@@ -78,7 +106,7 @@ class SAMSender(object):
         self.transport = transport
 
     def sendHello(self):
-        self.transport.write(b'HELLO VERSION MIN=3.0 MAX=3.2\n')
+        self.transport.write(b'HELLO VERSION MIN=3.0 MAX=3.3\n')
 
     def sendNamingLookup(self, name):
         msg = 'NAMING LOOKUP NAME=%s\n' % name
@@ -110,6 +138,7 @@ class SAMReceiver(object):
     def prepareParsing(self, parser):
         # Store the factory for later use
         self.factory = parser.factory
+        self.parser = parser
         self.sender.sendHello()
 
     def wrapProto(self, proto, peerAddress, invertTLS=False):
@@ -125,10 +154,19 @@ class SAMReceiver(object):
             invertTLS)
         proto.makeConnection(self.transportWrapper)
 
+    def startPumping(self):
+        # Hand the transport straight to the wrapped Protocol, so that stream
+        # data no longer passes through the parser. Transports that don't
+        # expose their protocol keep using the State_readData shortcut.
+        transport = self.sender.transport
+        if self.wrappedProto and getattr(transport, 'protocol', None) is self.parser:
+            transport.protocol = SAMStreamPump(self.parser, self.wrappedProto)
+
     def dataReceived(self, data):
         self.wrappedProto.dataReceived(data)
 
     def finishParsing(self, reason):
+        self.stopPinging()
         if self.wrappedProto:
             self.wrappedProto.connectionLost(reason)
         else:
@@ -141,7 +179,11 @@ class SAMReceiver(object):
             self.factory.resultNotOK(result, message)
             return
         self.factory.samVersion = version
-        self.command()
+        if hasattr(self.factory, 'connectionReady'):
+            # Pooled connections wait here until they are needed
+            self.factory.connectionReady(self)
+        else:
+            self.command()
 
     def lookupReply(self, result, name, value=None, message=None):
         if result != c.RESULT_OK:
@@ -152,12 +194,24 @@ class SAMReceiver(object):
     def _sendPing(self):
         self.lastPing = str(time.time())
         self.sender.sendPing(self.lastPing)
-        self.pingTimeout = reactor.callLater(KEEPALIVE_TIMEOUT, self.sender.transport.loseConnection)
+        self.pingTimeout = self._keepalive(self.pingTimeout, self._pingTimedOut)
+
+    def _pingTimedOut(self):
+        self.sender.transport.loseConnection()
+
+    def _keepalive(self, timer, func):
+        # Every SAM connection shares one timer wheel and reuses its timers,
+        # so that all keepalives cost a single reactor timer between them.
+        if timer is None:
+            wheel = keepaliveWheel(getattr(self.sender.transport, 'reactor', None))
+            return wheel.callLater(KEEPALIVE_TIMEOUT, func)
+        timer.reset(KEEPALIVE_TIMEOUT)
+        return timer
 
     def _resetPingTimeout(self):
         if self.pingTimeout:
             self.pingTimeout.cancel()
-        self.pinger = reactor.callLater(KEEPALIVE_TIMEOUT, self._sendPing)
+        self.pinger = self._keepalive(self.pinger, self._sendPing)
 
     def ping(self, data):
         self.sender.sendPong(data)
@@ -168,13 +222,13 @@ class SAMReceiver(object):
             self._resetPingTimeout()
 
     def startPinging(self):
-        self.pinger = reactor.callLater(KEEPALIVE_TIMEOUT, self._sendPing)
+        self.pinger = self._keepalive(self.pinger, self._sendPing)
         self.currentRule = 'State_keepalive'
 
     def stopPinging(self):
-        if self.pinger and self.pinger.active():
+        if self.pinger:
             self.pinger.cancel()
-        if self.pingTimeout and self.pingTimeout.active():
+        if self.pingTimeout:
             self.pingTimeout.cancel()
 
 class SAMFactory(ClientFactory):
@@ -203,10 +257,47 @@ class SAMFactory(ClientFactory):
         raise c.samErrorMap.get(result)(string=(message if message else result))
 
 
-class SAMI2PServerTunnelProtocol(I2PServerTunnelProtocol):
-    def setPeer(self, data):
-        self.peer = peerSAM(data)
-        self.transport.peerAddr = self.peer
+class SAMI2PServerTunnelProtocol(Protocol):
+    """A stream that the SAM bridge forwarded to a local port.
+
+    The bridge first sends a line with the peer's Destination, so the wrapped
+    Protocol is only built once that line has arrived. The transport then
+    delivers data straight to the wrapped Protocol.
+    """
+    wrappedProto = None
+    peer = None
+
+    def __init__(self, wrappedFactory, serverAddr):
+        self.wrappedFactory = wrappedFactory
+        self._serverAddr = serverAddr
+        self._buffer = b''
+
+    def dataReceived(self, data):
+        if self.wrappedProto:
+            self.wrappedProto.dataReceived(data)
+            return
+        self._buffer += data
+        if b'\n' not in self._buffer:
+            return
+        # First line is the peer's Destination.
+        line, data = self._buffer.split(b'\n', 1)
+        self._buffer = b''
+        self.peer = peerSAM(line)
+        proto = self.wrappedFactory.buildProtocol(self.peer)
+        if proto is None:
+            self.transport.loseConnection()
+            return
+        self.wrappedProto = proto
+        proto.makeConnection(
+            I2PTunnelTransport(self.transport, self._serverAddr, self.peer))
+        if data:
+            proto.dataReceived(data)
+        if getattr(self.transport, 'protocol', None) is self:
+            self.transport.protocol = proto
+
+    def connectionLost(self, reason):
+        if self.wrappedProto:
+            self.wrappedProto.connectionLost(reason)
 
 
 @implementer(IProtocolFactory)
@@ -218,8 +309,7 @@ class I2PFactoryWrapper(object):
         self.serverAddr = serverAddr
 
     def buildProtocol(self, addr):
-        wrappedProto = self.w.buildProtocol(addr)
-        proto = self.protocol(wrappedProto, self.serverAddr)
+        proto = self.protocol(self.w, self.serverAddr)
         proto.factory = self
         return proto
 
@@ -12,6 +12,15 @@ from twisted.internet.error import (
 
 DEFAULT_SIGTYPE = 'EdDSA_SHA512_Ed25519'
 
+STYLE_STREAM = 'STREAM'
+STYLE_DATAGRAM = 'DATAGRAM'
+STYLE_RAW = 'RAW'
+STYLE_PRIMARY = 'PRIMARY'
+SESSION_STYLES = (STYLE_STREAM, STYLE_DATAGRAM, STYLE_RAW, STYLE_PRIMARY)
+
+# The SAM bridge's default port for sending datagrams
+DEFAULT_UDP_PORT = 7655
+
 RESULT_OK = 'OK'
 RESULT_CANT_REACH_PEER = 'CANT_REACH_PEER'
 RESULT_DUPLICATED_DEST = 'DUPLICATED_DEST'
@@ -0,0 +1,222 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from twisted.internet import error, reactor
+from twisted.internet.interfaces import IListeningPort
+from twisted.internet.protocol import DatagramProtocol
+from zope.interface import implementer
+
+from txi2p.sam import constants as c
+from txi2p.sam.base import cmpSAM, peerSAM
+from txi2p.sam.session import getSession
+
+DEFAULT_UDP_ADDRESS = ('127.0.0.1', c.DEFAULT_UDP_PORT)
+
+
+class _SAMForwardProtocol(DatagramProtocol):
+    """Receives the datagrams that the SAM bridge forwards to a local port."""
+
+    def __init__(self, port):
+        self.port = port
+
+    def datagramReceived(self, data, addr):
+        self.port.forwardedDatagramReceived(data)
+
+
+@implementer(IListeningPort)
+class SAMDatagramPort(object):
+    """Sends and receives I2P datagrams for a ``DATAGRAM`` or ``RAW`` session.
+
+    The SAM bridge forwards incoming datagrams to a local UDP port, and
+    outgoing datagrams are sent to the SAM bridge's UDP port, so no datagram
+    goes over the SAM control connection. Outgoing datagrams are queued, and
+    everything queued in one reactor iteration is sent by a single timed
+    call. The SAM bridge reads one datagram per UDP packet, so each datagram
+    is still its own packet.
+
+    This is given to the :class:`twisted.internet.protocol.DatagramProtocol`
+    as its transport, and has the ``write`` method of
+    :class:`twisted.internet.interfaces.IUDPTransport`. ``DATAGRAM`` sessions
+    call ``datagramReceived`` with the sender's :class:`txi2p.I2PAddress`.
+    ``RAW`` datagrams are anonymous, so their address is `None`.
+
+    Args:
+        protocol (twisted.internet.protocol.DatagramProtocol): The protocol to
+            deliver datagrams to.
+        samUdpAddress (tuple): The host and port that the SAM bridge receives
+            datagrams on.
+        clock: An :class:`twisted.internet.interfaces.IReactorTime` provider.
+
+    Attributes:
+        session (txi2p.sam.SAMSession): The session this port belongs to.
+        sent (int): The number of datagrams sent.
+        batches (int): The number of times the queue was flushed.
+    """
+
+    def __init__(self, protocol, samUdpAddress=DEFAULT_UDP_ADDRESS, clock=None):
+        self.protocol = protocol
+        self.samUdpAddress = samUdpAddress
+        self.session = None
+        self.sent = 0
+        self.batches = 0
+        self._clock = clock or reactor
+        self._udpPort = None
+        self._queue = []
+        self._flushCall = None
+
+    def startListening(self):
+        pass
+
+    def startSession(self, session, udpPort):
+        self.session = session
+        self._udpPort = udpPort
+        session.datagramPort = self
+        self.protocol.makeConnection(self)
+
+    def stopListening(self):
+        """Send any queued datagrams, then close the port and its session."""
+        self.flush()
+        self.protocol.doStop()
+        d = self._udpPort.stopListening()
+        self.session.datagramPort = None
+        self.session.close()
+        return d
+
+    def getHost(self):
+        return self.session.address
+
+    def forwardedDatagramReceived(self, data):
+        if self.session.style == c.STYLE_RAW:
+            self.protocol.datagramReceived(data, None)
+            return
+        # First line is the sender's Destination
+        if b'\n' not in data:
+            return
+        header, data = data.split(b'\n', 1)
+        self.protocol.datagramReceived(data, peerSAM(header))
+
+    def _header(self, addr):
+        # addr is an I2PAddress, or a Destination or I2P hostname
+        dest = getattr(addr, 'destination', addr)
+        msg = '3.0 %s %s' % (self.session.id, dest)
+        if cmpSAM(self.session.samVersion, '3.2') >= 0:
+            if self.session.address.port:
+                msg += ' FROM_PORT=%d' % self.session.address.port
+            if getattr(addr, 'port', None):
+                msg += ' TO_PORT=%d' % addr.port
+        msg += '\n'
+        return msg.encode('utf-8')
+
+    def write(self, datagram, addr):
+        """Queue a datagram to be sent.
+
+        Args:
+            datagram (bytes): The datagram payload.
+            addr: The :class:`txi2p.I2PAddress` to send to, or a Destination
+                or I2P hostname.
+        """
+        self._queue.append(self._header(addr) + datagram)
+        if not self._flushCall:
+            self._flushCall = self._clock.callLater(0, self.flush)
+
+    def writeSequence(self, datagrams, addr):
+        """Queue several datagrams to be sent to the same address."""
+        header = self._header(addr)
+        self._queue.extend(header + datagram for datagram in datagrams)
+        if not self._flushCall:
+            self._flushCall = self._clock.callLater(0, self.flush)
+
+    def flush(self):
+        """Send all queued datagrams now, one UDP packet each."""
+        if self._flushCall and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        if not self._queue:
+            return
+        queue, self._queue = self._queue, []
+        write = self._udpPort.write
+        for packet in queue:
+            write(packet, self.samUdpAddress)
+        self.sent += len(queue)
+        self.batches += 1
+
+
+def listenDatagrams(protocol, samEndpoint, nickname=None, style=c.STYLE_DATAGRAM,
+                    keyfile=None, localPort=None, options=None, sigType=None,
+                    samUdpAddress=DEFAULT_UDP_ADDRESS, reactor=reactor):
+    """Create a SAM session for sending and receiving I2P datagrams.
+
+    The function returns a :class:`twisted.internet.defer.Deferred`; register
+    callbacks to receive the return value or errors.
+
+    Args:
+        protocol (twisted.internet.protocol.DatagramProtocol): The protocol to
+            deliver datagrams to.
+        samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the SAM API.
+        nickname (str): The SAM session nickname. The session must not already
+            exist.
+        style (str): ``'DATAGRAM'`` for repliable datagrams, or ``'RAW'`` for
+            anonymous datagrams.
+        keyfile (str): Path to a local file containing the keypair to use for
+            the session Destination. If non-existent, new keys will be
+            generated and stored.
+        localPort (int): The port to send datagrams from inside I2P. Ignored
+            if the SAM server doesn't support SAM v3.2 or higher.
+        options (dict): I2CP options to configure the session with.
+        sigType (str): The SigType to use if generating a new Destination.
+        samUdpAddress (tuple): The host and port that the SAM bridge receives
+            datagrams on.
+        reactor: The reactor to listen for forwarded datagrams on.
+
+    Returns:
+        txi2p.sam.datagram.SAMDatagramPort: The port, once the session has
+        been created.
+
+    Raises:
+        twisted.internet.error.UnsupportedSocketType: if ``style`` is not
+            ``'DATAGRAM'`` or ``'RAW'``, or the session exists with another
+            style.
+        ValueError: if the session already has a datagram port, or the SAM
+            bridge forwards its datagrams to another local port.
+    """
+    if style not in (c.STYLE_DATAGRAM, c.STYLE_RAW):
+        raise error.UnsupportedSocketType()
+
+    port = SAMDatagramPort(protocol, samUdpAddress, reactor)
+    udpPort = reactor.listenUDP(0, _SAMForwardProtocol(port),
+                                interface='127.0.0.1')
+    forwardPort = udpPort.getHost().port
+    try:
+        d = getSession(nickname,
+                       samEndpoint=samEndpoint,
+                       style=style,
+                       keyfile=keyfile,
+                       localPort=localPort,
+                       options=options or {},
+                       sigType=sigType,
+                       forwardPort=forwardPort,
+                       forwardHost='127.0.0.1')
+    except Exception:
+        udpPort.stopListening()
+        raise
+
+    def startSession(session):
+        if session.style != style:
+            raise error.UnsupportedSocketType()
+        if session.datagramPort:
+            raise ValueError('Session %s already has a datagram port' % session.nickname)
+        if session.forwardPort != forwardPort:
+            # An existing session, whose datagrams go somewhere else
+            raise ValueError('Session %s forwards datagrams to another port' % session.nickname)
+        port.startSession(session, udpPort)
+        return port
+
+    def stopListening(f):
+        udpPort.stopListening()
+        return f
+
+    d.addCallback(startSession)
+    d.addErrback(stopListening)
+    return d
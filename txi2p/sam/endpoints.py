@@ -2,12 +2,14 @@
 # See COPYING for details.
 
 from builtins import object
-from twisted.internet import defer, error, interfaces
+from twisted.internet import defer, error, interfaces, reactor
 from twisted.internet.endpoints import serverFromString
+from twisted.python import failure
 from zope.interface import implementer
 
 from txi2p.sam.base import I2PFactoryWrapper
-from txi2p.sam.session import SAMSession, getSession
+from txi2p.sam.group import SHARD_ROUND_ROBIN, SAMSessionGroup, getSessionGroup
+from txi2p.sam.session import SAMSession, getSession, lookupCheck, streamCheck
 from txi2p.sam.stream import (
     StreamConnectFactory,
     StreamAcceptPort,
@@ -15,12 +17,28 @@ from txi2p.sam.stream import (
     StreamForwardPort,
 )
 
+LISTEN_ACCEPT = 'accept'
+LISTEN_FORWARD = 'forward'
+
+WARMUP_LOOKUP = 'lookup'
+WARMUP_STREAM = 'stream'
+
 
 def _parseHost(host):
     # TODO: Validate I2P domain, B32 etc.
     return (host, None) if host[-4:] == '.i2p' else (None, host)
 
 
+def _readyCheck(warmup, host=None, port=None):
+    if warmup is None or callable(warmup):
+        return warmup
+    if warmup == WARMUP_LOOKUP:
+        return lookupCheck
+    if warmup == WARMUP_STREAM and host:
+        return streamCheck(host, port)
+    raise ValueError('Unknown warm-up check: %s' % warmup)
+
+
 @implementer(interfaces.IStreamClientEndpoint)
 class SAMI2PStreamClientEndpoint(object):
     """I2P stream client endpoint backed by the SAM API.
@@ -38,7 +56,7 @@ class SAMI2PStreamClientEndpoint(object):
     """
 
     @classmethod
-    def new(cls, samEndpoint, host, port=None, nickname=None, autoClose=False, keyfile=None, localPort=None, options=None, sigType=None):
+    def new(cls, samEndpoint, host, port=None, nickname=None, autoClose=False, keyfile=None, localPort=None, options=None, sigType=None, poolSize=None, namingCache=None, warmup=None, warmupTimeout=None, supervisor=None):
         """Create an I2P client endpoint backed by the SAM API.
 
         If a SAM session for ``nickname`` already exists, it will be used, and
@@ -68,10 +86,31 @@ class SAMI2PStreamClientEndpoint(object):
             sigType (str): The SigType to use if generating a new Destination.
                 Defaults to Ed25519 if supported, falling back to
                 ECDSA_SHA256_P256 and then DSA_SHA1.
+            poolSize (int): If set, the session keeps up to this many SAM
+                connections ready for new streams, saving a round trip to the
+                SAM bridge per stream.
+            namingCache (txi2p.sam.naming.NamingCache): If set, the session
+                caches hostname lookups here, and looks up the names it
+                doesn't have over one SAM connection that stays open.
+            warmup: If set, a new session holds streams back until it passes
+                a check: ``'lookup'`` looks up the session's own B32 address,
+                and ``'stream'`` opens a test stream to ``host`` and ``port``.
+                A callable is used as the check. See
+                :meth:`txi2p.sam.SAMSession.warmUp`.
+            warmupTimeout (float): Seconds after which a new session gives up
+                waiting for the warm-up check.
+            supervisor (txi2p.sam.supervisor.SessionSupervisor): If set, a
+                new session is re-created by this if its SAM connection is
+                lost.
         """
         d = getSession(nickname,
                        samEndpoint=samEndpoint,
                        autoClose=autoClose,
+                       poolSize=poolSize,
+                       namingCache=namingCache,
+                       readyCheck=_readyCheck(warmup, host, port),
+                       readyTimeout=warmupTimeout,
+                       supervisor=supervisor,
                        keyfile=keyfile,
                        options=options,
                        sigType=sigType)
@@ -97,18 +136,33 @@ class SAMI2PStreamClientEndpoint(object):
         will immediately close.
         """
 
-        def createStream(val):
-            if self._session.style != 'STREAM':
-                raise error.UnsupportedSocketType()
-
-            i2pFac = StreamConnectFactory(fac, self._session, self._host, self._dest, self._port, self._localPort)
-            d = self._session.samEndpoint.connect(i2pFac)
+        def connectStream(dest):
+            i2pFac = StreamConnectFactory(fac, self._session, self._host, dest,
+                                          self._port, self._localPort)
+            samEndpoint = self._session.pool or self._session.samEndpoint
+            d = samEndpoint.connect(i2pFac)
             # Once the SAM IProtocol is returned, wait for the
             # real IProtocol to be returned after tunnel creation,
             # and pass it to any further registered callbacks.
             d.addCallback(lambda proto: i2pFac.deferred)
             return d
 
+        def createStream(val):
+            if not self._session.ready:
+                d = self._session.whenReady()
+                d.addCallback(createStream)
+                return d
+            if self._session.style != 'STREAM':
+                raise error.UnsupportedSocketType()
+
+            if self._session.namingCache and not self._dest:
+                # The session's resolver answers from the cache, and sends
+                # misses down the one SAM connection it keeps for lookups
+                d = self._session.resolve(self._host)
+                d.addCallback(connectStream)
+                return d
+            return connectStream(self._dest)
+
         if self._session:
             return createStream(None)
 
@@ -120,6 +174,95 @@ class SAMI2PStreamClientEndpoint(object):
         return self._sessionDeferred
 
 
+@implementer(interfaces.IStreamClientEndpoint)
+class SAMI2PShardedClientEndpoint(object):
+    """I2P stream client endpoint that spreads streams over several sessions.
+
+    Args:
+        group (txi2p.sam.group.SAMSessionGroup): The SAM sessions to connect
+            with. A group can be shared by several endpoints.
+        host (str): The I2P hostname or Destination to connect to.
+        port (int): The port to connect to inside I2P. If unset or `None`, the
+            default (null) port is used. Ignored if the SAM server doesn't
+            support SAM v3.2 or higher.
+        localPort (int): The port to connect from inside I2P. Ignored if the
+            SAM server doesn't support SAM v3.2 or higher.
+    """
+
+    @classmethod
+    def new(cls, samEndpoint, host, port=None, nickname=None, shards=2, strategy=SHARD_ROUND_ROBIN, autoClose=False, localPort=None, options=None, sigType=None, poolSize=None, namingCache=None):
+        """Create an I2P client endpoint backed by a group of SAM sessions.
+
+        The sessions are created concurrently, each with a new transient
+        Destination. See :func:`txi2p.sam.group.getSessionGroup`.
+
+        Args:
+            samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+                endpoint that will connect to the SAM API.
+            host (str): The I2P hostname or Destination to connect to.
+            port (int): The port to connect to inside I2P.
+            nickname (str): The prefix of the SAM session nicknames.
+            shards (int): The number of sessions.
+            strategy (str): How to spread streams over the sessions:
+                ``'roundRobin'``, ``'leastStreams'`` or ``'hash'``. See
+                :class:`txi2p.sam.group.SAMSessionGroup`.
+            autoClose (bool): `true` if each session should close
+                automatically once no more connections are using it.
+            localPort (int): The port to connect from inside I2P.
+            options (dict): I2CP options to configure the sessions with.
+            sigType (str): The SigType to use for the new Destinations.
+            poolSize (int): If set, each session keeps up to this many SAM
+                connections ready for new streams.
+            namingCache (txi2p.sam.naming.NamingCache): If set, the sessions
+                share this cache of hostname lookups.
+        """
+        d = getSessionGroup(nickname, shards,
+                            samEndpoint=samEndpoint,
+                            strategy=strategy,
+                            autoClose=autoClose,
+                            poolSize=poolSize,
+                            namingCache=namingCache,
+                            options=options or {},
+                            sigType=sigType)
+        return cls(d, host, port, localPort)
+
+    def __init__(self, group, host, port=None, localPort=None):
+        self._host = host
+        self._port = port
+        self._localPort = localPort
+        if isinstance(group, SAMSessionGroup):
+            self._group = group
+        else:
+            self._group = None
+            self._groupDeferred = group
+
+    def connect(self, fac):
+        """Connect over I2P, with the session that the group picks."""
+
+        def connectShard(val):
+            i = self._group.choose(self._host)
+            endpoint = SAMI2PStreamClientEndpoint(
+                self._group.sessions[i], self._host, self._port, self._localPort)
+            self._group.streamStarted(i)
+            d = endpoint.connect(fac)
+
+            def finished(result):
+                self._group.streamFinished(i, isinstance(result, failure.Failure))
+                return result
+            d.addBoth(finished)
+            return d
+
+        if self._group:
+            return defer.maybeDeferred(connectShard, None)
+
+        def saveGroup(group):
+            self._group = group
+            return None
+        self._groupDeferred.addCallback(saveGroup)
+        self._groupDeferred.addCallback(connectShard)
+        return self._groupDeferred
+
+
 @implementer(interfaces.IStreamServerEndpoint)
 class SAMI2PStreamServerEndpoint(object):
     """I2P server endpoint backed by the SAM API.
@@ -129,7 +272,7 @@ class SAMI2PStreamServerEndpoint(object):
     """
 
     @classmethod
-    def new(cls, samEndpoint, keyfile, port=None, nickname=None, autoClose=False, options=None, sigType=None):
+    def new(cls, samEndpoint, keyfile, port=None, nickname=None, autoClose=False, options=None, sigType=None, minAccepts=None, maxAccepts=None, listenMode=LISTEN_ACCEPT, reactor=reactor, warmup=None, warmupTimeout=None, supervisor=None):
         """Create an I2P server endpoint backed by the SAM API.
 
         If a SAM session for ``nickname`` already exists, it will be used, and
@@ -154,17 +297,48 @@ class SAMI2PStreamServerEndpoint(object):
             sigType (str): The SigType to use if generating a new Destination.
                 Defaults to Ed25519 if supported, falling back to
                 ECDSA_SHA256_P256 and then DSA_SHA1.
+            minAccepts (int): The fewest pending ``STREAM ACCEPT``
+                connections to keep open. See
+                :class:`txi2p.sam.stream.StreamAcceptPort`.
+            maxAccepts (int): The most pending ``STREAM ACCEPT`` connections
+                to keep open during bursts of incoming connections.
+            listenMode (str): ``'accept'`` to receive each incoming stream
+                over its own ``STREAM ACCEPT`` connection, or ``'forward'`` to
+                have the SAM bridge forward incoming streams to a local TCP
+                port. Forwarding needs no SAM round trip per stream, but the
+                SAM bridge must be able to reach ``127.0.0.1`` on this host.
+            reactor: The reactor to listen on in ``'forward'`` mode.
+            warmup: If set, a new session holds streams back until it passes
+                a check: ``'lookup'`` looks up the session's own B32 address.
+                A callable is used as the check. See
+                :meth:`txi2p.sam.SAMSession.warmUp`.
+            warmupTimeout (float): Seconds after which a new session gives up
+                waiting for the warm-up check.
+            supervisor (txi2p.sam.supervisor.SessionSupervisor): If set, a
+                new session is re-created by this if its SAM connection is
+                lost. Pending ``STREAM ACCEPT`` connections are opened again
+                once it is back.
         """
         d = getSession(nickname,
                        samEndpoint=samEndpoint,
                        autoClose=autoClose,
+                       readyCheck=_readyCheck(warmup),
+                       readyTimeout=warmupTimeout,
+                       supervisor=supervisor,
                        keyfile=keyfile,
                        localPort=port,
                        options=options,
                        sigType=sigType)
-        return cls(d)
-
-    def __init__(self, session):
+        return cls(d, minAccepts, maxAccepts, listenMode, reactor)
+
+    def __init__(self, session, minAccepts=None, maxAccepts=None,
+                 listenMode=LISTEN_ACCEPT, reactor=reactor):
+        if listenMode not in (LISTEN_ACCEPT, LISTEN_FORWARD):
+            raise ValueError('Unknown listen mode: %s' % listenMode)
+        self._minAccepts = minAccepts
+        self._maxAccepts = maxAccepts
+        self._listenMode = listenMode
+        self._reactor = reactor
         if isinstance(session, SAMSession):
             self._session = session
         else:
@@ -185,40 +359,55 @@ class SAMI2PStreamServerEndpoint(object):
             if self._session.style != 'STREAM':
                 raise error.UnsupportedSocketType()
 
-            p = StreamAcceptPort(self._session, fac)
+            p = StreamAcceptPort(self._session, fac,
+                                 self._minAccepts, self._maxAccepts)
             p.startListening()
             return p
 
-#        def createForwardingStream(val):
-#            if self._session.style != 'STREAM':
-#                raise error.UnsupportedSocketType()
-#
-#            serverEndpoint = serverFromString(self._reactor,
-#                                              'tcp:0:interface=127.0.0.1')
-#            wrappedFactory = I2PFactoryWrapper(fac, self._session.address)
-#            d = serverEndpoint.listen(wrappedFactory)
-#
-#            def setupForward(port):
-#                local_port = port.getHost().port
-#                i2pFac = StreamForwardFactory(self._session, local_port)
-#                d2 = self._session.samEndpoint.connect(i2pFac)
-#                d2.addCallback(lambda proto: i2pFac.deferred)
-#                d2.addCallback(lambda forwardingProto: (port, forwardingProto))
-#                return d2
-#
-#            def handlePort((port, forwardingProto)):
-#                return StreamForwardPort(port, forwardingProto, self._session.address)
-#
-#            d.addCallback(setupForward)
-#            d.addCallback(handlePort)
-#            return d
+        def createForwardingStream(val):
+            if self._session.style != 'STREAM':
+                raise error.UnsupportedSocketType()
+
+            serverEndpoint = serverFromString(self._reactor,
+                                              'tcp:0:interface=127.0.0.1')
+            wrappedFactory = I2PFactoryWrapper(fac, self._session.address)
+            d = serverEndpoint.listen(wrappedFactory)
+
+            def setupForward(port):
+                local_port = port.getHost().port
+                i2pFac = StreamForwardFactory(self._session, local_port)
+                d2 = self._session.samEndpoint.connect(i2pFac)
+                d2.addCallback(lambda proto: i2pFac.deferred)
+                d2.addCallback(lambda forwardingProto: StreamForwardPort(
+                    port, forwardingProto, self._session.address))
+
+                def stopListening(f):
+                    port.stopListening()
+                    return f
+                d2.addErrback(stopListening)
+                return d2
+
+            d.addCallback(setupForward)
+            return d
+
+        if self._listenMode == LISTEN_FORWARD:
+            createListeningStream = createForwardingStream
+        else:
+            createListeningStream = createAcceptingStream
+
+        def createStream(val):
+            if not self._session.ready:
+                d = self._session.whenReady()
+                d.addCallback(createStream)
+                return d
+            return createListeningStream(val)
 
         if self._session:
-            return createAcceptingStream(None)
+            return createStream(None)
 
         def saveSession(session):
             self._session = session
             return None
         self._sessionDeferred.addCallback(saveSession)
-        self._sessionDeferred.addCallback(createAcceptingStream)
+        self._sessionDeferred.addCallback(createStream)
         return self._sessionDeferred
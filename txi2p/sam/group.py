@@ -0,0 +1,165 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from builtins import range
+import bisect
+import hashlib
+import os
+from twisted.internet import defer, error
+
+from txi2p.sam import session
+
+SHARD_ROUND_ROBIN = 'roundRobin'
+SHARD_LEAST_STREAMS = 'leastStreams'
+SHARD_HASH = 'hash'
+SHARD_STRATEGIES = (SHARD_ROUND_ROBIN, SHARD_LEAST_STREAMS, SHARD_HASH)
+
+# Points on the hash ring per session
+HASH_REPLICAS = 64
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class SAMSessionGroup(object):
+    """A group of SAM sessions that outbound streams are spread across.
+
+    Each session has its own Destination and tunnels, so a group of ``N``
+    sessions has ``N`` times the tunnel capacity of one.
+
+    Args:
+        sessions (list): The :class:`txi2p.sam.SAMSession` instances.
+        strategy (str): How to pick a session for a new stream.
+            ``'roundRobin'`` takes each session in turn. ``'leastStreams'``
+            takes the session with the fewest open and opening streams.
+            ``'hash'`` always takes the same session for the same host, by
+            consistent hashing, so that a host sees one Destination.
+
+    Attributes:
+        sessions (list): The sessions in the group.
+        strategy (str): The strategy in use.
+        connects (list): The number of streams started on each session.
+        failures (list): The number of those that failed.
+    """
+
+    def __init__(self, sessions, strategy=SHARD_ROUND_ROBIN):
+        if strategy not in SHARD_STRATEGIES:
+            raise ValueError('Unknown shard strategy: %s' % strategy)
+        self.sessions = list(sessions)
+        self.strategy = strategy
+        self.connects = [0] * len(self.sessions)
+        self.failures = [0] * len(self.sessions)
+        self._pending = [0] * len(self.sessions)
+        self._next = 0
+        self._ring = sorted(
+            (_hash('%s-%d' % (s.nickname, r)), i)
+            for i, s in enumerate(self.sessions)
+            for r in range(HASH_REPLICAS))
+        self._ringKeys = [point for point, i in self._ring]
+
+    def _open(self):
+        return [i for i, s in enumerate(self.sessions) if not s._closed]
+
+    def _load(self, i):
+        return len(self.sessions[i]._streams) + self._pending[i]
+
+    def choose(self, host):
+        """Pick the index of the session for a new stream to ``host``.
+
+        Closed sessions are skipped.
+
+        Raises:
+            twisted.internet.error.ConnectionDone: if every session is closed.
+        """
+        available = self._open()
+        if not available:
+            raise error.ConnectionDone()
+
+        if self.strategy == SHARD_LEAST_STREAMS:
+            return min(available, key=lambda i: (self._load(i), self.connects[i]))
+
+        if self.strategy == SHARD_HASH:
+            pos = bisect.bisect(self._ringKeys, _hash(host))
+            for n in range(len(self._ring)):
+                i = self._ring[(pos + n) % len(self._ring)][1]
+                if i in available:
+                    return i
+
+        for n in range(len(self.sessions)):
+            i = (self._next + n) % len(self.sessions)
+            if i in available:
+                self._next = i + 1
+                return i
+
+    def streamStarted(self, i):
+        self.connects[i] += 1
+        self._pending[i] += 1
+
+    def streamFinished(self, i, failed=False):
+        self._pending[i] -= 1
+        if failed:
+            self.failures[i] += 1
+
+    def stats(self):
+        """Per-session load statistics.
+
+        Returns:
+            list: A dict for each session, with its ``nickname``, the number
+            of ``streams`` open and ``pending``, and the number of
+            ``connects`` and ``failures`` so far.
+        """
+        return [{
+            'nickname': s.nickname,
+            'streams': len(s._streams),
+            'pending': self._pending[i],
+            'connects': self.connects[i],
+            'failures': self.failures[i],
+        } for i, s in enumerate(self.sessions)]
+
+    def close(self):
+        """Close every session in the group."""
+        for s in self.sessions:
+            if not s._closed:
+                s.close()
+
+
+def getSessionGroup(nickname, size, samEndpoint=None, strategy=SHARD_ROUND_ROBIN, **kwargs):
+    """Create a group of SAM sessions.
+
+    The sessions are created concurrently, and are named ``nickname-0`` to
+    ``nickname-<size - 1>``. Sessions with those nicknames that already exist
+    are used as they are. The other arguments are as for
+    :func:`txi2p.sam.session.getSession`.
+
+    Args:
+        nickname (str): The prefix of the session nicknames.
+        size (int): The number of sessions.
+        strategy (str): See :class:`SAMSessionGroup`.
+
+    Returns:
+        A Deferred that fires with the :class:`SAMSessionGroup` once every
+        session has been created. If any of them fails, the others that were
+        created for the group are closed.
+    """
+    if strategy not in SHARD_STRATEGIES:
+        raise ValueError('Unknown shard strategy: %s' % strategy)
+    if not nickname:
+        nickname = 'txi2p-%d' % os.getpid()
+
+    nicknames = ['%s-%d' % (nickname, i) for i in range(size)]
+    existing = [n for n in nicknames if n in session._sessions]
+    ds = [session.getSession(n, samEndpoint, **kwargs) for n in nicknames]
+    d = defer.DeferredList(ds, consumeErrors=True)
+
+    def gotSessions(results):
+        failures = [result for success, result in results if not success]
+        if failures:
+            for success, result in results:
+                if success and result.nickname not in existing:
+                    result.close()
+            return failures[0]
+        return SAMSessionGroup([result for success, result in results], strategy)
+    d.addCallback(gotSessions)
+    return d
@@ -0,0 +1,183 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from builtins import range
+import math
+from twisted.python import log
+
+DEFAULT_TICK = 1.0
+DEFAULT_SLOTS = 512
+
+
+class WheelTimer(object):
+    """A timer scheduled on a :class:`TimerWheel`.
+
+    It has the ``active``, ``cancel``, ``reset`` and ``getTime`` methods of
+    :class:`twisted.internet.interfaces.IDelayedCall`, but cancelling a timer
+    that is no longer active does nothing.
+    """
+    __slots__ = ('wheel', 'tick', 'func', 'args')
+
+    def __init__(self, wheel, func, args):
+        self.wheel = wheel
+        self.tick = None
+        self.func = func
+        self.args = args
+
+    def active(self):
+        return self.tick is not None
+
+    def cancel(self):
+        if self.tick is not None:
+            self.wheel._remove(self)
+
+    def reset(self, delay):
+        """Fire ``delay`` seconds from now instead."""
+        if self.tick is not None:
+            self.wheel._remove(self)
+        self.wheel._add(self, delay)
+
+    def getTime(self):
+        return self.tick * self.wheel.tick
+
+
+class TimerWheel(object):
+    """Runs many coarse timers off a single reactor timer.
+
+    Timers are kept in a ring of ``slots`` buckets, each covering ``tick``
+    seconds, so scheduling, cancelling and resetting a timer are O(1) and
+    never touch the reactor. The reactor only has one pending call, which
+    fires once per tick while any timer is scheduled. Timers fire up to
+    ``tick`` seconds late, never early. Timers further away than
+    ``slots * tick`` seconds stay in their bucket for more than one turn.
+
+    Args:
+        tick (float): The resolution, in seconds.
+        slots (int): The number of buckets.
+        clock: An :class:`twisted.internet.interfaces.IReactorTime` provider.
+
+    Attributes:
+        scheduled (int): The number of timers scheduled, including resets.
+        cancelled (int): The number of timers cancelled, including resets.
+        fired (int): The number of timers that fired.
+        wakeups (int): The number of times the reactor timer fired.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, clock=None):
+        self.tick = tick
+        self.slots = slots
+        self.scheduled = 0
+        self.cancelled = 0
+        self.fired = 0
+        self.wakeups = 0
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        # dicts keep insertion order, so timers in a bucket fire in order
+        self._buckets = [{} for i in range(slots)]
+        self._count = 0
+        self._current = None
+        self._call = None
+        self._advancing = False
+
+    def __len__(self):
+        return self._count
+
+    def callLater(self, delay, func, *args):
+        """Call ``func(*args)`` in ``delay`` seconds.
+
+        Returns:
+            WheelTimer: The timer.
+        """
+        timer = WheelTimer(self, func, args)
+        self._add(timer, delay)
+        return timer
+
+    def _now(self):
+        now = self._clock.seconds()
+        # The epsilon stops float error from landing just before a tick
+        return now, int(math.floor(now / self.tick + 1e-9))
+
+    def _add(self, timer, delay):
+        if self._call is None and not self._advancing:
+            self._start()
+        # Round up, so that timers never fire early
+        tick = int(math.ceil((self._clock.seconds() + delay) / self.tick))
+        if tick <= self._current:
+            tick = self._current + 1
+        timer.tick = tick
+        self._buckets[tick % self.slots][timer] = None
+        self._count += 1
+        self.scheduled += 1
+
+    def _remove(self, timer):
+        del self._buckets[timer.tick % self.slots][timer]
+        timer.tick = None
+        self._count -= 1
+        self.cancelled += 1
+        if not self._count and not self._advancing:
+            self._stop()
+
+    def _start(self):
+        now, self._current = self._now()
+        self._schedule(now)
+
+    def _schedule(self, now):
+        self._call = self._clock.callLater(
+            max(0, (self._current + 1) * self.tick - now), self._advance)
+
+    def _stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._current = None
+
+    def _advance(self):
+        self._call = None
+        self.wakeups += 1
+        now, nowTick = self._now()
+        start = self._current
+        self._current = max(start, nowTick)
+        self._advancing = True
+        try:
+            # After a long stall every bucket is visited once
+            for i in range(min(nowTick - start, self.slots)):
+                bucket = self._buckets[(start + 1 + i) % self.slots]
+                due = [timer for timer in bucket if timer.tick <= nowTick]
+                for timer in due:
+                    if timer.tick is None or timer.tick > nowTick:
+                        # Cancelled or reset by an earlier timer
+                        continue
+                    del bucket[timer]
+                    timer.tick = None
+                    self._count -= 1
+                    self.fired += 1
+                    try:
+                        timer.func(*timer.args)
+                    except:
+                        log.err()
+        finally:
+            self._advancing = False
+        if self._count:
+            self._schedule(now)
+        else:
+            self._current = None
+
+# One wheel per clock, so that connections on other event loops get their own
+_wheels = {}
+
+
+def keepaliveWheel(clock=None):
+    """The timer wheel shared by the keepalives of all SAM connections.
+
+    Args:
+        clock: The :class:`twisted.internet.interfaces.IReactorTime` provider
+            that the connections run on. Defaults to the reactor.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    wheel = _wheels.get(clock)
+    if wheel is None:
+        wheel = _wheels[clock] = TimerWheel(clock=clock)
+    return wheel
@@ -0,0 +1,285 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from collections import OrderedDict
+from twisted.internet import defer, error, reactor
+from twisted.internet.error import UnknownHostError
+from twisted.python import failure
+
+from txi2p.sam import constants as c
+from txi2p.sam.base import (cmpSAM, makeSAMProtocol, SAMSender, SAMReceiver,
+                             SAMFactory)
+
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_TTL = 60 * 60
+DEFAULT_NEGATIVE_TTL = 60
+
+
+class NamingCache(object):
+    """A cache of I2P hostname to Destination lookups.
+
+    A cache can be given to a single session, or shared by several sessions.
+    Entries expire after a TTL, and the least recently used entries are
+    evicted once the cache is full. Names that the SAM bridge could not find
+    are also cached, for a shorter time. While a name is being looked up,
+    further connects to it wait for that lookup instead of sending their own.
+
+    Args:
+        maxSize (int): The maximum number of names to cache.
+        ttl (int): Seconds to cache a Destination for.
+        negativeTTL (int): Seconds to remember that a name was not found.
+        clock: An :class:`twisted.internet.interfaces.IReactorTime` provider.
+
+    Attributes:
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups sent to the SAM bridge.
+        merged (int): The number of lookups that waited for another lookup of
+            the same name.
+    """
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL,
+                 negativeTTL=DEFAULT_NEGATIVE_TTL, clock=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self._clock = clock or reactor
+        # name -> (expiry time, Destination or None if not found)
+        self._entries = OrderedDict()
+        # name -> list of Deferreds waiting for the lookup
+        self._inFlight = {}
+
+    def lookup(self, name):
+        """Look up a name in the cache.
+
+        Returns:
+            `None` if the caller must look the name up itself, in which case
+            it must report the outcome with :meth:`resolved`,
+            :meth:`notFound` or :meth:`failed`. Otherwise, a Deferred that
+            fires with the Destination for ``name``, or with `None` if the
+            lookup it waited for failed and the caller should look the name
+            up itself.
+        """
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            expiry, dest = entry
+            if expiry > self._clock.seconds():
+                # Re-insert to mark as most recently used
+                self._entries[name] = entry
+                self.hits += 1
+                if dest is None:
+                    return defer.fail(UnknownHostError(string=name))
+                return defer.succeed(dest)
+
+        if name in self._inFlight:
+            def cancel(d):
+                if name in self._inFlight and d in self._inFlight[name]:
+                    self._inFlight[name].remove(d)
+            d = defer.Deferred(cancel)
+            self._inFlight[name].append(d)
+            self.merged += 1
+            return d
+
+        self._inFlight[name] = []
+        self.misses += 1
+        return None
+
+    def resolved(self, name, dest):
+        """Store the Destination that ``name`` resolved to."""
+        self._store(name, dest, self.ttl)
+        for d in self._inFlight.pop(name, []):
+            d.callback(dest)
+
+    def notFound(self, name):
+        """Record that the SAM bridge could not find ``name``."""
+        self._store(name, None, self.negativeTTL)
+        for d in self._inFlight.pop(name, []):
+            d.errback(UnknownHostError(string=name))
+
+    def failed(self, name):
+        """Report that looking up ``name`` failed for another reason.
+
+        Nothing is cached, and anything waiting for the lookup is told to look
+        the name up itself.
+        """
+        for d in self._inFlight.pop(name, []):
+            d.callback(None)
+
+    def _store(self, name, dest, ttl):
+        self._entries.pop(name, None)
+        self._entries[name] = (self._clock.seconds() + ttl, dest)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+
+class NamingLookupReceiver(SAMReceiver):
+    def command(self):
+        # The connection stays open between lookups, so keep it alive
+        if cmpSAM(self.factory.samVersion, '3.2') >= 0:
+            self.pinger = self._keepalive(self.pinger, self._sendPing)
+        self.currentRule = 'State_resolver'
+        self.factory.resolverReady(self)
+
+    def lookupReply(self, result, name, value=None, message=None):
+        self.factory.resolver._lookupReply(result, name, value, message)
+
+
+# A Protocol for looking up names via SAM
+NamingLookupProtocol = makeSAMProtocol(
+    SAMSender,
+    NamingLookupReceiver)
+
+
+class NamingLookupFactory(SAMFactory):
+    protocol = NamingLookupProtocol
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.samVersion = None
+
+    def resolverReady(self, receiver):
+        self.resolver._connected(self, receiver)
+
+    def connectionFailed(self, reason):
+        self.resolver._connectionLost(self, reason)
+
+
+class SAMNamingResolver(object):
+    """Looks up I2P hostnames over a single SAM connection.
+
+    The connection is opened on the first lookup and kept open, with
+    keepalive pings if the SAM bridge supports them, and every lookup is
+    pipelined through it; replies are matched to lookups by name.
+    Concurrent lookups of the same name are sent once. If the connection is
+    lost, pending lookups fail and the next lookup reconnects. Once the
+    resolver is closed, lookups fail.
+
+    Args:
+        samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the SAM API.
+        namingCache (NamingCache): If set, lookups are answered from and
+            stored in this cache.
+
+    Attributes:
+        sent (int): The number of ``NAMING LOOKUP`` commands sent.
+    """
+
+    def __init__(self, samEndpoint, namingCache=None):
+        self.samEndpoint = samEndpoint
+        self.namingCache = namingCache
+        self.sent = 0
+        self._factory = None
+        self._receiver = None
+        self._closed = False
+        # name -> list of Deferreds, for lookups that have not been answered
+        self._waiting = {}
+        # Names waiting for the connection to be ready
+        self._unsent = []
+
+    def resolve(self, name):
+        """Look up the Destination for ``name``.
+
+        Returns:
+            A Deferred that fires with the Destination as a base64 string, or
+            fails with :class:`twisted.internet.error.UnknownHostError` if the
+            SAM bridge could not find the name.
+        """
+        if self._closed:
+            return defer.fail(error.ConnectionDone())
+        cache = self.namingCache
+        if cache is not None:
+            d = cache.lookup(name)
+            if d is not None:
+                d.addCallback(self._retry, name)
+                return d
+
+        if name in self._waiting:
+            d = defer.Deferred()
+            self._waiting[name].append(d)
+            return d
+
+        d = defer.Deferred()
+        self._waiting[name] = [d]
+        if self._receiver:
+            self._send(name)
+        else:
+            self._unsent.append(name)
+            self._connect()
+        return d
+
+    def _retry(self, dest, name):
+        if dest is not None:
+            return dest
+        # A failed lookup by someone else leaves it to us
+        if self._closed:
+            raise error.ConnectionDone()
+        return self.resolve(name)
+
+    def close(self):
+        """Close the connection, failing any pending and later lookups."""
+        self._closed = True
+        fac, self._factory = self._factory, None
+        receiver, self._receiver = self._receiver, None
+        self._failAll(failure.Failure(error.ConnectionDone()))
+        if receiver:
+            receiver.sender.transport.loseConnection()
+        elif fac and fac.currentCandidate:
+            fac.currentCandidate.transport.loseConnection()
+
+    def _connect(self):
+        if self._factory:
+            return
+        fac = self._factory = NamingLookupFactory(self)
+        d = self.samEndpoint.connect(fac)
+        d.addErrback(lambda f: self._connectionLost(fac, f))
+
+    def _send(self, name):
+        self.sent += 1
+        self._receiver.sender.sendNamingLookup(name)
+
+    def _connected(self, fac, receiver):
+        if fac is not self._factory:
+            receiver.sender.transport.loseConnection()
+            return
+        self._receiver = receiver
+        unsent, self._unsent = self._unsent, []
+        for name in unsent:
+            self._send(name)
+
+    def _connectionLost(self, fac, reason):
+        if fac is not self._factory:
+            return
+        self._factory = None
+        self._receiver = None
+        self._failAll(reason)
+
+    def _failAll(self, reason):
+        waiting, self._waiting = self._waiting, {}
+        self._unsent = []
+        for name, ds in waiting.items():
+            if self.namingCache is not None:
+                self.namingCache.failed(name)
+            for d in ds:
+                d.errback(reason)
+
+    def _lookupReply(self, result, name, value, message):
+        ds = self._waiting.pop(name, [])
+        cache = self.namingCache
+        if result == c.RESULT_OK:
+            if cache is not None:
+                cache.resolved(name, value)
+            for d in ds:
+                d.callback(value)
+            return
+
+        if cache is not None:
+            if result == c.RESULT_KEY_NOT_FOUND:
+                cache.notFound(name)
+            else:
+                cache.failed(name)
+        errorClass = c.samErrorMap.get(result, error.ConnectError)
+        for d in ds:
+            d.errback(errorClass(string=(message if message else result)))
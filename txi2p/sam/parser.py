@@ -0,0 +1,139 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+
+
+class SAMParseError(ValueError):
+    """Raised when a SAM bridge sends a line that cannot be parsed."""
+
+
+def parseOptions(line):
+    """Parse the ``KEY=VALUE`` options of a SAM reply.
+
+    Keys are lowercased. Values may be quoted with ``"`` to include spaces.
+    This matches the ``OPTIONS`` rule in :data:`txi2p.grammar.samGrammarSource`.
+
+    Args:
+        line (str): The options part of a reply, without the trailing newline.
+
+    Returns:
+        dict: The parsed options.
+    """
+    options = {}
+    pos = 0
+    end = len(line)
+    while pos < end:
+        eq = line.find('=', pos)
+        if eq < 0:
+            raise SAMParseError('Option without value: %r' % line[pos:])
+        key = line[pos:eq].lower()
+        pos = eq + 1
+        if line.startswith('"', pos):
+            close = line.find('"', pos + 1)
+            if close < 0:
+                raise SAMParseError('Unterminated quoted value: %r' % line[pos:])
+            value = line[pos + 1:close]
+            pos = close + 1
+        else:
+            close = line.find(' ', pos)
+            if close < 0:
+                close = end
+            value = line[pos:close]
+            pos = close
+        options[key] = value
+        if pos < end:
+            if line[pos] != ' ':
+                raise SAMParseError('Unexpected data after value: %r' % line[pos:])
+            pos += 1
+    return options
+
+
+def _parseKeepalive(command, line):
+    data = line[len(command):]
+    if data and data[0] != ' ':
+        raise SAMParseError('Unexpected %s line: %r' % (command, line))
+    return data.lstrip(' ') or None
+
+
+# Maps each receiver state onto the reply it expects and the receiver method
+# that handles it. State_keepalive, State_primary, State_resolver and
+# State_readData are handled separately.
+_replyRules = {
+    'State_hello':   ('HELLO REPLY ',    'hello'),
+    'State_create':  ('SESSION STATUS ', 'create'),
+    'State_connect': ('STREAM STATUS ',  'connect'),
+    'State_accept':  ('STREAM STATUS ',  'accept'),
+    'State_forward': ('STREAM STATUS ',  'forward'),
+    'State_naming':  ('NAMING REPLY ',   'lookupReply'),
+    'State_dest':    ('DEST REPLY ',     'destGenerated'),
+}
+
+
+class SAMLineParser(object):
+    """An incremental, line-based parser for SAM control replies.
+
+    This is a drop-in replacement for the ``TrampolinedParser`` that Parsley
+    builds from :data:`txi2p.grammar.samGrammarSource`. It reads whole lines
+    from ``bytes`` and dispatches them to the same receiver methods, based on
+    the receiver's ``currentRule``.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self._buffer = b''
+
+    def _setupInterp(self):
+        # The grammar interpreter must be reset when currentRule is changed
+        # from outside of a rule action. This parser reads currentRule for
+        # every line, so there is nothing to reset.
+        pass
+
+    def receive(self, data):
+        """Receive and parse some data.
+
+        Args:
+            data (bytes): Data received from the SAM bridge.
+        """
+        buf = self._buffer + data if self._buffer else data
+        pos = 0
+        receiver = self.receiver
+        while pos < len(buf):
+            if receiver.currentRule == 'State_readData':
+                self._buffer = b''
+                receiver.dataReceived(buf[pos:])
+                return
+            eol = buf.find(b'\n', pos)
+            if eol < 0:
+                break
+            line = buf[pos:eol].decode('utf-8')
+            pos = eol + 1
+            self._dispatch(line)
+        self._buffer = buf[pos:]
+
+    def _dispatch(self, line):
+        receiver = self.receiver
+        rule = receiver.currentRule
+        if rule in ('State_keepalive', 'State_primary', 'State_resolver'):
+            if line.startswith('PING'):
+                receiver.ping(_parseKeepalive('PING', line))
+            elif line.startswith('PONG'):
+                receiver.pong(_parseKeepalive('PONG', line))
+            elif rule == 'State_primary' and line.startswith('SESSION STATUS '):
+                # Reply to a SESSION ADD or SESSION REMOVE
+                receiver.subsessionStatus(
+                    **parseOptions(line[len('SESSION STATUS '):]))
+            elif rule == 'State_resolver' and line.startswith('NAMING REPLY '):
+                receiver.lookupReply(
+                    **parseOptions(line[len('NAMING REPLY '):]))
+            else:
+                raise SAMParseError('Unexpected keepalive line: %r' % line)
+            return
+
+        try:
+            prefix, method = _replyRules[rule]
+        except KeyError:
+            raise SAMParseError('Unknown parser state: %s' % rule)
+        if not line.startswith(prefix):
+            raise SAMParseError('Expected %r, got %r' % (prefix, line))
+        getattr(receiver, method)(**parseOptions(line[len(prefix):]))
@@ -0,0 +1,151 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IStreamClientEndpoint
+from zope.interface import implementer
+
+from txi2p.sam.base import SAMFactory
+from txi2p.sam.stream import StreamConnectProtocol
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_IDLE_AGE = 5 * 60
+
+
+class PooledConnectionFactory(SAMFactory):
+    protocol = StreamConnectProtocol
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.samVersion = None
+        self.expiry = None
+        self.deferred = defer.Deferred(self._cancel)
+
+    def connectionReady(self, receiver):
+        # Called instead of command() once HELLO has completed.
+        self.pool._connectionReady(self)
+
+    def connectionFailed(self, reason):
+        self.pool._connectionFailed(self)
+
+    def adopt(self, factory):
+        """Hand this connection over to ``factory`` and run its command."""
+        proto = self.currentCandidate
+        proto.factory = factory
+        proto.receiver.factory = factory
+        factory.currentCandidate = proto
+        factory.samVersion = self.samVersion
+        proto.receiver.command()
+        # The parser was waiting for a rule that has now been replaced.
+        proto._parser._setupInterp()
+        return proto
+
+
+@implementer(IStreamClientEndpoint)
+class SAMConnectionPool(object):
+    """A pool of SAM bridge connections that have already completed HELLO.
+
+    The pool is used as the endpoint for ``STREAM CONNECT`` connections. Each
+    connect takes an idle connection if there is one, which skips the connection
+    and ``HELLO VERSION`` round trips; otherwise it dials the SAM bridge as usual.
+    The pool refills itself in the background.
+
+    Args:
+        samEndpoint (twisted.internet.interfaces.IStreamClientEndpoint): An
+            endpoint that will connect to the SAM API.
+        size (int): The maximum number of idle connections to keep.
+        minIdle (int): The pool refills once fewer than this many connections
+            are idle or being opened. Defaults to ``size``.
+        maxIdleAge (int): Seconds after which an idle connection is closed and
+            replaced.
+        clock: An :class:`twisted.internet.interfaces.IReactorTime` provider.
+
+    Attributes:
+        hits (int): The number of connects that used an idle connection.
+        misses (int): The number of connects that had to dial the SAM bridge.
+    """
+
+    def __init__(self, samEndpoint, size=DEFAULT_POOL_SIZE, minIdle=None,
+                 maxIdleAge=DEFAULT_MAX_IDLE_AGE, clock=None):
+        self.samEndpoint = samEndpoint
+        self.size = size
+        self.minIdle = size if minIdle is None else min(minIdle, size)
+        self.maxIdleAge = maxIdleAge
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock or reactor
+        self._idle = []
+        self._pending = []
+        self._stopped = False
+
+    def start(self):
+        """Start filling the pool."""
+        self._stopped = False
+        self._fill()
+
+    def stop(self):
+        """Close all idle connections and stop refilling the pool."""
+        self._stopped = True
+        idle, self._idle = self._idle, []
+        for fac in idle:
+            self._cancelExpiry(fac)
+            fac.currentCandidate.sender.transport.loseConnection()
+
+    def connect(self, factory):
+        """Connect a :class:`txi2p.sam.stream.StreamConnectFactory`.
+
+        Returns:
+            A Deferred that fires with the SAM protocol, as for
+            ``samEndpoint.connect``.
+        """
+        if self._idle:
+            pooledFac = self._idle.pop()
+            self._cancelExpiry(pooledFac)
+            self.hits += 1
+            proto = pooledFac.adopt(factory)
+            self._fill()
+            return defer.succeed(proto)
+        self.misses += 1
+        self._fill()
+        return self.samEndpoint.connect(factory)
+
+    def _fill(self):
+        if self._stopped:
+            return
+        if len(self._idle) + len(self._pending) >= self.minIdle:
+            return
+        for i in range(self.size - len(self._idle) - len(self._pending)):
+            fac = PooledConnectionFactory(self)
+            self._pending.append(fac)
+            d = self.samEndpoint.connect(fac)
+            # Failed connections are not retried until the pool is next used.
+            d.addErrback(lambda f, fac=fac: self._connectionFailed(fac))
+
+    def _connectionReady(self, fac):
+        if fac in self._pending:
+            self._pending.remove(fac)
+        if self._stopped:
+            fac.currentCandidate.sender.transport.loseConnection()
+            return
+        fac.expiry = self._clock.callLater(self.maxIdleAge, self._expire, fac)
+        self._idle.append(fac)
+
+    def _connectionFailed(self, fac):
+        if fac in self._pending:
+            self._pending.remove(fac)
+        if fac in self._idle:
+            self._idle.remove(fac)
+            self._cancelExpiry(fac)
+
+    def _expire(self, fac):
+        fac.expiry = None
+        if fac in self._idle:
+            self._idle.remove(fac)
+            fac.currentCandidate.sender.transport.loseConnection()
+        self._fill()
+
+    def _cancelExpiry(self, fac):
+        if fac.expiry and fac.expiry.active():
+            fac.expiry.cancel()
+        fac.expiry = None
@@ -5,11 +5,18 @@ from __future__ import print_function
 from builtins import object
 import os
 import sys
-from twisted.internet import defer, error
+from twisted.internet import defer, error, reactor
+try:
+    from twisted.internet.interfaces import IUNIXTransport
+except ImportError:
+    # Twisted < 11.1
+    IUNIXTransport = None
+from twisted.internet.protocol import Factory, Protocol
 from twisted.python import failure, log
 
 from txi2p import grammar
 from txi2p.address import I2PAddress
+from txi2p.keystore import keyStore
 from txi2p.sam import constants as c
 from txi2p.sam.base import (
     cmpSAM,
@@ -18,13 +25,31 @@ from txi2p.sam.base import (
     SAMReceiver,
     SAMFactory,
 )
+from txi2p.sam.naming import SAMNamingResolver
+from txi2p.sam.pool import DEFAULT_MAX_IDLE_AGE, SAMConnectionPool
+from txi2p.sam.stream import StreamConnectFactory
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def keepTransportAlive(transport):
+    """Help keep a SAM control connection open without SAM keepalives.
+
+    TCP connections have TCP keepalive enabled. A Unix socket can't be dropped
+    by a NAT or firewall, and is closed as soon as the SAM bridge goes away,
+    so it needs nothing.
+    """
+    if IUNIXTransport and IUNIXTransport.providedBy(transport):
+        return
+    try:
+        transport.setTcpKeepAlive(1)
+    except AttributeError as e:
+        eprint(e)
+
+
 class SessionCreateSender(SAMSender):
-    def sendSessionCreate(self, samVersion, style, id, privKey=None, localPort=None, options={}, sigType=None):
+    def sendSessionCreate(self, samVersion, style, id, privKey=None, localPort=None, options={}, sigType=None, forwardPort=None, forwardHost=None):
         msg = 'SESSION CREATE'
         msg += ' STYLE=%s' % style
         msg += ' ID=%s' % id
@@ -33,19 +58,58 @@ class SessionCreateSender(SAMSender):
             msg += ' SIGNATURE_TYPE=%s' % (sigType and sigType or c.DEFAULT_SIGTYPE)
         if localPort:
             msg += ' FROM_PORT=%d' % localPort
+        if forwardPort:
+            msg += ' PORT=%d' % forwardPort
+            if forwardHost:
+                msg += ' HOST=%s' % forwardHost
         for key in options:
             msg += ' %s=%s' % (key, options[key])
         msg += '\n'
         self.transport.write(msg.encode('utf-8'))
 
+    def sendSessionAdd(self, style, id, fromPort=None, listenPort=None, options={}):
+        msg = 'SESSION ADD'
+        msg += ' STYLE=%s' % style
+        msg += ' ID=%s' % id
+        if fromPort:
+            msg += ' FROM_PORT=%d' % fromPort
+        if listenPort:
+            msg += ' LISTEN_PORT=%d' % listenPort
+        for key in options:
+            msg += ' %s=%s' % (key, options[key])
+        msg += '\n'
+        self.transport.write(msg.encode('utf-8'))
+
+    def sendSessionRemove(self, id):
+        msg = 'SESSION REMOVE ID=%s\n' % id
+        self.transport.write(msg.encode('utf-8'))
+
 
 class SessionCreateReceiver(SAMReceiver):
     def command(self):
+        if self.factory.style == c.STYLE_PRIMARY and \
+                cmpSAM(self.factory.samVersion, '3.3') < 0:
+            raise error.UnsupportedSocketType('PRIMARY sessions require SAM 3.3')
         if not (hasattr(self.factory, 'nickname') and self.factory.nickname):
             # All tunnels in the same process use the same nickname
             # TODO is using the PID a security risk?
             self.factory.nickname = 'txi2p-%d' % os.getpid()
 
+        # The parser moves on to the next rule as soon as this returns, so
+        # set it now even if the keyfile is still being read
+        self.currentRule = 'State_create'
+        keyLoading = getattr(self.factory, 'keyLoading', None)
+        if keyLoading:
+            keyLoading.addCallbacks(lambda _: self._sendSessionCreate(),
+                                    self._keysNotLoaded)
+        else:
+            self._sendSessionCreate()
+
+    def _keysNotLoaded(self, reason):
+        # The factory has already failed, so give up on the session
+        self.sender.transport.loseConnection()
+
+    def _sendSessionCreate(self):
         self.sender.sendSessionCreate(
             self.factory.samVersion,
             self.factory.style,
@@ -53,8 +117,9 @@ class SessionCreateReceiver(SAMReceiver):
             self.factory.privKey,
             self.factory.localPort,
             self.factory.options,
-            self.factory.sigType)
-        self.currentRule = 'State_create'
+            self.factory.sigType,
+            self.factory.forwardPort,
+            self.factory.forwardHost)
 
     def create(self, result, destination=None, message=None):
         if result != c.RESULT_OK:
@@ -71,7 +136,9 @@ class SessionCreateReceiver(SAMReceiver):
                     self.factory.privKey,
                     self.factory.localPort,
                     self.factory.options,
-                    fallback)
+                    fallback,
+                    self.factory.forwardPort,
+                    self.factory.forwardHost)
             else:
                 self.factory.resultNotOK(result, message)
             return
@@ -85,12 +152,15 @@ class SessionCreateReceiver(SAMReceiver):
         if cmpSAM(self.factory.samVersion, '3.2') >= 0:
             self.startPinging()
         else:
-            try:
-                self.sender.transport.setTcpKeepAlive(1)
-            except AttributeError as e:
-                eprint(e)
+            keepTransportAlive(self.sender.transport)
+        if self.factory.style == c.STYLE_PRIMARY:
+            # Subsessions are added and removed over this connection
+            self.currentRule = 'State_primary'
         self.factory.sessionCreated(self, dest)
 
+    def subsessionStatus(self, result, id=None, message=None, **kwargs):
+        self.factory.subsessionStatus(result, message)
+
 
 # A Protocol for making a SAM session
 SessionCreateProtocol = makeSAMProtocol(
@@ -100,9 +170,11 @@ SessionCreateProtocol = makeSAMProtocol(
 
 class SessionCreateFactory(SAMFactory):
     protocol = SessionCreateProtocol
+    # The reactor to read the keyfile with, if not the global one
+    reactor = None
 
-    def __init__(self, nickname, style='STREAM', keyfile=None, localPort=None, options={}, sigType=None):
-        if style != 'STREAM':
+    def __init__(self, nickname, style='STREAM', keyfile=None, localPort=None, options={}, sigType=None, forwardPort=None, forwardHost=None):
+        if style not in c.SESSION_STYLES:
             raise error.UnsupportedSocketType()
         self.nickname = nickname
         self.style = style
@@ -110,31 +182,67 @@ class SessionCreateFactory(SAMFactory):
         self.localPort = localPort
         self.options = options
         self.sigType = sigType
+        # Where a DATAGRAM or RAW session forwards incoming datagrams
+        self.forwardPort = forwardPort
+        self.forwardHost = forwardHost
         self.deferred = defer.Deferred(self._cancel)
         self.samVersion = None
         self.privKey = None
+        # The SAMSession, once it has been created
+        self.samSession = None
         self._writeKeypair = False
+        # Fires once the keyfile has been read
+        self.keyLoading = None
 
     def startFactory(self):
-        if self._keyfile:
-            try:
-                f = open(self._keyfile, 'r')
-                self.privKey = f.read()
-                f.close()
-            except IOError:
-                log.msg('Could not load private key from %s' % self._keyfile)
-                self._writeKeypair = True
+        # A supervisor re-creating the session already has the keys
+        if self._keyfile and not self.privKey:
+            self.keyLoading = keyStore.load(self._keyfile, self.reactor)
+            self.keyLoading.addCallbacks(self._keyLoaded, self._keyLoadFailed)
+
+    def _keyLoaded(self, privKey):
+        if privKey is None:
+            log.msg('Could not load private key from %s' % self._keyfile)
+            self._writeKeypair = True
+        else:
+            self.privKey = privKey
+
+    def _keyLoadFailed(self, reason):
+        log.msg('Could not read private key from %s' % self._keyfile)
+        self.connectionFailed(reason)
+        return reason
 
     def sessionCreated(self, proto, pubKey):
-        if self._writeKeypair:
-            try:
-                f = open(self._keyfile, 'w')
-                f.write(str(self.privKey))
-                f.close()
-            except IOError:
-                log.msg('Could not save private key to %s' % self._keyfile)
-        # Now continue on with creation of SAMSession
-        self.deferred.callback((self.samVersion, self.style, self.nickname, proto, pubKey, self.localPort))
+        result = (self.samVersion, self.style, self.nickname, proto, pubKey, self.localPort)
+        if not self._writeKeypair:
+            self.deferred.callback(result)
+            return
+
+        def saveFailed(f):
+            f.trap(IOError, OSError)
+            log.msg('Could not save private key to %s' % self._keyfile)
+        d = keyStore.save(self._keyfile, self.privKey,
+                          getattr(proto.sender.transport, 'reactor', None))
+        d.addErrback(saveFailed)
+
+        def saved(_):
+            # The SAM connection may have been lost meanwhile
+            if not self.deferred.called:
+                # Now continue on with creation of SAMSession
+                self.deferred.callback(result)
+        d.addCallback(saved)
+
+    def subsessionStatus(self, result, message):
+        self.samSession._subsessionStatus(result, message)
+
+    def connectionFailed(self, reason):
+        if self.samSession:
+            self.samSession._controlConnectionLost(reason)
+        SAMFactory.connectionFailed(self, reason)
+
+
+# Seconds between attempts of a warm-up check
+WARMUP_RETRY_INTERVAL = 10
 
 
 # Dictionary containing all active SAM sessions
@@ -155,6 +263,30 @@ class SAMSession(object):
         id (str): SAM Session ID, autogenerated if ``nickname`` is None, else
             ``nickname``.
         address (txi2p.I2PAddress): The Destination of this session.
+        pool (txi2p.sam.pool.SAMConnectionPool): The pool of pre-connected SAM
+            sockets used for outbound streams, or `None` if not enabled.
+        namingCache (txi2p.sam.naming.NamingCache): The cache of hostname
+            lookups used for outbound streams, or `None` if not enabled.
+        resolver (txi2p.sam.naming.SAMNamingResolver): The resolver used by
+            :meth:`resolve`, and by outbound streams if ``namingCache`` is
+            set, or `None` if it has not been used yet.
+        datagramPort (txi2p.sam.datagram.SAMDatagramPort): The port that
+            receives this session's datagrams, for ``DATAGRAM`` and ``RAW``
+            sessions.
+        forwardPort (int): The local UDP port that the SAM bridge forwards
+            this session's datagrams to, or `None`.
+        primary (txi2p.sam.SAMSession): The ``PRIMARY`` session that this is a
+            subsession of, or `None`.
+        subsessions (dict): The subsessions of a ``PRIMARY`` session, by
+            nickname.
+        ready (bool): `False` while new streams are held back by
+            :meth:`warmUp`.
+        timings (dict): Seconds taken to get the session going. ``'create'``
+            is the time from connecting to the SAM bridge until the session
+            was created, and ``'ready'`` the time that :meth:`warmUp` took
+            after that, with ``'checks'`` attempts of its check.
+        supervisor (txi2p.sam.supervisor.SessionSupervisor): Re-creates the
+            session if its SAM connection is lost, or `None`.
     """
 
     def __init__(self):
@@ -164,10 +296,174 @@ class SAMSession(object):
         self.style = 'STREAM'
         self.id = None
         self.address = None
+        self.pool = None
+        self.namingCache = None
+        self.resolver = None
+        self.datagramPort = None
+        self.forwardPort = None
+        self.primary = None
+        self.subsessions = {}
+        self.ready = True
+        self.timings = {}
+        self.supervisor = None
         self._proto = None
         self._autoClose = False
         self._closed = False
         self._streams = []
+        # (subsession or None for a removal, Deferred), in the order sent
+        self._subsessionRequests = []
+        self._readyWaiters = []
+        self._warmUpCall = None
+        self._warmUpTimeout = None
+        self._recoveryCallbacks = []
+
+    def startPool(self, size, minIdle=None, maxIdleAge=DEFAULT_MAX_IDLE_AGE):
+        """Keep a pool of SAM connections that have already completed HELLO.
+
+        Outbound streams will use a pooled connection when one is idle.
+
+        Args:
+            size (int): The maximum number of idle connections to keep.
+            minIdle (int): The pool refills once fewer than this many
+                connections are idle. Defaults to ``size``.
+            maxIdleAge (int): Seconds after which an idle connection is
+                replaced.
+        """
+        if self.pool:
+            self.pool.stop()
+        self.pool = SAMConnectionPool(self.samEndpoint, size, minIdle, maxIdleAge)
+        self.pool.start()
+
+    def warmUp(self, check, timeout=None, interval=WARMUP_RETRY_INTERVAL, clock=None):
+        """Hold new streams back until ``check`` succeeds.
+
+        Tunnels take a while to build after a session is created, and streams
+        opened before then are slow or fail. ``check`` is retried every
+        ``interval`` seconds until it succeeds, and then :meth:`whenReady`
+        fires.
+
+        Args:
+            check (callable): Called with the session, and returns a Deferred
+                that fires once the session is usable. See
+                :func:`lookupCheck` and :func:`streamCheck`.
+            timeout (float): Seconds after which to give up. The session is
+                then closed, and :meth:`whenReady` fails with
+                :class:`twisted.internet.error.TimeoutError`.
+            interval (float): Seconds between attempts.
+            clock: An :class:`twisted.internet.interfaces.IReactorTime`
+                provider.
+        """
+        if not self.ready or self._closed:
+            return
+        clock = clock or reactor
+        self.ready = False
+        self.timings['checks'] = 0
+        start = clock.seconds()
+
+        def attempt():
+            self._warmUpCall = None
+            self.timings['checks'] += 1
+            d = defer.maybeDeferred(check, self)
+            d.addCallbacks(succeeded, retry)
+
+        def succeeded(result):
+            if self.ready or self._closed:
+                return
+            self.timings['ready'] = clock.seconds() - start
+            self._stopWarmUp()
+            self._becameReady()
+
+        def retry(f):
+            if self.ready or self._closed:
+                return
+            log.msg('Session %s is not ready yet: %s' % (self.nickname, f.value))
+            self._warmUpCall = clock.callLater(interval, attempt)
+
+        def timedOut():
+            self._warmUpTimeout = None
+            self._warmUpFailed(failure.Failure(error.TimeoutError(
+                'Session %s was not ready after %s seconds' % (self.nickname, timeout))))
+            self.close()
+
+        if timeout:
+            self._warmUpTimeout = clock.callLater(timeout, timedOut)
+        attempt()
+
+    def whenReady(self):
+        """Wait until the session is usable.
+
+        Returns:
+            A Deferred that fires with the session once :meth:`warmUp` has
+            succeeded, or straight away if the session is not warming up.
+        """
+        if self._closed:
+            return defer.fail(error.ConnectionDone())
+        if self.ready:
+            return defer.succeed(self)
+        if self.supervisor and self.supervisor.failFast():
+            return defer.fail(error.ConnectError(
+                string='Session %s is being re-created' % self.nickname))
+        d = defer.Deferred()
+        self._readyWaiters.append(d)
+        return d
+
+    def _becameReady(self):
+        self.ready = True
+        waiting, self._readyWaiters = self._readyWaiters, []
+        for d in waiting:
+            d.callback(self)
+
+    def addRecoveryCallback(self, f):
+        """Call ``f`` with no arguments whenever the session is re-created."""
+        self._recoveryCallbacks.append(f)
+
+    def removeRecoveryCallback(self, f):
+        if f in self._recoveryCallbacks:
+            self._recoveryCallbacks.remove(f)
+
+    def _recovered(self, samVersion, proto, pubKey, localPort):
+        self.samVersion = samVersion
+        self.address = I2PAddress(pubKey, port=localPort)
+        self._proto = proto
+        self._becameReady()
+        for f in list(self._recoveryCallbacks):
+            f()
+
+    def _controlConnectionLost(self, reason):
+        if self._closed:
+            return
+        # The router has dropped the subsessions too
+        self._dropSubsessions(reason)
+        if self.supervisor:
+            self.ready = False
+            self.supervisor.connectionLost(reason)
+
+    def _stopWarmUp(self):
+        for call in (self._warmUpCall, self._warmUpTimeout):
+            if call and call.active():
+                call.cancel()
+        self._warmUpCall = self._warmUpTimeout = None
+
+    def _warmUpFailed(self, reason):
+        self._stopWarmUp()
+        waiting, self._readyWaiters = self._readyWaiters, []
+        for d in waiting:
+            d.errback(reason)
+
+    def resolve(self, name):
+        """Look up the Destination for an I2P hostname.
+
+        All lookups made through a session share one SAM connection, which
+        stays open until the session closes.
+
+        Returns:
+            A Deferred that fires with the Destination as a base64 string.
+        """
+        if self._closed:
+            return defer.fail(error.ConnectionDone())
+        if not self.resolver:
+            self.resolver = SAMNamingResolver(self.samEndpoint, self.namingCache)
+        return self.resolver.resolve(name)
 
     def addStream(self, stream):
         """Register a stream with this session.
@@ -198,14 +494,172 @@ class SAMSession(object):
             self.close()
 
     def close(self):
-        """Close the session."""
+        """Close the session.
+
+        Closing a ``PRIMARY`` session also closes its subsessions.
+        """
+        self._close()
+
+    def _close(self, reason=None):
+        self._closeLocally(reason)
+        if self.primary:
+            self.primary._removeSubsession(self)
+        else:
+            self._proto.sender.transport.loseConnection()
+
+    def _closeLocally(self, reason=None):
         self._closed = True
         self._streams = []
-        self._proto.sender.transport.loseConnection()
+        self._recoveryCallbacks = []
+        if self.supervisor:
+            self.supervisor.stop()
+        if self.pool:
+            self.pool.stop()
+        if self.resolver:
+            self.resolver.close()
+        self._dropSubsessions(failure.Failure(error.ConnectionDone()))
         del _sessions[self.nickname]
+        self._warmUpFailed(reason or failure.Failure(error.ConnectionDone()))
+
+    def addSubsession(self, nickname, style=c.STYLE_STREAM, fromPort=None, listenPort=None, options=None):
+        """Add a subsession to this ``PRIMARY`` session.
+
+        Subsessions share the Destination, tunnels and I2CP connection of the
+        primary session, so adding one doesn't wait for new tunnels to be
+        built. Once added, the subsession can be used like any other session,
+        and :func:`getSession` will return it for ``nickname``.
+
+        Args:
+            nickname (str): The subsession nickname, which must not be in use.
+            style (str): The subsession style. Only ``'STREAM'`` is supported.
+            fromPort (int): The port that the subsession connects from inside
+                I2P.
+            listenPort (int): The port inside I2P that the subsession receives
+                incoming streams on. Defaults to ``fromPort``.
+            options (dict): Options to configure the subsession with.
+
+        Returns:
+            A Deferred that fires with the subsession's :class:`SAMSession`.
+        """
+        if self._closed:
+            return defer.fail(error.ConnectionDone())
+        if self.style != c.STYLE_PRIMARY or style != c.STYLE_STREAM:
+            return defer.fail(error.UnsupportedSocketType())
+        if nickname in _sessions or nickname in _pending_sessions:
+            return defer.fail(ValueError('Session %s already exists' % nickname))
+
+        s = SAMSession()
+        s.nickname = nickname
+        s.samEndpoint = self.samEndpoint
+        s.samVersion = self.samVersion
+        s.style = style
+        s.id = nickname
+        s.address = I2PAddress(self.address, port=fromPort)
+        s.namingCache = self.namingCache
+        s.primary = self
+        # getSession() calls for the nickname wait for the reply
+        _pending_sessions[nickname] = []
+        d = defer.Deferred()
+        self._subsessionRequests.append((s, d))
+        self._proto.sender.sendSessionAdd(style, nickname, fromPort, listenPort,
+                                          options or {})
+        return d
+
+    def _removeSubsession(self, subsession):
+        self.subsessions.pop(subsession.nickname, None)
+        if self._closed:
+            return
+        d = defer.Deferred()
+        d.addErrback(lambda f: log.msg('Could not remove subsession %s: %s' % (
+            subsession.nickname, f.value)))
+        self._subsessionRequests.append((None, d))
+        self._proto.sender.sendSessionRemove(subsession.id)
+
+    def _subsessionStatus(self, result, message):
+        # Replies come back in the order that the requests were sent
+        if not self._subsessionRequests:
+            return
+        s, d = self._subsessionRequests.pop(0)
+        if result != c.RESULT_OK:
+            f = failure.Failure(c.samErrorMap.get(result, error.ConnectError)(
+                string=(message if message else result)))
+        else:
+            f = None
+        if s is None:
+            # SESSION REMOVE
+            if f:
+                d.errback(f)
+            else:
+                d.callback(None)
+            return
+
+        waiting = _pending_sessions.pop(s.nickname, [])
+        if f:
+            for w in waiting:
+                w.errback(f)
+            d.errback(f)
+            return
+        _sessions[s.nickname] = s
+        self.subsessions[s.nickname] = s
+        for w in waiting:
+            w.callback(s)
+        d.callback(s)
+
+    def _dropSubsessions(self, reason):
+        subsessions, self.subsessions = self.subsessions, {}
+        for s in subsessions.values():
+            s._closeLocally()
+        requests, self._subsessionRequests = self._subsessionRequests, []
+        for s, d in requests:
+            if s:
+                for w in _pending_sessions.pop(s.nickname, []):
+                    w.errback(reason)
+            d.errback(reason)
+
+
+def lookupCheck(session):
+    """A warm-up check that looks up the session's own B32 address.
+
+    This succeeds once the router has published the session's LeaseSet,
+    which needs its inbound tunnels to have been built.
+    """
+    return session.resolve(session.address.host)
+
+
+class _CloseOnConnect(Protocol):
+    def connectionMade(self):
+        self.transport.loseConnection()
+
+
+def streamCheck(host, port=None):
+    """Make a warm-up check that opens a test stream.
+
+    The stream is closed as soon as it is open. This shouldn't be used with
+    sessions that close automatically once they have no streams.
+
+    Args:
+        host (str): The I2P hostname or Destination to connect to.
+        port (int): The port to connect to inside I2P.
+    """
+    if host[-4:] == '.i2p':
+        host, dest = host, None
+    else:
+        host, dest = None, host
+
+    def check(session):
+        fac = StreamConnectFactory(Factory.forProtocol(_CloseOnConnect),
+                                   session, host, dest, port,
+                                   namingCache=session.namingCache)
+        d = session.samEndpoint.connect(fac)
+        d.addCallback(lambda proto: fac.deferred)
+        return d
+    return check
 
 
-def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
+def getSession(nickname, samEndpoint=None, autoClose=False, poolSize=None,
+               poolMinIdle=None, poolMaxIdleAge=DEFAULT_MAX_IDLE_AGE,
+               namingCache=None, readyCheck=None, readyTimeout=None,
+               supervisor=None, **kwargs):
     """Get or create a SAM session.
 
     Args:
@@ -214,6 +668,22 @@ def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
             endpoint that will connect to the SAM API.
         autoClose (bool): `true` if the session should close automatically once
             no more connections are using it.
+        poolSize (int): If set, a new session keeps up to this many idle SAM
+            connections ready for outbound streams. See
+            :meth:`SAMSession.startPool`.
+        poolMinIdle (int): The pool refills once fewer than this many
+            connections are idle.
+        poolMaxIdleAge (int): Seconds after which an idle pooled connection is
+            replaced.
+        namingCache (txi2p.sam.naming.NamingCache): If set, a new session
+            caches hostname lookups here. A cache can be shared by several
+            sessions.
+        readyCheck (callable): If set, a new session holds new streams back
+            until this check succeeds. See :meth:`SAMSession.warmUp`.
+        readyTimeout (float): Seconds after which a new session gives up
+            waiting for ``readyCheck``.
+        supervisor (txi2p.sam.supervisor.SessionSupervisor): If set, a new
+            session is re-created by this when its SAM connection is lost.
     """
     if nickname in _sessions:
         return defer.succeed(_sessions[nickname])
@@ -239,6 +709,17 @@ def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
         s.address = I2PAddress(pubKey, port=localPort)
         s._proto = proto
         s._autoClose = autoClose
+        s.namingCache = namingCache
+        s.forwardPort = kwargs.get('forwardPort')
+        s.timings['create'] = reactor.seconds() - start
+        if readyCheck:
+            # Before anyone waiting for the session gets it
+            s.warmUp(readyCheck, readyTimeout)
+        sessionFac.samSession = s
+        if supervisor:
+            supervisor.supervise(s, sessionFac.privKey, kwargs)
+        if poolSize:
+            s.startPool(poolSize, poolMinIdle, poolMaxIdleAge)
         _sessions[nickname] = s
 
         waiting = _pending_sessions.pop(nickname, [])
@@ -254,6 +735,7 @@ def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
         return f
 
     _pending_sessions[nickname] = []
+    start = reactor.seconds()
     sessionFac = SessionCreateFactory(nickname, **kwargs)
     d = samEndpoint.connect(sessionFac)
     # Force caller to wait until the session is actually created
@@ -263,6 +745,34 @@ def getSession(nickname, samEndpoint=None, autoClose=False, **kwargs):
     return d
 
 
+def warmSession(nickname, samEndpoint=None, readyCheck=None, readyTimeout=None, **kwargs):
+    """Create a SAM session now, and wait until it is usable.
+
+    Services can call this at startup, so that their first connection doesn't
+    wait for the session to be created and its tunnels to be built. Endpoints
+    that use the session hold their streams back until it is ready.
+
+    The other arguments are as for :func:`getSession`.
+
+    Args:
+        readyCheck (callable): A check that must succeed before the session
+            is ready, such as :func:`lookupCheck` or :func:`streamCheck`. If
+            `None`, the session is ready once it has been created.
+        readyTimeout (float): Seconds after which to give up waiting for
+            ``readyCheck``.
+
+    Returns:
+        A Deferred that fires with the :class:`SAMSession` once it is ready.
+        Its ``timings`` record how long that took.
+    """
+    d = getSession(nickname, samEndpoint,
+                   readyCheck=readyCheck,
+                   readyTimeout=readyTimeout,
+                   **kwargs)
+    d.addCallback(lambda s: s.whenReady())
+    return d
+
+
 class DestGenerateSender(SAMSender):
     def sendDestGenerate(self, samVersion, sigType=None):
         msg = 'DEST GENERATE'
@@ -311,19 +821,18 @@ class DestGenerateFactory(SAMFactory):
         self._keyfile = keyfile
         self.sigType = sigType
         self.deferred = defer.Deferred(self._cancel)
+        self._saving = False
 
     def destGenerated(self, pubKey, privKey):
-        if os.path.exists(self._keyfile):
-            self.deferred.errback(failure.Failure(ValueError('The keyfile already exists')))
-            return
-
-        try:
-            f = open(self._keyfile, 'w')
-            f.write(str(privKey))
-            f.close()
-            self.deferred.callback(I2PAddress(pubKey))
-        except IOError as e:
-            self.deferred.errback(failure.Failure(e))
+        self._saving = True
+        d = keyStore.save(self._keyfile, privKey, exclusive=True)
+        d.addCallback(lambda _: I2PAddress(pubKey))
+        d.chainDeferred(self.deferred)
+
+    def connectionFailed(self, reason):
+        # The SAM connection is closed while the keyfile is written
+        if not self._saving:
+            SAMFactory.connectionFailed(self, reason)
 
 
 def generateDestination(keyfile, samEndpoint, sigType=None):
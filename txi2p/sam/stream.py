@@ -3,6 +3,7 @@
 
 from builtins import range
 from builtins import object
+from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectError, UnknownHostError
 from twisted.internet.interfaces import IListeningPort
@@ -19,6 +20,10 @@ from txi2p.sam.base import (
     SAMFactory,
 )
 
+DEFAULT_MIN_ACCEPTS = 8
+DEFAULT_MAX_ACCEPTS = 32
+ACCEPT_IDLE_TIMEOUT = 60
+
 
 class StreamConnectSender(SAMSender):
     def sendStreamConnect(self, id, destination, port=None, localPort=None):
@@ -42,6 +47,15 @@ class StreamConnectReceiver(SAMReceiver):
             self.sender.sendNamingLookup(self.factory.host)
             self.currentRule = 'State_naming'
 
+    def lookupReply(self, result, name, value=None, message=None):
+        cache = getattr(self.factory, 'namingCache', None)
+        if cache:
+            if result == c.RESULT_OK:
+                cache.resolved(self.factory.host, value)
+            elif result == c.RESULT_KEY_NOT_FOUND:
+                cache.notFound(self.factory.host)
+        SAMReceiver.lookupReply(self, result, name, value, message)
+
     def postLookup(self, dest):
         self.factory.dest = dest
         self.doConnect()
@@ -69,15 +83,22 @@ StreamConnectProtocol = makeSAMProtocol(
 class StreamConnectFactory(SAMFactory):
     protocol = StreamConnectProtocol
 
-    def __init__(self, clientFactory, session, host, dest, port=None, localPort=None):
+    def __init__(self, clientFactory, session, host, dest, port=None, localPort=None, namingCache=None):
         self._clientFactory = clientFactory
         self.session = session
         self.host = host
         self.dest = dest
         self.port = port
         self.localPort = localPort
+        self.namingCache = namingCache
         self.deferred = Deferred(self._cancel);
 
+    def connectionFailed(self, reason):
+        if self.namingCache and not self.dest:
+            # Don't leave other connects waiting for our lookup
+            self.namingCache.failed(self.host)
+        SAMFactory.connectionFailed(self, reason)
+
     def streamConnectionEstablished(self, streamProto):
         self.session.addStream(streamProto)
         peerAddress = I2PAddress(self.dest, self.host, self.port)
@@ -86,6 +107,7 @@ class StreamConnectFactory(SAMFactory):
             self.deferred.cancel()
             return
         streamProto.wrapProto(proto, peerAddress)
+        streamProto.startPumping()
         self.deferred.callback(proto)
 
 
@@ -130,6 +152,13 @@ class StreamAcceptReceiver(SAMReceiver):
                 if self.initialData:
                     data, self.initialData = self.initialData, None
                     self.wrappedProto.dataReceived(data)
+                self.startPumping()
+
+    def finishParsing(self, reason):
+        if not self.peer and hasattr(self.factory, 'listeningPort'):
+            # Lost before a peer arrived
+            self.factory.listeningPort.acceptLost(self)
+        SAMReceiver.finishParsing(self, reason)
 
 
 StreamAcceptProtocol = makeSAMProtocol(
@@ -161,33 +190,164 @@ class StreamAcceptFactory(SAMFactory):
 
 @implementer(IListeningPort)
 class StreamAcceptPort(object):
-    def __init__(self, session, factory):
+    """Listens for I2P streams with pending ``STREAM ACCEPT`` connections.
+
+    The number of pending accepts adapts to the incoming connection rate.
+    When a peer takes the last pending accept, further peers may be queuing
+    in the SAM bridge, so the target is doubled. When a peer arrives at an
+    accept that has waited longer than ``idleTimeout``, there are more
+    accepts than needed, so the target shrinks by one. While the target is
+    above ``minAccepts``, accepts that have waited ``idleTimeout`` are also
+    closed every ``idleTimeout`` seconds, down to ``minAccepts``, so that
+    the target shrinks back once peers stop arriving. SAM bridges older
+    than 3.2 only allow one pending accept per session.
+
+    Accepts that fail to open are not replaced until the next peer arrives,
+    so that an unreachable SAM bridge is not retried in a loop.
+
+    Args:
+        session (txi2p.sam.SAMSession): The SAM session to listen on.
+        factory (twisted.internet.interfaces.IProtocolFactory): The factory
+            for incoming connections.
+        minAccepts (int): The fewest pending accepts to keep open.
+        maxAccepts (int): The most pending accepts to keep open.
+        idleTimeout (int): Seconds an accept can wait for a peer before it
+            counts as spare.
+        clock: An :class:`twisted.internet.interfaces.IReactorTime` provider.
+
+    Attributes:
+        accepts (list): The accepts that are waiting for a peer.
+        target (int): The number of pending accepts currently aimed for.
+        accepted (int): The number of peers accepted.
+        totalWait (float): Total seconds that accepts waited for peers.
+        maxWait (float): The longest that an accept waited for a peer.
+    """
+
+    def __init__(self, session, factory, minAccepts=None, maxAccepts=None,
+                 idleTimeout=ACCEPT_IDLE_TIMEOUT, clock=None):
         self.session = session
         self.factory = StreamAcceptFactory(factory, session, self)
+        # Lost accepts are handled by acceptLost(), not the shared Deferred
+        self.factory.deferred.addErrback(lambda f: None)
+        if cmpSAM(session.samVersion, '3.2') >= 0:
+            self.minAccepts = minAccepts or DEFAULT_MIN_ACCEPTS
+            self.maxAccepts = max(self.minAccepts,
+                                  maxAccepts or DEFAULT_MAX_ACCEPTS)
+        else:
+            self.minAccepts = self.maxAccepts = 1
+        self.idleTimeout = idleTimeout
+        self.target = self.minAccepts
         self.accepts = []
+        self.accepted = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self._clock = clock or reactor
+        self._acceptedAt = {}
+        self._opening = 0
+        self._listening = False
+        # Accepts that were closed for being idle
+        self._closing = set()
+        self._shrinkCall = None
+
+    @property
+    def meanWait(self):
+        """The mean number of seconds that accepts waited for peers."""
+        if not self.accepted:
+            return 0.0
+        return self.totalWait / self.accepted
 
     def startListening(self):
-        if cmpSAM(self.session.samVersion, '3.2') >= 0:
-            active = 8
-        else:
-            active = 1
-        for i in range(0, active):
-            self.openAccept()
+        self._listening = True
+        # Accepts are lost along with the session
+        self.session.addRecoveryCallback(self._fill)
+        self._fill()
+        self._scheduleShrink()
 
     def stopListening(self):
-        for pending in self.accepts:
+        self._listening = False
+        self.session.removeRecoveryCallback(self._fill)
+        if self._shrinkCall:
+            self._shrinkCall.cancel()
+            self._shrinkCall = None
+        accepts, self.accepts = self.accepts, []
+        self._acceptedAt = {}
+        for pending in accepts:
             pending.sender.transport.loseConnection()
-        self.accepts = []
 
     def openAccept(self):
-        self.session.samEndpoint.connect(self.factory)
+        self._opening += 1
+        d = self.session.samEndpoint.connect(self.factory)
+        d.addErrback(self._openFailed)
+
+    def _openFailed(self, reason):
+        self._opening = max(0, self._opening - 1)
+
+    def _fill(self):
+        if not self._listening:
+            return
+        for i in range(self.target - len(self.accepts) - self._opening):
+            self.openAccept()
+
+    def _scheduleShrink(self):
+        if self._shrinkCall or not self._listening:
+            return
+        if self.target > self.minAccepts:
+            self._shrinkCall = self._clock.callLater(self.idleTimeout,
+                                                     self._shrink)
+
+    def _shrink(self):
+        self._shrinkCall = None
+        now = self._clock.seconds()
+        spare = len(self.accepts) - self.minAccepts
+        # Oldest first
+        for proto in list(self.accepts):
+            if spare <= 0:
+                break
+            if now - self._acceptedAt[proto] >= self.idleTimeout:
+                self.accepts.remove(proto)
+                del self._acceptedAt[proto]
+                self._closing.add(proto)
+                proto.sender.transport.loseConnection()
+                spare -= 1
+        self.target = max(self.minAccepts,
+                          min(self.target, len(self.accepts) + self._opening))
+        self._scheduleShrink()
 
     def addAccept(self, proto):
+        self._opening = max(0, self._opening - 1)
+        if not self._listening:
+            proto.sender.transport.loseConnection()
+            return
         self.accepts.append(proto)
+        self._acceptedAt[proto] = self._clock.seconds()
 
     def removeAccept(self, proto):
+        if proto in self._closing:
+            # A peer arrived as the accept was being closed
+            return
         self.accepts.remove(proto)
-        self.openAccept()
+        wait = self._clock.seconds() - self._acceptedAt.pop(proto)
+        self.accepted += 1
+        self.totalWait += wait
+        self.maxWait = max(self.maxWait, wait)
+        if not self.accepts:
+            self.target = min(self.maxAccepts, self.target * 2)
+        elif wait > self.idleTimeout:
+            self.target = max(self.minAccepts, self.target - 1)
+        self._fill()
+        self._scheduleShrink()
+
+    def acceptLost(self, proto):
+        if proto in self._closing:
+            self._closing.remove(proto)
+            return
+        if not self._listening:
+            return
+        if proto in self.accepts:
+            self.accepts.remove(proto)
+            self._acceptedAt.pop(proto, None)
+        else:
+            self._opening = max(0, self._opening - 1)
 
     def getHost(self):
         return self.session.address
@@ -0,0 +1,167 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from builtins import object
+from twisted.internet import reactor
+from twisted.python import log
+
+from txi2p.sam.session import SessionCreateFactory
+
+RECOVERY_QUEUE = 'queue'
+RECOVERY_FAIL = 'fail'
+
+
+class SessionSupervisor(object):
+    """Re-creates a SAM session when its SAM connection is lost.
+
+    A SAM session only lives as long as the connection it was created on, so
+    it is gone once the SAM bridge or the router restarts, or the keepalive
+    times out. The supervisor then creates it again with the same nickname,
+    Destination and options. Failed attempts are retried with exponential
+    backoff.
+
+    The :class:`txi2p.sam.SAMSession` object stays the same throughout, so
+    endpoints that use it carry on once it is back. Subsessions of a
+    ``PRIMARY`` session are not re-added.
+
+    Args:
+        whileRecovering (str): What new streams do while the session is being
+            re-created: ``'queue'`` to wait until it is back, or ``'fail'``
+            to fail straight away with
+            :class:`twisted.internet.error.ConnectError`.
+        initialDelay (float): Seconds before the first attempt.
+        maxDelay (float): The most seconds between attempts.
+        factor (float): How much the delay grows after each failed attempt.
+        maxAttempts (int): Attempts after which to give up and close the
+            session. If `None`, the supervisor never gives up.
+        clock: An :class:`twisted.internet.interfaces.IReactorTime` provider.
+
+    Attributes:
+        session (txi2p.sam.SAMSession): The supervised session.
+        recovering (bool): `True` while the session is being re-created.
+        reconnects (int): The number of times the session was re-created.
+        attempts (int): The number of attempts, including failed ones.
+        outages (list): How many seconds each outage lasted.
+        lastError: Why the last attempt failed.
+    """
+
+    def __init__(self, whileRecovering=RECOVERY_QUEUE, initialDelay=1.0,
+                 maxDelay=300.0, factor=2.0, maxAttempts=None, clock=None):
+        if whileRecovering not in (RECOVERY_QUEUE, RECOVERY_FAIL):
+            raise ValueError('Unknown recovery mode: %s' % whileRecovering)
+        self.whileRecovering = whileRecovering
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.maxAttempts = maxAttempts
+        self.session = None
+        self.recovering = False
+        self.reconnects = 0
+        self.attempts = 0
+        self.outages = []
+        self.lastError = None
+        self._clock = clock or reactor
+        self._privKey = None
+        self._factoryArgs = {}
+        self._delay = initialDelay
+        self._outageStart = None
+        self._outageAttempts = 0
+        self._call = None
+        self._stopped = False
+
+    def supervise(self, session, privKey, factoryArgs):
+        """Start supervising a session.
+
+        Args:
+            session (txi2p.sam.SAMSession): The session.
+            privKey (str): The private keys of the session's Destination.
+            factoryArgs (dict): The arguments that the session was created
+                with, for :class:`txi2p.sam.session.SessionCreateFactory`.
+        """
+        self.session = session
+        self._privKey = privKey
+        self._factoryArgs = dict(factoryArgs)
+        session.supervisor = self
+
+    @property
+    def currentOutage(self):
+        """Seconds since the session was lost, or `None` if it is up."""
+        if self._outageStart is None:
+            return None
+        return self._clock.seconds() - self._outageStart
+
+    def failFast(self):
+        return self.recovering and self.whileRecovering == RECOVERY_FAIL
+
+    def stats(self):
+        """Recovery metrics for the session.
+
+        Returns:
+            dict: ``reconnects``, ``attempts``, the ``outages`` so far and the
+            ``currentOutage``.
+        """
+        return {
+            'reconnects': self.reconnects,
+            'attempts': self.attempts,
+            'outages': list(self.outages),
+            'currentOutage': self.currentOutage,
+        }
+
+    def connectionLost(self, reason):
+        if self._stopped or self.recovering:
+            return
+        log.msg('SAM session %s lost, re-creating it: %s' % (
+            self.session.nickname, reason.value))
+        self.recovering = True
+        self._outageStart = self._clock.seconds()
+        self._outageAttempts = 0
+        self._delay = self.initialDelay
+        self._schedule()
+
+    def stop(self):
+        """Stop supervising. Called when the session is closed."""
+        self._stopped = True
+        self.recovering = False
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._call = self._clock.callLater(self._delay, self._attempt)
+        self._delay = min(self._delay * self.factor, self.maxDelay)
+
+    def _attempt(self):
+        self._call = None
+        self.attempts += 1
+        self._outageAttempts += 1
+        fac = SessionCreateFactory(self.session.nickname, **self._factoryArgs)
+        # Keep the same Destination, even if it was transient
+        fac.privKey = self._privKey
+        d = self.session.samEndpoint.connect(fac)
+        d.addCallback(lambda proto: fac.deferred)
+        d.addCallbacks(self._succeeded, self._failed, callbackArgs=(fac,))
+
+    def _succeeded(self, result, fac):
+        (samVersion, style, id, proto, pubKey, localPort) = result
+        if self._stopped:
+            # The session was closed meanwhile
+            proto.sender.transport.loseConnection()
+            return
+        self.recovering = False
+        self.reconnects += 1
+        self.outages.append(self._clock.seconds() - self._outageStart)
+        self._outageStart = None
+        fac.samSession = self.session
+        self.session._recovered(samVersion, proto, pubKey, localPort)
+
+    def _failed(self, reason):
+        if self._stopped:
+            return
+        self.lastError = reason.value
+        if self.maxAttempts and self._outageAttempts >= self.maxAttempts:
+            log.msg('Giving up on SAM session %s: %s' % (
+                self.session.nickname, reason.value))
+            # Anything waiting for the session gets this failure
+            self.session._close(reason)
+            return
+        self._schedule()
@@ -0,0 +1,180 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import error
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.keystore import keyStore
+from txi2p.sam import session
+from txi2p.sam.keepalive import _wheels, keepaliveWheel
+from txi2p.test.util import TEST_B64
+from .util import FakeSAMBridge
+
+try:
+    import asyncio
+    from txi2p.sam import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+
+class AsyncioTestMixin(object):
+    if aio is None:
+        skip = 'asyncio support requires Python 3.5 or later'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(_wheels.pop, aio.loopClock(self.loop), None)
+
+    def wait(self, coro, timeout=5):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+    def waitFor(self, condition, timeout=5):
+        for i in range(int(timeout / 0.01)):
+            if condition():
+                return
+            self.wait(asyncio.sleep(0.01))
+        raise AssertionError('Timed out')
+
+
+class TestLoopClock(AsyncioTestMixin, unittest.TestCase):
+    def test_callLater(self):
+        clock = aio.loopClock(self.loop)
+        self.assertIs(clock, aio.loopClock(self.loop))
+        fired = []
+        call = clock.callLater(0.01, fired.append, 'a')
+        self.assertTrue(call.active())
+        self.waitFor(lambda: fired)
+        self.assertEqual(['a'], fired)
+
+    def test_cancel(self):
+        clock = aio.loopClock(self.loop)
+        fired = []
+        call = clock.callLater(0, fired.append, 'a')
+        call.cancel()
+        self.assertFalse(call.active())
+        self.wait(asyncio.sleep(0.01))
+        self.assertEqual([], fired)
+
+
+class TestAsyncioAPI(AsyncioTestMixin, unittest.TestCase):
+    def setUp(self):
+        AsyncioTestMixin.setUp(self)
+        self.bridge = FakeSAMBridge()
+        clock = aio.loopClock(self.loop)
+        self.server = self.wait(self.loop.create_server(
+            lambda: aio._ConnectionAdapter(self.bridge, clock),
+            '127.0.0.1', 0))
+        self.samPort = self.server.sockets[0].getsockname()[1]
+        self.addCleanup(self.stopBridge)
+
+    def stopBridge(self):
+        self.bridge.disconnectAll()
+        self.waitFor(lambda: not self.bridge.connections)
+        for s in list(session._sessions.values()):
+            s.close()
+        self.server.close()
+        self.wait(self.server.wait_closed())
+
+    def getSession(self, **kwargs):
+        return self.wait(aio.getSession(self.id(), samPort=self.samPort, **kwargs))
+
+    def test_getSession(self):
+        s = self.getSession()
+        self.assertEqual(I2PAddress(TEST_B64), s.address)
+        self.assertIs(s, session._sessions[self.id()])
+        self.assertIs(s, self.getSession())
+        # Keepalives run on the event loop
+        receiver = s._proto
+        self.assertEqual('State_keepalive', receiver.currentRule)
+        self.assertIs(keepaliveWheel(aio.loopClock(self.loop)),
+                      receiver.pinger.wheel)
+
+    def test_getSessionWithKeyfile(self):
+        keyfile = self.mktemp()
+        self.addCleanup(keyStore.forget)
+        s = self.getSession(keyfile=keyfile)
+        self.assertEqual(I2PAddress(TEST_B64), s.address)
+        # The new keys were written on the loop's executor
+        with open(keyfile) as f:
+            self.assertEqual(TEST_B64, f.read())
+
+    def test_getSessionFailure(self):
+        self.bridge.failCreate = [self.id()]
+        self.assertRaises(error.ConnectError, self.getSession)
+        self.assertNotIn(self.id(), session._sessions)
+
+    def test_getSessionRefused(self):
+        self.assertRaises(ConnectionRefusedError, self.wait,
+                          aio.getSession(self.id(), samPort=1))
+
+    def test_reactorOptions(self):
+        self.assertRaises(ValueError, self.wait,
+                          aio.getSession(self.id(), poolSize=2))
+
+    def test_openConnection(self):
+        s = self.getSession()
+        reader, writer = self.wait(aio.openConnection(s, 'spam.i2p', 81))
+        self.assertEqual(I2PAddress(TEST_B64, 'spam.i2p', 81),
+                         writer.get_extra_info('peername'))
+        self.assertEqual(s.address, writer.get_extra_info('sockname'))
+        self.assertEqual(1, len(s._streams))
+        connect = [l for l in self.bridge.commands if l.startswith('STREAM CONNECT')]
+        self.assertIn('TO_PORT=81', connect[0])
+
+        writer.write(b'foo')
+        self.waitFor(lambda: self.bridge.received)
+        self.assertEqual([b'foo'], self.bridge.received)
+        self.bridge.streams[0].transport.write(b'bar')
+        self.assertEqual(b'bar', self.wait(reader.readexactly(3)))
+
+        writer.close()
+        self.waitFor(lambda: not s._streams)
+
+    def test_createConnection(self):
+        s = self.getSession()
+        received = []
+        lost = []
+
+        class Client(asyncio.Protocol):
+            def data_received(self, data):
+                received.append(data)
+
+            def connection_lost(self, exc):
+                lost.append(exc)
+
+        transport, proto = self.wait(aio.createConnection(Client, s, TEST_B64))
+        self.assertIsInstance(proto, Client)
+        self.assertIsInstance(transport, aio.I2PStreamTransport)
+        # No lookup for a Destination
+        self.assertFalse([l for l in self.bridge.commands if l.startswith('NAMING')][1:])
+        self.bridge.streams[0].transport.write(b'bar')
+        self.waitFor(lambda: received)
+        self.assertEqual([b'bar'], received)
+        self.bridge.streams[0].transport.loseConnection()
+        self.waitFor(lambda: lost)
+        self.assertEqual([None], lost)
+        self.assertEqual([], s._streams)
+
+    def test_startServer(self):
+        s = self.getSession()
+        clients = []
+        server = self.wait(aio.startServer(
+            lambda r, w: clients.append((r, w)), s, minAccepts=2))
+        self.assertEqual(s.address, server.address)
+        self.waitFor(lambda: len(self.bridge.accepts) == 2)
+
+        self.bridge.peerArrives(b'hello')
+        self.waitFor(lambda: clients)
+        reader, writer = clients[0]
+        self.assertEqual(b'hello', self.wait(reader.readexactly(5)))
+        self.assertEqual(TEST_B64, writer.get_extra_info('peername').destination)
+        writer.write(b'world')
+        self.waitFor(lambda: self.bridge.received)
+        self.assertEqual([b'world'], self.bridge.received)
+
+        server.close()
+        self.waitFor(lambda: not self.bridge.accepts)
+        writer.close()
+        self.waitFor(lambda: not s._streams)
@@ -0,0 +1,57 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.sam.base import I2PFactoryWrapper
+from txi2p.test.util import TEST_B64, FakeFactory
+from .util import connectionLostFailure
+
+
+class TestSAMI2PServerTunnelProtocol(unittest.TestCase):
+    def makeProto(self, wrappedFactory=None):
+        self.serverAddr = I2PAddress(TEST_B64, 'spam.i2p')
+        fac = I2PFactoryWrapper(wrappedFactory or FakeFactory(), self.serverAddr)
+        proto = fac.buildProtocol(None)
+        transport = proto_helpers.StringTransportWithDisconnection()
+        transport.protocol = proto
+        proto.makeConnection(transport)
+        return proto
+
+    def test_wrappedProtoWaitsForPeer(self):
+        proto = self.makeProto()
+        proto.dataReceived(TEST_B64[:10].encode('utf-8'))
+        self.assertIsNone(proto.wrappedProto)
+
+    def test_wrappedProtoBuiltWithPeer(self):
+        proto = self.makeProto()
+        proto.dataReceived(('%s FROM_PORT=34444 TO_PORT=0\n' % TEST_B64).encode('utf-8'))
+        wrapped = proto.wrappedProto
+        self.assertEqual(I2PAddress(TEST_B64, port=34444), wrapped.transport.getPeer())
+        self.assertEqual(self.serverAddr, wrapped.transport.getHost())
+
+    def test_initialDataPassed(self):
+        proto = self.makeProto()
+        proto.dataReceived(('%s\nfoo' % TEST_B64).encode('utf-8'))
+        self.assertEqual(b'foo', proto.wrappedProto.data)
+
+    def test_transportDeliversToWrappedProto(self):
+        proto = self.makeProto()
+        transport = proto.transport
+        proto.dataReceived(('%s\n' % TEST_B64).encode('utf-8'))
+        self.assertIs(proto.wrappedProto, transport.protocol)
+
+    def test_buildProtocolReturnsNone(self):
+        wrappedFactory = FakeFactory()
+        wrappedFactory.buildProtocol = lambda addr: None
+        proto = self.makeProto(wrappedFactory)
+        proto.dataReceived(('%s\n' % TEST_B64).encode('utf-8'))
+        self.assertFalse(proto.transport.connected)
+
+    def test_connectionLost(self):
+        proto = self.makeProto()
+        proto.dataReceived(('%s\n' % TEST_B64).encode('utf-8'))
+        proto.connectionLost(connectionLostFailure)
+        self.assertTrue(proto.wrappedProto.closed)
@@ -0,0 +1,206 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+try:
+    # Python 3
+    from unittest.mock import Mock
+except:
+    # Python 2 (library)
+    from mock import Mock
+from twisted.internet import defer, error, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import DatagramProtocol
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.sam import datagram
+from txi2p.sam.session import SAMSession, getSession
+from txi2p.test.util import TEST_B64
+from .util import FakeSAMBridge
+
+
+class RecordingProtocol(DatagramProtocol):
+    def __init__(self):
+        self.received = []
+
+    def datagramReceived(self, data, addr):
+        self.received.append((data, addr))
+
+
+def makeSession(style='DATAGRAM', samVersion='3.2', localPort=None):
+    s = SAMSession()
+    s.nickname = s.id = 'foo'
+    s.style = style
+    s.samVersion = samVersion
+    s.address = I2PAddress(TEST_B64, port=localPort)
+    s.close = Mock()
+    return s
+
+
+class TestSAMDatagramPort(unittest.TestCase):
+    def makePort(self, **kw):
+        self.clock = task.Clock()
+        self.proto = RecordingProtocol()
+        self.udpPort = Mock()
+        port = datagram.SAMDatagramPort(self.proto, ('127.0.0.1', 7655), self.clock)
+        port.startSession(makeSession(**kw), self.udpPort)
+        return port
+
+    def sentPackets(self):
+        return [args[0] for args, kw in self.udpPort.write.call_args_list]
+
+    def test_protocolStarted(self):
+        port = self.makePort()
+        self.assertIs(port, self.proto.transport)
+        self.assertIs(port, port.session.datagramPort)
+        self.assertEqual(port.session.address, port.getHost())
+
+    def test_writesBatchedPerTick(self):
+        port = self.makePort()
+        port.write(b'foo', TEST_B64)
+        port.write(b'bar', TEST_B64)
+        self.assertFalse(self.udpPort.write.called)
+        self.clock.advance(0)
+        self.assertEqual([
+            ('3.0 foo %s\nfoo' % TEST_B64).encode('utf-8'),
+            ('3.0 foo %s\nbar' % TEST_B64).encode('utf-8'),
+        ], self.sentPackets())
+        self.udpPort.write.assert_called_with(
+            self.sentPackets()[-1], ('127.0.0.1', 7655))
+        self.assertEqual((2, 1), (port.sent, port.batches))
+
+    def test_writeSequence(self):
+        port = self.makePort()
+        port.writeSequence([b'foo', b'bar'], I2PAddress(TEST_B64))
+        self.clock.advance(0)
+        self.assertEqual(2, len(self.sentPackets()))
+        self.assertEqual(1, port.batches)
+
+    def test_writeWithPorts(self):
+        port = self.makePort(localPort=81)
+        port.write(b'foo', I2PAddress(TEST_B64, port=80))
+        port.flush()
+        self.assertEqual(
+            [('3.0 foo %s FROM_PORT=81 TO_PORT=80\nfoo' % TEST_B64).encode('utf-8')],
+            self.sentPackets())
+
+    def test_writeWithPortsBefore3_2(self):
+        port = self.makePort(samVersion='3.1', localPort=81)
+        port.write(b'foo', I2PAddress(TEST_B64, port=80))
+        port.flush()
+        self.assertEqual(
+            [('3.0 foo %s\nfoo' % TEST_B64).encode('utf-8')],
+            self.sentPackets())
+
+    def test_flushCancelsPendingFlush(self):
+        port = self.makePort()
+        port.write(b'foo', TEST_B64)
+        port.flush()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(1, port.batches)
+
+    def test_datagramReceived(self):
+        port = self.makePort()
+        port.forwardedDatagramReceived(
+            ('%s FROM_PORT=80 TO_PORT=0\nfoo' % TEST_B64).encode('utf-8'))
+        self.assertEqual([(b'foo', I2PAddress(TEST_B64, port=80))],
+                         self.proto.received)
+
+    def test_rawDatagramReceived(self):
+        port = self.makePort(style='RAW')
+        port.forwardedDatagramReceived(b'foo\nbar')
+        self.assertEqual([(b'foo\nbar', None)], self.proto.received)
+
+    def test_stopListening(self):
+        port = self.makePort()
+        session = port.session
+        port.write(b'foo', TEST_B64)
+        port.stopListening()
+        self.assertEqual(1, len(self.sentPackets()))
+        self.assertTrue(self.udpPort.stopListening.called)
+        self.assertIsNone(session.datagramPort)
+        self.assertTrue(session.close.called)
+
+
+class TestListenDatagrams(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeSAMBridge()
+        self.port = reactor.listenTCP(0, self.bridge, interface='127.0.0.1')
+        self.samEndpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.port.getHost().port)
+        # Stands in for the SAM bridge's UDP port
+        self.bridgeUdp = RecordingProtocol()
+        self.udpPort = reactor.listenUDP(0, self.bridgeUdp, interface='127.0.0.1')
+        self.addCleanup(self.udpPort.stopListening)
+        self.addCleanup(self.port.stopListening)
+
+    def listen(self, proto, style='DATAGRAM'):
+        d = datagram.listenDatagrams(
+            proto, self.samEndpoint, self.id(), style=style,
+            samUdpAddress=('127.0.0.1', self.udpPort.getHost().port))
+        d.addCallback(self._listening)
+        return d
+
+    def _listening(self, port):
+        self.addCleanup(port.stopListening)
+        return port
+
+    @defer.inlineCallbacks
+    def waitFor(self, condition):
+        while not condition():
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    def test_unsupportedStyle(self):
+        self.assertRaises(error.UnsupportedSocketType, datagram.listenDatagrams,
+                          RecordingProtocol(), self.samEndpoint, style='STREAM')
+
+    @defer.inlineCallbacks
+    def test_sendAndReceive(self):
+        proto = RecordingProtocol()
+        port = yield self.listen(proto)
+        create = [l for l in self.bridge.commands if l.startswith('SESSION CREATE')][0]
+        self.assertIn('STYLE=DATAGRAM', create)
+        self.assertIn('HOST=127.0.0.1', create)
+        forwardPort = int(create.split('PORT=')[1].split(' ')[0])
+
+        # The bridge forwards a datagram from a peer
+        self.udpPort.write(('%s FROM_PORT=80 TO_PORT=0\nfoo' % TEST_B64).encode('utf-8'),
+                           ('127.0.0.1', forwardPort))
+        yield self.waitFor(lambda: proto.received)
+        self.assertEqual([(b'foo', I2PAddress(TEST_B64, port=80))], proto.received)
+
+        # The protocol replies
+        proto.transport.write(b'bar', proto.received[0][1])
+        yield self.waitFor(lambda: self.bridgeUdp.received)
+        self.assertEqual(
+            ('3.0 %s %s TO_PORT=80\nbar' % (self.id(), TEST_B64)).encode('utf-8'),
+            self.bridgeUdp.received[0][0])
+
+    @defer.inlineCallbacks
+    def test_sessionExistsWithOtherStyle(self):
+        yield self.listen(RecordingProtocol(), style='RAW')
+        d = self.listen(RecordingProtocol())
+        yield self.assertFailure(d, error.UnsupportedSocketType)
+
+    @defer.inlineCallbacks
+    def test_sessionAlreadyHasPort(self):
+        yield self.listen(RecordingProtocol())
+        d = self.listen(RecordingProtocol())
+        yield self.assertFailure(d, ValueError)
+
+    @defer.inlineCallbacks
+    def test_sessionForwardsElsewhere(self):
+        s = yield getSession(self.id(), samEndpoint=self.samEndpoint,
+                             style='DATAGRAM')
+        self.addCleanup(s.close)
+        d = self.listen(RecordingProtocol())
+        yield self.assertFailure(d, ValueError)
+        self.assertIsNone(s.datagramPort)
+
+    def test_udpPortClosedIfNoSession(self):
+        mreactor = Mock()
+        mreactor.listenUDP.return_value.getHost.return_value.port = 1234
+        # A new session needs an API endpoint
+        self.assertRaises(ValueError, datagram.listenDatagrams,
+                          RecordingProtocol(), None, self.id(), reactor=mreactor)
+        self.assertTrue(mreactor.listenUDP.return_value.stopListening.called)
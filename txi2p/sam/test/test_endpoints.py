@@ -7,14 +7,17 @@ try:
 except:
     # Python 2 (library)
     import mock
+from twisted.internet import defer, task
 from twisted.internet.error import ConnectionLost, ConnectionRefusedError
 from twisted.python import failure
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from txi2p.sam import endpoints
-from txi2p.sam.session import SAMSession
+from txi2p.sam.naming import NamingCache
+from txi2p.sam.session import SAMSession, lookupCheck
 from txi2p.test.util import FakeEndpoint, FakeFactory, fakeSession
+from .util import MultiFakeEndpoint
 
 
 connectionLostFailure = failure.Failure(ConnectionLost())
@@ -57,6 +60,95 @@ class SAMI2PStreamClientEndpointTestCase(unittest.TestCase):
         self.assertSubstring('HELLO VERSION', samEndpoint.transport.value().decode('utf-8'))
 
 
+    def test_streamConnectCachedName(self):
+        samEndpoint = FakeEndpoint()
+        session = SAMSession()
+        session.nickname = 'foo'
+        session.samEndpoint = samEndpoint
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        session._autoClose = True
+        session.namingCache = NamingCache()
+        session.namingCache.resolved('foo.i2p', 'bar')
+        endpoint = endpoints.SAMI2PStreamClientEndpoint(session, 'foo.i2p')
+        endpoint.connect(None)
+        samEndpoint.proto.transport.clear()
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self.assertEqual(b'STREAM CONNECT ID=foo DESTINATION=bar SILENT=false\n',
+                         samEndpoint.transport.value())
+
+
+    def test_streamConnectResolvesThroughSession(self):
+        session = SAMSession()
+        session.nickname = 'foo'
+        session.samEndpoint = MultiFakeEndpoint()
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        session._autoClose = True
+        session.namingCache = NamingCache()
+        endpoint = endpoints.SAMI2PStreamClientEndpoint(session, 'foo.i2p')
+        endpoint.connect(None)
+        endpoint.connect(None)
+        self.addCleanup(session.samEndpoint.protos[0].receiver.stopPinging)
+        # Both connects wait for one lookup, on the resolver's connection
+        proto = session.samEndpoint.protos[0]
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self.assertEqual(b'HELLO VERSION MIN=3.0 MAX=3.3\n'
+                         b'NAMING LOOKUP NAME=foo.i2p\n',
+                         proto.transport.value())
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=foo.i2p VALUE=bar\n')
+        self.assertEqual(3, len(session.samEndpoint.protos))
+        for streamProto in session.samEndpoint.protos[1:]:
+            streamProto.transport.clear()
+            streamProto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+            self.assertEqual(
+                b'STREAM CONNECT ID=foo DESTINATION=bar SILENT=false\n',
+                streamProto.transport.value())
+
+    def test_streamConnectFailureReleasesLookup(self):
+        session = SAMSession()
+        session.nickname = 'foo'
+        session.samEndpoint = FakeEndpoint(failure=connectionRefusedFailure)
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        session._autoClose = True
+        session.namingCache = NamingCache()
+        endpoint = endpoints.SAMI2PStreamClientEndpoint(session, 'foo.i2p')
+        d = endpoint.connect(None)
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assertEqual({}, session.namingCache._inFlight)
+
+
+    def test_streamConnectWaitsForWarmUp(self):
+        samEndpoint = FakeEndpoint()
+        session = SAMSession()
+        session.nickname = 'foo'
+        session.samEndpoint = samEndpoint
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        check = defer.Deferred()
+        session.warmUp(lambda s: check, clock=task.Clock())
+        endpoint = endpoints.SAMI2PStreamClientEndpoint(session, 'foo.i2p')
+        endpoint.connect(None)
+        self.assertFalse(hasattr(samEndpoint, 'transport'))
+        check.callback(None)
+        self.assertSubstring('HELLO VERSION', samEndpoint.transport.value().decode('utf-8'))
+
+
+    def test_newWithWarmup(self):
+        samEndpoint = FakeEndpoint()
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            endpoint = endpoints.SAMI2PStreamClientEndpoint.new(
+                samEndpoint, 'foo.i2p', warmup='lookup', warmupTimeout=30)
+        self.assertIs(lookupCheck, endpoint._sessionDeferred.kwargs['readyCheck'])
+        self.assertEqual(30, endpoint._sessionDeferred.kwargs['readyTimeout'])
+
+
+    def test_badWarmup(self):
+        self.assertRaises(ValueError, endpoints.SAMI2PStreamClientEndpoint.new,
+                          FakeEndpoint(), 'foo.i2p', warmup='foo')
+
+
 
 class SAMI2PStreamServerEndpointTestCase(unittest.TestCase):
     """
@@ -91,3 +183,48 @@ class SAMI2PStreamServerEndpointTestCase(unittest.TestCase):
         endpoint = endpoints.SAMI2PStreamServerEndpoint(session)
         endpoint.listen(None)
         self.assertSubstring('HELLO VERSION', str(samEndpoint.transport.value()))
+
+
+    def test_streamListenForward(self):
+        samEndpoint = FakeEndpoint()
+        reactor = proto_helpers.MemoryReactor()
+        session = SAMSession()
+        session.nickname = 'foo'
+        session.samEndpoint = samEndpoint
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        session.style = 'STREAM'
+        session._autoClose = True
+        endpoint = endpoints.SAMI2PStreamServerEndpoint(
+            session, listenMode=endpoints.LISTEN_FORWARD, reactor=reactor)
+        endpoint.listen(FakeFactory())
+        self.assertEqual('127.0.0.1', reactor.tcpServers[0][3])
+        samEndpoint.proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self.assertSubstring('STREAM FORWARD ID=foo PORT=%d' % reactor.tcpServers[0][0],
+                             str(samEndpoint.transport.value()))
+
+
+    def test_streamListenWaitsForWarmUp(self):
+        samEndpoint = FakeEndpoint()
+        session = SAMSession()
+        session.nickname = 'foo'
+        session.samEndpoint = samEndpoint
+        session.samVersion = '3.1'
+        session.id = 'foo'
+        check = defer.Deferred()
+        session.warmUp(lambda s: check, clock=task.Clock())
+        endpoint = endpoints.SAMI2PStreamServerEndpoint(session)
+        endpoint.listen(None)
+        self.assertFalse(hasattr(samEndpoint, 'transport'))
+        check.callback(None)
+        self.assertSubstring('HELLO VERSION', str(samEndpoint.transport.value()))
+
+
+    def test_streamWarmupNeedsHost(self):
+        self.assertRaises(ValueError, endpoints.SAMI2PStreamServerEndpoint.new,
+                          FakeEndpoint(), '', warmup='stream')
+
+
+    def test_badListenMode(self):
+        self.assertRaises(ValueError, endpoints.SAMI2PStreamServerEndpoint,
+                          None, listenMode='foo')
@@ -0,0 +1,153 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import defer, error, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.sam import group, session
+from txi2p.sam.endpoints import SAMI2PShardedClientEndpoint
+from txi2p.test.util import TEST_B64, FakeFactory
+from .util import FakeSAMBridge
+
+
+def makeSession(nickname):
+    s = session.SAMSession()
+    s.nickname = s.id = nickname
+    s.samVersion = '3.2'
+    s.address = I2PAddress(TEST_B64)
+    return s
+
+
+def makeGroup(size=3, strategy=group.SHARD_ROUND_ROBIN):
+    return group.SAMSessionGroup(
+        [makeSession('foo-%d' % i) for i in range(size)], strategy)
+
+
+class TestSAMSessionGroup(unittest.TestCase):
+    def test_badStrategy(self):
+        self.assertRaises(ValueError, makeGroup, strategy='foo')
+
+    def test_roundRobin(self):
+        g = makeGroup()
+        self.assertEqual([0, 1, 2, 0], [g.choose('spam.i2p') for i in range(4)])
+
+    def test_roundRobinSkipsClosed(self):
+        g = makeGroup()
+        g.sessions[1]._closed = True
+        self.assertEqual([0, 2, 0], [g.choose('spam.i2p') for i in range(3)])
+
+    def test_allClosed(self):
+        g = makeGroup()
+        for s in g.sessions:
+            s._closed = True
+        self.assertRaises(error.ConnectionDone, g.choose, 'spam.i2p')
+
+    def test_leastStreams(self):
+        g = makeGroup(strategy=group.SHARD_LEAST_STREAMS)
+        g.sessions[0]._streams = ['a', 'b']
+        g.sessions[1]._streams = ['c']
+        self.assertEqual(2, g.choose('spam.i2p'))
+        # Streams that are still opening count too
+        g.streamStarted(2)
+        g.streamStarted(2)
+        self.assertEqual(1, g.choose('spam.i2p'))
+        g.streamFinished(2)
+        g.streamFinished(2, failed=True)
+        self.assertEqual(2, g.choose('spam.i2p'))
+
+    def test_hash(self):
+        g = makeGroup(strategy=group.SHARD_HASH)
+        hosts = ['host%d.i2p' % i for i in range(50)]
+        chosen = [g.choose(h) for h in hosts]
+        self.assertEqual(chosen, [g.choose(h) for h in hosts])
+        self.assertEqual(set([0, 1, 2]), set(chosen))
+
+    def test_hashMovesOnlyClosedSessionsHosts(self):
+        g = makeGroup(strategy=group.SHARD_HASH)
+        hosts = ['host%d.i2p' % i for i in range(50)]
+        before = [g.choose(h) for h in hosts]
+        g.sessions[1]._closed = True
+        after = [g.choose(h) for h in hosts]
+        for b, a in zip(before, after):
+            if b != 1:
+                self.assertEqual(b, a)
+            else:
+                self.assertNotEqual(1, a)
+
+    def test_stats(self):
+        g = makeGroup(size=2)
+        g.sessions[0]._streams = ['a']
+        g.streamStarted(0)
+        g.streamStarted(1)
+        g.streamFinished(1, failed=True)
+        self.assertEqual([
+            {'nickname': 'foo-0', 'streams': 1, 'pending': 1, 'connects': 1, 'failures': 0},
+            {'nickname': 'foo-1', 'streams': 0, 'pending': 0, 'connects': 1, 'failures': 1},
+        ], g.stats())
+
+
+class TestGetSessionGroup(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeSAMBridge()
+        self.port = reactor.listenTCP(0, self.bridge, interface='127.0.0.1')
+        self.samEndpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.port.getHost().port)
+        self.addCleanup(self.port.stopListening)
+
+    def tearDown(self):
+        for s in list(session._sessions.values()):
+            s.close()
+
+    @defer.inlineCallbacks
+    def test_getSessionGroup(self):
+        d = group.getSessionGroup('foo', 3, self.samEndpoint,
+                                  strategy=group.SHARD_LEAST_STREAMS)
+        # Every session is being created at once
+        self.assertEqual(set(['foo-0', 'foo-1', 'foo-2']),
+                         set(session._pending_sessions))
+        g = yield d
+        self.assertEqual(['foo-0', 'foo-1', 'foo-2'],
+                         [s.nickname for s in g.sessions])
+        self.assertEqual(group.SHARD_LEAST_STREAMS, g.strategy)
+
+    @defer.inlineCallbacks
+    def test_getSessionGroupFailure(self):
+        # An existing session is used, and left alone on failure
+        yield session.getSession('foo-1', self.samEndpoint)
+        self.port.stopListening()
+        d = group.getSessionGroup('foo', 2, self.samEndpoint)
+        yield self.assertFailure(d, error.ConnectionRefusedError)
+        self.assertEqual(['foo-1'], list(session._sessions))
+
+    @defer.inlineCallbacks
+    def test_getSessionGroupFailureClosesCreated(self):
+        self.bridge.failCreate = ['foo-1']
+        d = group.getSessionGroup('foo', 2, self.samEndpoint)
+        yield self.assertFailure(d, error.ConnectError)
+        self.assertEqual({}, session._sessions)
+
+    def test_badStrategy(self):
+        self.assertRaises(ValueError, group.getSessionGroup, 'foo', 2,
+                          self.samEndpoint, strategy='foo')
+
+    @defer.inlineCallbacks
+    def test_shardedEndpoint(self):
+        endpoint = SAMI2PShardedClientEndpoint.new(
+            self.samEndpoint, 'spam.i2p', nickname='foo', shards=2)
+        protos = []
+        for i in range(4):
+            proto = yield endpoint.connect(FakeFactory())
+            protos.append(proto)
+        g = endpoint._group
+        self.assertEqual([2, 2], g.connects)
+        self.assertEqual([2, 2], [s['streams'] for s in g.stats()])
+        connects = [l for l in self.bridge.commands if l.startswith('STREAM CONNECT')]
+        self.assertEqual(['foo-0', 'foo-1', 'foo-0', 'foo-1'],
+                         [l.split('ID=')[1].split(' ')[0] for l in connects])
+        # Streams must be gone before their sessions are closed
+        for proto in protos:
+            proto.transport.loseConnection()
+        while any(s._streams for s in g.sessions):
+            yield task.deferLater(reactor, 0.01, lambda: None)
@@ -0,0 +1,128 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from txi2p.sam import keepalive
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = keepalive.TimerWheel(tick=1.0, slots=8, clock=self.clock)
+        self.fired = []
+
+    def callLater(self, delay, name):
+        return self.wheel.callLater(delay, self.fired.append, name)
+
+    def test_fires(self):
+        timer = self.callLater(3, 'a')
+        self.assertTrue(timer.active())
+        self.assertEqual(3, timer.getTime())
+        self.clock.advance(2)
+        self.assertEqual([], self.fired)
+        self.clock.advance(1)
+        self.assertEqual(['a'], self.fired)
+        self.assertFalse(timer.active())
+
+    def test_neverFiresEarly(self):
+        self.clock.advance(0.5)
+        self.callLater(1, 'a')
+        self.clock.advance(1)
+        self.assertEqual([], self.fired)
+        self.clock.advance(0.5)
+        self.assertEqual(['a'], self.fired)
+
+    def test_singleReactorCall(self):
+        for i in range(100):
+            self.callLater(i % 5 + 1, i)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.assertEqual(100, len(self.wheel))
+
+    def test_cancel(self):
+        timer = self.callLater(2, 'a')
+        timer.cancel()
+        self.assertFalse(timer.active())
+        # Cancelling again does nothing
+        timer.cancel()
+        self.assertEqual(0, len(self.wheel))
+        # With no timers left there is nothing for the reactor to run
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.clock.advance(5)
+        self.assertEqual([], self.fired)
+
+    def test_reset(self):
+        timer = self.callLater(2, 'a')
+        self.clock.advance(1)
+        timer.reset(2)
+        self.clock.advance(1)
+        self.assertEqual([], self.fired)
+        self.clock.advance(1)
+        self.assertEqual(['a'], self.fired)
+        # An expired timer can be reset too
+        timer.reset(1)
+        self.clock.advance(1)
+        self.assertEqual(['a', 'a'], self.fired)
+        # Only resetting the active timer cancelled it
+        self.assertEqual(1, self.wheel.cancelled)
+
+    def test_longerThanOneTurn(self):
+        self.callLater(20, 'a')
+        self.clock.pump([1] * 19)
+        self.assertEqual([], self.fired)
+        self.clock.advance(1)
+        self.assertEqual(['a'], self.fired)
+
+    def test_catchesUp(self):
+        self.callLater(1, 'a')
+        self.callLater(3, 'b')
+        self.callLater(12, 'c')
+        self.clock.advance(10)
+        self.assertEqual(['a', 'b'], self.fired)
+        self.clock.advance(2)
+        self.assertEqual(['a', 'b', 'c'], self.fired)
+
+    def test_callbackCancelsAnother(self):
+        # Timers in the same tick fire in the order they were scheduled
+        self.wheel.callLater(1, lambda: other.cancel())
+        other = self.callLater(1, 'b')
+        self.clock.advance(1)
+        self.assertEqual([], self.fired)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_callbackSchedules(self):
+        self.wheel.callLater(1, self.callLater, 0, 'a')
+        self.clock.advance(1)
+        self.assertEqual([], self.fired)
+        self.clock.advance(1)
+        self.assertEqual(['a'], self.fired)
+
+    def test_callbackError(self):
+        self.wheel.callLater(1, lambda: 1 / 0)
+        self.callLater(1, 'a')
+        self.clock.advance(1)
+        self.assertEqual(['a'], self.fired)
+        self.assertEqual(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+
+    def test_metrics(self):
+        timer = self.callLater(1, 'a')
+        timer.reset(1)
+        self.callLater(2, 'b').cancel()
+        self.clock.pump([1, 1])
+        self.assertEqual(3, self.wheel.scheduled)
+        self.assertEqual(2, self.wheel.cancelled)
+        self.assertEqual(1, self.wheel.fired)
+        self.assertEqual(1, self.wheel.wakeups)
+
+
+class TestKeepaliveWheel(unittest.TestCase):
+    def test_shared(self):
+        self.assertIs(keepalive.keepaliveWheel(), keepalive.keepaliveWheel())
+
+    def test_perClock(self):
+        clock = task.Clock()
+        self.addCleanup(keepalive._wheels.pop, clock)
+        wheel = keepalive.keepaliveWheel(clock)
+        self.assertIs(wheel, keepalive.keepaliveWheel(clock))
+        self.assertIsNot(wheel, keepalive.keepaliveWheel())
@@ -0,0 +1,208 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import task
+from twisted.internet.error import ConnectionDone, ConnectError, UnknownHostError
+from twisted.trial import unittest
+
+from txi2p.sam.naming import NamingCache, SAMNamingResolver
+from txi2p.test.util import TEST_B64
+from .util import MultiFakeEndpoint, connectionLostFailure, connectionRefusedFailure
+
+
+class TestNamingCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = NamingCache(maxSize=2, ttl=60, negativeTTL=10, clock=self.clock)
+
+    def test_missThenHit(self):
+        self.assertIsNone(self.cache.lookup('spam.i2p'))
+        self.cache.resolved('spam.i2p', TEST_B64)
+        d = self.cache.lookup('spam.i2p')
+        self.assertEqual(TEST_B64, self.successResultOf(d))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_entryExpires(self):
+        self.cache.lookup('spam.i2p')
+        self.cache.resolved('spam.i2p', TEST_B64)
+        self.clock.advance(60)
+        self.assertIsNone(self.cache.lookup('spam.i2p'))
+        self.assertEqual(2, self.cache.misses)
+
+    def test_notFoundIsCached(self):
+        self.cache.lookup('spam.i2p')
+        self.cache.notFound('spam.i2p')
+        self.failureResultOf(self.cache.lookup('spam.i2p'), UnknownHostError)
+        self.clock.advance(10)
+        self.assertIsNone(self.cache.lookup('spam.i2p'))
+
+    def test_leastRecentlyUsedEvicted(self):
+        for name in ['spam.i2p', 'eggs.i2p']:
+            self.cache.lookup(name)
+            self.cache.resolved(name, name)
+        # Use spam.i2p so that eggs.i2p is the least recently used
+        self.cache.lookup('spam.i2p')
+        self.cache.lookup('ham.i2p')
+        self.cache.resolved('ham.i2p', 'ham.i2p')
+        self.assertIsNone(self.cache.lookup('eggs.i2p'))
+        self.assertEqual('spam.i2p', self.successResultOf(self.cache.lookup('spam.i2p')))
+
+    def test_concurrentLookupsMerged(self):
+        self.assertIsNone(self.cache.lookup('spam.i2p'))
+        d1 = self.cache.lookup('spam.i2p')
+        d2 = self.cache.lookup('spam.i2p')
+        self.assertNoResult(d1)
+        self.cache.resolved('spam.i2p', TEST_B64)
+        self.assertEqual(TEST_B64, self.successResultOf(d1))
+        self.assertEqual(TEST_B64, self.successResultOf(d2))
+        self.assertEqual((1, 2), (self.cache.misses, self.cache.merged))
+
+    def test_mergedLookupNotFound(self):
+        self.cache.lookup('spam.i2p')
+        d = self.cache.lookup('spam.i2p')
+        self.cache.notFound('spam.i2p')
+        self.failureResultOf(d, UnknownHostError)
+
+    def test_mergedLookupFailed(self):
+        self.cache.lookup('spam.i2p')
+        d = self.cache.lookup('spam.i2p')
+        self.cache.failed('spam.i2p')
+        self.assertIsNone(self.successResultOf(d))
+        # Nothing was cached
+        self.assertIsNone(self.cache.lookup('spam.i2p'))
+
+    def test_mergedLookupCancelled(self):
+        self.cache.lookup('spam.i2p')
+        d = self.cache.lookup('spam.i2p')
+        d.cancel()
+        self.failureResultOf(d)
+        self.cache.resolved('spam.i2p', TEST_B64)
+
+
+class TestSAMNamingResolver(unittest.TestCase):
+    def setUp(self):
+        self.samEndpoint = MultiFakeEndpoint()
+        self.resolver = SAMNamingResolver(self.samEndpoint)
+        self.addCleanup(self.stopPinging)
+
+    def stopPinging(self):
+        for proto in self.samEndpoint.protos:
+            proto.receiver.stopPinging()
+
+    def connect(self, version='3.2'):
+        proto = self.samEndpoint.protos[-1]
+        proto.dataReceived(
+            ('HELLO REPLY RESULT=OK VERSION=%s\n' % version).encode('utf-8'))
+        return proto
+
+    def test_lookupsShareConnection(self):
+        self.resolver.resolve('spam.i2p')
+        self.resolver.resolve('eggs.i2p')
+        proto = self.connect()
+        self.assertEqual(1, len(self.samEndpoint.protos))
+        self.assertEqual(
+            b'HELLO VERSION MIN=3.0 MAX=3.3\n'
+            b'NAMING LOOKUP NAME=spam.i2p\n'
+            b'NAMING LOOKUP NAME=eggs.i2p\n',
+            proto.transport.value())
+        proto.transport.clear()
+        self.resolver.resolve('ham.i2p')
+        self.assertEqual(b'NAMING LOOKUP NAME=ham.i2p\n', proto.transport.value())
+        self.assertEqual(1, len(self.samEndpoint.protos))
+
+    def test_repliesMatchedByName(self):
+        d1 = self.resolver.resolve('spam.i2p')
+        d2 = self.resolver.resolve('eggs.i2p')
+        proto = self.connect()
+        proto.dataReceived(
+            b'NAMING REPLY RESULT=OK NAME=eggs.i2p VALUE=eggs\n'
+            b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spam\n')
+        self.assertEqual('spam', self.successResultOf(d1))
+        self.assertEqual('eggs', self.successResultOf(d2))
+
+    def test_duplicateLookupsSentOnce(self):
+        d1 = self.resolver.resolve('spam.i2p')
+        d2 = self.resolver.resolve('spam.i2p')
+        proto = self.connect()
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spam\n')
+        self.assertEqual(1, self.resolver.sent)
+        self.assertEqual('spam', self.successResultOf(d1))
+        self.assertEqual('spam', self.successResultOf(d2))
+
+    def test_lookupErrors(self):
+        d1 = self.resolver.resolve('spam.i2p')
+        d2 = self.resolver.resolve('eggs.i2p')
+        proto = self.connect()
+        proto.dataReceived(
+            b'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=spam.i2p\n'
+            b'NAMING REPLY RESULT=INVALID_KEY NAME=eggs.i2p MESSAGE="foo"\n')
+        self.failureResultOf(d1, UnknownHostError)
+        self.failureResultOf(d2, ConnectError)
+
+    def test_usesNamingCache(self):
+        self.resolver.namingCache = NamingCache()
+        d = self.resolver.resolve('spam.i2p')
+        proto = self.connect()
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spam\n')
+        self.assertEqual('spam', self.successResultOf(d))
+        d = self.resolver.resolve('spam.i2p')
+        self.assertEqual('spam', self.successResultOf(d))
+        self.assertEqual(1, self.resolver.sent)
+
+    def test_connectionRefused(self):
+        self.samEndpoint.failure = connectionRefusedFailure
+        d = self.resolver.resolve('spam.i2p')
+        self.failureResultOf(d).trap(connectionRefusedFailure.type)
+
+    def test_connectionLostFailsPendingAndReconnects(self):
+        d = self.resolver.resolve('spam.i2p')
+        proto = self.connect()
+        proto.connectionLost(connectionLostFailure)
+        self.failureResultOf(d).trap(connectionLostFailure.type)
+        self.resolver.resolve('spam.i2p')
+        self.assertEqual(2, len(self.samEndpoint.protos))
+
+    def test_close(self):
+        d = self.resolver.resolve('spam.i2p')
+        proto = self.connect()
+        self.resolver.close()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertFalse(proto.transport.connected)
+
+    def test_answersPings(self):
+        d = self.resolver.resolve('spam.i2p')
+        proto = self.connect()
+        proto.transport.clear()
+        proto.dataReceived(b'PING 1234\n')
+        self.assertEqual(b'PONG 1234\n', proto.transport.value())
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=spam\n')
+        self.assertEqual('spam', self.successResultOf(d))
+
+    def test_keptAlive(self):
+        d = self.resolver.resolve('spam.i2p')
+        proto = self.connect()
+        self.assertTrue(proto.receiver.pinger.active())
+        self.resolver.close()
+        self.failureResultOf(d, ConnectionDone)
+        self.assertFalse(proto.receiver.pinger.active())
+
+    def test_notKeptAliveBefore3_2(self):
+        self.resolver.resolve('spam.i2p')
+        proto = self.connect('3.1')
+        self.assertIsNone(proto.receiver.pinger)
+
+    def test_closeFailsLaterLookups(self):
+        self.resolver.close()
+        self.failureResultOf(self.resolver.resolve('spam.i2p'), ConnectionDone)
+        self.assertEqual([], self.samEndpoint.protos)
+
+    def test_closeFailsMergedLookups(self):
+        self.resolver.namingCache = NamingCache()
+        d1 = self.resolver.resolve('spam.i2p')
+        d2 = self.resolver.resolve('spam.i2p')
+        self.connect()
+        self.resolver.close()
+        self.failureResultOf(d1, ConnectionDone)
+        self.failureResultOf(d2, ConnectionDone)
+        # No connection is opened for the merged lookup
+        self.assertEqual(1, len(self.samEndpoint.protos))
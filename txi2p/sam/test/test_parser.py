@@ -0,0 +1,147 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+try:
+    # Python 3
+    from unittest.mock import Mock
+except:
+    # Python 2 (library)
+    from mock import Mock
+from twisted.trial import unittest
+
+from txi2p.sam import base
+from txi2p.sam.parser import parseOptions, SAMLineParser, SAMParseError
+from txi2p.sam.test import test_naming, test_session, test_stream
+
+
+class TestParseOptions(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual({}, parseOptions(''))
+
+    def test_single(self):
+        self.assertEqual({'result': 'OK'}, parseOptions('RESULT=OK'))
+
+    def test_multiple(self):
+        self.assertEqual({'result': 'OK', 'version': '3.1'},
+                         parseOptions('RESULT=OK VERSION=3.1'))
+
+    def test_quoted(self):
+        self.assertEqual({'result': 'I2P_ERROR', 'message': 'foo bar baz'},
+                         parseOptions('RESULT=I2P_ERROR MESSAGE="foo bar baz"'))
+
+    def test_valueContainsEquals(self):
+        self.assertEqual({'value': 'spam=='}, parseOptions('VALUE=spam=='))
+
+    def test_missingValue(self):
+        self.assertRaises(SAMParseError, parseOptions, 'RESULT')
+
+    def test_unterminatedQuote(self):
+        self.assertRaises(SAMParseError, parseOptions, 'MESSAGE="foo bar')
+
+    def test_dataAfterQuote(self):
+        self.assertRaises(SAMParseError, parseOptions, 'MESSAGE="foo"bar')
+
+
+class TestSAMLineParser(unittest.TestCase):
+    def makeParser(self, rule):
+        receiver = Mock()
+        receiver.currentRule = rule
+        return receiver, SAMLineParser(receiver)
+
+    def test_hello(self):
+        receiver, parser = self.makeParser('State_hello')
+        parser.receive(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        receiver.hello.assert_called_with(result='OK', version='3.1')
+
+    def test_partialLines(self):
+        receiver, parser = self.makeParser('State_naming')
+        parser.receive(b'NAMING REPLY RESULT=OK ')
+        self.assertFalse(receiver.lookupReply.called)
+        parser.receive(b'NAME=spam.i2p VALUE=bar\n')
+        receiver.lookupReply.assert_called_with(
+            result='OK', name='spam.i2p', value='bar')
+
+    def test_unexpectedReply(self):
+        receiver, parser = self.makeParser('State_hello')
+        self.assertRaises(SAMParseError, parser.receive,
+                          b'STREAM STATUS RESULT=OK\n')
+
+    def test_pingWithData(self):
+        receiver, parser = self.makeParser('State_keepalive')
+        parser.receive(b'PING 1234\nPONG\n')
+        receiver.ping.assert_called_with('1234')
+        receiver.pong.assert_called_with(None)
+
+    def test_dataAfterStatus(self):
+        receiver, parser = self.makeParser('State_connect')
+        def connect(**options):
+            receiver.currentRule = 'State_readData'
+        receiver.connect.side_effect = connect
+        parser.receive(b'STREAM STATUS RESULT=OK\nEgg and spam')
+        receiver.dataReceived.assert_called_with(b'Egg and spam')
+
+
+class LineParserMixin(object):
+    def setUp(self):
+        self.patch(base.SAMParserProtocol, 'useLineParser', True)
+        super(LineParserMixin, self).setUp()
+
+
+class TestSessionCreateProtocolLineParser(
+        LineParserMixin, test_session.TestSessionCreateProtocol):
+    pass
+
+
+class TestSessionCreateFactoryLineParser(
+        LineParserMixin, test_session.TestSessionCreateFactory):
+    pass
+
+
+class TestDestGenerateProtocolLineParser(
+        LineParserMixin, test_session.TestDestGenerateProtocol):
+    pass
+
+
+class TestDestGenerateFactoryLineParser(
+        LineParserMixin, test_session.TestDestGenerateFactory):
+    pass
+
+
+class TestTestAPIProtocolLineParser(
+        LineParserMixin, test_session.TestTestAPIProtocol):
+    pass
+
+
+class TestStreamConnectProtocolLineParser(
+        LineParserMixin, test_stream.TestStreamConnectProtocol):
+    pass
+
+
+class TestStreamConnectFactoryLineParser(
+        LineParserMixin, test_stream.TestStreamConnectFactory):
+    pass
+
+
+class TestStreamAcceptProtocolLineParser(
+        LineParserMixin, test_stream.TestStreamAcceptProtocol):
+    pass
+
+
+class TestStreamAcceptFactoryLineParser(
+        LineParserMixin, test_stream.TestStreamAcceptFactory):
+    pass
+
+
+class TestStreamForwardProtocolLineParser(
+        LineParserMixin, test_stream.TestStreamForwardProtocol):
+    pass
+
+
+class TestStreamForwardFactoryLineParser(
+        LineParserMixin, test_stream.TestStreamForwardFactory):
+    pass
+
+
+class TestSAMNamingResolverLineParser(
+        LineParserMixin, test_naming.TestSAMNamingResolver):
+    pass
@@ -0,0 +1,130 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+try:
+    # Python 3
+    from unittest.mock import Mock
+except:
+    # Python 2 (library)
+    from mock import Mock
+from twisted.internet import task
+from twisted.trial import unittest
+
+from txi2p.sam import pool
+from txi2p.sam.stream import StreamConnectFactory
+from txi2p.test.util import TEST_B64, FakeFactory
+from .util import (
+    MultiFakeEndpoint,
+    connectionLostFailure,
+    connectionRefusedFailure,
+)
+
+
+def helloAll(protos):
+    for proto in protos:
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+
+
+class TestSAMConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.samEndpoint = MultiFakeEndpoint()
+        self.clock = task.Clock()
+        self.pool = pool.SAMConnectionPool(
+            self.samEndpoint, size=2, maxIdleAge=60, clock=self.clock)
+
+    def makeStreamFactory(self):
+        session = Mock()
+        session.id = 'foo'
+        return StreamConnectFactory(FakeFactory(), session, None, TEST_B64)
+
+    def test_startSendsHello(self):
+        self.pool.start()
+        self.assertEqual(2, len(self.samEndpoint.protos))
+        for proto in self.samEndpoint.protos:
+            self.assertEqual(b'HELLO VERSION MIN=3.0 MAX=3.3\n',
+                             proto.transport.value())
+
+    def test_helloParksConnection(self):
+        self.pool.start()
+        for proto in self.samEndpoint.protos:
+            proto.transport.clear()
+        helloAll(self.samEndpoint.protos)
+        self.assertEqual(2, len(self.pool._idle))
+        for proto in self.samEndpoint.protos:
+            self.assertEqual(b'', proto.transport.value())
+
+    def test_connectUsesIdleConnection(self):
+        self.pool.minIdle = 1
+        self.pool.start()
+        helloAll(self.samEndpoint.protos)
+        proto = self.samEndpoint.protos[-1]
+        proto.transport.clear()
+        fac = self.makeStreamFactory()
+        self.assertEqual(proto, self.successResultOf(self.pool.connect(fac)))
+        self.assertEqual(
+            ('STREAM CONNECT ID=foo DESTINATION=%s SILENT=false\n' % TEST_B64).encode('utf-8'),
+            proto.transport.value())
+        self.assertEqual(fac, proto.factory)
+        self.assertEqual('3.1', fac.samVersion)
+        self.assertEqual(1, self.pool.hits)
+        # Still at minIdle, so the pool does not refill yet
+        self.assertEqual(1, len(self.pool._idle))
+        self.assertEqual(2, len(self.samEndpoint.protos))
+
+    def test_adoptedConnectionCompletesStream(self):
+        self.pool.start()
+        helloAll(self.samEndpoint.protos)
+        fac = self.makeStreamFactory()
+        proto = self.successResultOf(self.pool.connect(fac))
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        wrapped = self.successResultOf(fac.deferred)
+        self.assertEqual(proto.receiver.wrappedProto, wrapped)
+
+    def test_connectRefillsPool(self):
+        self.pool.minIdle = 2
+        self.pool.start()
+        helloAll(self.samEndpoint.protos)
+        self.pool.connect(self.makeStreamFactory())
+        self.assertEqual(3, len(self.samEndpoint.protos))
+        self.assertEqual(1, len(self.pool._pending))
+
+    def test_connectWithoutIdleDials(self):
+        self.pool.start()
+        fac = self.makeStreamFactory()
+        proto = self.successResultOf(self.pool.connect(fac))
+        self.assertEqual(1, self.pool.misses)
+        self.assertEqual(fac, proto.factory)
+        self.assertEqual(3, len(self.samEndpoint.protos))
+
+    def test_idleConnectionExpires(self):
+        self.pool.minIdle = 2
+        self.pool.start()
+        helloAll(self.samEndpoint.protos)
+        first = self.samEndpoint.protos[0]
+        self.clock.advance(60)
+        self.assertFalse(first.transport.connected)
+        # Both expired connections are replaced
+        self.assertEqual(4, len(self.samEndpoint.protos))
+        self.assertEqual(2, len(self.pool._pending))
+
+    def test_idleConnectionLost(self):
+        self.pool.start()
+        helloAll(self.samEndpoint.protos)
+        self.samEndpoint.protos[0].connectionLost(connectionLostFailure)
+        self.assertEqual(1, len(self.pool._idle))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+    def test_failedConnectionsNotRetried(self):
+        self.samEndpoint.failure = connectionRefusedFailure
+        self.pool.start()
+        self.assertEqual([], self.pool._pending)
+        self.assertEqual([], self.samEndpoint.protos)
+
+    def test_stopClosesIdleConnections(self):
+        self.pool.start()
+        helloAll(self.samEndpoint.protos)
+        self.pool.stop()
+        for proto in self.samEndpoint.protos:
+            self.assertFalse(proto.transport.connected)
+        self.assertEqual([], self.pool._idle)
+        self.assertEqual([], self.clock.getDelayedCalls())
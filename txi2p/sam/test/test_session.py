@@ -10,16 +10,25 @@ except:
     from mock import Mock
 import os
 import twisted
-from twisted.internet import defer
+from twisted.internet import defer, error, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.python.versions import Version
 from twisted.test import proto_helpers
 from twisted.trial import unittest
+from zope.interface import alsoProvides
 
 from txi2p.address import I2PAddress
+from txi2p.keystore import keyStore
 from txi2p.sam import session
 from txi2p.sam.constants import DEFAULT_SIGTYPE
 from txi2p.test.util import TEST_B64
-from .util import SAMProtocolTestMixin, SAMFactoryTestMixin
+from .util import (
+    FakeSAMBridge,
+    MultiFakeEndpoint,
+    SAMProtocolTestMixin,
+    SAMFactoryTestMixin,
+    waitFor,
+)
 
 if twisted.version < Version('twisted', 12, 3, 0):
     skipSRO = 'TestCase.successResultOf() requires twisted 12.3 or newer'
@@ -78,6 +87,17 @@ class TestSessionCreateProtocol(SAMProtocolTestMixin, unittest.TestCase):
             'SESSION CREATE STYLE=STREAM ID=foo DESTINATION=TRANSIENT SIGNATURE_TYPE=%s FROM_PORT=81\n' % DEFAULT_SIGTYPE,
             proto.transport.value().decode('utf-8'))
 
+    def test_sessionCreateWithForwardAfterHello(self):
+        fac, proto = self.makeProto()
+        fac.style = 'DATAGRAM'
+        fac.forwardPort = 34444
+        fac.forwardHost = '127.0.0.1'
+        proto.transport.clear()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self.assertEquals(
+            'SESSION CREATE STYLE=DATAGRAM ID=foo DESTINATION=TRANSIENT SIGNATURE_TYPE=%s PORT=34444 HOST=127.0.0.1\n' % DEFAULT_SIGTYPE,
+            proto.transport.value().decode('utf-8'))
+
     def test_sessionCreateWithOptionsAfterHello(self):
         fac, proto = self.makeProto()
         fac.style = 'STREAM'
@@ -177,6 +197,41 @@ class TestSessionCreateProtocol(SAMProtocolTestMixin, unittest.TestCase):
         # Cleanup
         self.addCleanup(proto.receiver.stopPinging)
 
+    def test_primarySessionRequires3_3(self):
+        fac, proto = self.makeProto()
+        fac.style = 'PRIMARY'
+        proto.transport.clear()
+        self.assertRaises(error.UnsupportedSocketType, proto.dataReceived,
+                          b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+        self.assertEquals(b'', proto.transport.value())
+
+    def test_primarySessionReceivesSubsessionStatus(self):
+        fac, proto = self.makeProto()
+        fac.style = 'PRIMARY'
+        fac.sessionCreated = Mock()
+        fac.subsessionStatus = Mock()
+        proto.transport.clear()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.3\n')
+        self.assertTrue(proto.transport.value().startswith(
+            b'SESSION CREATE STYLE=PRIMARY ID=foo '))
+        proto.transport.clear()
+        proto.dataReceived(('SESSION STATUS RESULT=OK DESTINATION=%s\n' % TEST_B64).encode('utf-8'))
+        proto.dataReceived(('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        self.addCleanup(proto.receiver.stopPinging)
+        self.assertEquals('State_primary', proto.receiver.currentRule)
+        proto.transport.clear()
+        proto.receiver.sender.sendSessionAdd('STREAM', 'bar', 80, 81, {'i2cp.foo': 'baz'})
+        self.assertEquals(
+            b'SESSION ADD STYLE=STREAM ID=bar FROM_PORT=80 LISTEN_PORT=81 i2cp.foo=baz\n',
+            proto.transport.value())
+        proto.dataReceived(b'SESSION STATUS RESULT=OK ID=bar MESSAGE="ADD bar"\n')
+        fac.subsessionStatus.assert_called_with('OK', 'ADD bar')
+        proto.transport.clear()
+        proto.receiver.sender.sendSessionRemove('bar')
+        self.assertEquals(b'SESSION REMOVE ID=bar\n', proto.transport.value())
+        proto.dataReceived(b'SESSION STATUS RESULT=INVALID_ID ID=bar\n')
+        fac.subsessionStatus.assert_called_with('INVALID_ID', None)
+
 
 class FakeEndpoint(object):
     def __init__(self, failure=None):
@@ -196,21 +251,71 @@ class TestSessionCreateFactory(SAMFactoryTestMixin, unittest.TestCase):
     factory = session.SessionCreateFactory
     blankFactoryArgs = ('',)
 
+    def test_unsupportedStyle(self):
+        self.assertRaises(error.UnsupportedSocketType,
+                          session.SessionCreateFactory, 'foo', style='SEQPACKET')
+
+    def test_datagramStyles(self):
+        for style in ('DATAGRAM', 'RAW', 'PRIMARY'):
+            fac = session.SessionCreateFactory('foo', style=style)
+            self.assertEqual(style, fac.style)
+
+    def setUp(self):
+        SAMFactoryTestMixin.setUp(self)
+        self.addCleanup(keyStore.forget)
+
     def test_startFactory(self):
         tmp = '/tmp/TestSessionCreateFactory.privKey'
         fac, proto = self.makeProto('foo', keyfile=tmp)
         fac.doStart()
-        self.assertTrue(fac._writeKeypair)
+        d = fac.keyLoading
+        d.addCallback(lambda _: self.assertTrue(fac._writeKeypair))
+        return d
 
     def test_startFactoryWithExistingKeyfile(self):
         tmp = '/tmp/TestSessionCreateFactory.privKey'
         f = open(tmp, 'w')
         f.write(u'foo')
         f.close()
+        self.addCleanup(os.remove, tmp)
         fac, proto = self.makeProto('foo', keyfile=tmp)
         fac.doStart()
-        self.assertEqual('foo', fac.privKey)
-        os.remove(tmp)
+        d = fac.keyLoading
+        d.addCallback(lambda _: self.assertEqual('foo', fac.privKey))
+        return d
+
+    def test_startFactoryWithPrivKey(self):
+        fac, proto = self.makeProto('foo', keyfile='/tmp/TestSessionCreateFactory.privKey')
+        fac.privKey = 'bar'
+        fac.doStart()
+        self.assertIsNone(fac.keyLoading)
+
+    def test_sessionCreateWaitsForKeyfile(self):
+        fac, proto = self.makeProto('foo', keyfile='/tmp/TestSessionCreateFactory.privKey')
+        fac.keyLoading = defer.Deferred()
+        proto.transport.clear()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        self.assertEqual(b'', proto.transport.value())
+        fac.privKey = 'bar'
+        fac.keyLoading.callback('bar')
+        self.assertEqual(b'SESSION CREATE STYLE=STREAM ID=foo DESTINATION=bar\n',
+                         proto.transport.value())
+        proto.transport.clear()
+        proto.dataReceived(b'SESSION STATUS RESULT=OK DESTINATION=bar\n')
+        self.assertEqual(b'NAMING LOOKUP NAME=ME\n', proto.transport.value())
+
+    def test_unreadableKeyfile(self):
+        self.patch(keyStore, 'load',
+                   lambda path, reactor: defer.fail(ValueError('bad keyfile')))
+        fac, proto = self.makeProto('foo', keyfile='/tmp/TestSessionCreateFactory.privKey')
+        fac.doStart()
+        self.assertFailure(fac.deferred, ValueError)
+        proto.transport.clear()
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        # No session is created
+        self.assertEqual(b'', proto.transport.value())
+        self.assertTrue(proto.transport.disconnecting)
+        return fac.deferred
 
     def test_sessionCreated(self):
         mreactor = proto_helpers.MemoryReactor()
@@ -235,12 +340,16 @@ class TestSessionCreateFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto.receiver.currentRule = 'State_naming'
         proto._parser._setupInterp()
         proto.dataReceived(('NAMING REPLY RESULT=OK NAME=ME VALUE=%s\n' % TEST_B64).encode('utf-8'))
-        f = open(tmp, 'r')
-        privKey = f.read()
-        f.close()
-        self.assertEqual('bar', privKey)
-        # Cleanup
-        os.remove(tmp)
+        self.addCleanup(os.remove, tmp)
+
+        def checkKeyfile(s):
+            f = open(tmp, 'r')
+            privKey = f.read()
+            f.close()
+            self.assertEqual('bar', privKey)
+            self.assertEqual(TEST_B64, s[4])
+        fac.deferred.addCallback(checkKeyfile)
+        return fac.deferred
 
 
 class TestSAMSession(unittest.TestCase):
@@ -288,6 +397,172 @@ class TestSAMSession(unittest.TestCase):
         self.assertEqual([], self.s._streams)
         self.assertEqual({'foo': self.s}, session._sessions)
 
+    def test_resolve(self):
+        self.s.samEndpoint = MultiFakeEndpoint()
+        d1 = self.s.resolve('spam.i2p')
+        d2 = self.s.resolve('eggs.i2p')
+        self.assertEqual(1, len(self.s.samEndpoint.protos))
+        self.s.close()
+        self.failureResultOf(d1)
+        self.failureResultOf(d2)
+        self.failureResultOf(self.s.resolve('spam.i2p'))
+
+    def test_warmUp(self):
+        clock = task.Clock()
+        attempts = []
+        def check(s):
+            attempts.append(s)
+            if len(attempts) < 3:
+                return defer.fail(error.ConnectError())
+            return defer.succeed(None)
+        self.s.warmUp(check, interval=10, clock=clock)
+        self.assertFalse(self.s.ready)
+        d = self.s.whenReady()
+        self.assertNoResult(d)
+        clock.advance(10)
+        self.assertNoResult(d)
+        clock.advance(10)
+        self.assertIs(self.s, self.successResultOf(d))
+        self.assertTrue(self.s.ready)
+        self.assertEqual([self.s] * 3, attempts)
+        self.assertEqual({'checks': 3, 'ready': 20}, self.s.timings)
+        self.assertEqual([], clock.getDelayedCalls())
+    test_warmUp.skip = skipSRO
+
+    def test_warmUpTimeout(self):
+        clock = task.Clock()
+        self.s.warmUp(lambda s: defer.fail(error.ConnectError()),
+                      timeout=25, interval=10, clock=clock)
+        d = self.s.whenReady()
+        clock.advance(10)
+        clock.advance(10)
+        clock.advance(5)
+        self.failureResultOf(d, error.TimeoutError)
+        self.assertEqual(3, self.s.timings['checks'])
+        self.assertNotIn('ready', self.s.timings)
+        self.assertEqual({}, session._sessions)
+        self.assertFalse(self.tr.connected)
+        self.assertEqual([], clock.getDelayedCalls())
+    test_warmUpTimeout.skip = skipSRO
+
+    def test_closeWhileWarmingUp(self):
+        clock = task.Clock()
+        self.s.warmUp(lambda s: defer.Deferred(), clock=clock)
+        d = self.s.whenReady()
+        self.s.close()
+        self.failureResultOf(d, error.ConnectionDone)
+        self.failureResultOf(self.s.whenReady(), error.ConnectionDone)
+        self.assertEqual([], clock.getDelayedCalls())
+    test_closeWhileWarmingUp.skip = skipSRO
+
+    def test_lookupCheck(self):
+        self.s.address = I2PAddress(TEST_B64)
+        self.s.resolve = Mock()
+        session.lookupCheck(self.s)
+        self.s.resolve.assert_called_with(self.s.address.host)
+
+    def test_streamCheck(self):
+        self.s.samEndpoint = MultiFakeEndpoint()
+        d = session.streamCheck('spam.i2p', 80)(self.s)
+        proto = self.s.samEndpoint.protos[0]
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+        proto.transport.clear()
+        proto.dataReceived(('NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=%s\n' % TEST_B64).encode('utf-8'))
+        self.assertEqual(
+            ('STREAM CONNECT ID=foo DESTINATION=%s SILENT=false TO_PORT=80\n' % TEST_B64).encode('utf-8'),
+            proto.transport.value())
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        self.successResultOf(d)
+        # The test stream is closed straight away
+        self.assertFalse(proto.transport.connected)
+    test_streamCheck.skip = skipSRO
+
+    def test_addSubsession_notPrimary(self):
+        self.failureResultOf(self.s.addSubsession('bar'), error.UnsupportedSocketType)
+
+
+class TestPrimarySession(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeSAMBridge(version='3.3')
+        self.port = reactor.listenTCP(0, self.bridge, interface='127.0.0.1')
+        self.samEndpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.port.getHost().port)
+        self.addCleanup(self.port.stopListening)
+
+    def tearDown(self):
+        for s in list(session._sessions.values()):
+            if not s.primary:
+                s.close()
+
+    def getPrimary(self):
+        return session.getSession('primary', samEndpoint=self.samEndpoint,
+                                  style='PRIMARY')
+
+    @defer.inlineCallbacks
+    def test_addSubsession(self):
+        primary = yield self.getPrimary()
+        sub = yield primary.addSubsession('sub', fromPort=80, listenPort=81)
+        self.assertIn('SESSION ADD STYLE=STREAM ID=sub FROM_PORT=80 LISTEN_PORT=81',
+                      self.bridge.commands)
+        self.assertEqual(['sub'], self.bridge.subsessions)
+        self.assertIs(primary, sub.primary)
+        self.assertEqual({'sub': sub}, primary.subsessions)
+        self.assertEqual(I2PAddress(TEST_B64, port=80), sub.address)
+        # The subsession shares the primary's control connection
+        self.assertEqual(1, len(self.bridge.connections))
+        same = yield session.getSession('sub')
+        self.assertIs(sub, same)
+
+    @defer.inlineCallbacks
+    def test_getSessionWaitsForSubsession(self):
+        primary = yield self.getPrimary()
+        d = primary.addSubsession('sub')
+        waiting = session.getSession('sub')
+        sub = yield d
+        same = yield waiting
+        self.assertIs(sub, same)
+
+    @defer.inlineCallbacks
+    def test_addSubsession_duplicate(self):
+        primary = yield self.getPrimary()
+        yield primary.addSubsession('sub')
+        yield self.assertFailure(primary.addSubsession('sub'), ValueError)
+        # Rejected by the bridge
+        self.bridge.subsessions.append('other')
+        yield self.assertFailure(primary.addSubsession('other'), error.ConnectError)
+        self.assertNotIn('other', session._sessions)
+
+    @defer.inlineCallbacks
+    def test_closeSubsession(self):
+        primary = yield self.getPrimary()
+        sub = yield primary.addSubsession('sub')
+        sub.close()
+        yield waitFor(lambda: not self.bridge.subsessions)
+        self.assertIn('SESSION REMOVE ID=sub', self.bridge.commands)
+        self.assertEqual({}, primary.subsessions)
+        self.assertNotIn('sub', session._sessions)
+        self.assertIn('primary', session._sessions)
+
+    @defer.inlineCallbacks
+    def test_closePrimary(self):
+        primary = yield self.getPrimary()
+        sub = yield primary.addSubsession('sub')
+        pending = primary.addSubsession('pending')
+        primary.close()
+        yield self.assertFailure(pending, error.ConnectionDone)
+        self.assertTrue(sub._closed)
+        self.assertEqual({}, session._sessions)
+        self.assertEqual({}, session._pending_sessions)
+
+    @defer.inlineCallbacks
+    def test_primaryConnectionLost(self):
+        primary = yield self.getPrimary()
+        sub = yield primary.addSubsession('sub')
+        self.bridge.disconnectAll()
+        yield waitFor(lambda: sub._closed)
+        self.assertEqual({}, primary.subsessions)
+        self.assertNotIn('sub', session._sessions)
+
 
 class TestGetSession(unittest.TestCase):
     def tearDown(self):
@@ -323,6 +598,19 @@ class TestGetSession(unittest.TestCase):
         self.assertEqual(81, s.address.port)
     test_getSession_newNickname_withPort.skip = skipSRO
 
+    def test_getSession_newNickname_withPool(self):
+        proto = proto_helpers.AccumulatingProtocol()
+        samEndpoint = FakeEndpoint()
+        samEndpoint.deferred = defer.succeed(None)
+        samEndpoint.facDeferred = defer.succeed(('3.1', 'STREAM', 'nick', proto, TEST_B64, None))
+        d = session.getSession('nick', samEndpoint, poolSize=3, poolMinIdle=1)
+        s = self.successResultOf(d)
+        self.assertEqual(3, s.pool.size)
+        self.assertEqual(1, s.pool.minIdle)
+        # One connection for the session, three for the pool
+        self.assertEqual(4, samEndpoint.called)
+    test_getSession_newNickname_withPool.skip = skipSRO
+
     def test_getSession_newNickname_withoutEndpoint(self):
         proto = proto_helpers.AccumulatingProtocol()
         samEndpoint = FakeEndpoint()
@@ -331,6 +619,42 @@ class TestGetSession(unittest.TestCase):
         self.assertRaises(ValueError, session.getSession, 'nick')
     test_getSession_newNickname_withoutEndpoint.skip = skipSRO
 
+    def test_getSession_newNickname_withReadyCheck(self):
+        samEndpoint = FakeEndpoint()
+        samEndpoint.deferred = defer.succeed(None)
+        samEndpoint.facDeferred = defer.succeed(('3.1', 'STREAM', 'foo', None, TEST_B64, None))
+        check = defer.Deferred()
+        s = self.successResultOf(session.getSession(
+            'foo', samEndpoint, readyCheck=lambda s: check))
+        self.assertFalse(s.ready)
+        self.assertIn('create', s.timings)
+        d = s.whenReady()
+        check.callback(None)
+        self.assertIs(s, self.successResultOf(d))
+    test_getSession_newNickname_withReadyCheck.skip = skipSRO
+
+    def test_warmSession(self):
+        samEndpoint = FakeEndpoint()
+        samEndpoint.deferred = defer.succeed(None)
+        samEndpoint.facDeferred = defer.succeed(('3.1', 'STREAM', 'foo', None, TEST_B64, None))
+        check = defer.Deferred()
+        d = session.warmSession('foo', samEndpoint, readyCheck=lambda s: check)
+        self.assertNoResult(d)
+        # Other users of the session get it, but wait to use it
+        s = self.successResultOf(session.getSession('foo'))
+        check.callback(None)
+        self.assertIs(s, self.successResultOf(d))
+        self.assertEqual(1, s.timings['checks'])
+    test_warmSession.skip = skipSRO
+
+    def test_warmSession_noCheck(self):
+        samEndpoint = FakeEndpoint()
+        samEndpoint.deferred = defer.succeed(None)
+        samEndpoint.facDeferred = defer.succeed(('3.1', 'STREAM', 'foo', None, TEST_B64, None))
+        s = self.successResultOf(session.warmSession('foo', samEndpoint))
+        self.assertTrue(s.ready)
+    test_warmSession_noCheck.skip = skipSRO
+
     def test_getSession_existingNickname(self):
         proto = proto_helpers.AccumulatingProtocol()
         samEndpoint = FakeEndpoint()
@@ -426,10 +750,9 @@ class TestDestGenerateFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto.receiver.currentRule = 'State_dest'
         proto._parser._setupInterp()
         proto.dataReceived(('DEST REPLY PUB=%s PRIV=%s\n' % (TEST_B64, 'TEST_PRIV')).encode('utf-8'))
-        s = self.successResultOf(fac.deferred)
-        self.assertEqual(I2PAddress(TEST_B64), s)
-        os.remove(tmp)
-    test_destGenerated.skip = skipSRO
+        self.addCleanup(os.remove, tmp)
+        fac.deferred.addCallback(self.assertEqual, I2PAddress(TEST_B64))
+        return fac.deferred
 
     def test_destGenerated_privKeySaved(self):
         tmp = '/tmp/TestDestGenerateFactory.privKey'
@@ -439,11 +762,15 @@ class TestDestGenerateFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto.receiver.currentRule = 'State_dest'
         proto._parser._setupInterp()
         proto.dataReceived(('DEST REPLY PUB=%s PRIV=%s\n' % (TEST_B64, 'TEST_PRIV')).encode('utf-8'))
-        f = open(tmp, 'r')
-        privKey = f.read()
-        f.close()
-        self.assertEqual('TEST_PRIV', privKey)
-        os.remove(tmp)
+        self.addCleanup(os.remove, tmp)
+
+        def checkKeyfile(_):
+            f = open(tmp, 'r')
+            privKey = f.read()
+            f.close()
+            self.assertEqual('TEST_PRIV', privKey)
+        fac.deferred.addCallback(checkKeyfile)
+        return fac.deferred
 
     def test_destGenerated_keyfileExists(self):
         tmp = '/tmp/TestDestGenerateFactory.privKey'
@@ -456,9 +783,8 @@ class TestDestGenerateFactory(SAMFactoryTestMixin, unittest.TestCase):
         proto.receiver.currentRule = 'State_dest'
         proto._parser._setupInterp()
         proto.dataReceived(('DEST REPLY PUB=%s PRIV=%s\n' % (TEST_B64, 'TEST_PRIV')).encode('utf-8'))
-        self.assertIsInstance(self.failureResultOf(fac.deferred).value, ValueError)
-        os.remove(tmp)
-    test_destGenerated_keyfileExists.skip = skipSRO
+        self.addCleanup(os.remove, tmp)
+        return self.assertFailure(fac.deferred, ValueError)
 
 
 class TestGenerateDestination(unittest.TestCase):
@@ -509,3 +835,18 @@ class TestTestAPI(unittest.TestCase):
         self.assertEqual(1, samEndpoint.called)
         self.assertEqual(True, s)
     test_testAPI.skip = skipSRO
+
+
+class TestKeepTransportAlive(unittest.TestCase):
+    def test_tcpKeepAlive(self):
+        transport = Mock()
+        session.keepTransportAlive(transport)
+        transport.setTcpKeepAlive.assert_called_with(1)
+
+    def test_unixNeedsNothing(self):
+        if not session.IUNIXTransport:
+            raise unittest.SkipTest('IUNIXTransport requires twisted 11.1 or newer')
+        transport = Mock()
+        alsoProvides(transport, session.IUNIXTransport)
+        session.keepTransportAlive(transport)
+        self.assertFalse(transport.setTcpKeepAlive.called)
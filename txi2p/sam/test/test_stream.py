@@ -9,15 +9,23 @@ except:
     from mock import Mock
 import os
 import twisted
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python.versions import Version
 from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from txi2p.address import I2PAddress
 from txi2p.sam import stream
+from txi2p.sam.base import SAMStreamPump
+from txi2p.sam.naming import NamingCache
 from txi2p.test.util import TEST_B64, FakeFactory
-from .util import SAMProtocolTestMixin, SAMFactoryTestMixin
+from .util import (
+    MultiFakeEndpoint,
+    SAMProtocolTestMixin,
+    SAMFactoryTestMixin,
+    connectionLostFailure,
+    connectionRefusedFailure,
+)
 
 if twisted.version < Version('twisted', 12, 3, 0):
     skipSRO = 'TestCase.successResultOf() requires twisted 12.3 or newer'
@@ -97,6 +105,28 @@ class TestStreamConnectProtocol(SAMProtocolTestMixin, unittest.TestCase):
             b'STREAM CONNECT ID=foo DESTINATION=bar SILENT=false\n',
             proto.transport.value())
 
+    def test_namingLookupPopulatesCache(self):
+        fac, proto = self.makeProto()
+        fac.session = Mock()
+        fac.session.id = 'foo'
+        fac.dest = None
+        fac.host = 'spam.i2p'
+        fac.namingCache = NamingCache()
+        fac.namingCache.lookup('spam.i2p')
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        proto.dataReceived(b'NAMING REPLY RESULT=OK NAME=spam.i2p VALUE=bar\n')
+        self.assertEqual('bar', self.successResultOf(fac.namingCache.lookup('spam.i2p')))
+
+    def test_namingLookupErrorIsCached(self):
+        fac, proto = self.makeProto()
+        fac.dest = None
+        fac.host = 'spam.i2p'
+        fac.namingCache = NamingCache()
+        fac.namingCache.lookup('spam.i2p')
+        proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+        proto.dataReceived(b'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=spam.i2p\n')
+        self.failureResultOf(fac.namingCache.lookup('spam.i2p'))
+
     def test_streamConnectReturnsError(self):
         fac, proto = self.makeProto()
         fac.session = Mock()
@@ -125,6 +155,15 @@ class TestStreamConnectFactory(SAMFactoryTestMixin, unittest.TestCase):
     factory = stream.StreamConnectFactory
     blankFactoryArgs = (None, Mock(), '', '')
 
+    def test_connectionFailedReleasesLookup(self):
+        cache = NamingCache()
+        cache.lookup('spam.i2p')
+        waiter = cache.lookup('spam.i2p')
+        fac = self.factory(None, Mock(), 'spam.i2p', None, namingCache=cache)
+        fac.connectionFailed(connectionRefusedFailure)
+        self.failureResultOf(fac.deferred)
+        self.assertIsNone(self.successResultOf(waiter))
+
     def test_streamConnectionEstablished(self):
         mreactor = proto_helpers.MemoryReactor()
         wrappedFactory = FakeFactory()
@@ -139,6 +178,36 @@ class TestStreamConnectFactory(SAMFactoryTestMixin, unittest.TestCase):
         self.assertEqual(proto.receiver.wrappedProto, streamProto)
     test_streamConnectionEstablished.skip = skipSRO
 
+    def test_streamConnectionEstablishedStartsPump(self):
+        wrappedFactory = FakeFactory()
+        session = Mock()
+        fac, proto = self.makeProto(wrappedFactory, session, 'spam.i2p', 'foo')
+        proto.transport.protocol = proto
+        # Shortcut to end of SAM stream connect protocol
+        proto.receiver.currentRule = 'State_connect'
+        proto._parser._setupInterp()
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        pump = proto.transport.protocol
+        self.assertIsInstance(pump, SAMStreamPump)
+        # Data goes straight to the wrapped Protocol...
+        pump.dataReceived(b'Egg and spam')
+        self.assertEqual(b'Egg and spam', wrappedFactory.proto.data)
+        # ... but connection loss is still handled by the parser.
+        pump.connectionLost(None)
+        self.assertTrue(wrappedFactory.proto.closed)
+        session.removeStream.assert_called_with(proto.receiver)
+
+    def test_streamConnectionEstablishedNoPumpWithoutProtocol(self):
+        wrappedFactory = FakeFactory()
+        fac, proto = self.makeProto(wrappedFactory, Mock(), 'spam.i2p', 'foo')
+        # Shortcut to end of SAM stream connect protocol
+        proto.receiver.currentRule = 'State_connect'
+        proto._parser._setupInterp()
+        proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+        proto.dataReceived(b'Egg and spam')
+        self.assertFalse(hasattr(proto.transport, 'protocol'))
+        self.assertEqual(b'Egg and spam', wrappedFactory.proto.data)
+
 
 class TestStreamAcceptProtocol(SAMProtocolTestMixin, unittest.TestCase):
     protocol = stream.StreamAcceptProtocol
@@ -267,6 +336,171 @@ class TestStreamAcceptFactory(SAMFactoryTestMixin, unittest.TestCase):
         self.assertEqual(wrappedFactory.proto, proto.receiver.wrappedProto)
     test_streamAcceptEstablished.skip = skipSRO
 
+    def test_streamAcceptIncomingStartsPump(self):
+        wrappedFactory = FakeFactory()
+        fac, proto = self.makeProto(wrappedFactory, Mock(), Mock())
+        proto.transport.protocol = proto
+        # Shortcut to end of SAM stream accept protocol
+        proto.receiver.currentRule = 'State_readData'
+        proto._parser._setupInterp()
+        proto.dataReceived(('%s FROM_PORT=34444 TO_PORT=0\nEgg' % TEST_B64).encode('utf-8'))
+        pump = proto.transport.protocol
+        self.assertIsInstance(pump, SAMStreamPump)
+        pump.dataReceived(b' and spam')
+        self.assertEqual(b'Egg and spam', wrappedFactory.proto.data)
+
+
+class TestStreamAcceptPort(unittest.TestCase):
+    def setUp(self):
+        self.samEndpoint = MultiFakeEndpoint()
+        self.clock = task.Clock()
+        self.session = Mock()
+        self.session.id = 'foo'
+        self.session.samVersion = '3.2'
+        self.session.samEndpoint = self.samEndpoint
+
+    def makePort(self, **kw):
+        return stream.StreamAcceptPort(
+            self.session, FakeFactory(), clock=self.clock, **kw)
+
+    def establish(self, protos):
+        for proto in protos:
+            proto.dataReceived(b'HELLO REPLY RESULT=OK VERSION=3.2\n')
+            proto.dataReceived(b'STREAM STATUS RESULT=OK\n')
+
+    def peerArrives(self, proto):
+        proto.dataReceived(('%s FROM_PORT=0 TO_PORT=0\n' % TEST_B64).encode('utf-8'))
+
+    def test_startListening(self):
+        port = self.makePort(minAccepts=2)
+        port.startListening()
+        self.assertEqual(2, len(self.samEndpoint.protos))
+        self.establish(self.samEndpoint.protos)
+        self.assertEqual(self.samEndpoint.protos,
+                         [r.parser for r in port.accepts])
+
+    def test_startListeningBefore3_2(self):
+        self.session.samVersion = '3.1'
+        port = self.makePort(minAccepts=4, maxAccepts=8)
+        port.startListening()
+        self.assertEqual((1, 1), (port.minAccepts, port.maxAccepts))
+        self.assertEqual(1, len(self.samEndpoint.protos))
+
+    def test_acceptReplaced(self):
+        port = self.makePort(minAccepts=2)
+        port.startListening()
+        self.establish(self.samEndpoint.protos)
+        self.clock.advance(5)
+        self.peerArrives(self.samEndpoint.protos[0])
+        self.assertEqual(3, len(self.samEndpoint.protos))
+        self.assertEqual(2, port.target)
+        self.assertEqual((1, 5.0, 5.0), (port.accepted, port.totalWait, port.maxWait))
+
+    def test_growsWhenDrained(self):
+        port = self.makePort(minAccepts=2, maxAccepts=5)
+        port.startListening()
+        self.establish(self.samEndpoint.protos)
+        self.peerArrives(self.samEndpoint.protos[0])
+        self.peerArrives(self.samEndpoint.protos[1])
+        self.assertEqual(4, port.target)
+        # One replacement from the first peer, then up to the new target
+        self.assertEqual(2 + 4, len(self.samEndpoint.protos))
+        self.establish(self.samEndpoint.protos[2:])
+        for proto in self.samEndpoint.protos[2:]:
+            self.peerArrives(proto)
+        self.assertEqual(5, port.target)
+
+    def test_shrinksWhenIdle(self):
+        port = self.makePort(minAccepts=2, maxAccepts=8)
+        port.target = 4
+        port.startListening()
+        # Established just before the first check for idle accepts, so that
+        # the peer arrives before the next check closes them
+        self.clock.advance(port.idleTimeout - 1)
+        self.establish(self.samEndpoint.protos)
+        self.clock.advance(1)
+        self.clock.advance(port.idleTimeout - 0.5)
+        self.peerArrives(self.samEndpoint.protos[0])
+        self.assertEqual(3, port.target)
+        # Not replaced
+        self.assertEqual(4, len(self.samEndpoint.protos))
+        self.assertEqual(3, len(port.accepts))
+        port.stopListening()
+
+    def test_idleAcceptsClosed(self):
+        port = self.makePort(minAccepts=2, maxAccepts=8)
+        port.target = 4
+        port.startListening()
+        self.establish(self.samEndpoint.protos)
+        self.clock.advance(port.idleTimeout / 2)
+        # A peer takes one accept, and it is replaced
+        self.peerArrives(self.samEndpoint.protos[0])
+        self.establish(self.samEndpoint.protos[4:])
+        self.clock.advance(port.idleTimeout / 2)
+        # The two oldest idle accepts are closed, leaving minAccepts
+        self.assertEqual(2, port.target)
+        self.assertEqual([self.samEndpoint.protos[3], self.samEndpoint.protos[4]],
+                         [r.parser for r in port.accepts])
+        self.assertFalse(self.samEndpoint.protos[1].transport.connected)
+        self.assertFalse(self.samEndpoint.protos[2].transport.connected)
+        # Closed accepts are not replaced
+        self.assertEqual(5, len(self.samEndpoint.protos))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_idleAcceptsKeptAtMinimum(self):
+        port = self.makePort(minAccepts=2, maxAccepts=8)
+        port.startListening()
+        self.establish(self.samEndpoint.protos)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.clock.advance(port.idleTimeout * 2)
+        self.assertEqual(2, len(port.accepts))
+
+    def test_stopListeningCancelsShrink(self):
+        port = self.makePort(minAccepts=2, maxAccepts=8)
+        port.target = 4
+        port.startListening()
+        port.stopListening()
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_meanWait(self):
+        port = self.makePort(minAccepts=2)
+        self.assertEqual(0.0, port.meanWait)
+        port.startListening()
+        self.establish(self.samEndpoint.protos)
+        self.clock.advance(2)
+        self.peerArrives(self.samEndpoint.protos[0])
+        self.clock.advance(2)
+        self.peerArrives(self.samEndpoint.protos[1])
+        self.assertEqual(3.0, port.meanWait)
+        self.assertEqual(4.0, port.maxWait)
+
+    def test_lostAcceptForgotten(self):
+        port = self.makePort(minAccepts=2)
+        port.startListening()
+        self.establish(self.samEndpoint.protos)
+        self.samEndpoint.protos[0].connectionLost(connectionLostFailure)
+        self.assertEqual(1, len(port.accepts))
+        self.assertEqual(2, len(self.samEndpoint.protos))
+
+    def test_failedAcceptNotRetried(self):
+        self.samEndpoint.failure = connectionRefusedFailure
+        port = self.makePort(minAccepts=2)
+        port.startListening()
+        self.assertEqual(0, port._opening)
+        self.assertEqual([], self.samEndpoint.protos)
+
+    def test_stopListening(self):
+        port = self.makePort(minAccepts=2)
+        port.startListening()
+        self.establish(self.samEndpoint.protos[:1])
+        port.stopListening()
+        self.assertEqual([], port.accepts)
+        self.assertFalse(self.samEndpoint.protos[0].transport.connected)
+        # An accept that was still opening is closed once established
+        self.establish(self.samEndpoint.protos[1:])
+        self.assertEqual([], port.accepts)
+        self.assertFalse(self.samEndpoint.protos[1].transport.connected)
+
 
 class TestStreamForwardProtocol(SAMProtocolTestMixin, unittest.TestCase):
     protocol = stream.StreamForwardProtocol
@@ -0,0 +1,153 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+from twisted.internet import defer, error, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.trial import unittest
+
+from txi2p.sam import session
+from txi2p.sam.endpoints import (
+    SAMI2PStreamClientEndpoint,
+    SAMI2PStreamServerEndpoint,
+)
+from txi2p.sam.supervisor import RECOVERY_FAIL, SessionSupervisor
+from txi2p.test.util import TEST_B64, FakeFactory
+from .util import FakeSAMBridge, waitFor
+
+
+class TestSessionSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeSAMBridge()
+        self.port = reactor.listenTCP(0, self.bridge, interface='127.0.0.1')
+        self.samEndpoint = TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.port.getHost().port)
+        self.clock = task.Clock()
+        self.addCleanup(self.stopBridge)
+
+    @defer.inlineCallbacks
+    def stopBridge(self):
+        # Streams must be gone before their session is closed
+        self.bridge.disconnectAll()
+        yield waitFor(lambda: not self.bridge.connections)
+        for s in list(session._sessions.values()):
+            s.close()
+        yield self.port.stopListening()
+
+    def getSession(self, **kwargs):
+        self.supervisor = SessionSupervisor(clock=self.clock, **kwargs)
+        return session.getSession('foo', self.samEndpoint,
+                                  supervisor=self.supervisor)
+
+    def creates(self):
+        return [l for l in self.bridge.commands if l.startswith('SESSION CREATE')]
+
+    @defer.inlineCallbacks
+    def loseSession(self, s):
+        self.bridge.disconnectAll()
+        yield waitFor(lambda: self.supervisor.recovering)
+        self.assertFalse(s.ready)
+
+    def test_badRecoveryMode(self):
+        self.assertRaises(ValueError, SessionSupervisor, whileRecovering='foo')
+
+    @defer.inlineCallbacks
+    def test_sessionRecreated(self):
+        s = yield self.getSession()
+        self.assertIs(self.supervisor, s.supervisor)
+        self.assertIn('DESTINATION=TRANSIENT', self.creates()[0])
+        yield self.loseSession(s)
+        self.assertEqual(0, self.supervisor.currentOutage)
+        self.clock.advance(1)
+        yield waitFor(lambda: s.ready)
+        # The same Destination is used again
+        self.assertIn('DESTINATION=%s' % TEST_B64, self.creates()[1])
+        self.assertIs(s, session._sessions['foo'])
+        self.assertEqual({
+            'reconnects': 1,
+            'attempts': 1,
+            'outages': [1.0],
+            'currentOutage': None,
+        }, self.supervisor.stats())
+
+    @defer.inlineCallbacks
+    def test_backoff(self):
+        s = yield self.getSession(initialDelay=1, factor=2, maxDelay=3)
+        yield self.loseSession(s)
+        self.bridge.failCreate = ['foo']
+        self.clock.advance(1)
+        yield waitFor(lambda: self.clock.getDelayedCalls())
+        self.assertEqual(3, self.clock.getDelayedCalls()[0].getTime())
+        self.clock.advance(2)
+        yield waitFor(lambda: self.clock.getDelayedCalls())
+        # Capped at maxDelay
+        self.assertEqual(6, self.clock.getDelayedCalls()[0].getTime())
+        self.assertIsInstance(self.supervisor.lastError, error.ConnectError)
+        self.bridge.failCreate = []
+        self.clock.advance(3)
+        yield waitFor(lambda: s.ready)
+        self.assertEqual(3, self.supervisor.attempts)
+        self.assertEqual([6.0], self.supervisor.outages)
+
+    @defer.inlineCallbacks
+    def test_connectQueuedWhileRecovering(self):
+        s = yield self.getSession()
+        yield self.loseSession(s)
+        endpoint = SAMI2PStreamClientEndpoint(s, 'spam.i2p')
+        d = endpoint.connect(FakeFactory())
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        proto = yield d
+        self.assertEqual(TEST_B64, proto.transport.getPeer().destination)
+
+    @defer.inlineCallbacks
+    def test_connectFailsFastWhileRecovering(self):
+        s = yield self.getSession(whileRecovering=RECOVERY_FAIL)
+        yield self.loseSession(s)
+        endpoint = SAMI2PStreamClientEndpoint(s, 'spam.i2p')
+        yield self.assertFailure(endpoint.connect(FakeFactory()), error.ConnectError)
+        self.clock.advance(1)
+        yield waitFor(lambda: s.ready)
+
+    @defer.inlineCallbacks
+    def test_givesUp(self):
+        s = yield self.getSession(maxAttempts=2)
+        yield self.loseSession(s)
+        self.bridge.failCreate = ['foo']
+        d = s.whenReady()
+        self.clock.advance(1)
+        yield waitFor(lambda: self.clock.getDelayedCalls())
+        self.clock.advance(2)
+        yield self.assertFailure(d, error.ConnectError)
+        self.assertTrue(s._closed)
+        self.assertNotIn('foo', session._sessions)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    @defer.inlineCallbacks
+    def test_closeWhileRecovering(self):
+        s = yield self.getSession()
+        yield self.loseSession(s)
+        s.close()
+        self.assertFalse(self.supervisor.recovering)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    @defer.inlineCallbacks
+    def test_unsupervisedSessionNotRecreated(self):
+        s = yield session.getSession('foo', self.samEndpoint)
+        self.bridge.disconnectAll()
+        yield waitFor(lambda: not self.bridge.connections)
+        self.assertTrue(s.ready)
+        self.assertEqual(1, len(self.creates()))
+
+    @defer.inlineCallbacks
+    def test_acceptsReopened(self):
+        s = yield self.getSession()
+        endpoint = SAMI2PStreamServerEndpoint(s, minAccepts=1)
+        port = yield endpoint.listen(FakeFactory())
+        self.addCleanup(port.stopListening)
+        yield waitFor(lambda: self.bridge.accepts)
+        yield self.loseSession(s)
+        yield waitFor(lambda: not port.accepts)
+        self.clock.advance(1)
+        yield waitFor(lambda: self.bridge.accepts)
+        self.assertEqual(2, len([l for l in self.bridge.commands
+                                 if l.startswith('STREAM ACCEPT')]))
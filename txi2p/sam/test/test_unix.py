@@ -0,0 +1,106 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+try:
+    # Python 3
+    from unittest.mock import patch
+except:
+    # Python 2 (library)
+    from mock import patch
+from twisted.internet import defer, interfaces, reactor
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.trial import unittest
+
+from txi2p.address import I2PAddress
+from txi2p.sam.endpoints import (
+    SAMI2PStreamClientEndpoint,
+    SAMI2PStreamServerEndpoint,
+)
+from txi2p.sam.session import getSession
+from txi2p.test.util import TEST_B64, FakeFactory
+from .util import FakeSAMBridge, waitFor
+
+if not interfaces.IReactorUNIX.providedBy(reactor):
+    skip = 'This reactor does not support Unix sockets'
+else:
+    skip = None
+
+
+class SAMOverUNIXSocketTestCase(unittest.TestCase):
+    """
+    Tests for the SAM API against a fake SAM bridge on a Unix socket.
+    """
+
+    skip = skip
+
+    def setUp(self):
+        self.bridge = FakeSAMBridge()
+        path = self.mktemp()
+        self.port = reactor.listenUNIX(path, self.bridge)
+        self.samEndpoint = UNIXClientEndpoint(reactor, path)
+        self.session = None
+        self.addCleanup(self.stopBridge)
+
+    @defer.inlineCallbacks
+    def stopBridge(self):
+        # Streams must be gone before their session is closed
+        self.bridge.disconnectAll()
+        yield waitFor(lambda: not self.bridge.connections)
+        if self.session:
+            self.session.close()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def getSession(self, **kwargs):
+        self.session = yield getSession(
+            self.id(), samEndpoint=self.samEndpoint, **kwargs)
+        defer.returnValue(self.session)
+
+    @defer.inlineCallbacks
+    def test_sessionCreated(self):
+        self.bridge.version = '3.1'
+        with patch('txi2p.sam.session.eprint') as eprint:
+            session = yield self.getSession()
+        self.assertEqual(I2PAddress(TEST_B64), session.address)
+        # No TCP keepalive to complain about
+        self.assertFalse(eprint.called)
+
+    @defer.inlineCallbacks
+    def test_sessionKeepalive(self):
+        session = yield self.getSession()
+        receiver = session._proto
+        self.assertEqual('State_keepalive', receiver.currentRule)
+        # Fire the keepalive timer now
+        receiver.pinger.cancel()
+        receiver._sendPing()
+        yield waitFor(lambda: not receiver.pingTimeout.active())
+        self.assertIn('PING %s' % receiver.lastPing, self.bridge.commands)
+
+    @defer.inlineCallbacks
+    def test_streamConnect(self):
+        session = yield self.getSession(poolSize=1)
+        yield waitFor(lambda: session.pool._idle)
+        endpoint = SAMI2PStreamClientEndpoint(session, 'spam.i2p')
+        proto = yield endpoint.connect(FakeFactory())
+        self.assertEqual(1, session.pool.hits)
+        self.assertEqual(I2PAddress(TEST_B64, 'spam.i2p'),
+                         proto.transport.getPeer())
+        proto.transport.write(b'foo')
+        yield waitFor(lambda: self.bridge.received)
+        self.assertEqual([b'foo'], self.bridge.received)
+        self.bridge.streams[0].transport.write(b'bar')
+        yield waitFor(lambda: proto.data)
+        self.assertEqual(b'bar', proto.data)
+
+    @defer.inlineCallbacks
+    def test_streamListen(self):
+        session = yield self.getSession()
+        endpoint = SAMI2PStreamServerEndpoint(session, minAccepts=1)
+        fac = FakeFactory()
+        port = yield endpoint.listen(fac)
+        self.addCleanup(port.stopListening)
+        yield waitFor(lambda: self.bridge.accepts)
+        self.bridge.peerArrives(b'foo')
+        yield waitFor(lambda: getattr(fac, 'proto', None) and fac.proto.data)
+        self.assertEqual(b'foo', fac.proto.data)
+        self.assertEqual(TEST_B64, fac.proto.transport.getPeer().destination)
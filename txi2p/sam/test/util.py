@@ -8,18 +8,48 @@ try:
 except:
     # Python 2 (library)
     from mock import Mock
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
 from twisted.internet.error import ConnectionLost, ConnectionRefusedError
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ClientFactory, Factory, Protocol
 from twisted.python import failure
 from twisted.test import proto_helpers
 
 from txi2p.sam import constants as c
+from txi2p.test.util import TEST_B64
 
 connectionLostFailure = failure.Failure(ConnectionLost())
 connectionRefusedFailure = failure.Failure(ConnectionRefusedError())
 
 
+@defer.inlineCallbacks
+def waitFor(condition, timeout=5):
+    """Wait on the real reactor until ``condition()`` is true."""
+    for i in range(int(timeout / 0.01)):
+        if condition():
+            return
+        yield task.deferLater(reactor, 0.01, lambda: None)
+    raise AssertionError('Timed out')
+
+
+class MultiFakeEndpoint(object):
+    """Connects each factory to its own StringTransport."""
+
+    def __init__(self):
+        self.protos = []
+        self.failure = None
+
+    def connect(self, fac):
+        if self.failure:
+            return defer.fail(self.failure)
+        proto = fac.buildProtocol(None)
+        transport = proto_helpers.StringTransportWithDisconnection()
+        transport.protocol = proto
+        transport.abortConnection = transport.loseConnection
+        proto.makeConnection(transport)
+        self.protos.append(proto)
+        return defer.succeed(proto)
+
+
 class SAMProtocolTestMixin(object):
     def makeProto(self, *a, **kw):
         protoClass = kw.pop('_protoClass', self.protocol)
@@ -30,6 +60,8 @@ class SAMProtocolTestMixin(object):
         fac.localPort = None
         fac.options = {}
         fac.sigType = None
+        fac.forwardPort = None
+        fac.forwardHost = None
         fac.protocol = protoClass
         fac.resultNotOK = Mock()
         def raise_(reason):
@@ -168,3 +200,101 @@ class SAMFactoryTestMixin(object):
         fac, proto = self.makeProto(*self.blankFactoryArgs)
         for result, error in list(c.samErrorMap.items()):
             self.assertRaises(error, fac.resultNotOK, result, '')
+
+
+class FakeSAMBridgeProtocol(Protocol):
+    """Answers SAM commands like a SAM bridge with a single Destination."""
+    streaming = False
+
+    def connectionMade(self):
+        self.buf = b''
+        self.factory.connections.append(self)
+
+    def dataReceived(self, data):
+        if self.streaming:
+            self.factory.received.append(data)
+            return
+        self.buf += data
+        while b'\n' in self.buf and not self.streaming:
+            line, self.buf = self.buf.split(b'\n', 1)
+            self.lineReceived(line.decode('utf-8'))
+
+    def lineReceived(self, line):
+        self.factory.commands.append(line)
+        if line.startswith('HELLO'):
+            self.reply('HELLO REPLY RESULT=OK VERSION=%s' % self.factory.version)
+        elif line.startswith('SESSION CREATE'):
+            id = line.split('ID=')[1].split(' ')[0]
+            if id in self.factory.failCreate:
+                self.reply('SESSION STATUS RESULT=I2P_ERROR MESSAGE="Tunnels failed"')
+            else:
+                self.reply('SESSION STATUS RESULT=OK DESTINATION=%s' % TEST_B64)
+        elif line.startswith('SESSION ADD'):
+            id = line.split('ID=')[1].split(' ')[0]
+            if id in self.factory.subsessions:
+                self.reply('SESSION STATUS RESULT=DUPLICATED_ID ID=%s' % id)
+            else:
+                self.factory.subsessions.append(id)
+                self.reply('SESSION STATUS RESULT=OK ID=%s MESSAGE="ADD %s"' % (id, id))
+        elif line.startswith('SESSION REMOVE'):
+            id = line.split('ID=')[1]
+            self.factory.subsessions.remove(id)
+            self.reply('SESSION STATUS RESULT=OK ID=%s MESSAGE="REMOVE %s"' % (id, id))
+        elif line.startswith('NAMING LOOKUP'):
+            name = line.split('NAME=')[1]
+            self.reply('NAMING REPLY RESULT=OK NAME=%s VALUE=%s' % (name, TEST_B64))
+        elif line.startswith('STREAM CONNECT'):
+            self.reply('STREAM STATUS RESULT=OK')
+            self.streaming = True
+            self.factory.streams.append(self)
+        elif line.startswith('STREAM ACCEPT'):
+            self.reply('STREAM STATUS RESULT=OK')
+            self.streaming = True
+            self.factory.accepts.append(self)
+        elif line.startswith('PING'):
+            self.reply('PONG' + line[4:])
+
+    def reply(self, line):
+        self.transport.write(('%s\n' % line).encode('utf-8'))
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+        if self in self.factory.accepts:
+            self.factory.accepts.remove(self)
+
+
+class FakeSAMBridge(Factory):
+    """A fake SAM bridge to listen with on a real port or Unix socket.
+
+    Attributes:
+        commands (list): Every command line received.
+        connections (list): The open connections.
+        accepts (list): Connections with a ``STREAM ACCEPT`` that no peer has
+            arrived at yet.
+        streams (list): Connections with a ``STREAM CONNECT``.
+        received (list): Stream data received from clients.
+        subsessions (list): The IDs of added subsessions.
+        failCreate (list): The IDs of sessions that fail to be created.
+    """
+    protocol = FakeSAMBridgeProtocol
+
+    def __init__(self, version='3.2'):
+        self.version = version
+        self.commands = []
+        self.connections = []
+        self.accepts = []
+        self.streams = []
+        self.received = []
+        self.subsessions = []
+        self.failCreate = []
+
+    def peerArrives(self, data=b''):
+        """Hand a peer with ``data`` to the oldest pending accept."""
+        proto = self.accepts.pop(0)
+        proto.transport.write(
+            ('%s FROM_PORT=0 TO_PORT=0\n' % TEST_B64).encode('utf-8') + data)
+        return proto
+
+    def disconnectAll(self):
+        for proto in list(self.connections):
+            proto.transport.loseConnection()
@@ -1,9 +1,13 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+import copy
 import unittest
 
-from txi2p.address import I2PAddress
+from twisted.test import proto_helpers
+
+from txi2p import address
+from txi2p.address import I2PAddress, I2PTunnelTransport
 from txi2p.test.util import TEST_B64, TEST_B32
 
 
@@ -12,6 +16,12 @@ class TestI2PAddress(unittest.TestCase):
         addr = I2PAddress(TEST_B64)
         self.assertEqual((addr.destination, addr.host, addr.port), (TEST_B64, TEST_B32, None))
 
+    def test_noHost_hostIsLazy(self):
+        addr = I2PAddress(TEST_B64)
+        self.assertIsNone(addr._host)
+        self.assertEqual(TEST_B32, addr.host)
+        self.assertEqual(TEST_B32, I2PAddress(addr)._host)
+
     def test_host_noPort(self):
         addr = I2PAddress(TEST_B64, 'spam.i2p')
         self.assertEqual((addr.destination, addr.host, addr.port), (TEST_B64, 'spam.i2p', None))
@@ -82,3 +92,76 @@ class TestI2PAddress(unittest.TestCase):
     def test_hashWithPortString(self):
         addr = I2PAddress(TEST_B64, 'spam.i2p', '81')
         self.assertEqual(hash(addr), hash(('spam.i2p', 81)))
+
+    def test_noInstanceDict(self):
+        self.assertFalse(hasattr(I2PAddress(TEST_B64), '__dict__'))
+
+    def test_destinationInterned(self):
+        # Build an equal string that is a different object
+        dest = ''.join(list(TEST_B64))
+        self.assertIsNot(TEST_B64, dest)
+        self.assertIs(I2PAddress(TEST_B64).destination,
+                      I2PAddress(dest).destination)
+
+    def test_equality(self):
+        self.assertEqual(I2PAddress(TEST_B64, 'spam.i2p', 81),
+                         I2PAddress(TEST_B64, 'eggs.i2p', 81))
+        self.assertNotEqual(I2PAddress(TEST_B64, port=81),
+                            I2PAddress(TEST_B64, port=82))
+        self.assertNotEqual(I2PAddress(TEST_B64), TEST_B64)
+
+
+class TestI2PTunnelTransport(unittest.TestCase):
+    def setUp(self):
+        self.tr = proto_helpers.StringTransport()
+        self.local = I2PAddress(TEST_B64, 'spam.i2p')
+        self.peer = I2PAddress(TEST_B64, 'eggs.i2p')
+        self.wrapper = I2PTunnelTransport(self.tr, self.local, self.peer)
+
+    def test_addresses(self):
+        self.assertEqual(self.local, self.wrapper.getHost())
+        self.assertEqual(self.peer, self.wrapper.getPeer())
+
+    def test_writes(self):
+        self.wrapper.write(b'spam')
+        self.wrapper.writeSequence([b'eggs', b'ham'])
+        self.assertEqual(b'spameggsham', self.tr.value())
+
+    def test_loseConnection(self):
+        self.wrapper.loseConnection()
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_otherAttributesForwarded(self):
+        self.assertEqual(self.tr.producer, self.wrapper.producer)
+
+    def test_noInstanceDict(self):
+        # hasattr() would find the wrapped transport's __dict__
+        self.assertRaises(AttributeError,
+                          object.__getattribute__, self.wrapper, '__dict__')
+
+    def test_copy(self):
+        self.assertIs(self.tr, copy.copy(self.wrapper).t)
+
+
+class TestB32Host(unittest.TestCase):
+    def setUp(self):
+        self.oldCache = address._b32Cache
+        address._b32Cache = address.OrderedDict()
+
+    def tearDown(self):
+        address._b32Cache = self.oldCache
+
+    def test_b32Host(self):
+        self.assertEqual(TEST_B32, address.b32Host(TEST_B64))
+        self.assertEqual({TEST_B64: TEST_B32}, dict(address._b32Cache))
+        self.assertEqual(TEST_B32, address.b32Host(TEST_B64))
+
+    def test_cacheIsBounded(self):
+        oldSize = address.B32_CACHE_SIZE
+        address.B32_CACHE_SIZE = 2
+        try:
+            for dest in ['AAAA', 'BBBB', 'CCCC']:
+                address.b32Host(dest)
+        finally:
+            address.B32_CACHE_SIZE = oldSize
+        self.assertEqual(['BBBB', 'CCCC'], list(address._b32Cache))
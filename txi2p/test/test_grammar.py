@@ -1,10 +1,22 @@
 # Copyright (c) str4d <str4d@mail.i2p>
 # See COPYING for details.
 
+import os
+import shutil
+import sys
+import tempfile
 import unittest
-
+try:
+    # Python 3
+    from unittest.mock import patch
+except:
+    # Python 2 (library)
+    from mock import patch
+
+from ometa.grammar import OMeta
 from parsley import makeGrammar, ParseError
 
+from txi2p import grammar
 from txi2p.grammar import bobGrammarSource, samGrammarSource
 
 
@@ -112,3 +124,67 @@ class TestSAMGrammar(unittest.TestCase):
     def test_SAM_pong(self):
         self._test('SAM_pong', 'PONG\n', None)
         self._test('SAM_pong', 'PONG 1234567890\n', '1234567890')
+
+
+class TestParseGrammar(unittest.TestCase):
+    def setUp(self):
+        self._cacheDir = grammar.GRAMMAR_CACHE_DIR
+        self._cache = dict(grammar._grammarCache)
+        grammar.GRAMMAR_CACHE_DIR = tempfile.mkdtemp()
+        grammar._grammarCache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(grammar.GRAMMAR_CACHE_DIR)
+        grammar.GRAMMAR_CACHE_DIR = self._cacheDir
+        grammar._grammarCache.clear()
+        grammar._grammarCache.update(self._cache)
+
+    def test_sharedWithinProcess(self):
+        g1 = grammar.parseGrammar(grammar.i2pGrammarSource)
+        g2 = grammar.parseGrammar(grammar.i2pGrammarSource)
+        self.assertIs(g1, g2)
+
+    def test_persistedToDisk(self):
+        parsed = grammar.parseGrammar(grammar.i2pGrammarSource)
+        self.assertEqual(1, len(os.listdir(grammar.GRAMMAR_CACHE_DIR)))
+        grammar._grammarCache.clear()
+        loaded = grammar.parseGrammar(grammar.i2pGrammarSource)
+        self.assertIsNot(parsed, loaded)
+        self.assertEqual(OMeta(grammar.i2pGrammarSource).parseGrammar('Grammar'), loaded)
+
+    def test_corruptCacheFileIsIgnored(self):
+        grammar.parseGrammar(grammar.i2pGrammarSource)
+        for name in os.listdir(grammar.GRAMMAR_CACHE_DIR):
+            with open(os.path.join(grammar.GRAMMAR_CACHE_DIR, name), 'wb') as f:
+                f.write(b'spam')
+        grammar._grammarCache.clear()
+        self.assertEqual(OMeta(grammar.i2pGrammarSource).parseGrammar('Grammar'),
+                         grammar.parseGrammar(grammar.i2pGrammarSource))
+
+    def test_parsleyVersionInKey(self):
+        grammar.parseGrammar(grammar.i2pGrammarSource)
+        grammar._grammarCache.clear()
+        with patch.object(grammar, '_parsleyVersion', 'spam'):
+            grammar.parseGrammar(grammar.i2pGrammarSource)
+        self.assertEqual(2, len(os.listdir(grammar.GRAMMAR_CACHE_DIR)))
+
+    @patch.object(sys, 'platform', 'linux')
+    @patch.dict(os.environ, {'XDG_CACHE_HOME': '/tmp/spam'})
+    def test_userCacheDir(self):
+        self.assertEqual(os.path.join('/tmp/spam', 'txi2p'),
+                         grammar._userCacheDir())
+
+    @patch.object(sys, 'platform', 'linux')
+    @patch.dict(os.environ, {}, clear=True)
+    @patch.object(os.path, 'expanduser', lambda path: path)
+    def test_noUserCacheDir(self):
+        self.assertEqual('', grammar._userCacheDir())
+
+    def test_diskCacheDisabled(self):
+        cacheDir = grammar.GRAMMAR_CACHE_DIR
+        grammar.GRAMMAR_CACHE_DIR = ''
+        try:
+            grammar.parseGrammar(grammar.i2pGrammarSource)
+        finally:
+            grammar.GRAMMAR_CACHE_DIR = cacheDir
+        self.assertEqual([], os.listdir(cacheDir))
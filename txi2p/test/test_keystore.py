@@ -0,0 +1,153 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+import errno
+import os
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from txi2p import keystore
+from txi2p.keystore import KeyStore
+
+
+class TestKeyStore(unittest.TestCase):
+    def setUp(self):
+        self.store = KeyStore()
+        self.path = os.path.abspath(self.mktemp())
+
+    def writeKeyfile(self, keys):
+        with open(self.path, 'w') as f:
+            f.write(keys)
+
+    def readKeyfile(self):
+        with open(self.path, 'r') as f:
+            return f.read()
+
+    @defer.inlineCallbacks
+    def test_load(self):
+        self.writeKeyfile('foo')
+        keys = yield self.store.load(self.path)
+        self.assertEqual('foo', keys)
+        self.assertEqual(1, self.store.reads)
+
+    @defer.inlineCallbacks
+    def test_loadMissing(self):
+        keys = yield self.store.load(self.path)
+        self.assertIsNone(keys)
+
+    @defer.inlineCallbacks
+    def test_loadMissingNotCached(self):
+        keys = yield self.store.load(self.path)
+        self.assertIsNone(keys)
+        self.writeKeyfile('foo')
+        keys = yield self.store.load(self.path)
+        self.assertEqual('foo', keys)
+        self.assertEqual(2, self.store.reads)
+
+    def test_loadUnreadable(self):
+        os.mkdir(self.path)
+        d = self.store.load(self.path)
+        d = self.assertFailure(d, IOError)
+        d.addCallback(lambda _: self.assertEqual({}, self.store._keys))
+        return d
+
+    @defer.inlineCallbacks
+    def test_loadCached(self):
+        self.writeKeyfile('foo')
+        yield self.store.load(self.path)
+        self.writeKeyfile('bar')
+        d = self.store.load(self.path)
+        # Served from the cache, without a thread
+        self.assertEqual('foo', self.successResultOf(d))
+        self.assertEqual(1, self.store.reads)
+        self.store.forget(self.path)
+        keys = yield self.store.load(self.path)
+        self.assertEqual('bar', keys)
+        self.assertEqual(2, self.store.reads)
+
+    @defer.inlineCallbacks
+    def test_concurrentLoadsShareRead(self):
+        self.writeKeyfile('foo')
+        ds = [self.store.load(self.path) for i in range(5)]
+        results = yield defer.gatherResults(ds)
+        self.assertEqual(['foo'] * 5, results)
+        self.assertEqual(1, self.store.reads)
+
+    @defer.inlineCallbacks
+    def test_save(self):
+        yield self.store.save(self.path, 'foo')
+        self.assertEqual('foo', self.readKeyfile())
+        self.assertEqual([os.path.basename(self.path)],
+                         os.listdir(os.path.dirname(self.path)))
+        keys = yield self.store.load(self.path)
+        self.assertEqual('foo', keys)
+        self.assertEqual(0, self.store.reads)
+
+    @defer.inlineCallbacks
+    def test_saveReplaces(self):
+        self.writeKeyfile('foo')
+        yield self.store.save(self.path, 'bar')
+        self.assertEqual('bar', self.readKeyfile())
+
+    def test_saveExclusive(self):
+        self.writeKeyfile('foo')
+        d = self.store.save(self.path, 'bar', exclusive=True)
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(lambda _: self.assertEqual('foo', self.readKeyfile()))
+        return d
+
+    def test_saveExclusiveLeavesNoTempFile(self):
+        self.writeKeyfile('foo')
+        d = self.store.save(self.path, 'bar', exclusive=True)
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(lambda _: self.assertEqual(
+            [os.path.basename(self.path)],
+            os.listdir(os.path.dirname(self.path))))
+        return d
+
+    @defer.inlineCallbacks
+    def test_saveExclusiveWithoutLinks(self):
+        self.patch(keystore, '_link', None)
+        yield self.store.save(self.path, 'foo', exclusive=True)
+        self.assertEqual('foo', self.readKeyfile())
+        self.assertEqual([os.path.basename(self.path)],
+                         os.listdir(os.path.dirname(self.path)))
+        d = self.store.save(self.path, 'bar', exclusive=True)
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual('foo', self.readKeyfile())
+
+    @defer.inlineCallbacks
+    def test_saveExclusiveLinksUnsupported(self):
+        def link(src, dst):
+            raise OSError(errno.EPERM, 'Operation not permitted')
+        self.patch(keystore, '_link', link)
+        yield self.store.save(self.path, 'foo', exclusive=True)
+        self.assertEqual('foo', self.readKeyfile())
+        self.assertEqual([os.path.basename(self.path)],
+                         os.listdir(os.path.dirname(self.path)))
+
+    @defer.inlineCallbacks
+    def test_saveExclusiveNew(self):
+        yield self.store.save(self.path, 'foo', exclusive=True)
+        self.assertEqual('foo', self.readKeyfile())
+        self.assertEqual([os.path.basename(self.path)],
+                         os.listdir(os.path.dirname(self.path)))
+
+    def test_loadFailure(self):
+        def readKeys(path):
+            raise UnicodeDecodeError('ascii', b'\xff', 0, 1, 'invalid')
+        self.patch(keystore, '_readKeys', readKeys)
+        d = self.store.load(self.path)
+        d = self.assertFailure(d, UnicodeDecodeError)
+        d.addCallback(lambda _: self.assertEqual({}, self.store._loading))
+        return d
+
+    def test_saveFailure(self):
+        path = os.path.join(self.path, 'missing', 'keyfile')
+        d = self.store.save(path, 'foo')
+        d = self.assertFailure(d, IOError)
+        d.addCallback(lambda _: self.assertEqual({}, self.store._keys))
+        return d
+
+    def test_sharedStore(self):
+        self.assertIsInstance(keystore.keyStore, KeyStore)
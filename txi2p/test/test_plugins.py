@@ -18,12 +18,18 @@ from zope.interface.verify import verifyObject
 
 from txi2p.bob.endpoints import (BOBI2PClientEndpoint,
                                  BOBI2PServerEndpoint)
-from txi2p.sam.endpoints import (SAMI2PStreamClientEndpoint,
+from txi2p.sam.endpoints import (SAMI2PShardedClientEndpoint,
+                                 SAMI2PStreamClientEndpoint,
                                  SAMI2PStreamServerEndpoint)
 from txi2p.test.util import fakeSession
 
 if twisted.version < Version('twisted', 14, 0, 0):
-    skip = 'txi2p.plugins requires twisted 14.0 or newer'
+    parserSkip = 'txi2p.plugins requires twisted 14.0 or newer'
+else:
+    parserSkip = None
+
+if parserSkip:
+    skip = parserSkip
 elif sys.version_info[0] >= 3:
     skip = 'txi2p.plugins doesn\'t support Python 3 yet'
 else:
@@ -101,6 +107,27 @@ class I2PClientEndpointPluginTest(I2PPluginTestMixin, unittest.TestCase):
         self.assertEqual(s.kwargs['options'], {'inbound.length': '5', 'outbound.length': '5'})
         self.assertEqual(s.kwargs['sigType'], 'foobar')
 
+    def test_stringDescription_SAMWarmup(self):
+        from twisted.internet.endpoints import clientFromString
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            ep = clientFromString(
+                MemoryReactor(), "i2p:stats.i2p:api=SAM:warmup=stream:warmupTimeout=30")
+        s = ep._sessionDeferred
+        self.assertTrue(callable(s.kwargs['readyCheck']))
+        self.assertEqual(s.kwargs['readyTimeout'], 30.0)
+
+    def test_stringDescription_SAMSharded(self):
+        from twisted.internet.endpoints import clientFromString
+        fakeGroup = lambda nickname, size, **kwargs: (nickname, size, kwargs)
+        with mock.patch('txi2p.sam.endpoints.getSessionGroup', fakeGroup):
+            ep = clientFromString(
+                MemoryReactor(), "i2p:stats.i2p:api=SAM:nickname=foo:shards=3:shardStrategy=hash")
+        self.assertIsInstance(ep, SAMI2PShardedClientEndpoint)
+        self.assertEqual(ep._host, "stats.i2p")
+        nickname, size, kwargs = ep._groupDeferred
+        self.assertEqual(('foo', 3), (nickname, size))
+        self.assertEqual(kwargs['strategy'], 'hash')
+
 
 class I2PServerEndpointPluginTest(I2PPluginTestMixin, unittest.TestCase):
     """
@@ -153,3 +180,131 @@ class I2PServerEndpointPluginTest(I2PPluginTestMixin, unittest.TestCase):
         s = ep._sessionDeferred
         self.assertEqual(s.kwargs['options'], {'inbound.length': '5', 'outbound.length': '5'})
         self.assertEqual(s.kwargs['sigType'], 'foobar')
+
+    def test_stringDescription_SAMForward(self):
+        from twisted.internet.endpoints import serverFromString
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            ep = serverFromString(
+                MemoryReactor(), "i2p:/tmp/testkeys.foo:81:api=SAM:listenMode=forward")
+        self.assertIsInstance(ep, SAMI2PStreamServerEndpoint)
+        self.assertEqual(ep._listenMode, 'forward')
+        self.assertIsInstance(ep._reactor, MemoryReactor)
+
+    def test_stringDescription_SAMWarmup(self):
+        from twisted.internet.endpoints import serverFromString
+        from txi2p.sam.session import lookupCheck
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            ep = serverFromString(
+                MemoryReactor(), "i2p:/tmp/testkeys.foo:81:api=SAM:warmup=lookup")
+        s = ep._sessionDeferred
+        self.assertIs(s.kwargs['readyCheck'], lookupCheck)
+        self.assertIsNone(s.kwargs['readyTimeout'])
+
+    def test_stringDescription_SAMReconnect(self):
+        from twisted.internet.endpoints import serverFromString
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            ep = serverFromString(
+                MemoryReactor(), "i2p:/tmp/testkeys.foo:81:api=SAM:reconnect=fail")
+        supervisor = ep._sessionDeferred.kwargs['supervisor']
+        self.assertEqual('fail', supervisor.whileRecovering)
+
+
+class I2PClientParserOptionsTest(unittest.TestCase):
+    """
+    Unit tests for the string options of the I2P client endpoint parser, which
+    call the parser directly so that they also run on Python 3.
+    """
+
+    skip = parserSkip
+
+    def parse(self, host, **kwargs):
+        from txi2p.plugins import I2PClientParser
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            return I2PClientParser()._parseClient(MemoryReactor(), host, **kwargs)
+
+    def test_poolSize(self):
+        ep = self.parse('stats.i2p', api='SAM', poolSize='4')
+        self.assertEqual(4, ep._sessionDeferred.kwargs['poolSize'])
+
+    def test_noPoolSize(self):
+        ep = self.parse('stats.i2p', api='SAM')
+        self.assertIsNone(ep._sessionDeferred.kwargs['poolSize'])
+
+    def test_warmup(self):
+        ep = self.parse('stats.i2p', api='SAM', warmup='stream',
+                        warmupTimeout='30')
+        s = ep._sessionDeferred
+        self.assertTrue(callable(s.kwargs['readyCheck']))
+        self.assertEqual(30.0, s.kwargs['readyTimeout'])
+
+    def test_shards(self):
+        fakeGroup = lambda nickname, size, **kwargs: (nickname, size, kwargs)
+        with mock.patch('txi2p.sam.endpoints.getSessionGroup', fakeGroup):
+            ep = self.parse('stats.i2p', api='SAM', nickname='foo',
+                            shards='3', shardStrategy='hash', poolSize='2')
+        self.assertIsInstance(ep, SAMI2PShardedClientEndpoint)
+        nickname, size, kwargs = ep._groupDeferred
+        self.assertEqual(('foo', 3), (nickname, size))
+        self.assertEqual('hash', kwargs['strategy'])
+        self.assertEqual(2, kwargs['poolSize'])
+
+    def test_reconnect(self):
+        ep = self.parse('stats.i2p', api='SAM', reconnect='fail')
+        supervisor = ep._sessionDeferred.kwargs['supervisor']
+        self.assertEqual('fail', supervisor.whileRecovering)
+
+    def test_noReconnect(self):
+        ep = self.parse('stats.i2p', api='SAM')
+        self.assertIsNone(ep._sessionDeferred.kwargs['supervisor'])
+
+    def test_lingerTime(self):
+        ep = self.parse('stats.i2p', api='BOB', lingerTime='0.5')
+        self.assertIsInstance(ep, BOBI2PClientEndpoint)
+        self.assertEqual(0.5, ep._lingerTime)
+
+
+class I2PServerParserOptionsTest(unittest.TestCase):
+    """
+    Unit tests for the string options of the I2P server endpoint parser, which
+    call the parser directly so that they also run on Python 3.
+    """
+
+    skip = parserSkip
+
+    def parse(self, keyfile, **kwargs):
+        from txi2p.plugins import I2PServerParser
+        with mock.patch('txi2p.sam.endpoints.getSession', fakeSession):
+            return I2PServerParser()._parseServer(MemoryReactor(), keyfile, **kwargs)
+
+    def test_accepts(self):
+        ep = self.parse('/tmp/testkeys.foo', api='SAM', minAccepts='2',
+                        maxAccepts='8')
+        self.assertEqual((2, 8), (ep._minAccepts, ep._maxAccepts))
+
+    def test_listenMode(self):
+        ep = self.parse('/tmp/testkeys.foo', api='SAM', listenMode='forward')
+        self.assertEqual('forward', ep._listenMode)
+        self.assertIsInstance(ep._reactor, MemoryReactor)
+
+    def test_badListenMode(self):
+        self.assertRaises(ValueError, self.parse, '/tmp/testkeys.foo',
+                          api='SAM', listenMode='spam')
+
+    def test_warmup(self):
+        from txi2p.sam.session import lookupCheck
+        ep = self.parse('/tmp/testkeys.foo', port='81', api='SAM',
+                        warmup='lookup', warmupTimeout='10')
+        s = ep._sessionDeferred
+        self.assertIs(lookupCheck, s.kwargs['readyCheck'])
+        self.assertEqual(10.0, s.kwargs['readyTimeout'])
+        self.assertEqual(81, s.kwargs['localPort'])
+
+    def test_reconnect(self):
+        ep = self.parse('/tmp/testkeys.foo', api='SAM', reconnect='fail')
+        supervisor = ep._sessionDeferred.kwargs['supervisor']
+        self.assertEqual('fail', supervisor.whileRecovering)
+
+    def test_lingerTime(self):
+        ep = self.parse('/tmp/testkeys.foo', api='BOB', lingerTime='0.5')
+        self.assertIsInstance(ep, BOBI2PServerEndpoint)
+        self.assertEqual(0.5, ep._lingerTime)
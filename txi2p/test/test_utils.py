@@ -0,0 +1,34 @@
+# Copyright (c) str4d <str4d@mail.i2p>
+# See COPYING for details.
+
+import os
+import subprocess
+import sys
+from twisted.trial import unittest
+
+import txi2p
+
+# Run the subprocesses from the directory containing the txi2p package, so
+# that they import the same code as this process.
+_rootDir = os.path.dirname(os.path.dirname(os.path.abspath(txi2p.__file__)))
+
+
+class TestLazyApiImport(unittest.TestCase):
+    def _importedModules(self, code):
+        out = subprocess.check_output([sys.executable, '-c',
+            code + '; import sys; print(" ".join(sorted(sys.modules)))'],
+            cwd=_rootDir)
+        return out.decode('utf-8').split()
+
+    def test_apiModulesNotImported(self):
+        modules = self._importedModules('import txi2p.plugins')
+        self.assertNotIn('txi2p.bob', modules)
+        self.assertNotIn('txi2p.sam', modules)
+
+    def test_onlyPickedApiImported(self):
+        modules = self._importedModules(
+            'from twisted.internet import reactor; '
+            'from txi2p.utils import testAPI; '
+            'testAPI(reactor, "SAM", "tcp:127.0.0.1:7656")')
+        self.assertIn('txi2p.sam', modules)
+        self.assertNotIn('txi2p.bob', modules)
@@ -1,6 +1,5 @@
 from twisted.internet.endpoints import clientFromString
-
-from txi2p import sam
+from twisted.python.reflect import namedAny
 
 
 DEFAULT_ENDPOINT = {
@@ -26,8 +25,13 @@ def getApi(api, apiEndpoint, apiDict):
     return (api, apiEndpoint)
 
 
+def _apiFunction(apiDict, api):
+    # The API modules are only imported once an API has been picked.
+    return namedAny(apiDict[api])
+
+
 _apiTesters = {
-    'SAM': sam.testAPI,
+    'SAM': 'txi2p.sam.testAPI',
 }
 
 def testAPI(reactor, api=None, apiEndpoint=None):
@@ -53,11 +57,11 @@ def testAPI(reactor, api=None, apiEndpoint=None):
     api, apiEndpoint = getApi(api, apiEndpoint, _apiTesters)
     if isinstance(apiEndpoint, str):
         apiEndpoint = clientFromString(reactor, apiEndpoint)
-    return _apiTesters[api](apiEndpoint)
+    return _apiFunction(_apiTesters, api)(apiEndpoint)
 
 
 _apiGenerators = {
-    'SAM': sam.generateDestination,
+    'SAM': 'txi2p.sam.generateDestination',
 }
 
 def generateDestination(reactor, keyfile, api=None, apiEndpoint=None):
@@ -88,4 +92,4 @@ def generateDestination(reactor, keyfile, api=None, apiEndpoint=None):
     api, apiEndpoint = getApi(api, apiEndpoint, _apiGenerators)
     if isinstance(apiEndpoint, str):
         apiEndpoint = clientFromString(reactor, apiEndpoint)
-    return _apiGenerators[api](keyfile, apiEndpoint)
+    return _apiFunction(_apiGenerators, api)(keyfile, apiEndpoint)